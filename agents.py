@@ -1,54 +1,147 @@
 import os
+import re
 import json
+import time
+import logging
+import threading
+import contextvars
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime
-from typing import Optional, List, Dict, Any
+from types import SimpleNamespace
+from typing import Optional, List, Dict, Any, Tuple
 from dotenv import load_dotenv
 
 from agno.agent import Agent
 from agno.models.google import Gemini
 from agno.knowledge.knowledge import Knowledge
 from agno.vectordb.pgvector import PgVector, SearchType
-from agno.knowledge.embedder.google import GeminiEmbedder
-from agno.db.postgres import PostgresDb
 from agno.tools import tool
-import requests
+from agno.models.message import Message
+from agno.models.metrics import Metrics
+from agno.run.agent import RunInput, RunOutput
+from agno.run.base import RunStatus
+from agno.session.agent import AgentSession
+from agno.utils.string import generate_id_from_name
+
+import database
+import metrics
+import observability
+import prompt_cache
+import resilience
+import tenancy
+from database import SessionDb, database_url, get_engine
+from backend_sync import outbox, auth_headers
+from embedding_service import get_embedding_service
+from rag_cache import (FAQ_CACHE, AnswerCache, CachedAnswer, CachingEmbedder, SearchResultCache,
+                       changed_files, get_kb_version)
+from permission_index import PermissionSearch
+import retrieval
+from retrieval import HybridRetriever
+from history import HistoryManager, HistoryWindow, completed_runs, drop_history_window, model_summarizer
 
 load_dotenv()
+log = logging.getLogger(__name__)
 
 # Configuration
-DB_URL = os.getenv("DATABASE_URL")
-if DB_URL:
-    DB_URL = DB_URL.strip().strip("'").strip('"')
+DB_URL = database_url()
 
 TABLE_NAME = "cs_agno_vectordb1"
 SESSION_TABLE = "cs_agno_longterm_memory"
 
 # --- 1. RAG CONNECTION & ROBUST FILTERING ---
-embedder = GeminiEmbedder(id="text-embedding-004", dimensions=768)
-vector_db = PgVector(
-    table_name=TABLE_NAME,
-    schema="ai",
-    db_url=DB_URL,
-    search_type=SearchType.vector,
-    embedder=embedder
-)
-
-# Shared Session DB
-session_db = PostgresDb(db_url=DB_URL, session_table=SESSION_TABLE, db_schema="ai")
+# One pooled engine shared by every tenant's vector store, session store and caches
+engine = get_engine(DB_URL)
+# Query embeddings are memoized; misses go through the shared batching, rate-limited service
+embedder = CachingEmbedder(inner=get_embedding_service())
+
+@dataclass
+class TenantStore:
+    """One tenant's knowledge table, session table and the caches in front of them."""
+    tenant: str
+    vector_db: PgVector
+    # Filters on the typed permission columns before the ANN step (falls back to JSONB until migrated)
+    permission_search: PermissionSearch
+    # Vector + full-text candidates, MMR rerank and dedupe, packed to RAG_CONTEXT_TOKENS
+    retriever: HybridRetriever
+    search_cache: SearchResultCache
+    # Final answers to stateless first turns (FAQ_CACHE=1)
+    answer_cache: AnswerCache
+    session_db: SessionDb
+    # Token-budgeted history: recent turns verbatim, older turns folded into a summary
+    history_manager: HistoryManager
+
+_stores: Dict[str, TenantStore] = {}
+_stores_lock = threading.Lock()
+
+def _build_store(tenant: str) -> TenantStore:
+    table = tenancy.tenant_table(TABLE_NAME, tenant)
+    vector_db = PgVector(
+        table_name=table,
+        schema="ai",
+        db_engine=engine,
+        search_type=SearchType.vector,
+        embedder=embedder
+    )
+    permission_search = PermissionSearch(vector_db)
+    session_db = SessionDb(db_engine=engine, session_table=tenancy.tenant_table(SESSION_TABLE, tenant), db_schema="ai")
+    return TenantStore(
+        tenant=tenant,
+        vector_db=vector_db,
+        permission_search=permission_search,
+        retriever=HybridRetriever(permission_search),
+        search_cache=SearchResultCache(version_source=lambda: get_kb_version(engine, table), tenant=tenant),
+        answer_cache=AnswerCache(version_source=lambda: get_kb_version(engine, table),
+                                 changes_source=lambda since: changed_files(engine, table, since), tenant=tenant),
+        session_db=session_db,
+        history_manager=HistoryManager(session_db, summarize=model_summarizer(get_shared_model)),
+    )
+
+def get_store(tenant_id: Optional[str] = None) -> TenantStore:
+    """The store for a configured tenant (the default tenant for None), created on first use."""
+    tenant = tenancy.resolve_tenant(tenant_id)
+    store = _stores.get(tenant)
+    if store is not None:
+        return store
+    with _stores_lock:
+        store = _stores.get(tenant)
+        if store is None:
+            store = _stores[tenant] = _build_store(tenant)
+    return store
+
+def loaded_stores() -> List[TenantStore]:
+    return list(_stores.values())
+
+def caller_tenant(agent) -> str:
+    """The tenantId the request came with, for ThanosBE callbacks (an unconfigured one may use the default tables)."""
+    return getattr(agent, "callerTenantId", None) or getattr(agent, "tenantId", tenancy.DEFAULT_TENANT)
 
 def get_robust_filter(agent: Agent):
-    """Priority: allperm=1 > superperm > perm."""
+    """Priority: allperm=1 > superperm > perm, always scoped to the agent's tenant."""
     perm = str(getattr(agent, "perm", "0"))
     superperm = str(getattr(agent, "superperm", "0"))
     allperm = str(getattr(agent, "allperm", "0"))
+    scope = {"tenant_id": getattr(agent, "tenantId", tenancy.DEFAULT_TENANT)}
     
     if allperm == "1":
-        return {"allperm": 1}
+        return {**scope, "allperm": 1}
     elif superperm != "0":
-        return {"superperm": superperm}
+        return {**scope, "superperm": superperm}
     elif perm != "0":
-        return {"perm": perm}
-    return {}
+        return {**scope, "perm": perm}
+    return scope
+
+def documentation_context(query: str, meta_filter: dict) -> retrieval.PackedContext:
+    """Packed search results for a query within a permission filter, through the tenant's search cache."""
+    store = get_store(meta_filter["tenant_id"])
+    query_embedding = embedder.get_embedding(query)
+    context = store.search_cache.get(query, query_embedding, meta_filter)
+    if context is None:
+        # Reuses the cached query embedding, so a miss costs one embedding call at most
+        context = store.retriever.retrieve(query, query_embedding, meta_filter)
+        store.search_cache.put(query, query_embedding, meta_filter, context)
+    return context
 
 # --- 2. BACKEND ACTION TOOLS (ALIGNED WITH N8N SCHEMA) ---
 
@@ -58,21 +151,19 @@ def create_support_ticket(agent: Agent, title: str, main_issue: str, summary: st
     Creates a formal support ticket in the Thanos Staging Backend.
     Call this ONLY when the user confirms 'ticket details confirmed'.
     """
-    url = "https://stagebackend.julleyonline.co.in/api/v1/customer-support/n8n/ticket"
-    
     # Extract History for Backend
     history = []
     try:
         history_msgs = agent.get_chat_history()
         history = [{"role": getattr(m, "role", "unknown"), "content": getattr(m, "content", "")} for m in history_msgs]
     except Exception as e:
-        print(f"[TOOL ERROR] History retrieval failed: {e}")
+        log.warning("Chat history unavailable for ticket", extra={"error": str(e)})
         history = []
 
     payload = {
         "conversationId": agent.session_id,
         "userId": getattr(agent, "userId", "unknown"),
-        "tenantId": getattr(agent, "tenantId", "Thanos"),
+        "tenantId": caller_tenant(agent),
         "sessionId": agent.session_id,
         "title": title,
         "description": main_issue,
@@ -89,25 +180,23 @@ def create_support_ticket(agent: Agent, title: str, main_issue: str, summary: st
         }
     }
     
-    token = getattr(agent, "accessToken", "")
-    headers = {
-        "Authorization": f"Bearer {getattr(agent, 'accessToken', '')}",
-        "Content-Type": "application/json",
-    }
+    headers = auth_headers(getattr(agent, "accessToken", ""))
     
     try:
-        print(f"\n[BACKEND] Hitting staging ticket API for: {agent.session_id}")
-        response = requests.post(url, json=payload, headers=headers, timeout=15)
-        print(f"[BACKEND] Response Code: {response.status_code}")
+        response = outbox.deliver_now("ticket", payload, headers)
+        if response is None:
+            # ThanosBE is unreachable; the ticket is spooled and retried in the background
+            log.warning("Ticket queued for retry")
+            return "SUCCESS: Ticket details confirmed. The ticket has been queued and our team will follow up shortly."
         
         if response.status_code in [200, 201]:
-            print("[BACKEND] Ticket Created Successfully")
+            log.info("Ticket created", extra={"status": response.status_code})
             return "SUCCESS: Ticket details confirmed. Our team will follow up shortly."
         
-        print(f"[BACKEND] Error Details: {response.text}")
+        log.error("Ticket rejected", extra={"status": response.status_code, "body": response.text[:500]})
         return f"FAILURE: Backend returned {response.status_code}. Details: {response.text}"
     except Exception as e:
-        print(f"[BACKEND] Exception: {str(e)}")
+        log.exception("Ticket delivery failed")
         return f"FAILURE: API Connection Error: {str(e)}"
 
 @tool
@@ -117,12 +206,10 @@ def save_conversation_summary(agent: Agent, summary: str, topic: str, main_issue
     IMPORTANT: The agent MUST generate the 'summary', 'topic', and 'main_issue' itself by analyzing the chat history.
     DO NOT ask the user for these details. Identify the start and end of the conversation to provide a duration-aware summary.
     """
-    url = "https://stagebackend.julleyonline.co.in/api/v1/customer-support/n8n/conversation"
-    
     payload = {
         "conversationId": agent.session_id,
         "userId": getattr(agent, "userId", "unknown"),
-        "tenantId": getattr(agent, "tenantId", "Thanos"),
+        "tenantId": caller_tenant(agent),
         "sessionId": agent.session_id,
         "topic": topic,
         "description": main_issue,
@@ -133,85 +220,488 @@ def save_conversation_summary(agent: Agent, summary: str, topic: str, main_issue
         "closedAt": int(datetime.now().timestamp() * 1000),
         "lastMessageAt": int(datetime.now().timestamp() * 1000)
     }
-    token = getattr(agent, "accessToken", "")
-    headers = {
-        "Authorization": f"Bearer {getattr(agent, 'accessToken', '')}",
-        "Content-Type": "application/json",
-    }
+    headers = auth_headers(getattr(agent, "accessToken", ""))
     
     try:
-        print(f"\n[BACKEND] Saving summary to: {url}")
-        response = requests.post(url, json=payload, headers=headers, timeout=10)
-        print(f"[BACKEND] Response Code: {response.status_code}")
-        
-        status = "Synced." if response.status_code in [200, 201] else f"Error {response.status_code}"
-        if response.status_code not in [200, 201]:
-            print(f"[BACKEND] Error Details: {response.text}")
-            
-        return f"CONVERSATION SUMMARY:\n{summary}\n\n[Status: {status}]"
+        # Delivered by the background outbox so the reply doesn't wait on ThanosBE
+        outbox.enqueue("conversation", payload, headers)
+        log.info("Conversation summary queued")
+        return f"CONVERSATION SUMMARY:\n{summary}\n\n[Status: Queued for sync.]"
     except Exception as e:
-        print(f"[BACKEND] Summary Exception: {str(e)}")
+        log.exception("Conversation summary could not be queued")
         return f"CONVERSATION SUMMARY:\n{summary}\n\n[Status: Sync Error {str(e)}]"
 
 @tool
 def search_documentation(agent: Agent, query: str) -> str:
     """Search knowledge base based on user permissions."""
     meta_filter = get_robust_filter(agent)
-    print(f"\n[RAG] Searching: '{query}' | Filter: {meta_filter}")
-    results = vector_db.search(query=query, limit=5, filters=meta_filter)
-    if not results:
+    log.info("Searching documentation", extra={"query": query, "filter": meta_filter})
+    try:
+        context = documentation_context(query, meta_filter)
+    except resilience.CircuitOpen:
+        # Postgres is failing; the model can still answer or offer a ticket without the manuals
+        return "Documentation search is temporarily unavailable."
+    retrieval.report(context)
+    sources = getattr(agent, "retrieved_sources", None)
+    if sources is not None:
+        # What the FAQ cache invalidates the final answer by
+        sources.extend(context.documents)
+    if not context.documents:
         return "No specific documentation found for your request at your permission level."
-    return "\n\n".join([r.content for r in results])
+    return context.render()
 
 # --- 3. AGENT FACTORY ---
 
-def get_support_team(user_context: dict):
-    with open("prompt.md", "r") as f:
-        prompt_content = f.read()
-    
-    # Dynamic String Injection
-    instructions = prompt_content.replace("{{$json.userName}}", user_context.get("userName", "User"))
-    instructions = instructions.replace("{{$json.userEmail}}", user_context.get("userEmail", "Not provided"))
-    instructions = instructions.replace("{{$json.perm}}", str(user_context.get("perm", "0")))
-    instructions = instructions.replace("{{$json.allperm}}", str(user_context.get("allperm", "0")))
-    instructions = instructions.replace("{{$json.superperm}}", str(user_context.get("superperm", "0")))
+AGENT_NAME = "Julley Support"
+PROMPT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "prompt.md")
+MODEL_ID = "gemini-2.5-flash"
+# Tool calls the model issues in one step run concurrently, up to this many at a time (1 = one after another)
+TOOL_CALL_WORKERS = int(os.getenv("TOOL_CALL_WORKERS", "4"))
+
+CORE_BEHAVIOR = [
+    "--- AGENT CORE BEHAVIOR ---",
+    "1. You are a STATEFUL agent. Refer to Chat History for context.",
+    "2. If the user query is technical, SEARCH DOCUMENTS immediately.",
+    "3. TICKET LOGIC: When details are confirmed (Step 4), YOU MUST CALL 'create_support_ticket' immediately.",
+    "4. NEVER say 'ticket details confirmed' without calling the tool first.",
+    "5. COMPLETION LOGIC: When the user says thank you or the issue is resolved, CALL 'save_conversation_summary' immediately without asking the user for any details. Generate the summary, topic, and main issue yourself from history.",
+    "6. NEVER ask the user: 'What was the topic?' or 'Can you provide a summary?'. You are responsible for this.",
+    "7. TotalToken: Include this at the end of every response.",
+]
+
+SUPPORT_TOOLS = [search_documentation, create_support_ticket, save_conversation_summary]
+
+# Placeholder defaults when the user context does not carry a value
+PROMPT_DEFAULTS = {
+    "userName": "User",
+    "userEmail": "Not provided",
+    "perm": "0",
+    "allperm": "0",
+    "superperm": "0",
+}
+ROLE_FIELDS = ("perm", "superperm", "allperm")
+
+_PLACEHOLDER = re.compile(r"\{\{\$json\.(\w+)\}\}")
+
+class PromptTemplate:
+    """prompt.md split once into literal text and {{$json.field}} slots."""
+
+    def __init__(self, parts: list):
+        # Even indexes are literal text, odd indexes are placeholder names
+        self.parts = parts
+
+    @classmethod
+    def compile(cls, text: str) -> "PromptTemplate":
+        return cls(_PLACEHOLDER.split(text))
+
+    def partial(self, values: dict) -> "PromptTemplate":
+        """Fills the given fields now and keeps the remaining slots open."""
+        parts = [self.parts[0]]
+        for i in range(1, len(self.parts), 2):
+            name, literal = self.parts[i], self.parts[i + 1]
+            if name in values:
+                parts[-1] += str(values[name]) + literal
+            else:
+                parts.extend([name, literal])
+        return PromptTemplate(parts)
+
+    def split(self) -> Tuple[str, "PromptTemplate"]:
+        """
+        (static text, template of the rest): the cut is made at the paragraph
+        holding the first slot, so the static text never changes between users.
+        """
+        head = self.parts[0]
+        if len(self.parts) == 1:
+            return head, PromptTemplate([""])
+        cut = head.rfind("\n\n")
+        cut = cut if cut >= 0 else head.rfind("\n")
+        if cut < 0:
+            return "", self
+        return head[:cut].rstrip("\n"), PromptTemplate([head[cut:].lstrip("\n")] + self.parts[1:])
+
+    def render(self, values: dict) -> str:
+        out = list(self.parts)
+        for i in range(1, len(out), 2):
+            name = out[i]
+            out[i] = str(values.get(name, PROMPT_DEFAULTS.get(name, "")))
+        return "".join(out)
+
+_template_lock = threading.Lock()
+_prompt_template: Optional[PromptTemplate] = None
+# prompt.md up to its first placeholder paragraph, identical for every request
+_static_prompt = ""
+_prompt_mtime: Optional[float] = None
+_shared_model: Optional["TracedGemini"] = None
+# (perm, superperm, allperm) -> role-specific prompt template
+_role_templates: Dict[tuple, PromptTemplate] = {}
+
+def get_prompt_template() -> PromptTemplate:
+    """
+    Returns the per-user part of the compiled prompt.md (see get_static_prompt
+    for the rest), recompiling only when its mtime changes.
+    """
+    global _prompt_template, _prompt_mtime, _static_prompt
+    mtime = os.stat(PROMPT_PATH).st_mtime
+    if _prompt_template is not None and mtime == _prompt_mtime:
+        return _prompt_template
+    with _template_lock:
+        if _prompt_template is None or mtime != _prompt_mtime:
+            with open(PROMPT_PATH, "r") as f:
+                _static_prompt, _prompt_template = PromptTemplate.compile(f.read()).split()
+            _prompt_mtime = mtime
+            _role_templates.clear()
+            log.info("Compiled prompt template", extra={"path": PROMPT_PATH})
+    return _prompt_template
+
+def get_static_prompt() -> str:
+    get_prompt_template()
+    return _static_prompt
+
+def system_prefix() -> str:
+    """The start of every system instruction: core behavior and the static part of prompt.md."""
+    return prompt_cache.instruction_text([*CORE_BEHAVIOR, get_static_prompt()])
+
+def get_instructions(user_context: dict) -> List[str]:
+    """Agent instructions: the invariant blocks first, the user's own values last."""
+    # Only the per-user fields are rendered here; the prompt text and the
+    # role-specific substitutions come from the template cache.
+    suffix = get_role_template(user_context).render(user_context)
+    return [*CORE_BEHAVIOR, get_static_prompt(), suffix]
+
+def get_role_template(user_context: dict) -> PromptTemplate:
+    """Prompt template with the role/permission fields already filled in."""
+    template = get_prompt_template()
+    role_values = {
+        field: str(user_context.get(field, PROMPT_DEFAULTS[field])) for field in ROLE_FIELDS
+    }
+    key = tuple(role_values[field] for field in ROLE_FIELDS)
+    role_template = _role_templates.get(key)
+    if role_template is None:
+        role_template = template.partial(role_values)
+        _role_templates[key] = role_template
+    return role_template
+
+# Contents of the request being built on this thread, between _format_messages and get_request_params
+_request = threading.local()
+_tool_pool: Optional[ThreadPoolExecutor] = None
+
+def _needs_pause(function_call) -> bool:
+    """Human-in-the-loop calls, which agno pauses the run for instead of executing."""
+    function = function_call.function
+    return bool(function.requires_confirmation or function.requires_user_input
+                or function.external_execution or function.name == "get_user_input")
+
+def _with_timeout(kwargs: dict, seconds: float) -> dict:
+    """generate_content kwargs with an HTTP timeout, so an abandoned attempt is closed as well."""
+    from google.genai.types import GenerateContentConfig, HttpOptions
+    config = kwargs.get("config") or GenerateContentConfig()
+    if isinstance(config, dict):
+        config = GenerateContentConfig(**config)
+    options = (config.http_options or HttpOptions()).model_copy(update={"timeout": max(1, int(seconds * 1000))})
+    return {**kwargs, "config": config.model_copy(update={"http_options": options})}
+
+class GuardedModels:
+    """client.models whose generate calls run under resilience's deadline, breaker, hedging and retries."""
+
+    def __init__(self, models):
+        self._models = models
+
+    def __getattr__(self, name):
+        return getattr(self._models, name)
+
+    def generate_content(self, **kwargs):
+        return resilience.call_model(lambda timeout: self._models.generate_content(**_with_timeout(kwargs, timeout)))
+
+    def generate_content_stream(self, **kwargs):
+        return resilience.stream_model(
+            lambda timeout: self._models.generate_content_stream(**_with_timeout(kwargs, timeout)))
+
+class GuardedClient:
+    """google.genai client whose models go through GuardedModels; caches and the rest pass through."""
+
+    def __init__(self, client):
+        self._client = client
+        self.models = GuardedModels(client.models)
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+class TracedGemini(Gemini):
+    """
+    Gemini whose provider calls are timed as "model" spans (one per call, tool
+    rounds included) and bounded by the request deadline (GuardedClient). With
+    GEMINI_CONTEXT_CACHE=1, requests whose system instruction starts with
+    system_prefix() reference the cached prefix and tools instead, and send
+    the remaining user suffix as their first content.
+    """
+
+    def get_client(self):
+        return GuardedClient(super().get_client())
+
+    def invoke(self, *args, **kwargs):
+        with observability.span("model", model=self.id):
+            return super().invoke(*args, **kwargs)
+
+    def invoke_stream(self, *args, **kwargs):
+        with observability.span("model", model=self.id, stream=True):
+            yield from super().invoke_stream(*args, **kwargs)
+
+    def run_function_calls(self, function_calls, function_call_results, additional_input=None,
+                           current_function_call_count: int = 0, function_call_limit=None):
+        """
+        Runs the calls of one model step concurrently (agno runs them one after
+        another). Events and results are still yielded in the model's call order.
+        """
+        global _tool_pool
+        if (len(function_calls) < 2 or TOOL_CALL_WORKERS < 2 or function_call_limit is not None
+                or any(_needs_pause(fc) for fc in function_calls)):
+            yield from super().run_function_calls(function_calls, function_call_results, additional_input,
+                                                  current_function_call_count, function_call_limit)
+            return
+        if additional_input is None:
+            additional_input = []
+        if _tool_pool is None:
+            with _template_lock:
+                if _tool_pool is None:
+                    _tool_pool = ThreadPoolExecutor(max_workers=TOOL_CALL_WORKERS, thread_name_prefix="tool-call")
+
+        def run(function_call):
+            results = []
+            events = list(self.run_function_call(function_call=function_call, function_call_results=results,
+                                                 additional_input=additional_input))
+            return events, results
+
+        # Each call keeps the request's trace context, so its tool span nests under the turn
+        futures = [_tool_pool.submit(contextvars.copy_context().run, run, fc) for fc in function_calls]
+        for future in futures:
+            events, results = future.result()
+            yield from events
+            function_call_results.extend(results)
+        if additional_input:
+            function_call_results.extend(additional_input)
+
+    def _format_messages(self, messages, compress_tool_results: bool = False):
+        contents, system_message = super()._format_messages(messages, compress_tool_results)
+        _request.contents = contents
+        return contents, system_message
+
+    def get_request_params(self, system_message=None, response_format=None, tools=None, tool_choice=None):
+        contents, _request.contents = getattr(_request, "contents", None), None
+        cache_name = None
+        # The API refuses system_instruction, tools and tool_config next to cached content
+        if (prompt_cache.CONTEXT_CACHE and system_message and tools and contents is not None
+                and response_format is None and tool_choice is None):
+            prefix = system_prefix()
+            if system_message.startswith(prefix):
+                cache_name = prompt_cache.context_cache.lookup(self.get_client(), self.id, prefix, tools)
+        if cache_name is None:
+            return super().get_request_params(system_message, response_format, tools, tool_choice)
+
+        from google.genai.types import Content, GenerateContentConfig, Part
+        contents.insert(0, Content(role="user", parts=[Part(text=system_message[len(prefix):].strip())]))
+        params = super().get_request_params(None, response_format)
+        config = params.get("config") or GenerateContentConfig()
+        config.cached_content = cache_name
+        params["config"] = config
+        return params
+
+def get_shared_model() -> Gemini:
+    global _shared_model
+    if _shared_model is None:
+        with _template_lock:
+            if _shared_model is None:
+                _shared_model = TracedGemini(id=MODEL_ID)
+    return _shared_model
+
+def trace_tool(function_name: str, function_call, arguments: dict):
+    """Tool hook: times every tool call as a "tool.<name>" span."""
+    with observability.span(f"tool.{function_name}"):
+        return function_call(**arguments)
+
+# The default tenant's store, under the names single-tenant callers use
+_default_store = get_store(tenancy.DEFAULT_TENANT)
+vector_db = _default_store.vector_db
+permission_search = _default_store.permission_search
+retriever = _default_store.retriever
+search_cache = _default_store.search_cache
+session_db = _default_store.session_db
+history_manager = _default_store.history_manager
+
+def _warm_store(store: TenantStore, report: dict):
+    table = store.vector_db.table_name
+    if not store.session_db.prepare():
+        log.info("Created session table", extra={"table": f"ai.{store.session_db.session_table_name}"})
+    if f"ai.{table}" in report["missingTables"]:
+        log.warning("Knowledge table missing; run upsert_drive_docs.py",
+                    extra={"table": f"ai.{table}", "tenant": store.tenant})
+    else:
+        store.permission_search.layout()
+    store.search_cache.check_version()
+    store.answer_cache.check_version()
+
+def warm_up() -> dict:
+    """
+    Does at startup what the first chat turns would otherwise pay for: opens
+    pool connections, checks and reflects the tables, reads the permission
+    index layout and knowledge version of every configured tenant, compiles
+    the prompt (recording the token size of each block and tool schema) and
+    builds the model client.
+    """
+    started = time.perf_counter()
+    stores = [get_store(tenant) for tenant in tenancy.tenants()]
+    report = database.warm_up(engine, tables=[
+        ("ai", name) for store in stores for name in (store.vector_db.table_name, store.session_db.session_table_name)
+    ])
+    for store in stores:
+        _warm_store(store, report)
+    prompt_cache.account({
+        "core_behavior": prompt_cache.instruction_text(CORE_BEHAVIOR),
+        "prompt_static": get_static_prompt(),
+        "user_suffix": get_prompt_template().render({}),
+    }, SUPPORT_TOOLS)
+    try:
+        model = get_shared_model()
+        client = model.get_client()
+        if prompt_cache.CONTEXT_CACHE:
+            # Same key the first request computes, so that request finds the cache ready
+            tools = [{"type": "function", "function": prompt_cache.tool_schema(f)} for f in SUPPORT_TOOLS]
+            prompt_cache.context_cache.lookup(client, model.id, system_prefix(), tools)
+    except Exception as e:
+        log.warning("Model client not ready", extra={"error": str(e)})
+    report["seconds"] = round(time.perf_counter() - started, 3)
+    log.info("Warm-up done", extra=report)
+    return report
+
+def load_history(user_context: dict) -> HistoryWindow:
+    # User Request: "take the session id from the user" and "relate to the window"
+    session_id = user_context.get("conversationId") or user_context.get("sessionId")
+    # Sessions live in the tenant's own table, so IDs from different tenants never meet
+    store = get_store(user_context.get("tenantId"))
+    resilience.check("history")
+    with observability.span("history_load"):
+        return store.history_manager.build(session_id)
+
+def get_support_team(user_context: dict, window: Optional[HistoryWindow] = None,
+                      documentation: Optional[retrieval.PackedContext] = None):
+    """
+    window: the session's history if the caller already loaded it (see load_history).
+    documentation: search results for the message, retrieved ahead of the run (see prefetch_documentation).
+    """
+    instructions = get_instructions(user_context)
+    session_id = user_context.get("conversationId") or user_context.get("sessionId")
+    store = get_store(user_context.get("tenantId"))
+    if window is None:
+        window = load_history(user_context)
 
     support_agent = Agent(
-        name="Julley Support",
-        model=Gemini(id="gemini-2.5-flash"),
-        db=session_db,
-        instructions=[
-            "--- AGENT CORE BEHAVIOR ---",
-            "1. You are a STATEFUL agent. Refer to Chat History for context.",
-            "2. If the user query is technical, SEARCH DOCUMENTS immediately.",
-            "3. TICKET LOGIC: When details are confirmed (Step 4), YOU MUST CALL 'create_support_ticket' immediately.",
-            "4. NEVER say 'ticket details confirmed' without calling the tool first.",
-            "5. COMPLETION LOGIC: When the user says thank you or the issue is resolved, CALL 'save_conversation_summary' immediately without asking the user for any details. Generate the summary, topic, and main issue yourself from history.",
-            "6. NEVER ask the user: 'What was the topic?' or 'Can you provide a summary?'. You are responsible for this.",
-            "7. TotalToken: Include this at the end of every response.",
-            instructions,
-        ],
-        tools=[search_documentation, create_support_ticket, save_conversation_summary],
-        add_history_to_context=True,
-        num_history_runs=10
+        name=AGENT_NAME,
+        model=get_shared_model(),
+        db=store.session_db,
+        instructions=instructions,
+        tools=SUPPORT_TOOLS,
+        tool_hooks=[trace_tool],
+        # The window replaces agno's last-N-runs history and is rebuilt from the stored runs every turn
+        add_history_to_context=False,
+        additional_input=window.messages or None,
+        store_history_messages=False,
+        post_hooks=[drop_history_window],
+        # After the per-user instructions, so the prompt prefix stays the same
+        additional_context=documentation_block(documentation) if documentation else None,
+        cache_session=True,
     )
     
     for key, value in user_context.items():
         setattr(support_agent, key, value)
     
-    # User Request: "take the session id from the user" and "relate to the window"
     # We explicitly set the session_id to the user's provided ID.
-    # The 'num_history_runs=10' above ensures we load the last 10 interactions (Window) for this specific Session ID.
-    support_agent.session_id = user_context.get("conversationId") or user_context.get("sessionId")
+    support_agent.session_id = session_id
+    # Chunks the model was given during this turn, speculatively or by search_documentation
+    support_agent.retrieved_sources = list(documentation.documents) if documentation else []
+    support_agent.prefetched = documentation is not None
+    if window.session is not None:
+        # Already read to build the window; spares the run a second read of the session row
+        support_agent._cached_session = window.session
     return support_agent
 
+# --- 4. FAQ FAST PATH ---
+# With FAQ_CACHE=1, the first turn of a new session is looked up in the
+# tenant's answer cache (normalized message or a near-duplicate embedding,
+# within the same permission filter). A hit is stored in the session as a
+# regular run and skips the model entirely. Only answers produced by
+# search_documentation alone, citing at least one chunk and not mentioning the
+# user, are cached; they are dropped when a cited file is re-ingested.
+
+_TOTAL_TOKEN_LINE = re.compile(r"\s*TotalToken:.*$", re.IGNORECASE | re.DOTALL)
+_ANONYMOUS = {"", "unknown", "user", "not provided"}
+
+def is_first_turn(window: HistoryWindow) -> bool:
+    return window.session is None or not completed_runs(window.session)
+
+def _faq_key(user_context: dict):
+    message = user_context["message"]
+    return message, embedder.get_embedding(message), get_robust_filter(SimpleNamespace(**user_context))
+
+def cached_answer(user_context: dict, window: HistoryWindow) -> Optional[RunOutput]:
+    """The cached answer as a completed run saved to the session, or None to run the agent."""
+    if not FAQ_CACHE or not is_first_turn(window):
+        return None
+    store = get_store(user_context.get("tenantId"))
+    with observability.span("faq_cache"):
+        message, embedding, meta_filter = _faq_key(user_context)
+        answer = store.answer_cache.get(message, embedding, meta_filter)
+    if answer is None:
+        return None
+
+    session_id = user_context.get("conversationId") or user_context.get("sessionId")
+    run = RunOutput(
+        run_id=str(uuid.uuid4()),
+        agent_id=generate_id_from_name(AGENT_NAME),
+        agent_name=AGENT_NAME,
+        session_id=session_id,
+        user_id=user_context.get("userId"),
+        input=RunInput(input_content=message),
+        content=answer.content,
+        messages=[Message(role="user", content=message), Message(role="assistant", content=answer.content)],
+        metrics=Metrics(),
+        metadata={"faqCache": {"chunks": answer.chunk_ids, "tokensSaved": answer.tokens}},
+        status=RunStatus.completed,
+    )
+    session = window.session or AgentSession(
+        session_id=session_id, agent_id=run.agent_id, user_id=run.user_id, created_at=int(time.time()))
+    session.upsert_run(run)
+    store.session_db.upsert_session(session)
+    log.info("Answered from FAQ cache", extra={"chunks": len(answer.chunk_ids), "tokensSaved": answer.tokens})
+    return run
+
+def remember_answer(user_context: dict, window: HistoryWindow, agent: Agent, response: Any):
+    """Caches a first-turn answer that came from the documentation alone."""
+    if not FAQ_CACHE or not is_first_turn(window) or response.status != RunStatus.completed:
+        return
+    tools = {t.tool_name for t in (response.tools or [])}
+    sources = getattr(agent, "retrieved_sources", None) or []
+    content = _TOTAL_TOKEN_LINE.sub("", response.content or "").strip()
+    # Sources come from search_documentation or the speculative search; no other tool may have run
+    if tools - {"search_documentation"} or not sources or not content:
+        return
+    personal = (str(user_context.get(f) or "").strip().lower() for f in ("userName", "userEmail", "userId"))
+    if any(value not in _ANONYMOUS and len(value) > 2 and value in content.lower() for value in personal):
+        return
+    message, embedding, meta_filter = _faq_key(user_context)
+    answer = CachedAnswer(
+        content=content,
+        chunk_ids=list(dict.fromkeys(d.id for d in sources)),
+        file_ids={d.meta_data.get("file_id") for d in sources if d.meta_data.get("file_id")},
+        tokens=(response.metrics.input_tokens or 0) + (response.metrics.output_tokens or 0) if response.metrics else 0,
+    )
+    get_store(user_context.get("tenantId")).answer_cache.put(message, embedding, meta_filter, answer)
+
 def sync_turn_to_backend(agent: Any, response: Any):
-    url = "https://stagebackend.julleyonline.co.in/api/v1/customer-support/n8n/messages"
+    """Queues the user/assistant turn for the /messages callback. Returns once spooled."""
     user_msg = getattr(agent, "last_user_msg", "...")
     payload = {
         "conversationId": agent.session_id,
         "userId": getattr(agent, "userId", "unknown"),
-        "tenantId": getattr(agent, "tenantId", "Thanos"),
+        "tenantId": caller_tenant(agent),
         "sessionId": agent.session_id,
         "userName": getattr(agent, "userName", "Unknown"),
         "userEmail": getattr(agent, "userEmail", "Not provided"),
@@ -221,11 +711,87 @@ def sync_turn_to_backend(agent: Any, response: Any):
             {"senderType": "assistant", "content": response.content}
         ]
     }
-    headers = {
-        "Authorization": f"Bearer {getattr(agent, 'accessToken', '')}",
-        "Content-Type": "application/json",
-        }
+    headers = auth_headers(getattr(agent, "accessToken", ""))
+    try:
+        outbox.enqueue("messages", payload, headers, batch_key=agent.session_id)
+        return True
+    except Exception as e:
+        log.exception("Could not queue turn for sync")
+        return False
+
+# --- 5. SPECULATIVE RETRIEVAL ---
+# prompt.md has the model search the documentation for every question, which
+# costs a model round trip just to decide on the search_documentation call.
+# Instead, the user's message is searched with their permission filter as soon
+# as the turn starts, while the history loads, and the results go into the
+# first model call. The model still calls the tool when it wants another query.
+#
+#   SPECULATIVE_RETRIEVAL=0       turn it off
+#   SPECULATIVE_MIN_WORDS=3       shorter messages (greetings, "thanks") are not searched
+#   SPECULATIVE_TIMEOUT=2.0       seconds a turn waits for the search once its history is loaded
+#   SPECULATIVE_WORKERS=8         concurrent speculative searches
+
+SPECULATIVE_RETRIEVAL = os.getenv("SPECULATIVE_RETRIEVAL", "1").lower() in ("1", "true", "yes")
+SPECULATIVE_MIN_WORDS = int(os.getenv("SPECULATIVE_MIN_WORDS", "3"))
+SPECULATIVE_TIMEOUT = float(os.getenv("SPECULATIVE_TIMEOUT", "2.0"))
+SPECULATIVE_WORKERS = int(os.getenv("SPECULATIVE_WORKERS", "8"))
+DOCUMENTATION_TAG = "documentation_search"
+
+SPECULATIVE_SEARCHES = metrics.counter("speculative_retrieval_total", "Speculative documentation searches by outcome")
+
+_prefetch_pool: Optional[ThreadPoolExecutor] = None
+
+def documentation_block(context: retrieval.PackedContext) -> str:
+    return (
+        f"<{DOCUMENTATION_TAG}>\n"
+        "The documentation search tool has already been run for the user's latest message, with their "
+        "permissions. Answer from these results; call it again only to look up something they do not cover.\n\n"
+        f"{context.render()}\n"
+        f"</{DOCUMENTATION_TAG}>"
+    )
+
+def _speculative_search(message: str, meta_filter: dict) -> retrieval.PackedContext:
+    with observability.span("speculative_retrieval"):
+        return documentation_context(message, meta_filter)
+
+def prefetch_documentation(user_context: dict) -> Optional[Future]:
+    """Starts searching the user's message in the background; None when the message is not searched."""
+    global _prefetch_pool
+    message = user_context.get("message") or ""
+    if not SPECULATIVE_RETRIEVAL:
+        return None
+    if len(message.split()) < SPECULATIVE_MIN_WORDS:
+        SPECULATIVE_SEARCHES.inc(result="skipped")
+        return None
+    if _prefetch_pool is None:
+        with _template_lock:
+            if _prefetch_pool is None:
+                _prefetch_pool = ThreadPoolExecutor(max_workers=SPECULATIVE_WORKERS, thread_name_prefix="prefetch")
+    meta_filter = get_robust_filter(SimpleNamespace(**user_context))
+    return _prefetch_pool.submit(contextvars.copy_context().run, _speculative_search, message, meta_filter)
+
+def prefetched_documentation(future: Optional[Future]) -> Optional[retrieval.PackedContext]:
+    """The speculative search's results, or None if it found nothing, failed or is still running after SPECULATIVE_TIMEOUT."""
+    if future is None:
+        return None
     try:
-        requests.post(url, json=payload, headers=headers, timeout=5)
+        context = future.result(timeout=resilience.remaining(SPECULATIVE_TIMEOUT))
     except Exception as e:
-        print(f"[SYNC] Error syncing messages: {e}")
+        future.cancel()
+        SPECULATIVE_SEARCHES.inc(result="failed")
+        log.warning("Speculative retrieval dropped", extra={"error": str(e) or type(e).__name__})
+        return None
+    if not context.documents:
+        SPECULATIVE_SEARCHES.inc(result="empty")
+        return None
+    retrieval.report(context)
+    return context
+
+def note_speculation(agent: Agent, tool_names: set):
+    """Counts whether the model answered from the speculative results or searched again."""
+    if getattr(agent, "prefetched", False):
+        SPECULATIVE_SEARCHES.inc(result="searched_again" if "search_documentation" in tool_names else "answered")
+
+def speculation_stats() -> dict:
+    return {"enabled": SPECULATIVE_RETRIEVAL, "searches": SPECULATIVE_SEARCHES.snapshot(),
+            "toolCallWorkers": TOOL_CALL_WORKERS}
@@ -0,0 +1,501 @@
+import os
+import logging
+import json
+import time
+import uuid
+import random
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional, List, Dict, Any
+from dotenv import load_dotenv
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+import resilience
+
+load_dotenv()
+log = logging.getLogger(__name__)
+
+# --- Outbound delivery to ThanosBE ---
+# Every callback (message turns, tickets, conversation summaries) goes through
+# one pooled keep-alive session. Deliveries that don't need an answer are
+# written to an on-disk spool and sent by a background worker that batches
+# message turns per conversation and retries with exponential backoff, so a
+# backend outage delays data instead of dropping it.
+#
+# Groups are delivered concurrently by BACKEND_DELIVERY_WORKERS threads; one
+# endpoint may use at most half of them, so a slow endpoint can't hold up the
+# others, and a conversation's turns are never in flight twice. A record still
+# failing after BACKEND_MAX_ATTEMPTS attempts or BACKEND_MAX_AGE seconds is
+# moved to <spool>/dead and logged.
+#
+# Spool files hold no credentials: the Authorization header is kept in memory
+# and added back when the record is sent. Records recovered from a process
+# that died (or restarted) have lost theirs: they are sent with a newer record
+# of the same conversation when one is batched with them, else with
+# BACKEND_SERVICE_TOKEN. If ThanosBE refuses that with 401/403, they are held
+# and tried again every BACKEND_RETRY_MAX_DELAY seconds (until BACKEND_MAX_AGE)
+# instead of being dead-lettered. Spool files are created 0600.
+#
+# Every delivery carries an Idempotency-Key: the record ID, stable across
+# retries, so a ticket whose 5xx came after ThanosBE committed it is not
+# created twice.
+
+BACKEND_BASE_URL = os.getenv(
+    "THANOS_BACKEND_URL", "https://stagebackend.julleyonline.co.in/api/v1/customer-support/n8n"
+).rstrip("/")
+SPOOL_DIR = Path(os.getenv("BACKEND_SPOOL_DIR", "backend_spool"))
+POOL_SIZE = int(os.getenv("BACKEND_POOL_SIZE", "16"))
+BATCH_WINDOW = float(os.getenv("BACKEND_BATCH_WINDOW", "0.25"))
+MAX_BATCH_TURNS = int(os.getenv("BACKEND_MAX_BATCH_TURNS", "50"))
+RETRY_BASE_DELAY = float(os.getenv("BACKEND_RETRY_BASE_DELAY", "1.0"))
+RETRY_MAX_DELAY = float(os.getenv("BACKEND_RETRY_MAX_DELAY", "300"))
+DELIVERY_WORKERS = int(os.getenv("BACKEND_DELIVERY_WORKERS", "8"))
+MAX_ATTEMPTS = int(os.getenv("BACKEND_MAX_ATTEMPTS", "20"))
+MAX_AGE = float(os.getenv("BACKEND_MAX_AGE", "86400"))
+# Authorization of recovered records, whose user token was only in memory
+SERVICE_TOKEN = os.getenv("BACKEND_SERVICE_TOKEN", "")
+# Headers never written to the spool
+SECRET_HEADERS = {"Authorization"}
+# Answers to a recovered record's credential: held, not dead-lettered
+AUTH_STATUS = {401, 403}
+
+ENDPOINT_TIMEOUTS = {"messages": 5, "ticket": 15, "conversation": 10}
+RETRYABLE_STATUS = {408, 425, 429, 500, 502, 503, 504}
+
+QUEUE_DEPTH = metrics.gauge("backend_sync_queue_depth", "Deliveries waiting in the outbox")
+DELIVERED = metrics.counter("backend_sync_delivered_total", "Records delivered to ThanosBE")
+RETRIES = metrics.counter("backend_sync_retries_total", "Failed delivery attempts that will be retried")
+DEAD_LETTERS = metrics.counter("backend_sync_dead_letter_total",
+                               "Records moved to dead letters: rejected by ThanosBE, or out of attempts (expired)")
+HELD = metrics.counter("backend_sync_held_total", "Recovered records refused with 401/403, held for a later attempt")
+DELIVERY_LATENCY = metrics.histogram("backend_sync_delivery_seconds", "Enqueue to successful delivery")
+
+def build_http_session(pool_size: int = POOL_SIZE) -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+http_session = build_http_session()
+
+def endpoint_url(endpoint: str) -> str:
+    return f"{BACKEND_BASE_URL}/{endpoint}"
+
+def auth_headers(access_token: Optional[str]) -> dict:
+    return {
+        "Authorization": f"Bearer {access_token or ''}",
+        "Content-Type": "application/json",
+    }
+
+def new_record_id() -> str:
+    # time prefix keeps spool files in FIFO order
+    return f"{time.time_ns()}-{uuid.uuid4().hex[:8]}"
+
+def backoff_delay(attempts: int) -> float:
+    """Exponential backoff with full jitter, capped at RETRY_MAX_DELAY."""
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (2 ** attempts)))
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+class BackendOutbox:
+    """
+    Durable outbox for ThanosBE callbacks.
+
+    Records are spooled under <spool_dir>/<host>-<pid>/ before they are queued,
+    so each worker process owns its files. On start, a process adopts records
+    left behind by dead processes on the same host.
+    """
+
+    def __init__(self, spool_dir: Path = SPOOL_DIR, session: Optional[requests.Session] = None,
+                 workers: int = DELIVERY_WORKERS):
+        self.spool_dir = Path(spool_dir)
+        self.session = session or http_session
+        self.owner = f"{socket.gethostname()}-{os.getpid()}"
+        self.workers = max(1, workers)
+        self.endpoint_limit = max(1, self.workers // 2)
+        self._pending: List[Dict[str, Any]] = []
+        # Secret headers of spooled records, by record ID; never written to disk
+        self._credentials: Dict[str, dict] = {}
+        # Groups being delivered: per endpoint, conversations (batch keys) and records
+        self._busy_endpoints: Dict[str, int] = {}
+        self._busy_keys: set = set()
+        self._in_flight = 0
+        self._in_flight_records = 0
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = False
+
+    # --- lifecycle ---
+
+    @property
+    def own_dir(self) -> Path:
+        return self.spool_dir / self.owner
+
+    def start(self):
+        with self._cond:
+            if self._thread and self._thread.is_alive():
+                return
+            self.own_dir.mkdir(mode=0o700, parents=True, exist_ok=True)
+            self._adopt_orphans()
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name="backend-outbox", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        """Stops the worker. Undelivered records stay in the spool for the next start."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def _adopt_orphans(self):
+        host = socket.gethostname()
+        known = {r["id"] for r in self._pending}
+        for owner_dir in self.spool_dir.iterdir():
+            if not owner_dir.is_dir() or owner_dir.name == "dead":
+                continue
+            owner_host, _, pid = owner_dir.name.rpartition("-")
+            if owner_dir != self.own_dir:
+                if owner_host != host or not pid.isdigit() or _pid_alive(int(pid)):
+                    continue
+            for path in sorted(owner_dir.glob("*.json")):
+                target = self.own_dir / path.name
+                try:
+                    if path != target:
+                        os.rename(path, target)
+                    record = json.loads(target.read_text())
+                except (FileNotFoundError, json.JSONDecodeError):
+                    continue  # claimed by another process, or a torn write
+                if record["id"] not in known:
+                    record["next_attempt_at"] = 0
+                    if self._keep_credentials(record):
+                        # Spooled by an older version with its token; rewritten without it
+                        self._write_spool(record)
+                    self._pending.append(record)
+        if self._pending:
+            log.info("Recovered undelivered records", extra={"records": len(self._pending), "spool": str(self.spool_dir)})
+        self._set_depth()
+
+    # --- spool ---
+
+    def _spool_path(self, record: dict) -> Path:
+        return self.own_dir / f"{record['id']}.json"
+
+    def _keep_credentials(self, record: dict) -> bool:
+        """Moves the record's secret headers to memory. True if it had any."""
+        secrets = {k: v for k, v in record["headers"].items() if k in SECRET_HEADERS}
+        if secrets:
+            record["headers"] = {k: v for k, v in record["headers"].items() if k not in SECRET_HEADERS}
+            self._credentials[record["id"]] = secrets
+        return bool(secrets)
+
+    def _recovered(self, group: List[dict]) -> bool:
+        """True when no record of the group has its credentials in memory."""
+        return not any(record["id"] in self._credentials for record in group)
+
+    def _headers(self, group: List[dict]) -> dict:
+        """
+        Headers of the latest record, with the newest credentials any record of
+        the group still has (BACKEND_SERVICE_TOKEN if none) and the group's
+        Idempotency-Key.
+        """
+        headers = dict(group[-1]["headers"])
+        for record in reversed(group):
+            if record["id"] in self._credentials:
+                headers.update(self._credentials[record["id"]])
+                break
+        else:
+            if SERVICE_TOKEN:
+                headers["Authorization"] = f"Bearer {SERVICE_TOKEN}"
+        if len(group) == 1:
+            headers["Idempotency-Key"] = group[0]["id"]
+        else:
+            headers["Idempotency-Key"] = uuid.uuid5(uuid.NAMESPACE_OID, ",".join(r["id"] for r in group)).hex
+        return headers
+
+    def _write_spool(self, record: dict):
+        path = self._spool_path(record)
+        tmp = path.with_suffix(".tmp")
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            f.write(json.dumps(record))
+        os.replace(tmp, path)
+
+    def _remove_spool(self, record: dict):
+        self._credentials.pop(record["id"], None)
+        try:
+            self._spool_path(record).unlink()
+        except FileNotFoundError:
+            pass
+
+    def _dead_letter(self, record: dict):
+        self._credentials.pop(record["id"], None)
+        dead_dir = self.spool_dir / "dead"
+        dead_dir.mkdir(mode=0o700, parents=True, exist_ok=True)
+        try:
+            os.replace(self._spool_path(record), dead_dir / f"{record['id']}.json")
+        except FileNotFoundError:
+            pass
+
+    # --- producer side ---
+
+    def enqueue(self, endpoint: str, payload: dict, headers: dict, batch_key: Optional[str] = None,
+                record_id: Optional[str] = None) -> str:
+        """Spools a delivery and hands it to the background worker. Never blocks on the network."""
+        self.start()
+        now = time.time()
+        record = {
+            "id": record_id or new_record_id(),
+            "endpoint": endpoint,
+            "payload": payload,
+            "headers": dict(headers),
+            "batch_key": batch_key,
+            "attempts": 0,
+            "enqueued_at": now,
+            "next_attempt_at": now,
+        }
+        self._keep_credentials(record)
+        self._write_spool(record)
+        with self._cond:
+            self._pending.append(record)
+            self._set_depth()
+            self._cond.notify()
+        return record["id"]
+
+    def deliver_now(self, endpoint: str, payload: dict, headers: dict, timeout: Optional[float] = None):
+        """
+        Sends immediately and returns the response. If ThanosBE is unreachable or
+        answers with a retryable status, the record is spooled for background
+        retry and None is returned. The retries send the same Idempotency-Key.
+        """
+        record_id = new_record_id()
+        headers = {**headers, "Idempotency-Key": record_id}
+        gate = resilience.breaker("thanosbe")
+        # No longer than the request has left; with no time left the record goes straight to the spool
+        timeout = resilience.remaining(timeout or ENDPOINT_TIMEOUTS.get(endpoint, 10))
+        try:
+            if timeout <= 0:
+                raise resilience.exceeded("backend")
+            gate.allow()
+        except (resilience.CircuitOpen, resilience.DeadlineExceeded) as e:
+            log.warning("Delivery skipped, queued for retry", extra={"endpoint": endpoint, "error": str(e)})
+            self.enqueue(endpoint, payload, headers, record_id=record_id)
+            return None
+        try:
+            response = self.session.post(endpoint_url(endpoint), json=payload, headers=headers, timeout=timeout)
+        except requests.RequestException as e:
+            gate.failure()
+            log.warning("Delivery failed, queued for retry", extra={"endpoint": endpoint, "error": str(e)})
+            RETRIES.inc(endpoint=endpoint)
+            self.enqueue(endpoint, payload, headers, record_id=record_id)
+            return None
+        if response.status_code in RETRYABLE_STATUS:
+            gate.failure()
+            log.warning("Delivery returned a retryable status, queued for retry",
+                        extra={"endpoint": endpoint, "status": response.status_code})
+            RETRIES.inc(endpoint=endpoint)
+            self.enqueue(endpoint, payload, headers, record_id=record_id)
+            return None
+        gate.success()
+        return response
+
+    # --- worker side ---
+
+    def _run(self):
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="backend-deliver") as pool:
+            while True:
+                with self._cond:
+                    groups = self._next_groups()
+                    if groups is None:
+                        return
+                for group in groups:
+                    pool.submit(self._deliver, group)
+
+    def _sendable(self, record: dict, now: float) -> bool:
+        return (record["next_attempt_at"] <= now and record.get("batch_key") not in self._busy_keys
+                and self._busy_endpoints.get(record["endpoint"], 0) < self.endpoint_limit)
+
+    def _next_groups(self) -> Optional[List[List[dict]]]:
+        """
+        Blocks (holding the condition) until records are due and a delivery
+        slot is free, then claims the groups that fit. None means stop.
+        """
+        while not self._stopping:
+            now = time.time()
+            if self._in_flight < self.workers and any(self._sendable(r, now) for r in self._pending):
+                # Short window so turns that arrive together go out as one batch
+                self._cond.wait(BATCH_WINDOW)
+                now = time.time()
+                groups = []
+                for group in self._group([r for r in self._pending if self._sendable(r, now)]):
+                    key, endpoint = group[0].get("batch_key"), group[0]["endpoint"]
+                    if (self._in_flight >= self.workers or key in self._busy_keys
+                            or self._busy_endpoints.get(endpoint, 0) >= self.endpoint_limit):
+                        continue
+                    self._claim(group)
+                    groups.append(group)
+                claimed = {id(r) for group in groups for r in group}
+                self._pending = [r for r in self._pending if id(r) not in claimed]
+                if groups:
+                    return groups
+                continue
+            # Records that are due but blocked wait for a delivery to finish (notify)
+            next_due = min((r["next_attempt_at"] for r in self._pending if r["next_attempt_at"] > now), default=None)
+            self._cond.wait(None if next_due is None else max(next_due - now, 0.01))
+        return None
+
+    def _claim(self, group: List[dict]):
+        endpoint, key = group[0]["endpoint"], group[0].get("batch_key")
+        self._in_flight += 1
+        self._in_flight_records += len(group)
+        self._busy_endpoints[endpoint] = self._busy_endpoints.get(endpoint, 0) + 1
+        if key:
+            self._busy_keys.add(key)
+
+    def _release(self, group: List[dict]):
+        endpoint, key = group[0]["endpoint"], group[0].get("batch_key")
+        with self._cond:
+            self._in_flight -= 1
+            self._in_flight_records -= len(group)
+            self._busy_endpoints[endpoint] -= 1
+            self._busy_keys.discard(key)
+            self._set_depth()
+            self._cond.notify_all()
+
+    def _set_depth(self):
+        QUEUE_DEPTH.set(len(self._pending) + self._in_flight_records)
+
+    def _group(self, records: List[dict]) -> List[List[dict]]:
+        """Message turns for the same conversation are merged; everything else goes alone."""
+        groups: List[List[dict]] = []
+        batches: Dict[str, List[dict]] = {}
+        for record in records:
+            key = record.get("batch_key")
+            if record["endpoint"] != "messages" or not key:
+                groups.append([record])
+                continue
+            batch = batches.get(key)
+            if batch is None or len(batch) >= MAX_BATCH_TURNS:
+                batch = []
+                batches[key] = batch
+                groups.append(batch)
+            batch.append(record)
+        return groups
+
+    def _merge(self, group: List[dict]) -> dict:
+        if len(group) == 1:
+            return group[0]["payload"]
+        payload = dict(group[-1]["payload"])
+        payload["messages"] = [m for r in group for m in r["payload"].get("messages", [])]
+        return payload
+
+    def _deliver(self, group: List[dict]):
+        try:
+            self._send(group)
+        except Exception:
+            log.exception("Delivery worker failed", extra={"endpoint": group[0]["endpoint"]})
+            with self._cond:
+                self._pending.extend(group)
+        finally:
+            self._release(group)
+
+    def _send(self, group: List[dict]):
+        endpoint = group[0]["endpoint"]
+        # Latest record carries the freshest access token
+        headers = self._headers(group)
+        recovered = self._recovered(group)
+        gate = resilience.breaker("thanosbe")
+        try:
+            gate.allow()
+        except resilience.CircuitOpen as e:
+            # Held back until the breaker lets a probe through; not counted as an attempt
+            with self._cond:
+                for record in group:
+                    record["next_attempt_at"] = time.time() + e.retry_after + random.uniform(0, 1)
+                self._pending.extend(group)
+            return
+        status = None
+        try:
+            response = self.session.post(
+                endpoint_url(endpoint), json=self._merge(group), headers=headers,
+                timeout=ENDPOINT_TIMEOUTS.get(endpoint, 10),
+            )
+            status = response.status_code
+        except requests.RequestException as e:
+            log.warning("Delivery error", extra={"endpoint": endpoint, "error": str(e)})
+        (gate.failure if status is None or status in RETRYABLE_STATUS else gate.success)()
+
+        now = time.time()
+        if status is not None and 200 <= status < 300:
+            for record in group:
+                self._remove_spool(record)
+                DELIVERY_LATENCY.observe(now - record["enqueued_at"], endpoint=endpoint)
+            DELIVERED.inc(len(group), endpoint=endpoint)
+        elif recovered and status in AUTH_STATUS:
+            held = []
+            for record in group:
+                if now - record["enqueued_at"] >= MAX_AGE:
+                    self._dead_letter(record)
+                    DEAD_LETTERS.inc(endpoint=endpoint, reason="expired")
+                    continue
+                record["next_attempt_at"] = now + RETRY_MAX_DELAY
+                held.append(record)
+            log.warning("Recovered records refused without their user token, held",
+                        extra={"endpoint": endpoint, "status": status, "records": len(held),
+                               "serviceToken": bool(SERVICE_TOKEN)})
+            HELD.inc(len(held), endpoint=endpoint)
+            with self._cond:
+                self._pending.extend(held)
+        elif status is not None and status not in RETRYABLE_STATUS:
+            log.error("Delivery rejected, moved to dead letters",
+                      extra={"endpoint": endpoint, "status": status, "records": len(group)})
+            for record in group:
+                self._dead_letter(record)
+            DEAD_LETTERS.inc(len(group), endpoint=endpoint, reason="rejected")
+        else:
+            retry = []
+            for record in group:
+                record["attempts"] += 1
+                if record["attempts"] >= MAX_ATTEMPTS or now - record["enqueued_at"] >= MAX_AGE:
+                    self._dead_letter(record)
+                    continue
+                record["next_attempt_at"] = now + backoff_delay(record["attempts"])
+                self._write_spool(record)
+                retry.append(record)
+            if len(retry) < len(group):
+                log.error("Delivery gave up, moved to dead letters",
+                          extra={"endpoint": endpoint, "status": status, "records": len(group) - len(retry)})
+                DEAD_LETTERS.inc(len(group) - len(retry), endpoint=endpoint, reason="expired")
+            RETRIES.inc(len(retry), endpoint=endpoint)
+            with self._cond:
+                self._pending.extend(retry)
+
+    def stats(self) -> dict:
+        with self._cond:
+            depth = len(self._pending) + self._in_flight_records
+            oldest = min((r["enqueued_at"] for r in self._pending), default=None)
+        return {
+            "queueDepth": depth,
+            "oldestPendingAge": round(time.time() - oldest, 3) if oldest else None,
+            "delivered": DELIVERED.snapshot(),
+            "retries": RETRIES.snapshot(),
+            "deadLetters": DEAD_LETTERS.snapshot(),
+            "held": HELD.snapshot(),
+            "deliveryLatency": DELIVERY_LATENCY.snapshot(),
+        }
+
+outbox = BackendOutbox()
@@ -0,0 +1,142 @@
+"""
+Exercises the ThanosBE outbox against a local stub HTTP server.
+
+The stub fails the first --fail-first requests with 503, then accepts
+everything. The script queues message turns for a few conversations,
+waits for the queue to drain and reports batching, retries and delivery
+latency. It also checks that:
+
+  - spool files hold no access token, and delivered requests still carry it
+  - a ticket retried after a 503 is sent with the same Idempotency-Key
+  - records failing past BACKEND_MAX_ATTEMPTS end up in the dead-letter directory
+  - records recovered after a restart, refused with 401 without
+    BACKEND_SERVICE_TOKEN, are held rather than dead-lettered, and are
+    delivered with the service token once it is set
+
+Usage:
+    python benchmarks/backend_sync_check.py --turns 200 --conversations 5
+"""
+import os
+import sys
+import json
+import time
+import tempfile
+import argparse
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from harness import StubThanosBE
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Check outbox delivery against a stub ThanosBE")
+    parser.add_argument("--turns", type=int, default=200)
+    parser.add_argument("--conversations", type=int, default=5)
+    parser.add_argument("--fail-first", type=int, default=3)
+    args = parser.parse_args()
+
+    stub = StubThanosBE(fail_first=args.fail_first).start()
+    os.environ["THANOS_BACKEND_URL"] = stub.url
+    os.environ["BACKEND_RETRY_BASE_DELAY"] = "0.05"
+    os.environ["BACKEND_SPOOL_DIR"] = tempfile.mkdtemp(prefix="outbox-")
+    os.environ["BACKEND_MAX_ATTEMPTS"] = "3"
+    os.environ["BACKEND_RETRY_MAX_DELAY"] = "0.5"
+    import backend_sync
+
+    outbox = backend_sync.outbox
+    start = time.perf_counter()
+    for i in range(args.turns):
+        conversation = f"conv-{i % args.conversations}"
+        outbox.enqueue(
+            "messages",
+            {"conversationId": conversation, "messages": [
+                {"senderType": "user", "content": f"q{i}"},
+                {"senderType": "assistant", "content": f"a{i}"},
+            ]},
+            backend_sync.auth_headers("token"),
+            batch_key=conversation,
+        )
+    enqueue_time = time.perf_counter() - start
+    spool = Path(os.environ["BACKEND_SPOOL_DIR"])
+    spooled = [p for p in spool.rglob("*.json")]
+    leaked = [p for p in spooled if p.exists() and "token" in p.read_text()]
+    readable = [p for p in spooled if p.exists() and p.stat().st_mode & 0o077]
+
+    while outbox.stats()["queueDepth"] and time.perf_counter() - start < 30:
+        time.sleep(0.05)
+    stats = outbox.stats()
+    left = list(spool.rglob("*.json"))
+    turns_received = sum(len(body.get("messages", [])) // 2 for _, body in stub.received)
+    unauthorized = [a for a in stub.authorizations if a != "Bearer token"]
+
+    # The breaker is kept closed so every attempt below reaches the stub
+    import resilience
+    resilience._breakers["thanosbe"] = resilience.CircuitBreaker("thanosbe", failures=10 ** 6, reset=30.0)
+
+    # A ticket whose first attempt gets a 503 is retried under the same key
+    stub.fail_first = stub.requests + 1
+    ticket = outbox.deliver_now("ticket", {"title": "t"}, backend_sync.auth_headers("token"))
+    while outbox.stats()["queueDepth"] and time.perf_counter() - start < 30:
+        time.sleep(0.05)
+    ticket_keys = [key for path, key in stub.idempotency_keys if path == "/ticket"]
+
+    # ThanosBE down for good: records give up after BACKEND_MAX_ATTEMPTS
+    stub.fail_first = 10 ** 9
+    for i in range(3):
+        outbox.enqueue("conversation", {"conversationId": f"dead-{i}"}, backend_sync.auth_headers("token"))
+    while outbox.stats()["queueDepth"] and time.perf_counter() - start < 60:
+        time.sleep(0.05)
+    dead = list((spool / "dead").glob("*.json"))
+    outbox.stop()
+
+    # Restart: a process spooled two records and stopped before sending them;
+    # the next one adopts them without their user token
+    stub.fail_first = 0
+    stub.authorized = {"Bearer service"}
+    recovery_spool = Path(tempfile.mkdtemp(prefix="outbox-recovered-"))
+    crashed = backend_sync.BackendOutbox(recovery_spool)
+    crashed.own_dir.mkdir(parents=True)
+    crashed.start = lambda: None
+    for i in range(2):
+        crashed.enqueue("conversation", {"conversationId": f"recovered-{i}"}, backend_sync.auth_headers("token"))
+    restarted = backend_sync.BackendOutbox(recovery_spool)
+    restarted.start()
+    while not backend_sync.HELD.snapshot() and time.perf_counter() - start < 30:
+        time.sleep(0.05)
+    held = sum(backend_sync.HELD.snapshot().values())
+    held_dead = list((recovery_spool / "dead").glob("*.json"))
+    backend_sync.SERVICE_TOKEN = "service"
+    while restarted.stats()["queueDepth"] and time.perf_counter() - start < 60:
+        time.sleep(0.05)
+    restarted.stop()
+    stub.stop()
+    recovered = [body for path, body in stub.received if body.get("conversationId", "").startswith("recovered-")]
+
+    print(json.dumps({
+        "turnsQueued": args.turns,
+        "turnsDelivered": turns_received,
+        "httpRequests": stub.requests,
+        "enqueueMicrosPerTurn": round(enqueue_time / args.turns * 1e6, 1),
+        "spoolFilesLeft": len(left),
+        "deadLetterFiles": len(dead),
+        "ticketKeys": ticket_keys,
+        "recoveredHeld": held,
+        "recoveredDelivered": len(recovered),
+        **stats,
+        "deadLetters": backend_sync.DEAD_LETTERS.snapshot(),
+    }, indent=2))
+    assert turns_received == args.turns, "turns were lost"
+    assert not left, "spool not cleaned up"
+    assert spooled and not leaked, "access token written to the spool"
+    assert not readable, "spool files readable by others"
+    assert not unauthorized, "delivered without the access token"
+    assert len(dead) == 3, "expired records not dead-lettered"
+    assert ticket is None and len(ticket_keys) == 2 and len(set(ticket_keys)) == 1 and ticket_keys[0], \
+        "ticket retry without a stable Idempotency-Key"
+    assert held >= 2 and not held_dead, "recovered records refused with 401 were not held"
+    assert len(recovered) == 2, "recovered records not delivered with the service token"
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,304 @@
+"""
+Chunk counts, embedding calls and index size for a sample corpus of drone
+manuals, ingested three ways through the ingestion pipeline:
+
+  pages             the previous behaviour: one or more chunks per PDF page,
+                    Google Docs exported as PDF
+  structure         chunks along headings and sections, running headers and
+                    footers removed, Google Docs exported as HTML
+  structure+dedupe  the same, with near-duplicate chunks dropped before
+                    embedding (what ingestion does now)
+
+The manuals share boilerplate sections (safety notice, warranty, support
+contacts; identical or differing only in the product name), and every PDF
+page carries a running header and footer. Half of them are "Google Docs",
+served as PDF or HTML depending on the mode. Two permission groups are used,
+so duplicates may only be dropped within a group.
+
+Also reported: chunks still holding header/footer text, and for a query per
+section heading and permission group, how many of the top 5 results
+near-duplicate a higher one. The
+dedupe mode then re-ingests the manual whose boilerplate chunks the others
+point at, without those sections, and checks that the orphaned manuals are
+reported and, once re-ingested, every section is covered again.
+
+Usage:
+    python benchmarks/chunking_bench.py --manuals 8
+"""
+import os
+import sys
+import json
+import random
+import argparse
+import tempfile
+import threading
+from pathlib import Path
+from dataclasses import dataclass, field
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from chunking import NEAR_DUPLICATE_BITS
+from harness import HashEmbedder, bench_database_url
+
+PRODUCTS = ["Falcon X1", "Falcon X2", "Hawk Pro", "Hawk Mini", "Osprey", "Kestrel", "Merlin", "Harrier"]
+VOCABULARY = ("drone battery firmware calibration controller gps signal flight log compass motor propeller "
+              "telemetry mission waypoint payload camera gimbal sensor altitude landing takeoff wind hover "
+              "return home obstacle avoidance charging storage temperature update app pairing antenna").split()
+SHARED = {
+    "Safety Notice": ("Read every instruction before flying the {product}. Keep the aircraft in visual line of "
+                      "sight at all times and never fly over people, roads or airports. Check local regulations "
+                      "and obtain permission where it is required. Do not fly in rain, snow, fog or winds above "
+                      "the rated limit. Inspect propellers, arms and the battery latch before each flight and "
+                      "replace damaged parts. Keep children and pets away from the takeoff area. The operator is "
+                      "responsible for every flight and for any damage caused by misuse."),
+    "Warranty": ("The limited warranty covers defects in materials and workmanship for twelve months from the "
+                 "date of purchase. It does not cover crash damage, water damage, unauthorised modifications or "
+                 "normal wear of propellers and batteries. To make a claim, keep the proof of purchase and the "
+                 "serial number, and contact support before sending any product back. Repaired or replaced "
+                 "products are covered for the rest of the original period or ninety days, whichever is longer."),
+    "Contact Support": ("Support is available through the help center, by email and by phone on weekdays. Have "
+                        "the serial number, firmware version and flight logs ready when you contact us. Most "
+                        "questions are answered within one business day. Urgent safety issues are handled "
+                        "first. Training videos and the latest manuals can be downloaded from the help center."),
+}
+SECTIONS = [
+    ("1 Introduction", None), ("2 Safety Notice", "Safety Notice"), ("3 Flight Modes", None),
+    ("4 Calibration", None), ("4.1 Compass Calibration", None), ("4.2 IMU Calibration", None),
+    ("5 Battery Care", None), ("6 Troubleshooting", None), ("7 Warranty", "Warranty"),
+    ("8 Contact Support", "Contact Support"),
+]
+LINES_PER_PAGE = 40
+VARIANTS = {
+    "pages": dict(chunking="pages", near_duplicate_bits=-1),
+    "structure": dict(chunking="structure", near_duplicate_bits=-1),
+    "structure+dedupe": dict(chunking="structure", near_duplicate_bits=None),
+}
+
+
+@dataclass
+class CountingEmbedder(HashEmbedder):
+    calls: int = 0
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def get_embedding_and_usage(self, text: str):
+        with self._lock:
+            self.calls += 1
+        return super().get_embedding_and_usage(text)
+
+
+def section_text(product: str, heading: str, shared, rng) -> list:
+    """Paragraphs of one section."""
+    if shared:
+        return [SHARED[shared].format(product=product)]
+    topic = heading.split(" ", 1)[1].lower()
+    paragraphs = []
+    for _ in range(rng.randint(2, 4)):
+        sentences = [f"The {product} {topic} " + " ".join(rng.choice(VOCABULARY) for _ in range(rng.randint(8, 14)))
+                     + "." for _ in range(rng.randint(4, 6))]
+        paragraphs.append(" ".join(sentences))
+    return paragraphs
+
+
+def make_manual(index: int, without=()):
+    product = PRODUCTS[index % len(PRODUCTS)] + (f" {index // len(PRODUCTS) + 2}" if index >= len(PRODUCTS) else "")
+    rng = random.Random(index)
+    sections = [(heading, section_text(product, heading, shared, rng)) for heading, shared in SECTIONS
+                if shared not in without]
+    return product, sections
+
+
+def pdf_lines(product: str, sections: list) -> list:
+    lines = [f"{product.upper()} USER MANUAL", ""]
+    for heading, paragraphs in sections:
+        lines += ["", heading]
+        for paragraph in paragraphs:
+            words, line = paragraph.split(), ""
+            for word in words:
+                if len(line) + len(word) > 90:
+                    lines.append(line)
+                    line = word
+                else:
+                    line = f"{line} {word}".strip()
+            lines += [line, ""]
+    return lines
+
+
+def write_pdf(path: str, product: str, sections: list):
+    """Text PDF with a running header and a page-numbered footer on every page."""
+    body = pdf_lines(product, sections)
+    pages = [body[i:i + LINES_PER_PAGE] for i in range(0, len(body), LINES_PER_PAGE)]
+    offsets, kids = {}, []
+    with open(path, "wb") as out:
+        def obj(n, data):
+            offsets[n] = out.tell()
+            out.write(b"%d 0 obj\n" % n + data + b"\nendobj\n")
+
+        out.write(b"%PDF-1.4\n")
+        obj(1, b"<< /Type /Catalog /Pages 2 0 R >>")
+        obj(3, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+        for p, lines in enumerate(pages):
+            lines = [f"{product} User Manual - Revision 3", *lines,
+                     f"Page {p + 1} of {len(pages)} - ACME Robotics Confidential"]
+            escaped = [l.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)") for l in lines]
+            stream = b"BT /F1 10 Tf 12 TL 40 800 Td " + b" ".join(f"({l}) '".encode() for l in escaped) + b" ET"
+            content_id, page_id = 4 + 2 * p, 5 + 2 * p
+            obj(content_id, b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+            obj(page_id, b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Contents %d 0 R "
+                         b"/Resources << /Font << /F1 3 0 R >> >> >>" % content_id)
+            kids.append(page_id)
+        obj(2, b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b" ".join(b"%d 0 R" % k for k in kids), len(kids)))
+        size = max(offsets) + 1
+        xref = out.tell()
+        out.write(b"xref\n0 %d\n0000000000 65535 f \n" % size)
+        out.write(b"".join(b"%010d 00000 n \n" % offsets[n] for n in range(1, size)))
+        out.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (size, xref))
+
+
+def write_html(path: str, product: str, sections: list):
+    parts = [f"<html><head><style>p {{ margin: 0 }}</style></head><body><p class='title'>{product} User Manual</p>"]
+    for heading, paragraphs in sections:
+        level = heading.split(" ", 1)[0].count(".") + 1
+        parts.append(f"<h{level}>{heading}</h{level}>")
+        parts += [f"<p>{p}</p>" for p in paragraphs]
+    Path(path).write_text("".join(parts) + "</body></html>")
+
+
+def build_corpus(count: int, directory: str, revision: int = 1, only=None, without=()):
+    """Drive-like file descriptors; each manual is written as PDF and as HTML."""
+    files = []
+    for i in range(count) if only is None else [only]:
+        product, sections = make_manual(i, without)
+        stem = os.path.join(directory, f"manual-{i}-r{revision}")
+        write_pdf(stem + ".pdf", product, sections)
+        write_html(stem + ".html", product, sections)
+        doc = i % 2 == 1
+        files.append({
+            "id": f"manual-{i}", "name": f"{product} Manual" + ("" if doc else ".pdf"),
+            "mimeType": "application/vnd.google-apps.document" if doc else "application/pdf",
+            "md5Checksum": f"r{revision}", "stem": stem, "perm": "1" if i % 4 < 2 else "3",
+            "sections": [heading for heading, _ in sections],
+        })
+    return files
+
+
+def run_variant(name: str, variant: dict, files: list, args) -> dict:
+    from sqlalchemy import text
+    from agno.vectordb.pgvector import PgVector, SearchType
+    from chunking import simhash
+    from database import get_engine
+    from ingest_pipeline import IngestionPipeline, file_suffix
+
+    embedder = CountingEmbedder(dimensions=args.dimensions)
+    table = "cs_agno_bench_chunking_" + name.replace("+", "_")
+    vector_db = PgVector(table_name=table, schema="ai", db_engine=get_engine(), embedder=embedder,
+                         search_type=SearchType.vector)
+    vector_db.drop()
+    vector_db.create()
+
+    variant = {**variant, "near_duplicate_bits": args.bits if variant["near_duplicate_bits"] is None
+               else variant["near_duplicate_bits"]}
+
+    def pipeline():
+        return IngestionPipeline(
+            vector_db=vector_db, embedder=embedder,
+            fetch=lambda file: _copy(file["stem"] + file_suffix(file, variant["chunking"])),
+            metadata_for=lambda file: {"file_id": file["id"], "file_name": file["name"], "perm": file["perm"],
+                                       "superperm": 0, "allperm": 1, "tenant_id": "Thanos"},
+            workers=args.workers, **variant,
+        )
+
+    report = pipeline().run(files)
+    with vector_db.Session() as sess:
+        rows = sess.execute(text(f"SELECT content, meta_data FROM ai.{table}")).all()
+        size = sess.execute(text(f"SELECT pg_total_relation_size('ai.{table}')")).scalar()
+
+    duplicate_slots = searches = 0
+    for perm in sorted({f["perm"] for f in files}):
+        for heading, _ in SECTIONS:
+            query = heading.split(" ", 1)[1].lower()
+            results = vector_db.search(query, limit=5, filters={"perm": perm})
+            prints = []
+            for doc in results:
+                value = simhash(doc.content.split("\n\n", 1)[-1])
+                if any(bin(value ^ other).count("1") <= 3 for other in prints):
+                    duplicate_slots += 1
+                prints.append(value)
+            searches += 1
+
+    result = {
+        "chunks": len(rows),
+        "parsed": report["chunks"]["parsed"],
+        "nearDuplicates": report["chunks"]["nearDuplicates"],
+        "embeddingCalls": embedder.calls,
+        "tableBytes": size,
+        "avgChunkTokens": round(sum(len(c) for c, _ in rows) / 4 / max(1, len(rows)), 1),
+        "headerFooterChunks": sum("ACME Robotics Confidential" in c or "Revision 3" in c for c, _ in rows),
+        "top5DuplicateSlots": round(duplicate_slots / searches, 2),
+        "coverage": coverage(rows, files),
+    }
+    if variant["near_duplicate_bits"] >= 0:
+        result["update"] = update_check(pipeline, vector_db, table, files, args)
+    return result
+
+
+def _copy(path: str) -> str:
+    """The pipeline deletes what fetch returns, so hand it a copy."""
+    fd, target = tempfile.mkstemp(suffix=Path(path).suffix)
+    with os.fdopen(fd, "wb") as out:
+        out.write(Path(path).read_bytes())
+    return target
+
+
+def coverage(rows, files) -> float:
+    """Share of (manual, section) pairs with a stored chunk holding the section, via file_id or also_in."""
+    lines = {}
+    for content, meta in rows:
+        for owner in [meta["file_id"], *meta.get("also_in", [])]:
+            lines.setdefault(owner, set()).update(content.splitlines())
+    # A section heading starts its chunk, sits in its heading path or (merged small section) in its body
+    pairs = [(f["id"], heading) for f in files for heading in f["sections"]]
+    hits = sum(any(heading in line for line in lines.get(owner, ())) for owner, heading in pairs)
+    return round(hits / len(pairs), 3)
+
+
+def update_check(pipeline, vector_db, table: str, files: list, args) -> dict:
+    """Re-ingests the manual others defer to, without its shared sections; orphans must come back."""
+    from sqlalchemy import text
+    with vector_db.Session() as sess:
+        owner = sess.execute(text(
+            f"SELECT meta_data->>'file_id' FROM ai.{table} WHERE meta_data ? 'also_in' "
+            "GROUP BY 1 ORDER BY count(*) DESC LIMIT 1")).scalar()
+    index = int(owner.split("-")[1])
+    directory = str(Path(files[0]["stem"]).parent)
+    changed = build_corpus(len(files), directory, revision=2, only=index, without=tuple(SHARED))
+    first = pipeline().run(changed)
+    orphaned = [f for f in files if f["id"] in first["orphaned"]]
+    second = pipeline().run(orphaned) if orphaned else {"orphaned": []}
+    current = [changed[0] if f["id"] == owner else f for f in files]
+    with vector_db.Session() as sess:
+        rows = sess.execute(text(f"SELECT content, meta_data FROM ai.{table}")).all()
+    return {"replaced": owner, "orphaned": first["orphaned"], "orphanedAgain": second["orphaned"],
+            "coverage": coverage(rows, current)}
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Structure-aware chunking and near-duplicate elimination")
+    parser.add_argument("--manuals", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--dimensions", type=int, default=768)
+    parser.add_argument("--bits", type=int, default=NEAR_DUPLICATE_BITS, help="NEAR_DUPLICATE_BITS for the dedupe mode")
+    parser.add_argument("--variants", default=",".join(VARIANTS))
+    args = parser.parse_args()
+
+    os.environ["DATABASE_URL"] = bench_database_url()
+    directory = tempfile.mkdtemp(prefix="chunking-bench-")
+    files = build_corpus(args.manuals, directory)
+    report = {"params": vars(args), "variants": {}}
+    for name in args.variants.split(","):
+        report["variants"][name] = run_variant(name, VARIANTS[name], files, args)
+        print(name, json.dumps(report["variants"][name]), file=sys.stderr)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main_cli()
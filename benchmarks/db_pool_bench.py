@@ -0,0 +1,213 @@
+"""
+Cold-start and concurrent latency of the database work in a chat turn, with
+the previous per-object engines and with the shared pool from database.py.
+
+One "turn" is what the agent does against Postgres per message: read the
+session, a permission-filtered vector search and a keyword search, the
+knowledge-version check and the session write. Each mode runs in a fresh
+process:
+
+  legacy   PgVector(db_url=...) and PostgresDb(db_url=...): two engines with
+           their own pools, tables re-checked on every session read/write
+  shared   get_engine() + SessionDb, after database.warm_up() (timed separately)
+
+Reported per mode: process setup, warm-up, the first turn, steady-state
+sequential turns, then --threads concurrent workers (p50/p95/p99, connections
+opened, peak connections in use).
+
+Usage:
+    DATABASE_URL=postgresql+psycopg://... python benchmarks/db_pool_bench.py --threads 8,16
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+import threading
+from pathlib import Path
+from dataclasses import dataclass
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+VECTOR_TABLE = "cs_agno_pool_bench"
+SESSION_TABLE = "cs_agno_pool_bench_sessions"
+DIM = 768
+
+
+def setup(db_url: str, rows: int):
+    from sqlalchemy.dialects import postgresql
+    from agno.vectordb.pgvector import PgVector
+    import permission_index
+
+    rng = np.random.default_rng(3)
+    vector_db = PgVector(table_name=VECTOR_TABLE, schema="ai", db_url=db_url, embedder=_noop_embedder())
+    vector_db.drop()
+    vector_db.create()
+    vectors = rng.standard_normal((rows, DIM)).astype(np.float32)
+    batch = [{
+        "id": f"chunk-{i}", "name": f"doc-{i // 20}", "content": f"manual page {i} compass battery firmware",
+        "meta_data": {"perm": str(1 + i % 3), "superperm": 0, "allperm": 1}, "filters": None,
+        "embedding": vectors[i].tolist(), "usage": None, "content_hash": "h", "content_id": f"doc-{i // 20}",
+    } for i in range(rows)]
+    with vector_db.Session() as sess, sess.begin():
+        sess.execute(postgresql.insert(vector_db.table), batch)
+    permission_index.migrate(vector_db.db_engine, VECTOR_TABLE, min_partition_rows=rows // 10)
+    vector_db.db_engine.dispose()
+
+
+def _noop_embedder():
+    from agno.knowledge.embedder.base import Embedder
+
+    @dataclass
+    class NoopEmbedder(Embedder):
+        dimensions: int = DIM
+
+        def get_embedding(self, text):
+            raise RuntimeError("bench queries pass embeddings directly")
+
+    return NoopEmbedder()
+
+
+def build(mode: str, db_url: str):
+    """(session_db, searcher, version_check, engines) as each mode wires them."""
+    from agno.vectordb.pgvector import PgVector
+    from permission_index import PermissionSearch
+    from rag_cache import get_kb_version
+
+    if mode == "legacy":
+        from agno.db.postgres import PostgresDb
+        vector_db = PgVector(table_name=VECTOR_TABLE, schema="ai", db_url=db_url, embedder=_noop_embedder())
+        session_db = PostgresDb(db_url=db_url, session_table=SESSION_TABLE, db_schema="ai")
+        engines = [vector_db.db_engine, session_db.db_engine]
+    else:
+        import database
+        engine = database.get_engine(db_url)
+        vector_db = PgVector(table_name=VECTOR_TABLE, schema="ai", db_engine=engine, embedder=_noop_embedder())
+        session_db = database.SessionDb(db_engine=engine, session_table=SESSION_TABLE, db_schema="ai")
+        engines = [engine]
+    return session_db, PermissionSearch(vector_db), lambda: get_kb_version(vector_db.db_engine, VECTOR_TABLE), engines
+
+
+def child(mode: str, db_url: str, threads: list, turns: int):
+    from sqlalchemy import event
+
+    started = time.perf_counter()
+    from agno.db.base import SessionType
+    from agno.session.agent import AgentSession
+    session_db, searcher, version_check, engines = build(mode, db_url)
+    setup_seconds = time.perf_counter() - started
+
+    opened, in_use, peak = [0], [0], [0]
+    lock = threading.Lock()
+
+    def on_checkout(*_):
+        with lock:
+            in_use[0] += 1
+            peak[0] = max(peak[0], in_use[0])
+
+    def on_checkin(*_):
+        with lock:
+            in_use[0] -= 1
+
+    for engine in engines:
+        event.listen(engine, "connect", lambda *_: opened.__setitem__(0, opened[0] + 1))
+        event.listen(engine, "checkout", on_checkout)
+        event.listen(engine, "checkin", on_checkin)
+
+    warm_seconds = 0.0
+    if mode == "shared":
+        import database
+        t = time.perf_counter()
+        database.warm_up(engines[0], tables=[("ai", VECTOR_TABLE), ("ai", SESSION_TABLE)])
+        session_db.prepare()
+        searcher.layout()
+        warm_seconds = time.perf_counter() - t
+
+    rng = np.random.default_rng(5)
+    queries = rng.standard_normal((64, DIM)).astype(np.float32).tolist()
+
+    def turn(session_id: str, i: int):
+        session = session_db.get_session(session_id=session_id, session_type=SessionType.AGENT)
+        if session is None:
+            session = AgentSession(session_id=session_id, agent_id="bench", runs=[], created_at=int(time.time()))
+        meta_filter = {"perm": str(1 + i % 3)}
+        searcher.search("compass", queries[i % len(queries)], meta_filter, limit=20)
+        searcher.keyword_search("compass calibration battery", meta_filter, limit=20)
+        version_check()
+        session.session_data = {"turns": i}
+        session_db.upsert_session(session)
+
+    def timed(session_id, i):
+        t = time.perf_counter()
+        turn(session_id, i)
+        return time.perf_counter() - t
+
+    first = timed(f"{mode}-first", 0)
+    sequential = sorted(timed(f"{mode}-seq", i) for i in range(1, turns + 1))
+
+    from metrics import _percentile
+    result = {
+        "mode": mode, "setupMs": round(setup_seconds * 1000, 1), "warmUpMs": round(warm_seconds * 1000, 1),
+        "firstTurnMs": round(first * 1000, 2), "sequentialP50Ms": round(_percentile(sequential, 0.5) * 1000, 2),
+        "concurrent": [],
+    }
+    for workers in threads:
+        latencies, opened_before = [], opened[0]
+        peak[0] = in_use[0]
+
+        def worker(w):
+            for i in range(turns):
+                latencies.append(timed(f"{mode}-w{workers}-{w}", i))
+
+        t = time.perf_counter()
+        pool = [threading.Thread(target=worker, args=(w,)) for w in range(workers)]
+        for th in pool:
+            th.start()
+        for th in pool:
+            th.join()
+        elapsed = time.perf_counter() - t
+        values = sorted(latencies)
+        result["concurrent"].append({
+            "threads": workers, "turnsPerSecond": round(len(values) / elapsed, 1),
+            "p50Ms": round(_percentile(values, 0.5) * 1000, 2), "p95Ms": round(_percentile(values, 0.95) * 1000, 2),
+            "p99Ms": round(_percentile(values, 0.99) * 1000, 2),
+            "connectionsOpened": opened[0] - opened_before, "peakInUse": peak[0],
+        })
+    result["connectionsOpenedTotal"] = opened[0]
+    print(json.dumps(result))
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Cold start and concurrent DB latency, legacy vs shared pool")
+    parser.add_argument("--threads", default="8,16")
+    parser.add_argument("--turns", type=int, default=40, help="turns per worker")
+    parser.add_argument("--rows", type=int, default=3000)
+    parser.add_argument("--child", choices=("legacy", "shared"))
+    args = parser.parse_args()
+    db_url = os.environ["DATABASE_URL"]
+    threads = [int(t) for t in args.threads.split(",")]
+
+    if args.child:
+        child(args.child, db_url, threads, args.turns)
+        return
+
+    setup(db_url, args.rows)
+    results = []
+    for mode in ("legacy", "shared"):
+        out = subprocess.run([sys.executable, __file__, "--child", mode, "--threads", args.threads,
+                              "--turns", str(args.turns)], capture_output=True, text=True, check=True).stdout
+        results.append(json.loads(out.strip().splitlines()[-1]))
+
+    from sqlalchemy import create_engine, text
+    engine = create_engine(db_url)
+    with engine.begin() as conn:
+        conn.execute(text(f"DROP TABLE IF EXISTS ai.{VECTOR_TABLE}"))
+        conn.execute(text(f"DROP TABLE IF EXISTS ai.{SESSION_TABLE}"))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main_cli()
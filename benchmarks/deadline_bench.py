@@ -0,0 +1,202 @@
+"""
+/chat latency percentiles and outcomes with injected dependency slowness,
+with and without request deadlines, hedged model calls and circuit breakers
+(resilience.py). Requests go through the FastAPI app with the fake Gemini and
+the ThanosBE stub (harness.py); every request is the first turn of its own
+session.
+
+  modelTail      --slow-share of model calls take --slow-latency seconds
+                 noDeadline | deadline | deadline+hedge
+  geminiOutage   every model call hangs for 20s
+                 deadline without breaker | deadline with breaker
+  postgresSlow   every vector search sleeps --db-latency seconds in Postgres
+                 (pg_sleep inside the search transaction)
+                 noDeadline | deadline (statement_timeout, then the breaker)
+  thanosbeSlow   ticket requests, ThanosBE answers after --backend-latency seconds
+                 noDeadline | deadline | deadline with breaker
+
+Usage:
+    python benchmarks/deadline_bench.py --requests 60 --concurrency 8 --deadline 3 --out deadlines.json
+"""
+import sys
+import json
+import time
+import asyncio
+import argparse
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from harness import (HashEmbedder, StubThanosBE, bench_database_url, distractor_pages, fake_gemini,
+                     install_embedder, load_eval_set, use_bench_services)
+
+EVAL_SET = Path(__file__).resolve().parent / "retrieval_eval_set.json"
+UNLIMITED = 600.0
+NEVER_OPENS = 10 ** 6
+
+
+def configure(deadline: float, hedge_after: float = 0.0, breaker_failures: int = NEVER_OPENS):
+    import resilience
+    resilience.CHAT_DEADLINE = deadline
+    resilience.MODEL_HEDGE_AFTER = hedge_after
+    # Calls still hanging from the previous variant keep their old pool; this one starts with free workers
+    resilience._call_pool = None
+    resilience._breakers.clear()
+    for name in ("gemini", "postgres", "thanosbe"):
+        resilience._breakers[name] = resilience.CircuitBreaker(name, failures=breaker_failures, reset=30.0)
+
+
+async def post_all(messages, concurrency: int, tag: str):
+    import httpx
+    import main
+    gate = asyncio.Semaphore(concurrency)
+
+    async def one(client, i, message):
+        async with gate:
+            started = time.perf_counter()
+            response = await client.post("/chat", json={
+                "message": message, "conversationId": f"{tag}-{i}", "userId": f"user-{i}",
+                "userRole": "PILOT", "tenantId": "Thanos"})
+            return response.status_code, time.perf_counter() - started
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        return await asyncio.gather(*(one(client, i, m) for i, m in enumerate(messages)))
+
+
+def summary(results) -> dict:
+    from metrics import _percentile
+    statuses = {}
+    for status, _ in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    values = sorted(seconds for _, seconds in results)
+    ok = sorted(seconds for status, seconds in results if status == 200)
+    return {
+        "statuses": statuses,
+        "p50Ms": round(_percentile(values, 0.5) * 1000, 1),
+        "p95Ms": round(_percentile(values, 0.95) * 1000, 1),
+        "p99Ms": round(_percentile(values, 0.99) * 1000, 1),
+        "maxMs": round(values[-1] * 1000, 1),
+        "okP99Ms": round(_percentile(ok, 0.99) * 1000, 1) if ok else None,
+    }
+
+
+def run_variant(name: str, messages, args, model_kwargs: dict, **settings) -> dict:
+    import agents
+    import resilience
+    configure(**settings)
+    model = fake_gemini(latency=args.model_latency, output_tokens=40, **model_kwargs)
+    agents._shared_model = model
+    agents.embedder._cache.clear()
+    for store in agents.loaded_stores():
+        store.search_cache.invalidate()
+    before = resilience.stats()
+    started = time.perf_counter()
+    results = asyncio.run(post_all(messages, args.concurrency, f"{name}-{time.time_ns()}"))
+    report = summary(results)
+    report.update({
+        "wallSeconds": round(time.perf_counter() - started, 1),
+        "modelCalls": model.client.calls,
+        "slowModelCalls": model.client.slow_calls,
+        "hedges": resilience.stats()["hedges"] - before["hedges"],
+        "breakers": {n: g.state for n, g in resilience._breakers.items()},
+    })
+    print(name, json.dumps(report), file=sys.stderr)
+    return report
+
+
+def slow_postgres(seconds: float):
+    """Makes every typed vector search sleep inside its transaction, after its statement_timeout is set."""
+    import permission_index
+    from sqlalchemy import text
+    original = permission_index.bound_statement
+
+    def bound_then_sleep(sess):
+        original(sess)
+        if sess.get_bind().dialect.name == "postgresql":
+            sess.execute(text("SELECT pg_sleep(:s)"), {"s": seconds})
+
+    permission_index.bound_statement = bound_then_sleep
+    return lambda: setattr(permission_index, "bound_statement", original)
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Latency percentiles under dependency slowness")
+    parser.add_argument("--requests", type=int, default=60)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--deadline", type=float, default=3.0, help="CHAT_DEADLINE for the deadline variants")
+    parser.add_argument("--model-latency", type=float, default=0.2)
+    parser.add_argument("--slow-share", type=float, default=0.1)
+    parser.add_argument("--slow-latency", type=float, default=6.0)
+    parser.add_argument("--hedge-after", type=float, default=0.8)
+    parser.add_argument("--db-latency", type=float, default=5.0)
+    parser.add_argument("--backend-latency", type=float, default=8.0)
+    parser.add_argument("--scenarios", default="modelTail,geminiOutage,postgresSlow,thanosbeSlow")
+    parser.add_argument("--out", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    stub = StubThanosBE().start()
+    use_bench_services(bench_database_url(), stub.url)
+    from embedding_service import EMBED_DIMENSIONS
+    install_embedder(HashEmbedder(dimensions=EMBED_DIMENSIONS))
+    import agents
+    import main
+
+    eval_set = json.loads(EVAL_SET.read_text())
+    load_eval_set(agents.vector_db, HashEmbedder(dimensions=EMBED_DIMENSIONS), eval_set,
+                  distractor_pages(eval_set, 1, np.random.default_rng(12)))
+    agents.warm_up()
+    main.init_agent_pool(workers=args.concurrency)
+    main.outbox.start()
+    queries = [q["query"] for q in eval_set["queries"]]
+    messages = [queries[i % len(queries)] for i in range(args.requests)]
+    tail = {"slow_share": args.slow_share, "slow_latency": args.slow_latency}
+    hang = {"slow_share": 1.0, "slow_latency": 20.0}
+    scenarios = set(args.scenarios.split(","))
+    report = {"params": vars(args), "scenarios": {}}
+
+    if "modelTail" in scenarios:
+        report["scenarios"]["modelTail"] = {
+            "noDeadline": run_variant("modelTail.noDeadline", messages, args, tail, deadline=UNLIMITED),
+            "deadline": run_variant("modelTail.deadline", messages, args, tail, deadline=args.deadline),
+            "deadline+hedge": run_variant("modelTail.hedge", messages, args, tail, deadline=args.deadline,
+                                          hedge_after=args.hedge_after),
+        }
+    if "geminiOutage" in scenarios:
+        report["scenarios"]["geminiOutage"] = {
+            "deadline": run_variant("geminiOutage.deadline", messages, args, hang, deadline=args.deadline),
+            "deadline+breaker": run_variant("geminiOutage.breaker", messages, args, hang, deadline=args.deadline,
+                                            breaker_failures=5),
+        }
+    if "postgresSlow" in scenarios:
+        restore = slow_postgres(args.db_latency)
+        report["scenarios"]["postgresSlow"] = {
+            "noDeadline": run_variant("postgresSlow.noDeadline", messages, args, {}, deadline=UNLIMITED),
+            "deadline+breaker": run_variant("postgresSlow.breaker", messages, args, {}, deadline=args.deadline,
+                                            breaker_failures=5),
+        }
+        restore()
+    if "thanosbeSlow" in scenarios:
+        stub.latency = args.backend_latency
+        tickets = [f"Please open a ticket: {m}" for m in messages]
+        report["scenarios"]["thanosbeSlow"] = {
+            "noDeadline": run_variant("thanosbeSlow.noDeadline", tickets, args, {}, deadline=UNLIMITED),
+            "deadline": run_variant("thanosbeSlow.deadline", tickets, args, {}, deadline=args.deadline),
+            "deadline+breaker": run_variant("thanosbeSlow.breaker", tickets, args, {}, deadline=args.deadline,
+                                            breaker_failures=5),
+        }
+        stub.latency = 0.0
+
+    report["deadlineExceeded"] = __import__("resilience").DEADLINE_EXCEEDED.snapshot()
+    main.outbox.stop(timeout=0.1)
+    stub.stop()
+    if args.out:
+        Path(args.out).write_text(json.dumps(report, indent=2))
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,239 @@
+"""
+Checks per-session single flight and duplicate request coalescing through the
+FastAPI app, with the fake Gemini (harness.py) behind the real agent:
+
+  duplicates    --duplicates identical /chat requests per session, all at once
+                (no Idempotency-Key): one turn runs, the rest get its response
+  repeated      the same message sent again to each of those sessions after
+                the first was answered: no key, so it is a new turn
+  retries       one request with an Idempotency-Key, retries with the same key
+                while it runs, and one more after it finished (replayed from the
+                request log)
+  distinct      --distinct different messages to one session at once: every
+                turn runs, one after another, and every one is in the session
+  crossProcess  the same Idempotency-Key requests sent by this process and a
+                second one (this script with --child) at the same moment; the
+                session lock makes one process run the turn and the other
+                replay it
+
+Turns run are counted in process (main.run_chat_turn) and, for the cross-process
+phase, from the runs stored in the session table. Exits non-zero on a failed check.
+
+Usage:
+    python benchmarks/duplicate_requests_check.py --sessions 8 --duplicates 5
+"""
+import os
+import sys
+import json
+import asyncio
+import argparse
+import subprocess
+import threading
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from harness import (HashEmbedder, StubThanosBE, bench_database_url, distractor_pages, fake_gemini,
+                     install_embedder, load_eval_set, use_bench_services)
+
+EVAL_SET = Path(__file__).resolve().parent / "retrieval_eval_set.json"
+
+
+def setup(args, fresh: bool):
+    stub = StubThanosBE().start()
+    use_bench_services(bench_database_url(), stub.url)
+    from embedding_service import EMBED_DIMENSIONS
+    install_embedder(HashEmbedder(dimensions=EMBED_DIMENSIONS))
+    from sqlalchemy import text
+    import agents
+    import main
+    from session_lock import REQUESTS_TABLE
+
+    agents._shared_model = fake_gemini(latency=args.model_latency, output_tokens=args.output_tokens)
+    eval_set = json.loads(EVAL_SET.read_text())
+    if fresh:
+        load_eval_set(agents.vector_db, HashEmbedder(dimensions=EMBED_DIMENSIONS), eval_set,
+                      distractor_pages(eval_set, 1, np.random.default_rng(12)))
+        with agents.engine.begin() as conn:
+            conn.execute(text(f"DROP TABLE IF EXISTS ai.{agents.SESSION_TABLE}"))
+            conn.execute(text(f"DROP TABLE IF EXISTS {agents.history_manager.summary_table}"))
+            conn.execute(text(f"DROP TABLE IF EXISTS {REQUESTS_TABLE}"))
+    agents.warm_up()
+    main.request_log.prepare()
+    main.outbox.start()
+    return stub, [q["query"] for q in eval_set["queries"]]
+
+
+def count_turns():
+    """Wraps main.run_chat_turn; returns {conversationId: turns run in this process}."""
+    import main
+    counts, lock = {}, threading.Lock()
+    original = main.run_chat_turn
+
+    def counted(context, session_id):
+        with lock:
+            counts[session_id] = counts.get(session_id, 0) + 1
+        return original(context, session_id)
+
+    main.run_chat_turn = counted
+    return counts
+
+
+def stored_runs(session_ids) -> dict:
+    from sqlalchemy import text
+    import agents
+    with agents.engine.connect() as conn:
+        rows = conn.execute(text(
+            f"SELECT session_id, jsonb_array_length(COALESCE(runs::jsonb, '[]'::jsonb)) "
+            f"FROM ai.{agents.SESSION_TABLE} WHERE session_id = ANY(:ids)"
+        ), {"ids": list(session_ids)}).all()
+    return {session_id: runs for session_id, runs in rows}
+
+
+async def post_all(requests):
+    """requests: (payload, headers) pairs, sent concurrently; returns (status, body, replayed) per request."""
+    import httpx
+    import main
+
+    async def one(client, payload, headers):
+        response = await client.post("/chat", json=payload, headers=headers)
+        body = response.json() if response.status_code == 200 else None
+        return response.status_code, body, response.headers.get("Idempotent-Replayed") == "true"
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://check", timeout=None) as client:
+        return await asyncio.gather(*(one(client, p, h) for p, h in requests))
+
+
+def payload(session_id: str, message: str, user: str = "user-0") -> dict:
+    return {"message": message, "conversationId": session_id, "userId": user,
+            "userRole": "PILOT", "tenantId": "Thanos"}
+
+
+def check(report: dict, name: str, ok: bool, detail):
+    report["checks"][name] = {"ok": bool(ok), "detail": detail}
+
+
+def run_parent(args):
+    stub, queries = setup(args, fresh=True)
+    import main
+    from session_lock import COALESCED
+    counts = count_turns()
+    report = {"params": vars(args), "checks": {}}
+
+    # duplicates: identical requests, no key
+    sessions = [f"dup-{s}" for s in range(args.sessions)]
+    requests = [(payload(sid, queries[s % len(queries)]), {}) for s, sid in enumerate(sessions)
+                for _ in range(args.duplicates)]
+    results = asyncio.run(post_all(requests))
+    bodies = {}
+    for (p, _), (status, body, _) in zip(requests, results):
+        bodies.setdefault(p["conversationId"], set()).add(json.dumps(body, sort_keys=True))
+    check(report, "duplicates.allOk", all(status == 200 for status, _, _ in results),
+          sorted({status for status, _, _ in results}))
+    check(report, "duplicates.oneTurnPerSession", all(counts.get(sid) == 1 for sid in sessions),
+          {sid: counts.get(sid) for sid in sessions})
+    check(report, "duplicates.sameResponse", all(len(b) == 1 for b in bodies.values()),
+          {sid: len(b) for sid, b in bodies.items()})
+    check(report, "duplicates.replayedHeaders",
+          sum(replayed for _, _, replayed in results) == args.sessions * (args.duplicates - 1),
+          sum(replayed for _, _, replayed in results))
+
+    # repeated: the same message again, after the first was answered
+    again = asyncio.run(post_all([(payload(sid, queries[s % len(queries)]), {}) for s, sid in enumerate(sessions)]))
+    check(report, "repeated.newTurn", all(counts.get(sid) == 2 for sid in sessions),
+          {sid: counts.get(sid) for sid in sessions})
+    check(report, "repeated.notReplayed", all(status == 200 and not replayed for status, _, replayed in again),
+          [(status, replayed) for status, _, replayed in again])
+
+    # retries: same Idempotency-Key while running, then once more after completion
+    sessions = [f"retry-{s}" for s in range(args.sessions)]
+    requests = [(payload(sid, queries[(s + 3) % len(queries)]), {"Idempotency-Key": f"k-{sid}"})
+                for s, sid in enumerate(sessions) for _ in range(args.duplicates)]
+    asyncio.run(post_all(requests))
+    late = asyncio.run(post_all([(payload(sid, queries[(s + 3) % len(queries)]), {"Idempotency-Key": f"k-{sid}"})
+                                 for s, sid in enumerate(sessions)]))
+    check(report, "retries.oneTurnPerSession", all(counts.get(sid) == 1 for sid in sessions),
+          {sid: counts.get(sid) for sid in sessions})
+    check(report, "retries.lateRetryReplayed", all(status == 200 and replayed for status, _, replayed in late),
+          [(status, replayed) for status, _, replayed in late])
+
+    # distinct: different messages to one session at once
+    messages = [queries[i % len(queries)] + f" (case {i})" for i in range(args.distinct)]
+    results = asyncio.run(post_all([(payload("distinct-0", m), {}) for m in messages]))
+    runs = stored_runs(["distinct-0"]).get("distinct-0")
+    check(report, "distinct.allOk", all(status == 200 for status, _, _ in results),
+          sorted({status for status, _, _ in results}))
+    check(report, "distinct.everyTurnRan", counts.get("distinct-0") == args.distinct, counts.get("distinct-0"))
+    check(report, "distinct.noLostTurns", runs == args.distinct, {"storedRuns": runs})
+
+    # crossProcess: the same keyed requests from two processes
+    sessions = [f"cross-{s}" for s in range(args.sessions)]
+    child = subprocess.Popen([sys.executable, __file__, "--child", "--sessions", str(args.sessions),
+                              "--model-latency", str(args.model_latency),
+                              "--output-tokens", str(args.output_tokens)],
+                             stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True, env=os.environ.copy())
+    if child.stdout.readline().strip() != "ready":
+        raise SystemExit("child process failed to start")
+    requests = [(payload(sid, queries[(s + 5) % len(queries)]), {"Idempotency-Key": f"k-{sid}"})
+                for s, sid in enumerate(sessions)]
+    child.stdin.write("go\n")
+    child.stdin.flush()
+    results = asyncio.run(post_all(requests))
+    child_report = json.loads(child.stdout.read())
+    child.wait()
+    runs = stored_runs(sessions)
+    parent_turns = sum(counts.get(sid, 0) for sid in sessions)
+    check(report, "crossProcess.allOk",
+          all(status == 200 for status, _, _ in results) and child_report["statuses"] == {"200": args.sessions},
+          {"parent": sorted({status for status, _, _ in results}), "child": child_report["statuses"]})
+    check(report, "crossProcess.oneTurnPerSession", all(runs.get(sid) == 1 for sid in sessions),
+          {"storedRuns": runs, "parentTurns": parent_turns, "childTurns": child_report["turns"]})
+    check(report, "crossProcess.replayed", parent_turns + child_report["turns"] == args.sessions,
+          {"parentCoalesced": COALESCED.snapshot(), "childCoalesced": child_report["coalesced"]})
+
+    report["coalesced"] = COALESCED.snapshot()
+    report["singleFlight"] = __import__("session_lock").stats()
+    main.outbox.stop()
+    stub.stop()
+    print(json.dumps(report, indent=2))
+    failed = [name for name, result in report["checks"].items() if not result["ok"]]
+    if failed:
+        raise SystemExit(f"failed: {', '.join(failed)}")
+
+
+def run_child(args):
+    stub, queries = setup(args, fresh=False)
+    import main
+    from session_lock import COALESCED
+    counts = count_turns()
+    sessions = [f"cross-{s}" for s in range(args.sessions)]
+    requests = [(payload(sid, queries[(s + 5) % len(queries)]), {"Idempotency-Key": f"k-{sid}"})
+                for s, sid in enumerate(sessions)]
+    print("ready", flush=True)
+    sys.stdin.readline()
+    results = asyncio.run(post_all(requests))
+    statuses = {}
+    for status, _, _ in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    main.outbox.stop()
+    stub.stop()
+    print(json.dumps({"statuses": statuses, "turns": sum(counts.values()), "coalesced": COALESCED.snapshot()}))
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Per-session single flight and duplicate request coalescing")
+    parser.add_argument("--sessions", type=int, default=8)
+    parser.add_argument("--duplicates", type=int, default=5, help="identical requests per session")
+    parser.add_argument("--distinct", type=int, default=6, help="different messages sent to one session at once")
+    parser.add_argument("--model-latency", type=float, default=0.3)
+    parser.add_argument("--output-tokens", type=int, default=40)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    run_child(args) if args.child else run_parent(args)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,167 @@
+"""
+Compares per-text embedding calls with the shared embedding service against a
+local mock embedding API that enforces request and token rate limits.
+
+The mock answers 429 once more than --rpm requests or --tpm tokens arrive in
+a sliding --window (seconds; the real API uses 60). The workload is one
+ingestion run of --chunks chunk texts plus --queries user queries arriving
+concurrently. Reports wall time, API requests, 429s and query latency.
+
+Usage:
+    python benchmarks/embedding_service_bench.py --chunks 300 --queries 60
+"""
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+from collections import deque
+from pathlib import Path
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from agno.knowledge.embedder.base import Embedder
+from embedding_service import BatchingEmbedder, estimate_tokens, is_rate_limit_error
+from metrics import _percentile
+
+
+class RateLimitError(Exception):
+    code = 429
+
+
+class MockEmbeddingAPI:
+    def __init__(self, rpm: int, tpm: int, window: float, latency: float = 0.03, per_text: float = 0.0005):
+        self.rpm, self.tpm, self.window = rpm, tpm, window
+        self.latency, self.per_text = latency, per_text
+        self.calls = deque()  # (time, tokens)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.rejected = 0
+
+    def embed(self, texts):
+        tokens = sum(estimate_tokens(t) for t in texts)
+        with self.lock:
+            now = time.monotonic()
+            while self.calls and self.calls[0][0] < now - self.window:
+                self.calls.popleft()
+            if len(self.calls) + 1 > self.rpm or sum(t for _, t in self.calls) + tokens > self.tpm:
+                self.rejected += 1
+                raise RateLimitError("429 RESOURCE_EXHAUSTED")
+            self.calls.append((now, tokens))
+            self.requests += 1
+        time.sleep(self.latency + self.per_text * len(texts))
+        return [_vector(t) for t in texts], [None] * len(texts)
+
+
+@dataclass
+class MockEmbedder(Embedder):
+    api: MockEmbeddingAPI = None
+    dimensions: int = 8
+
+    def get_embedding_and_usage(self, text):
+        embeddings, usages = self.api.embed([text])
+        return embeddings[0], usages[0]
+
+    def get_embedding(self, text):
+        return self.get_embedding_and_usage(text)[0]
+
+
+def _vector(text):
+    digest = hashlib.md5(text.encode()).digest()
+    return [b / 255 for b in digest[:8]]
+
+
+def naive_call(embedder, text, failures, attempts=5):
+    """What the agent and ingestion did before: one request per text, retried on 429."""
+    for _ in range(attempts):
+        try:
+            return embedder.get_embedding_and_usage(text)
+        except Exception as e:
+            if not is_rate_limit_error(e):
+                raise
+            time.sleep(1.0)
+    failures.append(text)
+    return None
+
+
+def run(label, embed_one, embed_many, chunks, queries, query_gap):
+    latencies = []
+    started = time.perf_counter()
+
+    def ingest():
+        embed_many(chunks)
+
+    def ask(query):
+        t = time.perf_counter()
+        embed_one(query)
+        latencies.append(time.perf_counter() - t)
+
+    ingestion = threading.Thread(target=ingest)
+    ingestion.start()
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        futures = []
+        for query in queries:
+            futures.append(pool.submit(ask, query))
+            time.sleep(query_gap)
+        for f in futures:
+            f.result()
+    ingestion.join()
+    wall = time.perf_counter() - started
+    values = sorted(latencies)
+    return {
+        "mode": label,
+        "seconds": round(wall, 2),
+        "textsPerSecond": round((len(chunks) + len(queries)) / wall, 1),
+        "queryP50": round(_percentile(values, 0.5), 3),
+        "queryP95": round(_percentile(values, 0.95), 3),
+    }
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Benchmark the batching embedding service")
+    parser.add_argument("--chunks", type=int, default=300)
+    parser.add_argument("--queries", type=int, default=60)
+    parser.add_argument("--rpm", type=int, default=20, help="requests allowed per window")
+    parser.add_argument("--tpm", type=int, default=40000, help="tokens allowed per window")
+    parser.add_argument("--window", type=float, default=2.0, help="rate-limit window in seconds")
+    parser.add_argument("--query-gap", type=float, default=0.05)
+    args = parser.parse_args()
+
+    rng = random.Random(3)
+    words = "drone battery compass firmware gps controller propeller calibration flight log".split()
+    chunks = [" ".join(rng.choice(words) for _ in range(160)) + f" #{i}" for i in range(args.chunks)]
+    queries = [f"how do i fix the {rng.choice(words)} {rng.choice(words)}" for _ in range(args.queries)]
+    reports = []
+
+    # Before: one request per text, 8 concurrent embed workers
+    api = MockEmbeddingAPI(args.rpm, args.tpm, args.window)
+    naive, failures = MockEmbedder(api=api), []
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        report = run("per-text", lambda q: naive_call(naive, q, failures),
+                     lambda texts: list(pool.map(lambda t: naive_call(naive, t, failures), texts)),
+                     chunks, queries, args.query_gap)
+    reports.append({**report, "apiRequests": api.requests, "rateLimited": api.rejected, "failedTexts": len(failures)})
+
+    # After: shared service budgeted slightly under the API limits
+    api = MockEmbeddingAPI(args.rpm, args.tpm, args.window)
+    scale = 60.0 / args.window
+    service = BatchingEmbedder(
+        inner=MockEmbedder(api=api), batch_fn=api.embed,
+        requests_per_minute=args.rpm * scale * 0.9, tokens_per_minute=args.tpm * scale * 0.9,
+    )
+    # Burst capacity must fit inside one mock window
+    service.request_bucket.capacity = service.request_bucket.tokens = args.rpm * 0.9
+    service.token_bucket.capacity = service.token_bucket.tokens = args.tpm * 0.9
+    report = run("batched", service.get_embedding, service.get_embeddings_batch_and_usage,
+                 chunks, queries, args.query_gap)
+    reports.append({**report, "apiRequests": api.requests, "rateLimited": api.rejected, "failedTexts": 0})
+
+    print(json.dumps(reports, indent=2))
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,157 @@
+"""
+Per-turn prompt tokens of a scripted 30-turn support conversation, with the
+old history (agno's last 10 runs, tool results included) and with the
+HistoryManager window (recent turns + running summary, HISTORY_TOKEN_BUDGET).
+
+The conversation is built from retrieval_eval_set.json: 24 documentation
+questions, each answered after a search_documentation call whose result is the
+labelled page plus three others (about the size of a packed context), and a few
+follow-ups, a ticket and a closing turn. Runs are stored through agno's
+PostgresDb in a scratch session table, so both sides read what production reads.
+After every turn the summary fold runs synchronously, as the background fold
+would between two user messages.
+
+Prompt tokens = system prompt (prompt.md) + history + the new user message,
+for the first model call of the turn (the 4-chars-per-token estimate).
+
+--summarizer stub keeps the first sentence of every folded user message (no API
+key needed); --summarizer gemini uses the real model.
+
+Usage:
+    DATABASE_URL=postgresql+psycopg://... python benchmarks/history_window_bench.py
+"""
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import argparse
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from sqlalchemy import text
+from agno.db.postgres import PostgresDb
+from agno.models.message import Message
+from agno.run.agent import RunOutput
+from agno.run.base import RunStatus
+from agno.session.agent import AgentSession
+
+import history
+from embedding_service import estimate_tokens
+
+SESSION_TABLE = "cs_agno_history_bench"
+ROOT = Path(__file__).resolve().parent.parent
+EVAL_SET = Path(__file__).resolve().parent / "retrieval_eval_set.json"
+FOLLOW_UPS = {
+    3: "That didn't help, the warning is still there after I restarted everything.",
+    9: "Ok thanks. Can you remind me what you said about the compass earlier?",
+    16: "Got it, I'll try that tomorrow morning before the survey flight.",
+    21: "Our fleet manager is asking, please keep it short.",
+}
+
+
+def script(eval_set: dict) -> list:
+    """[(user message, tool name or None, tool args, tool result, answer)] for 30 turns."""
+    pages = {f"{d['id']}-p{n}": page for d in eval_set["documents"] for n, page in enumerate(d["pages"], start=1)}
+    keys = sorted(pages)
+    turns = [("Hi, I need help with my drone and our account.", None, None, None,
+              "Hello! I'm happy to help. What seems to be the problem?")]
+    for i, q in enumerate(eval_set["queries"]):
+        if len(turns) in FOLLOW_UPS:
+            turns.append((FOLLOW_UPS[len(turns)], None, None, None,
+                          "I understand. Based on what we covered, please repeat the last procedure step by "
+                          "step and tell me exactly which message appears, so I can narrow it down."))
+        relevant = pages[q["relevant"][0]]
+        others = [pages[keys[(i * 3 + k) % len(keys)]] for k in range(1, 4)]
+        result = "\n\n".join([relevant] + [p for p in others if p != relevant])
+        sentence = next(s for s in re.split(r"(?<=\.)\s+", relevant) if q["answer"].lower() in s.lower())
+        answer = (f"According to the documentation: {sentence} Let me know if you want the full procedure or "
+                  "if anything in the app looks different from this description.\nTotalToken: 2100")
+        turns.append((q["query"], "search_documentation", {"query": q["query"]}, result, answer))
+    turns.append(("Please raise a ticket, details confirmed.", "create_support_ticket",
+                  {"title": "Compass and battery warnings", "main_issue": "E-204 persists", "summary": "..."},
+                  "SUCCESS: Ticket details confirmed. Our team will follow up shortly.",
+                  "Your ticket has been created. Our team will follow up shortly."))
+    turns.append(("Thank you, that's all.", "save_conversation_summary",
+                  {"summary": "...", "topic": "Drone support", "main_issue": "E-204"},
+                  "CONVERSATION SUMMARY: ... [Status: Queued for sync.]", "You're welcome, have a safe flight!"))
+    return turns[:30]
+
+
+def run_output(session_id: str, turn: tuple) -> RunOutput:
+    user, tool, args, result, answer = turn
+    messages = [Message(role="user", content=user)]
+    if tool:
+        call_id = f"call_{uuid.uuid4().hex[:8]}"
+        messages.append(Message(role="assistant", tool_calls=[{
+            "id": call_id, "type": "function", "function": {"name": tool, "arguments": json.dumps(args)},
+        }]))
+        messages.append(Message(role="tool", tool_call_id=call_id, tool_name=tool, content=result))
+    messages.append(Message(role="assistant", content=answer))
+    return RunOutput(run_id=str(uuid.uuid4()), agent_id="julley-support", session_id=session_id,
+                     status=RunStatus.completed, messages=messages, created_at=int(time.time()))
+
+
+def stub_summarizer(previous: str, new_turns: str) -> str:
+    asked = [re.split(r"(?<=[.?!])\s", line[len("User: "):])[0] for line in new_turns.splitlines()
+             if line.startswith("User: ")]
+    words = (previous + " User asked: " + "; ".join(asked)).split()
+    return " ".join(words[-history.SUMMARY_WORDS:])
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Per-turn prompt tokens with and without the history window")
+    parser.add_argument("--summarizer", choices=("stub", "gemini"), default="stub")
+    parser.add_argument("--budget", type=int, default=history.TOKEN_BUDGET)
+    args = parser.parse_args()
+
+    if args.summarizer == "gemini":
+        from agents import get_shared_model
+        summarize = history.model_summarizer(get_shared_model)
+    else:
+        summarize = stub_summarizer
+
+    db = PostgresDb(db_url=os.environ["DATABASE_URL"], session_table=SESSION_TABLE, db_schema="ai")
+    manager = history.HistoryManager(db, summarize=summarize, budget=args.budget)
+    system_tokens = estimate_tokens((ROOT / "prompt.md").read_text())
+    session_id = f"bench-{uuid.uuid4().hex[:8]}"
+    session = AgentSession(session_id=session_id, agent_id="julley-support", runs=[], created_at=int(time.time()))
+
+    rows, folds = [], 0
+    for n, turn in enumerate(script(json.loads(EVAL_SET.read_text())), start=1):
+        user_tokens = estimate_tokens(turn[0])
+        started = time.perf_counter()
+        window = manager.build(session_id)
+        build_ms = (time.perf_counter() - started) * 1000
+        rows.append({
+            "turn": n,
+            "before": system_tokens + window.baseline_tokens + user_tokens,
+            "after": system_tokens + window.tokens + user_tokens,
+            "historyBefore": window.baseline_tokens,
+            "historyAfter": window.tokens,
+            "recentTurns": window.verbatim_turns,
+            "summarizedTurns": window.summarized_turns,
+            "buildMs": round(build_ms, 1),
+        })
+        run = run_output(session_id, turn)
+        session.runs.append(run)
+        db.upsert_session(session)
+        # As main.run_chat_turn does: fold from the window this turn was built from, plus its run
+        folds += manager.fold(session_id, window, run)
+
+    with db.db_engine.begin() as conn:
+        conn.execute(text(f"DROP TABLE IF EXISTS ai.{SESSION_TABLE}"))
+        conn.execute(text(f"DROP TABLE IF EXISTS {manager.summary_table}"))
+    before, after = sum(r["before"] for r in rows), sum(r["after"] for r in rows)
+    print(json.dumps({
+        "summarizer": args.summarizer, "budget": args.budget, "systemTokens": system_tokens, "folds": folds,
+        "totalPromptTokens": {"before": before, "after": after, "savedRatio": round(1 - after / before, 3)},
+        "lastTurn": {"before": rows[-1]["before"], "after": rows[-1]["after"]},
+        "turns": rows,
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,106 @@
+"""
+Benchmarks the staged ingestion pipeline on a synthetic corpus.
+
+Downloads are simulated with a fixed latency per file, embeddings come from
+a deterministic fake embedder with a fixed latency per call, and chunks are
+written to PgVector (--pg, uses DATABASE_URL) or discarded. Parsing and
+chunking use the real Agno text reader in the process pool.
+
+Usage:
+    python benchmarks/ingest_pipeline_bench.py --docs 300 --workers 1,4,8
+    DATABASE_URL=... python benchmarks/ingest_pipeline_bench.py --pg
+"""
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import tempfile
+import argparse
+from pathlib import Path
+from dataclasses import dataclass
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from agno.knowledge.embedder.base import Embedder
+from ingest_pipeline import IngestionPipeline
+
+WORDS = ("drone battery firmware calibration controller gps signal flight log compass motor "
+         "propeller telemetry mission waypoint payload camera gimbal sensor altitude").split()
+
+
+@dataclass
+class FakeEmbedder(Embedder):
+    dimensions: int = 768
+    latency: float = 0.01
+
+    def get_embedding_and_usage(self, text):
+        time.sleep(self.latency)
+        seed = int(hashlib.md5(text.encode()).hexdigest()[:8], 16)
+        rng = random.Random(seed)
+        return [rng.uniform(-1, 1) for _ in range(self.dimensions)], {"tokens": len(text) // 4}
+
+    def get_embedding(self, text):
+        return self.get_embedding_and_usage(text)[0]
+
+
+def make_corpus(count: int, words_per_doc: int):
+    rng = random.Random(1)
+    return [
+        {
+            "id": f"doc-{i}", "name": f"manual-{i}.txt", "mimeType": "text/plain",
+            "md5Checksum": f"md5-{i}",
+            "body": " ".join(rng.choice(WORDS) for _ in range(words_per_doc)),
+        }
+        for i in range(count)
+    ]
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Benchmark the ingestion pipeline")
+    parser.add_argument("--docs", type=int, default=300)
+    parser.add_argument("--words", type=int, default=3000, help="words per document")
+    parser.add_argument("--workers", default="1,4,8")
+    parser.add_argument("--download-latency", type=float, default=0.03)
+    parser.add_argument("--embed-latency", type=float, default=0.01)
+    parser.add_argument("--pg", action="store_true", help="write chunks to a PgVector bench table")
+    args = parser.parse_args()
+
+    corpus = make_corpus(args.docs, args.words)
+    temp_dir = tempfile.mkdtemp(prefix="ingest-bench-")
+    embedder = FakeEmbedder(latency=args.embed_latency)
+
+    vector_db = None
+    if args.pg:
+        from agno.vectordb.pgvector import PgVector
+        vector_db = PgVector(table_name="cs_agno_bench_ingest", schema="ai",
+                             db_url=os.environ["DATABASE_URL"], embedder=embedder)
+        vector_db.drop()
+        vector_db.create()
+
+    def fetch(file):
+        time.sleep(args.download_latency)
+        path = os.path.join(temp_dir, f"{file['id']}_{file['name']}")
+        Path(path).write_text(file["body"])
+        return path
+
+    results = []
+    for workers in [int(w) for w in args.workers.split(",")]:
+        pipeline = IngestionPipeline(
+            vector_db=vector_db,
+            embedder=embedder,
+            fetch=fetch,
+            metadata_for=lambda file: {"file_id": file["id"], "perm": "1"},
+            workers=workers,
+            parse_workers=min(workers, os.cpu_count() or 1),
+            write_rows=None if args.pg else (lambda files, rows, links: None),
+        )
+        report = pipeline.run(corpus)
+        results.append({"workers": workers, **report})
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main_cli()
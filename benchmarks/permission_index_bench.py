@@ -0,0 +1,193 @@
+"""
+Latency and recall of permission-scoped vector search before and after the
+permission_index migration, against a local Postgres with pgvector.
+
+For each --sizes entry a bench table is filled with clustered random vectors.
+Permission metadata uses the same mixed types the ingestion writes ("3", 0, 1).
+The same queries are then run in four modes:
+
+  jsonb             meta_data @> filter, no vector index (today's table)
+  jsonb+hnsw ef=5   global HNSW index with agno's default ef_search, then filter
+  jsonb+hnsw ef=100 same, with RAG_HNSW_EF_SEARCH's candidate list
+  typed             PermissionSearch after migrate() (typed columns, partial HNSW)
+
+Permissions under 10% of the table get no partial index here, so the typed
+mode also exercises the exact (btree + sort) route.
+
+Recall@k is measured against exact numpy search over the permitted rows.
+
+Usage:
+    DATABASE_URL=postgresql+psycopg://... python benchmarks/permission_index_bench.py --sizes 10000,100000
+    # Index builds on 1M rows want memory:
+    PGOPTIONS="-c maintenance_work_mem=2GB" python benchmarks/permission_index_bench.py --sizes 1000000
+"""
+import os
+import sys
+import json
+import time
+import argparse
+from pathlib import Path
+from dataclasses import dataclass
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from sqlalchemy import text
+from agno.knowledge.embedder.base import Embedder
+from agno.vectordb.pgvector import PgVector
+
+import permission_index
+from metrics import _percentile
+
+TABLE = "cs_agno_bench_acl"
+# (share of chunks, metadata) - mirrors DOCUMENT_ROLE_MAPPING's mixed value types
+GROUPS = [
+    (0.40, {"perm": "1", "superperm": "1", "allperm": 1}),
+    (0.30, {"perm": "2", "superperm": "2", "allperm": 1}),
+    (0.25, {"perm": 0, "superperm": "1", "allperm": 1}),
+    (0.05, {"perm": "3", "superperm": 0, "allperm": 1}),
+]
+FILTERS = [{"perm": "3"}, {"perm": "1"}, {"superperm": "2"}, {"allperm": 1}]
+
+
+@dataclass
+class NoopEmbedder(Embedder):
+    def get_embedding(self, text):
+        raise RuntimeError("bench queries pass embeddings directly")
+
+
+def make_data(n, dim, rng):
+    centers = rng.standard_normal((256, dim)).astype(np.float32)
+    vectors = centers[rng.integers(0, len(centers), n)] + 0.35 * rng.standard_normal((n, dim)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    shares = np.cumsum([g[0] for g in GROUPS])
+    groups = np.searchsorted(shares, rng.random(n), side="right").clip(0, len(GROUPS) - 1)
+    return vectors, groups
+
+
+def load(vector_db, vectors, groups):
+    vector_db.drop()
+    vector_db.create()
+    raw = vector_db.db_engine.raw_connection()
+    try:
+        with raw.driver_connection.cursor() as cur:
+            with cur.copy(f"COPY ai.{TABLE} (id, name, meta_data, content, embedding, content_hash, content_id) "
+                          "FROM STDIN") as copy:
+                for i, (vec, g) in enumerate(zip(vectors, groups)):
+                    meta = json.dumps({**GROUPS[g][1], "file_id": f"file-{i // 50}"})
+                    vec_text = "[" + ",".join(f"{x:.5f}" for x in vec) + "]"
+                    copy.write_row((f"chunk-{i}", f"doc-{i // 50}", meta, f"chunk {i}", vec_text, "h", f"file-{i // 50}"))
+        raw.driver_connection.commit()
+    finally:
+        raw.close()
+    with vector_db.db_engine.begin() as conn:
+        conn.execute(text(f"ANALYZE ai.{TABLE}"))
+
+
+def allowed_mask(groups, meta_filter):
+    ok = np.zeros(len(GROUPS), dtype=bool)
+    for g, (_, meta) in enumerate(GROUPS):
+        # Typed semantics: "3" and 3 are the same permission
+        ok[g] = all(str(meta.get(k)) == str(v) for k, v in meta_filter.items())
+    return ok[groups]
+
+
+def jsonb_search(vector_db, embedding, meta_filter, limit, ef_search):
+    with vector_db.Session() as sess, sess.begin():
+        sess.execute(text(f"SET LOCAL hnsw.ef_search = {ef_search}"))
+        rows = sess.execute(text(
+            f"SELECT id, name, meta_data, content, embedding, usage FROM ai.{TABLE} WHERE meta_data @> CAST(:f AS jsonb) "
+            "ORDER BY embedding <=> CAST(:q AS vector) LIMIT :k"
+        ), {"f": json.dumps(meta_filter), "q": str(list(map(float, embedding))), "k": limit}).fetchall()
+    return [r.id for r in rows]
+
+
+def measure(name, search, queries, vectors, groups, limit):
+    latencies, recalls, returned = [], [], []
+    for embedding, meta_filter in queries:
+        start = time.perf_counter()
+        ids = search(embedding, meta_filter)
+        latencies.append(time.perf_counter() - start)
+        mask = allowed_mask(groups, meta_filter)
+        candidates = np.flatnonzero(mask)
+        truth = candidates[np.argsort(-(vectors[candidates] @ embedding))[:limit]]
+        truth_ids = {f"chunk-{i}" for i in truth}
+        recalls.append(len(truth_ids & set(ids)) / limit)
+        returned.append(len(ids))
+    values = sorted(latencies)
+    return {
+        "mode": name,
+        "p50ms": round(_percentile(values, 0.5) * 1000, 2),
+        "p95ms": round(_percentile(values, 0.95) * 1000, 2),
+        "recallAtK": round(float(np.mean(recalls)), 3),
+        "avgRowsReturned": round(float(np.mean(returned)), 2),
+        "shortResults": int(sum(r < limit for r in returned)),
+    }
+
+
+def run_size(db_url, n, dim, num_queries, limit, rng):
+    vector_db = PgVector(table_name=TABLE, schema="ai", db_url=db_url, embedder=NoopEmbedder(dimensions=dim))
+    vectors, groups = make_data(n, dim, rng)
+    t = time.perf_counter()
+    load(vector_db, vectors, groups)
+    load_seconds = time.perf_counter() - t
+
+    queries = []
+    for i in range(num_queries):
+        q = vectors[rng.integers(0, n)] + 0.2 * rng.standard_normal(dim).astype(np.float32)
+        queries.append((q / np.linalg.norm(q), FILTERS[i % len(FILTERS)]))
+
+    results = [measure("jsonb", lambda e, f: jsonb_search(vector_db, e, f, limit, 40), queries, vectors, groups, limit)]
+
+    t = time.perf_counter()
+    with vector_db.db_engine.begin() as conn:
+        conn.execute(text(f"CREATE INDEX {TABLE}_hnsw_index ON ai.{TABLE} USING hnsw (embedding vector_cosine_ops) "
+                          f"WITH (m = {permission_index.HNSW_M}, ef_construction = {permission_index.HNSW_EF_CONSTRUCTION})"))
+    global_index_seconds = time.perf_counter() - t
+    for ef in (5, permission_index.EF_SEARCH):
+        results.append(measure(f"jsonb+hnsw ef={ef}", lambda e, f, ef=ef: jsonb_search(vector_db, e, f, limit, ef),
+                               queries, vectors, groups, limit))
+
+    t = time.perf_counter()
+    migration = permission_index.migrate(vector_db.db_engine, TABLE, min_partition_rows=n // 10)
+    migrate_seconds = time.perf_counter() - t
+    searcher = permission_index.PermissionSearch(vector_db)
+    results.append(measure("typed", lambda e, f: [d.id for d in searcher.search("", e.tolist(), f, limit)],
+                           queries, vectors, groups, limit))
+
+    by_filter = {}
+    for meta_filter in FILTERS:
+        subset = [q for q in queries if q[1] == meta_filter]
+        by_filter[json.dumps(meta_filter)] = {
+            r["mode"]: r["recallAtK"] for r in [
+                measure("jsonb+hnsw ef=5", lambda e, f: jsonb_search(vector_db, e, f, limit, 5), subset, vectors, groups, limit),
+                measure("typed", lambda e, f: [d.id for d in searcher.search("", e.tolist(), f, limit)],
+                        subset, vectors, groups, limit),
+            ]
+        }
+    vector_db.drop()
+    return {
+        "chunks": n, "dim": dim, "queries": num_queries,
+        "loadSeconds": round(load_seconds, 1), "globalIndexSeconds": round(global_index_seconds, 1),
+        "migrateSeconds": round(migrate_seconds, 1), "createdIndexes": migration["createdIndexes"],
+        "modes": results, "recallByFilter": by_filter,
+    }
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Benchmark permission-aware vector search")
+    parser.add_argument("--sizes", default="10000,100000")
+    parser.add_argument("--dim", type=int, default=64, help="768 in production; lower keeps index builds short")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--limit", type=int, default=5)
+    args = parser.parse_args()
+
+    db_url = os.environ["DATABASE_URL"]
+    rng = np.random.default_rng(11)
+    report = [run_size(db_url, int(n), args.dim, args.queries, args.limit, rng) for n in args.sizes.split(",")]
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,140 @@
+"""
+Per-turn input tokens, cached tokens and latency of chat turns with three
+system prompt layouts, against the fake Gemini's prefix-caching simulation
+(harness.FakeGeminiClient):
+
+  inline        the user identification block inside prompt.md, right after
+                the Role line (the layout before the prefix/suffix split), so
+                the common prefix of two users' requests is only the core
+                behavior block
+  prefix        the invariant prefix (core behavior + static prompt.md) first,
+                the user block last; implicit caching reuses the prefix
+  contextCache  the same layout with GEMINI_CONTEXT_CACHE=1: the prefix and the
+                tool declarations live in an explicit context cache
+
+Every variant runs the same sessions (different users and roles, a docs
+question per turn, the last turn closing the chat) through the real agent,
+tools and session table. "uncached" is the input the model has to prefill
+(input - cached); with --prefill-tps each uncached token adds to the model's
+time to first token.
+
+Usage:
+    python benchmarks/prompt_prefix_bench.py --sessions 16 --turns 3 --prefill-tps 4000
+"""
+import sys
+import json
+import time
+import argparse
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from harness import (HashEmbedder, StubThanosBE, bench_database_url, distractor_pages, fake_gemini,
+                     install_embedder, load_eval_set, use_bench_services)
+
+EVAL_SET = Path(__file__).resolve().parent / "retrieval_eval_set.json"
+VARIANTS = ("inline", "prefix", "contextCache")
+USERS = [("PILOT", "1", "0", "0"), ("CUSTOMER_SUPPORT", "2", "0", "0"), ("TECHNICIAN", "3", "0", "0"),
+         ("CUSTOMER_ADMIN", "0", "1", "0")]
+
+
+def inline_instructions(user_context: dict) -> list:
+    """The layout before the split: the user block right after prompt.md's first line."""
+    import agents
+    role, rest = agents.get_static_prompt().split("\n", 1)
+    user_block = agents.get_role_template(user_context).render(user_context).rstrip("\n")
+    return [*agents.CORE_BEHAVIOR, f"{role}\n{user_block}\n{rest}"]
+
+
+def run_variant(variant: str, args, queries: list) -> dict:
+    import agents
+    import prompt_cache
+    from metrics import _percentile
+
+    model = fake_gemini(latency=args.model_latency, output_tokens=args.output_tokens,
+                        prefill_tokens_per_second=args.prefill_tps)
+    agents._shared_model = model
+    prompt_cache.CONTEXT_CACHE = variant == "contextCache"
+    prompt_cache.context_cache = prompt_cache.ContextCache()
+    agents.get_instructions = inline_instructions if variant == "inline" else original_instructions
+
+    def session(s: int):
+        role, perm, superperm, allperm = USERS[s % len(USERS)]
+        turns = []
+        for t in range(args.turns):
+            context = {
+                "userName": f"User {s}", "userEmail": f"user{s}@example.com", "userId": f"user-{s}",
+                "userRole": role, "perm": perm, "superperm": superperm, "allperm": allperm,
+                "conversationId": f"prefix-{variant}-{s}", "tenantId": "Thanos",
+            }
+            last = t == args.turns - 1 and args.turns > 1
+            message = "Thanks, that's all for today." if last else queries[(s * args.turns + t) % len(queries)]
+            started = time.perf_counter()
+            window = agents.load_history(context)
+            agent = agents.get_support_team(context, window)
+            response = agent.run(message)
+            turns.append((time.perf_counter() - started, response.metrics))
+        return turns
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = [turn for turns in pool.map(session, range(args.sessions)) for turn in turns]
+    latencies = sorted(seconds for seconds, _ in results)
+    input_tokens = sum(m.input_tokens or 0 for _, m in results)
+    cached = sum(m.cache_read_tokens or 0 for _, m in results)
+    n = len(results)
+    return {
+        "turns": n,
+        "modelCalls": model.client.calls,
+        "inputPerTurn": round(input_tokens / n, 1),
+        "cachedPerTurn": round(cached / n, 1),
+        "uncachedPerTurn": round((input_tokens - cached) / n, 1),
+        "latency": {"p50Ms": round(_percentile(latencies, 0.5) * 1000, 1),
+                    "p95Ms": round(_percentile(latencies, 0.95) * 1000, 1),
+                    "meanMs": round(sum(latencies) / n * 1000, 1)},
+        "contextCache": prompt_cache.context_cache.stats()["lookups"] if variant == "contextCache" else None,
+    }
+
+
+def main_cli():
+    global original_instructions
+    parser = argparse.ArgumentParser(description="Prompt prefix caching: inline vs prefix vs explicit context cache")
+    parser.add_argument("--sessions", type=int, default=16)
+    parser.add_argument("--turns", type=int, default=3)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--model-latency", type=float, default=0.1, help="seconds before prefill starts")
+    parser.add_argument("--prefill-tps", type=float, default=4000, help="uncached prompt tokens per second")
+    parser.add_argument("--output-tokens", type=int, default=60)
+    parser.add_argument("--variants", default=",".join(VARIANTS))
+    args = parser.parse_args()
+
+    stub = StubThanosBE().start()
+    use_bench_services(bench_database_url(), stub.url)
+    from embedding_service import EMBED_DIMENSIONS
+    from sqlalchemy import text
+    install_embedder(HashEmbedder(dimensions=EMBED_DIMENSIONS))
+    import agents
+    import prompt_cache
+
+    eval_set = json.loads(EVAL_SET.read_text())
+    load_eval_set(agents.vector_db, HashEmbedder(dimensions=EMBED_DIMENSIONS), eval_set,
+                  distractor_pages(eval_set, 2, np.random.default_rng(12)))
+    with agents.engine.begin() as conn:
+        conn.execute(text(f"DROP TABLE IF EXISTS ai.{agents.SESSION_TABLE}"))
+    agents.warm_up()
+    original_instructions = agents.get_instructions
+    queries = [q["query"] for q in eval_set["queries"]]
+
+    report = {"params": vars(args), "blockTokens": prompt_cache.block_tokens(), "variants": {}}
+    for variant in args.variants.split(","):
+        report["variants"][variant] = run_variant(variant, args, queries)
+        print(variant, json.dumps(report["variants"][variant]), file=sys.stderr)
+    agents.get_instructions = original_instructions
+    stub.stop()
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main_cli()
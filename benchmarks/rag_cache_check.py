@@ -0,0 +1,123 @@
+"""
+Replays a repetitive support workload through the search_documentation
+caches with a deterministic embedder and an in-memory permissioned corpus.
+
+Reports embedding/result hit rates and embedding calls saved, and checks
+that every chunk served (cached or not) is visible under the requesting
+permission filter, i.e. no cache entry is ever served across filters.
+
+Usage:
+    python benchmarks/rag_cache_check.py --queries 5000
+"""
+import sys
+import json
+import random
+import hashlib
+import argparse
+from pathlib import Path
+from dataclasses import dataclass
+from types import SimpleNamespace
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from agno.knowledge.embedder.base import Embedder
+from rag_cache import CachingEmbedder, SearchResultCache, embedding_stats
+
+FILTERS = [{"perm": "1"}, {"perm": "3"}, {"superperm": "1"}, {"allperm": 1}, {}]
+QUESTIONS = [
+    "how do i calibrate the drone compass",
+    "battery not charging",
+    "how to reset the controller",
+    "firmware update failed",
+    "gps signal lost during flight",
+    "where can i download flight logs",
+]
+PHRASINGS = ["{q}", "{q}?", "  {q} ", "{Q}", "please tell me {q}"]
+
+
+@dataclass
+class HashEmbedder(Embedder):
+    """Deterministic bag-of-words embedder; counts real 'API' calls."""
+
+    dimensions: int = 768
+    calls: int = 0
+
+    def get_embedding(self, text):
+        self.calls += 1
+        vec = np.zeros(self.dimensions, dtype=np.float32)
+        for word in text.lower().replace("?", "").split():
+            seed = int(hashlib.md5(word.encode()).hexdigest()[:8], 16)
+            vec += np.random.default_rng(seed).standard_normal(self.dimensions)
+        return vec.tolist()
+
+    def get_embedding_and_usage(self, text):
+        return self.get_embedding(text), None
+
+
+def build_corpus(embedder, size=300):
+    rng = random.Random(7)
+    docs = []
+    for i in range(size):
+        question = rng.choice(QUESTIONS)
+        meta = rng.choice(FILTERS[:-1])
+        docs.append(SimpleNamespace(
+            id=f"chunk-{i}", content=f"[{json.dumps(meta)}] answer {i} about {question}",
+            meta_data=meta, vec=np.asarray(embedder.inner.get_embedding(question + f" {i}")),
+        ))
+    return docs
+
+
+def search(docs, embedding, meta_filter, limit=5):
+    """Same semantics as PgVector: JSONB containment filter, then cosine order."""
+    candidates = [d for d in docs if all(d.meta_data.get(k) == v for k, v in meta_filter.items())]
+    q = np.asarray(embedding)
+    candidates.sort(key=lambda d: -float(d.vec @ q / (np.linalg.norm(d.vec) * np.linalg.norm(q))))
+    return candidates[:limit]
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Check search_documentation caching")
+    parser.add_argument("--queries", type=int, default=5000)
+    parser.add_argument("--similarity", type=float, default=0.97)
+    args = parser.parse_args()
+
+    embedder = CachingEmbedder(inner=HashEmbedder())
+    docs = build_corpus(embedder)
+    embedder.inner.calls = 0
+    cache = SearchResultCache(similarity=args.similarity)
+
+    rng = random.Random(42)
+    leaks = 0
+    for _ in range(args.queries):
+        question = rng.choice(QUESTIONS)
+        query = rng.choice(PHRASINGS).format(q=question, Q=question.upper())
+        meta_filter = rng.choice(FILTERS)
+
+        embedding = embedder.get_embedding(query)
+        results = cache.get(query, embedding, meta_filter)
+        if results is None:
+            results = search(docs, embedding, meta_filter)
+            cache.put(query, embedding, meta_filter, results)
+
+        # Permission check: every returned chunk must be visible under this filter
+        for doc in results:
+            if any(doc.meta_data.get(k) != v for k, v in meta_filter.items()):
+                leaks += 1
+
+    report = {
+        "queries": args.queries,
+        "embeddingApiCalls": embedder.inner.calls,
+        "embeddingApiCallsWithoutCache": args.queries,
+        "permissionLeaks": leaks,
+        **embedding_stats(),
+        **cache.stats(),
+    }
+    print(json.dumps(report, indent=2))
+    assert leaks == 0, "cached results crossed a permission filter"
+    assert report["embeddingCallsMade"] == embedder.inner.calls
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,478 @@
+"""
+Replays captured chat traffic (TRAFFIC_CAPTURE, traffic_capture.py) against
+a server, to size CHAT_WORKERS and the DB pools before a rollout.
+
+  serve    runs the app on the bench services (harness.py: scratch pgvector
+           database with the labelled manuals, hash embedder, ThanosBE stub)
+           with a fake Gemini that replays the capture: each turn's model
+           calls take the captured latencies (times --model-scale) and issue
+           the captured tool calls
+  replay   sends the captured requests to --target, or to a `serve` process
+           it starts itself. New sessions arrive at their captured times
+           divided by --speed; later turns of a session wait for the previous
+           answer plus the captured think time (also divided by --speed), so
+           the concurrency profile follows the capture. Messages are filler
+           text of the captured length, tagged with the record's index so the
+           fake Gemini finds its turn. Both sides must load the same capture
+           files.
+
+The report has throughput, status codes, latency percentiles and a latency
+histogram (overall and per endpoint), schedule lag, and server resource use
+sampled from /health (agent pool and DB pool peaks) and, for a server it
+started and with psutil installed, CPU and memory. The capture's own numbers
+are printed alongside.
+
+Usage:
+    python benchmarks/replay_traffic.py replay traffic-*.jsonl --speed 2 --out replay.json
+    python benchmarks/replay_traffic.py replay traffic.jsonl --env CHAT_WORKERS=16 --env DB_POOL_SIZE=20
+    python benchmarks/replay_traffic.py serve traffic.jsonl --port 8001
+    python benchmarks/replay_traffic.py replay traffic.jsonl --target http://127.0.0.1:8001
+"""
+import os
+import re
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import tempfile
+import threading
+import subprocess
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from harness import (FakeGeminiClient, HashEmbedder, StubThanosBE, bench_database_url, distractor_pages,
+                     install_embedder, load_eval_set, tool_call, use_bench_services)
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+EVAL_SET = Path(__file__).resolve().parent / "retrieval_eval_set.json"
+MARKER = re.compile(r"\[replay (\d+)\]")
+FILLER = ("how do I calibrate the gimbal before a survey flight and why does the battery warning "
+          "show up after the firmware update on the controller when the drone is in return home mode").split()
+# Upper bounds (seconds) of the latency histogram
+BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+STAGE_COUNT = re.compile(r'^chat_stage_seconds_count\{stage="([^"]+)"\} (\d+)', re.MULTILINE)
+
+
+def load_capture(paths: List[str], limit: int = 0) -> List[dict]:
+    """Records of all capture files in arrival order. serve and replay must see the same list."""
+    records = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    records.sort(key=lambda r: r["t"])
+    return records[:limit] if limit else records
+
+
+def message_for(index: int, record: dict) -> str:
+    """Filler text of the captured length, tagged with the record's index."""
+    words = [f"[replay {index}]"]
+    i = 0
+    while len(" ".join(words)) < record.get("messageChars", 40):
+        words.append(FILLER[i % len(FILLER)])
+        i += 1
+    return " ".join(words)
+
+
+# --- serve ---
+
+class ReplayGeminiClient(FakeGeminiClient):
+    """
+    FakeGeminiClient whose calls follow the captured turns. The turn is the
+    record tagged in the latest user message; its k-th model call waits the
+    k-th captured model latency. The captured tool calls are spread over the
+    turn's first steps (calls of one step run concurrently, as in the app),
+    and the call after the last tool step answers.
+    """
+
+    def __init__(self, records: List[dict], model_scale: float = 1.0, **kwargs):
+        super().__init__(script=lambda message: None, **kwargs)
+        self.records = records
+        self.model_scale = model_scale
+        self._turn_calls: Dict[int, int] = {}
+        self._local = threading.local()
+
+    @staticmethod
+    def _turn(contents) -> tuple:
+        """(record index, message) of the latest tagged user message; earlier ones are history."""
+        for content in reversed(contents):
+            for part in content.parts or []:
+                found = MARKER.search(part.text or "") if content.role == "user" else None
+                if found:
+                    return int(found.group(1)), MARKER.sub("", part.text).strip()
+        return None, ""
+
+    def _steps(self, record: dict) -> List[List[str]]:
+        tools = [name for name, _ in record.get("tools", [])]
+        steps = min(len(tools), max(len(record.get("modelMs", [])) - 1, 1))
+        return [tools[i::steps] for i in range(steps)] if steps else []
+
+    def _reply(self, contents: list, config):
+        from google.genai import types
+        index, message = self._turn(contents)
+        record = self.records[index] if index is not None and index < len(self.records) else None
+        if record is None:
+            self._local.wait = self.latency
+            return super()._reply(contents, config)
+        with self._lock:
+            k = self._turn_calls.get(index, 0)
+            self._turn_calls[index] = k + 1
+        model_ms = record.get("modelMs") or [self.latency * 1000]
+        self._local.wait = model_ms[min(k, len(model_ms) - 1)] / 1000 * self.model_scale
+        self._local.output_tokens = max(1, (record.get("outputTokens") or self.output_tokens) // len(model_ms))
+        parts, usage = super()._reply(contents, config)
+        steps = self._steps(record)
+        offered = self._tool_names(getattr(config, "tools", None)) or {name for step in steps for name in step}
+        calls = [name for name in (steps[k] if k < len(steps) else []) if name in offered]
+        if not calls:
+            return parts, usage
+        with self._lock:
+            for name in calls:
+                self.tool_calls[name] = self.tool_calls.get(name, 0) + 1
+        return [types.Part(function_call=types.FunctionCall(id=f"call_{index}_{k}_{i}", name=name, args=args))
+                for i, (name, args) in enumerate(tool_call(n, message) for n in calls)], usage
+
+    def _first_token_wait(self) -> float:
+        return getattr(self._local, "wait", self.latency)
+
+    def _pad(self, text: str) -> str:
+        words = text.split()
+        target = getattr(self._local, "output_tokens", self.output_tokens)
+        filler = "Let me know if anything in the app looks different from this description.".split()
+        while len(words) < target:
+            words.extend(filler)
+        return " ".join(words[:target])
+
+
+def serve(args):
+    records = load_capture(args.capture, args.limit)
+    stub = StubThanosBE(latency=args.backend_latency).start()
+    use_bench_services(bench_database_url(), stub.url)
+    from embedding_service import EMBED_DIMENSIONS
+    hash_embedder = HashEmbedder(dimensions=EMBED_DIMENSIONS)
+    install_embedder(HashEmbedder(dimensions=EMBED_DIMENSIONS, latency=args.embed_latency))
+
+    import uvicorn
+    from sqlalchemy import text
+    import agents
+    import main
+
+    eval_set = json.loads(EVAL_SET.read_text())
+    load_eval_set(agents.vector_db, hash_embedder, eval_set,
+                  distractor_pages(eval_set, args.distractors, np.random.default_rng(12)))
+    with agents.engine.begin() as conn:
+        conn.execute(text(f"DROP TABLE IF EXISTS ai.{agents.SESSION_TABLE}"))
+        conn.execute(text(f"DROP TABLE IF EXISTS {agents.history_manager.summary_table}"))
+    agents._shared_model = agents.TracedGemini(id=agents.MODEL_ID,
+                                               client=ReplayGeminiClient(records, model_scale=args.model_scale))
+    print(f"Serving {len(records)} captured turns on http://{args.host}:{args.port}", file=sys.stderr)
+    uvicorn.run(main.app, host=args.host, port=args.port, log_level="warning")
+
+
+# --- replay ---
+
+class ServerMonitor:
+    """Peaks of the target's /health pool numbers and, for a local process, its CPU and memory."""
+
+    def __init__(self, client, pid: Optional[int] = None):
+        self.client = client
+        self.process = psutil.Process(pid) if psutil is not None and pid else None
+        self.samples = 0
+        self.agent_pool = {"inFlight": 0, "queued": 0}
+        self.db_pools: Dict[str, dict] = {}
+        self.cpu_percent: List[float] = []
+        self.rss_peak = 0
+        self.threads_peak = 0
+        self._cpu_start = None
+
+    async def sample(self):
+        try:
+            health = (await self.client.get("/health")).json()
+        except Exception:
+            return
+        self.samples += 1
+        pool = health.get("agentPool", {})
+        for key in self.agent_pool:
+            self.agent_pool[key] = max(self.agent_pool[key], pool.get(key, 0))
+        for name, stats in health.get("dbPool", {}).items():
+            peak = self.db_pools.setdefault(name, {"size": stats["size"], "maxOverflow": stats["maxOverflow"],
+                                                   "checkedOut": 0, "overflow": 0})
+            peak["checkedOut"] = max(peak["checkedOut"], stats["checkedOut"])
+            peak["overflow"] = max(peak["overflow"], stats["overflow"])
+        if self.process is not None:
+            if self._cpu_start is None:
+                self._cpu_start = self.process.cpu_times()
+                self.process.cpu_percent()
+            else:
+                self.cpu_percent.append(self.process.cpu_percent())
+            self.rss_peak = max(self.rss_peak, self.process.memory_info().rss)
+            self.threads_peak = max(self.threads_peak, self.process.num_threads())
+
+    async def stage_counts(self) -> Dict[str, int]:
+        """Spans per stage so far, from /metrics: model calls and tool calls the server made."""
+        try:
+            text = (await self.client.get("/metrics")).text
+        except Exception:
+            return {}
+        return {stage: int(n) for stage, n in STAGE_COUNT.findall(text)}
+
+    async def run(self, interval: float, stop: asyncio.Event):
+        while not stop.is_set():
+            await self.sample()
+            try:
+                await asyncio.wait_for(stop.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def report(self, requests: int) -> dict:
+        out = {"healthSamples": self.samples, "agentPoolPeak": self.agent_pool, "dbPoolPeak": self.db_pools}
+        if self.process is not None and self._cpu_start is not None:
+            end = self.process.cpu_times()
+            cpu = (end.user - self._cpu_start.user) + (end.system - self._cpu_start.system)
+            out.update({
+                "cpuSeconds": round(cpu, 2),
+                "cpuMsPerRequest": round(cpu * 1000 / requests, 1) if requests else None,
+                "cpuPercentMean": round(float(np.mean(self.cpu_percent)), 1) if self.cpu_percent else None,
+                "cpuPercentPeak": round(max(self.cpu_percent), 1) if self.cpu_percent else None,
+                "rssPeakMb": round(self.rss_peak / 2 ** 20, 1),
+                "threadsPeak": self.threads_peak,
+            })
+        elif self.process is None:
+            out["process"] = "not measured (external --target, or psutil not installed)"
+        return out
+
+
+def latency_report(seconds: List[float]) -> dict:
+    from metrics import _percentile
+    if not seconds:
+        return {"count": 0}
+    values = sorted(seconds)
+    histogram, low = {}, float("-inf")
+    for bound in BUCKETS + [float("inf")]:
+        label = f"<={bound}s" if bound != float("inf") else f">{BUCKETS[-1]}s"
+        histogram[label] = sum(low < v <= bound for v in values)
+        low = bound
+    return {
+        "count": len(values),
+        "p50Ms": round(_percentile(values, 0.5) * 1000, 1),
+        "p95Ms": round(_percentile(values, 0.95) * 1000, 1),
+        "p99Ms": round(_percentile(values, 0.99) * 1000, 1),
+        "maxMs": round(values[-1] * 1000, 1),
+        "histogram": histogram,
+    }
+
+
+def capture_report(records: List[dict]) -> dict:
+    span = records[-1]["t"] - records[0]["t"] if len(records) > 1 else 0.0
+    statuses: Dict[str, int] = {}
+    for r in records:
+        key = r.get("error") or str(r.get("status"))
+        statuses[key] = statuses.get(key, 0) + 1
+    return {
+        "requests": len(records),
+        "sessions": len({r["session"] for r in records}),
+        "spanSeconds": round(span, 1),
+        "requestsPerSecond": round(len(records) / span, 2) if span else None,
+        "peakConcurrent": max(r.get("concurrent", 1) for r in records),
+        "endpoints": {e: sum(r["endpoint"] == e for r in records) for e in sorted({r["endpoint"] for r in records})},
+        "outcomes": statuses,
+        "latency": latency_report([r["durationMs"] / 1000 for r in records if "durationMs" in r]),
+        "modelCallsPerTurn": round(float(np.mean([len(r.get("modelMs", [])) for r in records])), 2),
+        "toolCallsPerTurn": round(float(np.mean([len(r.get("tools", [])) for r in records])), 2),
+    }
+
+
+async def drive(records: List[dict], target: str, args, pid: Optional[int]) -> dict:
+    import httpx
+    run = f"{int(time.time())}"
+    t0 = records[0]["t"]
+    sessions: Dict[str, List[int]] = {}
+    for i, r in enumerate(records):
+        sessions.setdefault(r["session"], []).append(i)
+    results, lags = [], []
+    active = peak = 0
+
+    async def send(client, i: int, record: dict):
+        nonlocal active, peak
+        payload = {"message": message_for(i, record), "conversationId": f"replay-{run}-{record['session']}",
+                   "userId": f"replay-{record.get('user')}", "userRole": record.get("role", "USER")}
+        headers = {"Idempotency-Key": f"replay-{run}-{i}"} if record.get("idempotencyKey") else {}
+        active += 1
+        peak = max(peak, active)
+        started = time.perf_counter()
+        ttft, status = None, None
+        try:
+            if record["endpoint"] == "chat_stream":
+                async with client.stream("POST", "/chat/stream", json=payload, headers=headers) as response:
+                    status = response.status_code
+                    async for line in response.aiter_lines():
+                        if line == "event: delta" and ttft is None:
+                            ttft = time.perf_counter() - started
+                        elif line == "event: error":
+                            status = "error_event"
+            else:
+                status = (await client.post("/chat", json=payload, headers=headers)).status_code
+        except httpx.HTTPError as e:
+            status = type(e).__name__
+        finally:
+            active -= 1
+        results.append({"endpoint": record["endpoint"], "status": status,
+                        "seconds": time.perf_counter() - started, "ttft": ttft})
+
+    async def session(client, indexes: List[int], start: float):
+        ready = start
+        previous = None
+        for i in indexes:
+            record = records[i]
+            due = start + (record["t"] - t0) / args.speed
+            if previous is not None:
+                # The captured user waited this long after the previous answer
+                think = record["t"] - (previous["t"] + previous.get("durationMs", 0) / 1000)
+                due = max(due, ready + max(think, 0.0) / args.speed)
+            await asyncio.sleep(max(0.0, due - time.perf_counter()))
+            lags.append(max(0.0, time.perf_counter() - due))
+            await send(client, i, record)
+            ready = time.perf_counter()
+            previous = record
+
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    async with httpx.AsyncClient(base_url=target, timeout=args.timeout, limits=limits) as client:
+        monitor = ServerMonitor(client, pid)
+        stop = asyncio.Event()
+        await monitor.sample()
+        stages_before = await monitor.stage_counts()
+        sampler = asyncio.create_task(monitor.run(args.sample_interval, stop))
+        start = time.perf_counter()
+        await asyncio.gather(*(session(client, indexes, start) for indexes in sessions.values()))
+        wall = time.perf_counter() - start
+        stop.set()
+        await sampler
+        await monitor.sample()
+        stages = {k: n - stages_before.get(k, 0) for k, n in (await monitor.stage_counts()).items()}
+
+    statuses: Dict[str, int] = {}
+    for r in results:
+        statuses[str(r["status"])] = statuses.get(str(r["status"]), 0) + 1
+    ok = [r for r in results if r["status"] == 200]
+    by_endpoint = {e: latency_report([r["seconds"] for r in results if r["endpoint"] == e])
+                   for e in sorted({r["endpoint"] for r in results})}
+    ttfts = [r["ttft"] for r in results if r["ttft"] is not None]
+    return {
+        "requests": len(results),
+        "wallSeconds": round(wall, 2),
+        "throughputRps": round(len(results) / wall, 2) if wall else None,
+        "okPerSecond": round(len(ok) / wall, 2) if wall else None,
+        "statuses": statuses,
+        "peakConcurrent": peak,
+        "modelCallsPerTurn": round(stages.get("model", 0) / len(results), 2) if stages else None,
+        "toolCallsPerTurn": round(sum(n for k, n in stages.items() if k.startswith("tool.")) / len(results), 2)
+        if stages else None,
+        "latency": latency_report([r["seconds"] for r in results]),
+        "byEndpoint": by_endpoint,
+        "timeToFirstToken": latency_report(ttfts) if ttfts else None,
+        "scheduleLagMs": {"p50": round(float(np.percentile(lags, 50)) * 1000, 1),
+                          "p95": round(float(np.percentile(lags, 95)) * 1000, 1)} if lags else None,
+        "server": monitor.report(len(results)),
+    }
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(args) -> tuple:
+    """Starts `serve` in a subprocess with the --env overrides; returns (process, url, log path)."""
+    port = free_port()
+    env = dict(os.environ)
+    env.update(kv.split("=", 1) for kv in args.env)
+    cmd = [sys.executable, str(Path(__file__).resolve()), "serve", *args.capture, "--port", str(port),
+           "--model-scale", str(args.model_scale), "--backend-latency", str(args.backend_latency),
+           "--embed-latency", str(args.embed_latency), "--limit", str(args.limit)]
+    server_log = tempfile.NamedTemporaryFile(prefix="replay-server-", suffix=".log", delete=False)
+    process = subprocess.Popen(cmd, env=env, stdout=server_log, stderr=subprocess.STDOUT)
+    url = f"http://127.0.0.1:{port}"
+    import httpx
+    deadline = time.time() + args.startup_timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f"Replay server exited with {process.returncode}, see {server_log.name}")
+        try:
+            if httpx.get(f"{url}/health", timeout=1).status_code == 200:
+                return process, url, server_log.name
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    process.terminate()
+    raise SystemExit(f"Replay server did not start within {args.startup_timeout}s, see {server_log.name}")
+
+
+def replay(args):
+    records = load_capture(args.capture, args.limit)
+    if not records:
+        raise SystemExit("The capture is empty")
+    process, server_log = None, None
+    target = args.target
+    if target is None:
+        process, target, server_log = start_server(args)
+    try:
+        result = asyncio.run(drive(records, target, args, process.pid if process else None))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=30)
+    report = {
+        "params": {"capture": args.capture, "speed": args.speed, "modelScale": args.model_scale,
+                   "target": args.target or "local serve", "env": args.env, "serverLog": server_log},
+        "capture": capture_report(records),
+        "replay": result,
+    }
+    if args.out:
+        Path(args.out).write_text(json.dumps(report, indent=2))
+    else:
+        print(json.dumps(report, indent=2))
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Replay captured chat traffic for capacity planning")
+    commands = parser.add_subparsers(dest="command", required=True)
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("capture", nargs="+", help="TRAFFIC_CAPTURE files")
+    common.add_argument("--limit", type=int, default=0, help="replay only the first N requests")
+    common.add_argument("--model-scale", type=float, default=1.0, help="multiplies the captured model latencies")
+    common.add_argument("--backend-latency", type=float, default=0.0, help="ThanosBE stub latency (seconds)")
+    common.add_argument("--embed-latency", type=float, default=0.0, help="query embedding latency (seconds)")
+
+    srv = commands.add_parser("serve", parents=[common], help="run the app with the replaying fake Gemini")
+    srv.add_argument("--host", default="127.0.0.1")
+    srv.add_argument("--port", type=int, default=8001)
+    srv.add_argument("--distractors", type=int, default=3)
+
+    rep = commands.add_parser("replay", parents=[common], help="send the captured requests")
+    rep.add_argument("--target", help="URL of a running `serve`; by default one is started")
+    rep.add_argument("--speed", type=float, default=1.0, help="2 = arrivals and think times twice as fast")
+    rep.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                     help="environment of the started server, e.g. CHAT_WORKERS=16")
+    rep.add_argument("--timeout", type=float, default=120.0)
+    rep.add_argument("--sample-interval", type=float, default=0.5)
+    rep.add_argument("--startup-timeout", type=float, default=180.0)
+    rep.add_argument("--out", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+    if args.command == "serve":
+        serve(args)
+    else:
+        replay(args)
+
+
+if __name__ == "__main__":
+    main_cli()
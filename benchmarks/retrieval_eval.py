@@ -0,0 +1,115 @@
+"""
+Offline evaluation of search_documentation's retrieval against a small
+labelled set (retrieval_eval_set.json: four manuals with the production
+permission metadata, one chunk per page, 24 queries). Each manual also gets
+--distractors generated pages, mixed from other pages' sentences without the
+labelled answers, so every permission has to be searched rather than read whole.
+
+The set is loaded into a scratch table on a local pgvector and migrated with
+permission_index. Then each query runs with its permission filter in these modes:
+
+  vector top-5          what search_documentation sent before: 5 raw chunks
+  vector+pack           vector candidates, MMR/dedupe, packed to the budget
+  hybrid+pack           vector + full-text candidates (RRF), MMR/dedupe, packed
+
+Reported per mode: recall@k (a query counts when any of its labelled chunks
+is returned; labels list alternatives, such as the same page in two manuals),
+MRR of the first labelled chunk, answer hit rate (the labelled answer text
+survives packing), context tokens
+and retrieval latency. Queries whose answer is missing are listed.
+
+--embedder hash uses a local hashing embedder, so no API key is needed.
+Absolute recall is then lower than with Gemini embeddings, but the modes
+are comparable. --embedder gemini uses the real embedding service.
+
+Usage:
+    DATABASE_URL=postgresql+psycopg://... python benchmarks/retrieval_eval.py --budgets 800,1500
+"""
+import os
+import sys
+import json
+import time
+import argparse
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from agno.vectordb.pgvector import PgVector
+
+import permission_index
+from embedding_service import estimate_tokens
+from metrics import _percentile
+from retrieval import HybridRetriever
+from harness import HashEmbedder, distractor_pages, load_eval_set
+
+TABLE = "cs_agno_retrieval_eval"
+EVAL_SET = Path(__file__).resolve().parent / "retrieval_eval_set.json"
+
+
+def evaluate(name, run, queries, embeddings):
+    latencies, recalled, reciprocal, answered, tokens, misses = [], 0, 0.0, 0, [], []
+    for q, embedding in zip(queries, embeddings):
+        start = time.perf_counter()
+        documents = run(q, embedding)
+        latencies.append(time.perf_counter() - start)
+        ranks = [i for i, d in enumerate(documents, start=1) if d.id in q["relevant"]]
+        context = "\n\n".join(d.content for d in documents)
+        recalled += bool(ranks)
+        reciprocal += 1 / ranks[0] if ranks else 0.0
+        if q["answer"].lower() in context.lower():
+            answered += 1
+        else:
+            misses.append(q["query"])
+        tokens.append(estimate_tokens(context))
+    values = sorted(latencies)
+    return {
+        "mode": name,
+        "recallAtK": round(recalled / len(queries), 3),
+        "mrr": round(reciprocal / len(queries), 3),
+        "answerHitRate": round(answered / len(queries), 3),
+        "avgContextTokens": round(float(np.mean(tokens)), 1),
+        "p50ms": round(_percentile(values, 0.5) * 1000, 2),
+        "p95ms": round(_percentile(values, 0.95) * 1000, 2),
+        "misses": misses,
+    }
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Evaluate hybrid retrieval and context packing offline")
+    parser.add_argument("--embedder", choices=("hash", "gemini"), default="hash")
+    parser.add_argument("--budgets", default="800,1500", help="RAG_CONTEXT_TOKENS values to evaluate")
+    parser.add_argument("--k", type=int, default=5, help="chunks returned per query (max chunks when packing)")
+    parser.add_argument("--distractors", type=int, default=40, help="generated pages per manual")
+    args = parser.parse_args()
+
+    if args.embedder == "gemini":
+        from embedding_service import get_embedding_service
+        embedder = get_embedding_service()
+    else:
+        embedder = HashEmbedder()
+
+    eval_set = json.loads(EVAL_SET.read_text())
+    vector_db = PgVector(table_name=TABLE, schema="ai", db_url=os.environ["DATABASE_URL"], embedder=embedder)
+    distractors = distractor_pages(eval_set, args.distractors, np.random.default_rng(12))
+    chunks = load_eval_set(vector_db, embedder, eval_set, distractors)
+    searcher = permission_index.PermissionSearch(vector_db)
+    queries = eval_set["queries"]
+    embeddings = [embedder.get_embedding(q["query"]) for q in queries]
+
+    results = [evaluate(f"vector top-{args.k}", lambda q, e: searcher.search(q["query"], e, q["filter"], limit=args.k),
+                        queries, embeddings)]
+    for budget in [int(b) for b in args.budgets.split(",")]:
+        for hybrid in (False, True):
+            retriever = HybridRetriever(searcher, context_tokens=budget, max_chunks=args.k, hybrid=hybrid)
+            results.append(evaluate(
+                f"{'hybrid' if hybrid else 'vector'}+pack@{budget}",
+                lambda q, e: retriever.retrieve(q["query"], e, q["filter"]).documents, queries, embeddings,
+            ))
+    vector_db.drop()
+    print(json.dumps({"embedder": args.embedder, "chunks": chunks, "queries": len(queries), "modes": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main_cli()
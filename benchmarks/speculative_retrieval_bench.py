@@ -0,0 +1,138 @@
+"""
+End-to-end chat turn latency with and without speculative retrieval, and with
+sequential vs concurrent tool calls, against the fake Gemini (harness.py).
+
+  baseline      the model is called, asks for search_documentation, the search
+                runs, the model is called again with the results
+  speculative   the message is searched while the history loads and the results
+                go into the first model call, which answers directly
+  twoSearches   the model asks for two searches in one step (the question and a
+                troubleshooting rephrasing), run one after another
+                (TOOL_CALL_WORKERS=1) and concurrently
+
+Turns go through main.run_chat_turn (FAQ cache off): history from the session
+table, the real retriever over the labelled manuals, ThanosBE on a stub. The
+query embedding cache and the search cache are cleared between variants, and
+every variant uses its own sessions.
+
+Usage:
+    python benchmarks/speculative_retrieval_bench.py --sessions 16 --turns 3 --embed-latency 0.05
+"""
+import sys
+import json
+import time
+import argparse
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from harness import (HashEmbedder, StubThanosBE, bench_database_url, distractor_pages, fake_gemini,
+                     install_embedder, load_eval_set, support_script, use_bench_services)
+
+EVAL_SET = Path(__file__).resolve().parent / "retrieval_eval_set.json"
+CLOSING = "Thanks, that's all for today."
+ROLES = ["PILOT", "CUSTOMER_SUPPORT", "TECHNICIAN", "ADMIN"]
+
+
+def two_searches(message: str):
+    call = support_script(message)
+    if call and call[0] == "search_documentation":
+        return [call, ("search_documentation", {"query": f"troubleshooting {message}"})]
+    return call
+
+
+VARIANTS = {
+    "baseline": dict(speculative=False, tool_workers=1, script=support_script),
+    "speculative": dict(speculative=True, tool_workers=1, script=support_script),
+    "twoSearches.sequential": dict(speculative=False, tool_workers=1, script=two_searches),
+    "twoSearches.concurrent": dict(speculative=False, tool_workers=4, script=two_searches),
+}
+
+
+def run_variant(name: str, variant: dict, args, queries: list) -> dict:
+    import agents
+    import main
+    from metrics import _percentile
+
+    model = fake_gemini(latency=args.model_latency, output_tokens=args.output_tokens, script=variant["script"])
+    agents._shared_model = model
+    agents.SPECULATIVE_RETRIEVAL = variant["speculative"]
+    agents.TOOL_CALL_WORKERS = variant["tool_workers"]
+    agents.embedder._cache.clear()
+    agents.search_cache.invalidate()
+
+    def session(s: int):
+        latencies = []
+        for t in range(args.turns):
+            last = t == args.turns - 1 and args.turns > 1
+            context = main.validate_user_context({
+                "message": CLOSING if last else queries[(s * args.turns + t) % len(queries)],
+                "conversationId": f"spec-{name}-{s}", "userRole": ROLES[s % len(ROLES)],
+                "userId": f"user-{s}", "tenantId": "Thanos",
+            })
+            started = time.perf_counter()
+            main.run_chat_turn(context, context["conversationId"])
+            latencies.append((last, time.perf_counter() - started))
+        return latencies
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = [turn for turns in pool.map(session, range(args.sessions)) for turn in turns]
+
+    def summary(values):
+        values = sorted(values)
+        return {"count": len(values), "p50Ms": round(_percentile(values, 0.5) * 1000, 1),
+                "p95Ms": round(_percentile(values, 0.95) * 1000, 1),
+                "meanMs": round(sum(values) / len(values) * 1000, 1)}
+
+    return {
+        "questions": summary([seconds for last, seconds in results if not last]),
+        "all": summary([seconds for _, seconds in results]),
+        "modelCalls": model.client.calls,
+        "toolCalls": dict(model.client.tool_calls),
+    }
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Speculative retrieval and concurrent tool calls: turn latency")
+    parser.add_argument("--sessions", type=int, default=16)
+    parser.add_argument("--turns", type=int, default=3, help="turns per session; the last one closes the chat")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--model-latency", type=float, default=0.3)
+    parser.add_argument("--output-tokens", type=int, default=60)
+    parser.add_argument("--embed-latency", type=float, default=0.05, help="seconds per embedding request")
+    parser.add_argument("--variants", default=",".join(VARIANTS))
+    args = parser.parse_args()
+
+    stub = StubThanosBE().start()
+    use_bench_services(bench_database_url(), stub.url)
+    from embedding_service import EMBED_DIMENSIONS
+    from sqlalchemy import text
+    install_embedder(HashEmbedder(dimensions=EMBED_DIMENSIONS, latency=args.embed_latency))
+    import agents
+    import main
+
+    eval_set = json.loads(EVAL_SET.read_text())
+    load_eval_set(agents.vector_db, HashEmbedder(dimensions=EMBED_DIMENSIONS), eval_set,
+                  distractor_pages(eval_set, 2, np.random.default_rng(12)))
+    with agents.engine.begin() as conn:
+        conn.execute(text(f"DROP TABLE IF EXISTS ai.{agents.SESSION_TABLE}"))
+        conn.execute(text(f"DROP TABLE IF EXISTS {agents.history_manager.summary_table}"))
+    agents.warm_up()
+    main.outbox.start()
+    queries = [q["query"] for q in eval_set["queries"]]
+
+    report = {"params": vars(args), "variants": {}}
+    for name in args.variants.split(","):
+        report["variants"][name] = run_variant(name, VARIANTS[name], args, queries)
+        print(name, json.dumps(report["variants"][name]), file=sys.stderr)
+    report["speculativeSearches"] = agents.SPECULATIVE_SEARCHES.snapshot()
+    main.outbox.stop()
+    stub.stop()
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,505 @@
+"""
+Reproducible scenario benchmarks with every external service replaced by the
+deterministic stand-ins in harness.py (fake Gemini, hash embedder, stub
+ThanosBE, scratch pgvector), so no API key, Drive folder or staging backend
+is needed:
+
+  chat       concurrent sessions through the FastAPI app: the real agent, tools,
+             history window, session store and outbox, with a fake Gemini that
+             searches the docs, raises tickets and saves summaries on script
+  ingest     a synthetic corpus through the ingestion pipeline and embedding
+             service into a pgvector table, for each --ingest-workers value
+  retrieval  the labelled manuals plus distractors; concurrent permission-
+             filtered hybrid searches (query embedding included)
+  faq        first turns through /chat with FAQ_CACHE=1: a cold round, repeats
+             and rewordings, then one source file re-ingested
+  all        each of the above in its own process
+
+Every run prints one JSON document (commit, parameters and results per
+scenario; --out writes it to a file). Compare two of them with `compare`:
+
+    python benchmarks/suite.py all --out before.json
+    git checkout my-branch
+    python benchmarks/suite.py all --out after.json
+    python benchmarks/suite.py compare before.json after.json
+
+The database is BENCH_DATABASE_URL or a local pgserver instance (see harness.py).
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import platform
+import subprocess
+import contextlib
+import threading
+from pathlib import Path
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from harness import (HashEmbedder, StubThanosBE, bench_database_url, distractor_pages, fake_gemini,
+                     install_embedder, load_eval_set, use_bench_services)
+
+ROOT = Path(__file__).resolve().parent.parent
+EVAL_SET = Path(__file__).resolve().parent / "retrieval_eval_set.json"
+SCENARIOS = ("chat", "ingest", "retrieval", "faq")
+CLOSING = "Thanks, that's all for today."
+
+
+def _ms(seconds: float) -> float:
+    return round(seconds * 1000, 2)
+
+
+def _latency(values: list) -> dict:
+    from metrics import _percentile
+    values = sorted(values)
+    return {
+        "count": len(values),
+        "p50Ms": _ms(_percentile(values, 0.50)),
+        "p95Ms": _ms(_percentile(values, 0.95)),
+        "p99Ms": _ms(_percentile(values, 0.99)),
+        "meanMs": _ms(sum(values) / len(values)) if values else 0.0,
+    }
+
+
+# --- chat ---
+
+def run_chat(args) -> dict:
+    stub = StubThanosBE(latency=args.backend_latency).start()
+    use_bench_services(bench_database_url(), stub.url)
+    from embedding_service import EMBED_DIMENSIONS
+    hash_embedder = HashEmbedder(dimensions=EMBED_DIMENSIONS)
+    install_embedder(HashEmbedder(dimensions=EMBED_DIMENSIONS, latency=args.embed_latency))
+
+    import httpx
+    from sqlalchemy import text
+    import agents
+    import database
+    import main
+    import observability
+
+    model = fake_gemini(latency=args.model_latency, output_tokens=args.output_tokens,
+                        tokens_per_second=args.tokens_per_second, prefill_tokens_per_second=args.prefill_tps)
+    agents._shared_model = model
+    eval_set = json.loads(EVAL_SET.read_text())
+    chunks = load_eval_set(agents.vector_db, hash_embedder, eval_set,
+                           distractor_pages(eval_set, args.distractors, np.random.default_rng(12)))
+    with agents.engine.begin() as conn:
+        conn.execute(text(f"DROP TABLE IF EXISTS ai.{agents.SESSION_TABLE}"))
+        conn.execute(text(f"DROP TABLE IF EXISTS {agents.history_manager.summary_table}"))
+    if args.workers:
+        main.init_agent_pool(workers=args.workers)
+    agents.warm_up()
+    main.outbox.start()
+
+    queries = [q["query"] for q in eval_set["queries"]]
+    roles = ["PILOT", "CUSTOMER_SUPPORT", "TECHNICIAN", "ADMIN"]
+    endpoint = "/chat/stream" if args.stream else "/chat"
+    latencies, statuses, errors = [], {}, 0
+
+    async def session(client, sem, s: int):
+        nonlocal errors
+        async with sem:
+            for t in range(args.turns):
+                last = t == args.turns - 1 and args.turns > 1
+                payload = {
+                    "message": CLOSING if last else queries[(s * args.turns + t) % len(queries)],
+                    "conversationId": f"bench-{s}", "userRole": roles[s % len(roles)],
+                    "userId": f"user-{s}", "tenantId": "Thanos",
+                }
+                started = time.perf_counter()
+                response = await client.post(endpoint, json=payload)
+                latencies.append(time.perf_counter() - started)
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+                if response.status_code == 200 and args.stream and "event: error" in response.text:
+                    errors += 1
+
+    async def drive():
+        sem = asyncio.Semaphore(args.concurrency)
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            await asyncio.gather(*(session(client, sem, s) for s in range(args.sessions)))
+
+    started = time.perf_counter()
+    asyncio.run(drive())
+    wall = time.perf_counter() - started
+
+    deadline = time.time() + 30
+    while main.outbox.stats()["queueDepth"] and time.time() < deadline:
+        time.sleep(0.05)
+    main.outbox.stop()
+    stub.stop()
+
+    stages = {
+        key.split("=", 1)[1]: {"count": s["count"], "p50Ms": _ms(s["p50"]), "p95Ms": _ms(s["p95"])}
+        for key, s in observability.STAGE_SECONDS.snapshot().items()
+    }
+    tokens = {}
+    for key, value in main.CHAT_TOKENS.snapshot().items():
+        kind = dict(part.split("=", 1) for part in key.split(","))["kind"]
+        tokens[kind] = tokens.get(kind, 0) + int(value)
+    ttft = main.CHAT_TTFT.snapshot().get("endpoint=chat_stream")
+    turns = args.sessions * args.turns
+    return {
+        "params": {
+            "sessions": args.sessions, "turns": args.turns, "concurrency": args.concurrency,
+            "workers": main.CHAT_WORKERS, "stream": args.stream, "modelLatency": args.model_latency,
+            "outputTokens": args.output_tokens, "tokensPerSecond": args.tokens_per_second,
+            "prefillTokensPerSecond": args.prefill_tps, "embedLatency": args.embed_latency,
+            "backendLatency": args.backend_latency, "chunks": chunks,
+        },
+        "results": {
+            "requests": turns,
+            "ok": statuses.get(200, 0) - errors,
+            "rejected": statuses.get(503, 0),
+            "failed": turns - statuses.get(200, 0) - statuses.get(503, 0) + errors,
+            "wallSeconds": round(wall, 3),
+            "turnsPerSecond": round(turns / wall, 2),
+            "latency": _latency(latencies),
+            "timeToFirstTokenMs": {"p50": _ms(ttft["p50"]), "p95": _ms(ttft["p95"])} if ttft else None,
+            "stages": stages,
+            "modelCalls": model.client.calls,
+            "toolCalls": model.client.tool_calls,
+            "tokens": tokens,
+            "tokensPerTurn": {kind: round(n / turns, 1) for kind, n in tokens.items()},
+            "backendRequests": stub.by_path(),
+            "dbConnectionsOpened": sum(p["opened"] for p in database.pool_stats().values()),
+        },
+    }
+
+
+# --- faq ---
+
+def run_faq(args) -> dict:
+    stub = StubThanosBE(latency=args.backend_latency).start()
+    use_bench_services(bench_database_url(), stub.url)
+    os.environ["FAQ_CACHE"] = "1"
+    os.environ["RAG_CACHE_VERSION_CHECK"] = "0"
+    from embedding_service import EMBED_DIMENSIONS
+    hash_embedder = HashEmbedder(dimensions=EMBED_DIMENSIONS)
+    install_embedder(HashEmbedder(dimensions=EMBED_DIMENSIONS, latency=args.embed_latency))
+
+    import httpx
+    from sqlalchemy import text
+    import agents
+    import main
+    import rag_cache
+
+    model = fake_gemini(latency=args.model_latency, output_tokens=args.output_tokens)
+    agents._shared_model = model
+    eval_set = json.loads(EVAL_SET.read_text())
+    load_eval_set(agents.vector_db, hash_embedder, eval_set,
+                  distractor_pages(eval_set, args.distractors, np.random.default_rng(12)))
+    with agents.engine.begin() as conn:
+        conn.execute(text(f"DROP TABLE IF EXISTS ai.{agents.SESSION_TABLE}"))
+        conn.execute(text(f"DROP TABLE IF EXISTS {agents.history_manager.summary_table}"))
+    agents.warm_up()
+    main.outbox.start()
+
+    # Spread over the manuals, each asked by the role its labelled filter stands for
+    questions = eval_set["queries"][::3][:args.faq_questions]
+    roles = {("perm", "1"): "PILOT", ("perm", "3"): "TECHNICIAN", ("superperm", "1"): "CUSTOMER_ADMIN",
+             ("superperm", "2"): "SENIOR_CS", ("allperm", "1"): "ADMIN"}
+    counter = iter(range(1_000_000))
+
+    def rounds(messages):
+        latencies = []
+        calls_before = model.client.calls
+
+        async def one(client, sem, q, message):
+            async with sem:
+                n = next(counter)
+                payload = {"message": message, "conversationId": f"faq-{n}", "userId": f"u{n:05d}",
+                           "userRole": roles[next(iter((k, str(v)) for k, v in q["filter"].items()))]}
+                started = time.perf_counter()
+                response = await client.post("/chat", json=payload)
+                latencies.append(time.perf_counter() - started)
+                assert response.status_code == 200, response.text
+
+        async def drive():
+            sem = asyncio.Semaphore(args.concurrency)
+            transport = httpx.ASGITransport(app=main.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+                await asyncio.gather(*(one(client, sem, q, m) for q, m in messages))
+
+        asyncio.run(drive())
+        return {"turns": len(messages), "latency": _latency(latencies), "modelCalls": model.client.calls - calls_before}
+
+    def lookups():
+        return {outcome: rag_cache.CACHE_LOOKUPS.total(tier="answers", outcome=outcome)
+                for outcome in ("miss", "exact", "similar")}
+
+    phases = {}
+    phases["cold"] = rounds([(q, q["query"]) for q in questions])
+    before = lookups()
+    # Verbatim repeats, then rewordings that only differ in punctuation or an added greeting
+    warm = [(q, m) for _ in range(args.rounds) for q in questions
+            for m in (q["query"], q["query"].lower().rstrip("?"), f"Hi, {q['query']}")]
+    phases["warm"] = rounds(warm)
+    after = lookups()
+    phases["warm"]["lookups"] = {k: after.get(k, 0) - before.get(k, 0) for k in after}
+
+    reingested = questions[0]["relevant"][0].rsplit("-p", 1)[0]
+    rag_cache.bump_kb_version(agents.engine, agents.TABLE_NAME, file_ids=[reingested])
+    invalidated_before = rag_cache.FAQ_INVALIDATED.total()
+    phases["afterReingest"] = rounds([(q, q["query"]) for q in questions])
+    phases["afterReingest"]["invalidated"] = rag_cache.FAQ_INVALIDATED.total() - invalidated_before
+
+    main.outbox.stop()
+    stub.stop()
+    hit_latency = main.FAQ_HIT_LATENCY.snapshot().get("endpoint=chat")
+    spent = sum(int(v) for v in main.CHAT_TOKENS.snapshot().values())
+    return {
+        "params": {"questions": len(questions), "rounds": args.rounds, "concurrency": args.concurrency,
+                   "modelLatency": args.model_latency, "outputTokens": args.output_tokens,
+                   "embedLatency": args.embed_latency},
+        "results": {
+            **phases,
+            "hitLatencyMs": {"p50": _ms(hit_latency["p50"]), "p95": _ms(hit_latency["p95"])} if hit_latency else None,
+            "tokensSpent": spent,
+            "tokensSaved": int(rag_cache.FAQ_TOKENS_SAVED.total()),
+        },
+    }
+
+
+# --- ingest ---
+
+def run_ingest(args) -> dict:
+    database_url = bench_database_url()
+    use_bench_services(database_url, "http://127.0.0.1:9")
+    from agno.vectordb.pgvector import PgVector
+    from embedding_service import EMBED_DIMENSIONS
+    from ingest_pipeline import IngestionPipeline
+    from ingest_pipeline_bench import make_corpus
+    import database
+
+    embedder = HashEmbedder(dimensions=EMBED_DIMENSIONS, latency=args.embed_latency)
+    vector_db = PgVector(table_name="cs_agno_bench_ingest", schema="ai",
+                         db_engine=database.get_engine(database_url), embedder=embedder)
+    corpus = make_corpus(args.docs, args.words)
+    spool = Path(os.environ["BACKEND_SPOOL_DIR"])
+
+    def fetch(file):
+        time.sleep(args.download_latency)
+        path = spool / f"{file['id']}_{file['name']}"
+        path.write_text(file["body"])
+        return str(path)
+
+    runs = []
+    for workers in [int(w) for w in args.ingest_workers.split(",")]:
+        vector_db.drop()
+        vector_db.create()
+        # A fresh service per run: the rate-limit buckets would otherwise carry the previous run's usage
+        service = install_embedder(embedder)
+        requests_before = sum(service.stats()["requests"].values())
+        throttled_before = service.stats()["throttledSeconds"]
+        pipeline = IngestionPipeline(
+            vector_db=vector_db, embedder=service, fetch=fetch,
+            metadata_for=lambda file: {"file_id": file["id"], "perm": "1", "superperm": 0, "allperm": 0},
+            workers=workers,
+        )
+        report = pipeline.run(corpus)
+        chunks = sum(s["chunks"] for name, s in report["stages"].items() if name == "write")
+        runs.append({
+            "workers": workers,
+            "seconds": report["seconds"],
+            "filesPerSecond": report["filesPerSecond"],
+            "chunksPerSecond": round(chunks / report["seconds"], 1) if report["seconds"] else None,
+            "chunks": chunks,
+            "embedRequests": sum(service.stats()["requests"].values()) - requests_before,
+            "embedThrottledSeconds": round(service.stats()["throttledSeconds"] - throttled_before, 3),
+            "utilization": {name: s["utilization"] for name, s in report["stages"].items()},
+        })
+    vector_db.drop()
+    return {
+        "params": {"docs": args.docs, "words": args.words, "downloadLatency": args.download_latency,
+                   "embedLatency": args.embed_latency},
+        "results": {"runs": runs},
+    }
+
+
+# --- retrieval ---
+
+def run_retrieval(args) -> dict:
+    database_url = bench_database_url()
+    use_bench_services(database_url, "http://127.0.0.1:9")
+    from agno.vectordb.pgvector import PgVector
+    import database
+    from permission_index import PermissionSearch
+    from rag_cache import CachingEmbedder
+    from retrieval import HybridRetriever
+
+    hash_embedder = HashEmbedder()
+    embedder = CachingEmbedder(inner=install_embedder(HashEmbedder(latency=args.embed_latency)))
+    vector_db = PgVector(table_name="cs_agno_bench_retrieval", schema="ai",
+                         db_engine=database.get_engine(database_url), embedder=embedder)
+    eval_set = json.loads(EVAL_SET.read_text())
+    chunks = load_eval_set(vector_db, hash_embedder, eval_set,
+                           distractor_pages(eval_set, args.distractors, np.random.default_rng(12)))
+    retriever = HybridRetriever(PermissionSearch(vector_db))
+    retriever.searcher.layout()
+
+    workload = [q for _ in range(args.rounds) for q in eval_set["queries"]]
+    random.Random(4).shuffle(workload)
+    latencies, cold, warm, hits = [], [], [], [0, 0]
+    seen, lock = set(), threading.Lock()
+
+    def one(q):
+        started = time.perf_counter()
+        embedding = embedder.get_embedding(q["query"])
+        context = retriever.retrieve(q["query"], embedding, q["filter"])
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            (warm if q["query"] in seen else cold).append(elapsed)
+            if q["query"] not in seen:
+                seen.add(q["query"])
+                hits[0] += any(d.id in q["relevant"] for d in context.documents)
+                hits[1] += q["answer"].lower() in context.render().lower()
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(one, workload))
+    wall = time.perf_counter() - started
+    vector_db.drop()
+
+    queries = len(eval_set["queries"])
+    return {
+        "params": {"chunks": chunks, "queries": queries, "rounds": args.rounds, "concurrency": args.concurrency,
+                   "embedLatency": args.embed_latency},
+        "results": {
+            "queriesPerSecond": round(len(workload) / wall, 1),
+            "latency": _latency(latencies),
+            "firstSeen": _latency(cold),
+            "repeated": _latency(warm),
+            "recallAtK": round(hits[0] / queries, 3),
+            "answerHitRate": round(hits[1] / queries, 3),
+        },
+    }
+
+
+# --- output ---
+
+def _git(*cmd) -> str:
+    try:
+        return subprocess.run(["git", *cmd], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def document(scenarios: dict) -> dict:
+    return {
+        "suite": "agno-cs-bench",
+        "schemaVersion": 1,
+        "commit": _git("rev-parse", "--short", "HEAD") or None,
+        "dirty": bool(_git("status", "--porcelain", "--untracked-files=no")),
+        "createdAt": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "scenarios": scenarios,
+    }
+
+
+def flatten(value, prefix: str = "") -> dict:
+    """Numeric leaves as {"a.b.c": value}; list items are labelled by their "workers" field or index."""
+    if isinstance(value, bool) or value is None:
+        return {}
+    if isinstance(value, (int, float)):
+        return {prefix: value}
+    if isinstance(value, dict):
+        items = value.items()
+    elif isinstance(value, list):
+        items = [(f"workers={v['workers']}" if isinstance(v, dict) and "workers" in v else str(i), v)
+                 for i, v in enumerate(value)]
+    else:
+        return {}
+    out = {}
+    for key, child in items:
+        out.update(flatten(child, f"{prefix}.{key}" if prefix else str(key)))
+    return out
+
+
+def compare(before_path: str, after_path: str):
+    before, after = json.loads(Path(before_path).read_text()), json.loads(Path(after_path).read_text())
+    print(f"{'metric':<58} {before.get('commit') or '?':>12} {after.get('commit') or '?':>12} {'change':>9}")
+    for name in sorted(set(before["scenarios"]) & set(after["scenarios"])):
+        old = flatten(before["scenarios"][name]["results"])
+        new = flatten(after["scenarios"][name]["results"])
+        for key in sorted(set(old) & set(new)):
+            change = f"{(new[key] - old[key]) / old[key] * 100:+.1f}%" if old[key] else ""
+            print(f"{name + '.' + key:<58} {old[key]:>12.6g} {new[key]:>12.6g} {change:>9}")
+
+
+def main_cli():
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--out", help="write the JSON document here instead of stdout")
+    chat = common.add_argument_group("chat")
+    chat.add_argument("--sessions", type=int, default=24)
+    chat.add_argument("--turns", type=int, default=3, help="turns per session; the last one closes the chat")
+    chat.add_argument("--concurrency", type=int, default=8, help="sessions in flight / retrieval threads")
+    chat.add_argument("--workers", type=int, default=None, help="agent pool size (CHAT_WORKERS)")
+    chat.add_argument("--stream", action="store_true", help="use /chat/stream")
+    chat.add_argument("--model-latency", type=float, default=0.2, help="seconds before the first token")
+    chat.add_argument("--output-tokens", type=int, default=80)
+    chat.add_argument("--tokens-per-second", type=float, default=0.0, help="0 = whole answer at once")
+    chat.add_argument("--prefill-tps", type=float, default=0.0,
+                      help="uncached prompt tokens per second before the first token (0 = prompt size is free)")
+    chat.add_argument("--backend-latency", type=float, default=0.02)
+    corpus = common.add_argument_group("ingest / retrieval")
+    corpus.add_argument("--embed-latency", type=float, default=0.02, help="seconds per embedding request")
+    corpus.add_argument("--distractors", type=int, default=40, help="generated pages per manual")
+    corpus.add_argument("--docs", type=int, default=40)
+    corpus.add_argument("--words", type=int, default=1500, help="words per document")
+    corpus.add_argument("--download-latency", type=float, default=0.03)
+    corpus.add_argument("--ingest-workers", default="1,4")
+    corpus.add_argument("--rounds", type=int, default=4, help="times each labelled query is asked")
+    corpus.add_argument("--faq-questions", type=int, default=8, help="distinct first-turn questions (faq)")
+
+    parser = argparse.ArgumentParser(description="Deterministic chat, ingestion and retrieval benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+    for name in SCENARIOS + ("all",):
+        commands.add_parser(name, parents=[common])
+    diff = commands.add_parser("compare", help="compare two result documents")
+    diff.add_argument("before")
+    diff.add_argument("after")
+    args = parser.parse_args()
+
+    if args.command == "compare":
+        compare(args.before, args.after)
+        return
+    if args.command == "all":
+        # Separate processes, so one scenario's pools, caches and metrics don't leak into the next
+        passthrough, skip = [], False
+        for arg in sys.argv[2:]:
+            if skip or arg == "--out" or arg.startswith("--out="):
+                skip = arg == "--out"
+                continue
+            passthrough.append(arg)
+        scenarios = {}
+        for name in SCENARIOS:
+            out = subprocess.run([sys.executable, __file__, name, *passthrough],
+                                 capture_output=True, text=True, check=True).stdout
+            scenarios.update(json.loads(out)["scenarios"])
+        result = document(scenarios)
+    else:
+        runner = {"chat": run_chat, "ingest": run_ingest, "retrieval": run_retrieval, "faq": run_faq}[args.command]
+        # agno's logger and the ingestion report print to stdout; keep it for the JSON document
+        with contextlib.redirect_stdout(sys.stderr):
+            result = document({args.command: runner(args)})
+
+    output = json.dumps(result, indent=2)
+    if args.out:
+        Path(args.out).write_text(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,100 @@
+"""
+Checks how /chat routes a tenantId that is not in TENANTS, through the FastAPI
+app with the fake Gemini and the ThanosBE stub (harness.py):
+
+  fallback   by default the turn runs on the default tenant's tables: 200, the
+             session is stored in the default session table, no other tenant
+             store is created, and the /messages callback carries the
+             tenantId the request was sent with
+  strict     with TENANT_STRICT=1 the same request gets a 403
+
+Exits non-zero on a failed check.
+
+Usage:
+    python benchmarks/tenant_routing_check.py
+"""
+import sys
+import json
+import time
+import asyncio
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from harness import (HashEmbedder, StubThanosBE, bench_database_url, distractor_pages, fake_gemini,
+                     install_embedder, load_eval_set, use_bench_services)
+
+EVAL_SET = Path(__file__).resolve().parent / "retrieval_eval_set.json"
+UNCONFIGURED = "Unconfigured-Co"
+
+
+async def post(payload: dict):
+    import httpx
+    import main
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://check", timeout=None) as client:
+        response = await client.post("/chat", json=payload)
+        return response.status_code, response.json()
+
+
+def check(report: dict, name: str, ok: bool, detail):
+    report["checks"][name] = {"ok": bool(ok), "detail": detail}
+
+
+def main_cli():
+    stub = StubThanosBE().start()
+    use_bench_services(bench_database_url(), stub.url)
+    from embedding_service import EMBED_DIMENSIONS
+    install_embedder(HashEmbedder(dimensions=EMBED_DIMENSIONS))
+    from sqlalchemy import text
+    import agents
+    import main
+    import tenancy
+
+    agents._shared_model = fake_gemini(latency=0.01, output_tokens=20)
+    eval_set = json.loads(EVAL_SET.read_text())
+    load_eval_set(agents.vector_db, HashEmbedder(dimensions=EMBED_DIMENSIONS), eval_set,
+                  distractor_pages(eval_set, 1, np.random.default_rng(12)))
+    agents.warm_up()
+    main.request_log.prepare()
+    main.outbox.start()
+    report = {"tenant": UNCONFIGURED, "defaultTenant": tenancy.DEFAULT_TENANT, "checks": {}}
+
+    # fallback: an unconfigured tenant runs on the default tenant's tables
+    session_id = f"tenant-fallback-{time.time_ns()}"
+    payload = {"message": eval_set["queries"][0]["query"], "conversationId": session_id, "userId": "user-0",
+               "userRole": "PILOT", "tenantId": UNCONFIGURED}
+    status, body = asyncio.run(post(payload))
+    check(report, "fallback.ok", status == 200, status)
+    with agents.engine.connect() as conn:
+        stored = conn.execute(text(f"SELECT count(*) FROM ai.{agents.SESSION_TABLE} WHERE session_id = :id"),
+                              {"id": session_id}).scalar()
+    check(report, "fallback.defaultSessionTable", stored == 1, {"rows": stored})
+    stores = [store.tenant for store in agents.loaded_stores()]
+    check(report, "fallback.noOtherStore", stores == [tenancy.DEFAULT_TENANT], stores)
+    deadline = time.time() + 10
+    callbacks = []
+    while not callbacks and time.time() < deadline:
+        callbacks = [b for path, b in list(stub.received) if path == "/messages" and b.get("conversationId") == session_id]
+        time.sleep(0.05)
+    check(report, "fallback.callbackTenant", [b.get("tenantId") for b in callbacks] == [UNCONFIGURED],
+          [b.get("tenantId") for b in callbacks])
+
+    # strict: the same tenant is refused
+    tenancy.TENANT_STRICT = True
+    status, body = asyncio.run(post({**payload, "conversationId": f"tenant-strict-{time.time_ns()}"}))
+    tenancy.TENANT_STRICT = False
+    check(report, "strict.forbidden", status == 403, {"status": status, "body": body})
+
+    main.outbox.stop()
+    stub.stop()
+    print(json.dumps(report, indent=2))
+    failed = [name for name, result in report["checks"].items() if not result["ok"]]
+    if failed:
+        raise SystemExit(f"failed: {', '.join(failed)}")
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,162 @@
+"""
+Permission-filtered search latency and recall as the number of tenants grows,
+with every tenant's chunks in one shared table (tenant_id filter) and with
+one table per tenant (the routing agents.get_store() does).
+
+Each tenant has --rows chunks split over three perm values. For every tenant
+count, --queries random (tenant, perm, vector) searches go through
+PermissionSearch against both layouts. Both tables are migrated with the
+default RAG_PARTIAL_INDEX_MIN_ROWS, as upsert_drive_docs.py does after a sync.
+Reported per layout: p50/p95/p99 latency, how many of the `limit` slots came
+back filled, and recall against an exact in-memory ranking.
+
+Usage:
+    python benchmarks/tenant_search_bench.py --tenants 1,4,16 --rows 2000
+"""
+import sys
+import json
+import time
+import argparse
+from pathlib import Path
+from dataclasses import dataclass
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from harness import bench_database_url
+
+SHARED_TABLE = "cs_agno_tenant_bench_shared"
+TENANT_TABLE = "cs_agno_tenant_bench_t{}"
+PERMS = ("1", "2", "3")
+
+
+def _noop_embedder(dim: int):
+    from agno.knowledge.embedder.base import Embedder
+
+    @dataclass
+    class NoopEmbedder(Embedder):
+        dimensions: int = dim
+
+        def get_embedding(self, text):
+            raise RuntimeError("bench queries pass embeddings directly")
+
+    return NoopEmbedder()
+
+
+def tenant_chunks(tenant: int, rows: int, dim: int):
+    """Deterministic vectors and metadata of one tenant, the same in both layouts."""
+    rng = np.random.default_rng(1000 + tenant)
+    vectors = rng.standard_normal((rows, dim)).astype(np.float32)
+    metas = [{"perm": PERMS[i % 3], "superperm": 0, "allperm": 0, "tenant_id": f"tenant-{tenant}",
+              "file_id": f"t{tenant}-doc-{i // 20}"} for i in range(rows)]
+    return vectors, metas
+
+
+def load(vector_db, tenants, rows: int, dim: int):
+    from sqlalchemy.dialects import postgresql
+    import permission_index
+
+    vector_db.drop()
+    vector_db.create()
+    for tenant in tenants:
+        vectors, metas = tenant_chunks(tenant, rows, dim)
+        batch = [{
+            "id": f"t{tenant}-chunk-{i}", "name": meta["file_id"], "content": f"tenant {tenant} page {i}",
+            "meta_data": meta, "filters": None, "embedding": vectors[i].tolist(), "usage": None,
+            "content_hash": meta["file_id"], "content_id": meta["file_id"],
+        } for i, meta in enumerate(metas)]
+        with vector_db.Session() as sess, sess.begin():
+            for start in range(0, len(batch), 1000):
+                sess.execute(postgresql.insert(vector_db.table), batch[start:start + 1000])
+    permission_index.migrate(vector_db.db_engine, vector_db.table_name, vector_db.schema)
+
+
+def exact_top(tenant: int, perm: str, query: np.ndarray, rows: int, dim: int, limit: int) -> set:
+    vectors, metas = tenant_chunks(tenant, rows, dim)
+    ids = [i for i, meta in enumerate(metas) if meta["perm"] == perm]
+    candidates = vectors[ids]
+    scores = candidates @ query / (np.linalg.norm(candidates, axis=1) * np.linalg.norm(query))
+    return {f"t{tenant}-chunk-{ids[j]}" for j in np.argsort(-scores)[:limit]}
+
+
+def measure(searchers, queries, truth, limit: int) -> dict:
+    from metrics import _percentile
+
+    latencies, filled, hits = [], 0, 0
+    for (tenant, perm, vector), expected in zip(queries, truth):
+        searcher = searchers(tenant)
+        started = time.perf_counter()
+        docs = searcher.search("", vector.tolist(), {"tenant_id": f"tenant-{tenant}", "perm": perm}, limit=limit)
+        latencies.append(time.perf_counter() - started)
+        assert all(d.meta_data["tenant_id"] == f"tenant-{tenant}" for d in docs), "tenant leak"
+        filled += len(docs)
+        hits += len(expected & {d.id for d in docs})
+    values = sorted(latencies)
+    return {
+        "p50Ms": round(_percentile(values, 0.5) * 1000, 2), "p95Ms": round(_percentile(values, 0.95) * 1000, 2),
+        "p99Ms": round(_percentile(values, 0.99) * 1000, 2),
+        "filled": round(filled / (limit * len(queries)), 3), "recall": round(hits / (limit * len(queries)), 3),
+    }
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Search latency vs tenant count: shared table vs per-tenant tables")
+    parser.add_argument("--tenants", default="1,4,16", help="comma separated tenant counts")
+    parser.add_argument("--rows", type=int, default=2000, help="chunks per tenant")
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--limit", type=int, default=5)
+    parser.add_argument("--keep", action="store_true", help="keep the bench tables")
+    args = parser.parse_args()
+
+    from agno.vectordb.pgvector import PgVector
+    from sqlalchemy import text
+    import database
+    from permission_index import PermissionSearch
+
+    engine = database.get_engine(bench_database_url())
+    embedder = _noop_embedder(args.dim)
+
+    def table(name):
+        return PgVector(table_name=name, schema="ai", db_engine=engine, embedder=embedder)
+
+    counts = [int(n) for n in args.tenants.split(",")]
+    routed = []
+    for tenant in range(max(counts)):
+        vector_db = table(TENANT_TABLE.format(tenant))
+        load(vector_db, [tenant], args.rows, args.dim)
+        routed.append(PermissionSearch(vector_db))
+
+    rng = np.random.default_rng(7)
+    results = []
+    for count in counts:
+        shared_db = table(SHARED_TABLE)
+        started = time.perf_counter()
+        load(shared_db, range(count), args.rows, args.dim)
+        load_seconds = time.perf_counter() - started
+        shared = PermissionSearch(shared_db)
+
+        queries = [(int(rng.integers(count)), PERMS[int(rng.integers(3))],
+                    rng.standard_normal(args.dim).astype(np.float32)) for _ in range(args.queries)]
+        truth = [exact_top(t, p, v, args.rows, args.dim, args.limit) for t, p, v in queries]
+        # One untimed pass so both layouts are measured with warm caches
+        measure(lambda t: shared, queries[:20], truth[:20], args.limit)
+        measure(lambda t: routed[t], queries[:20], truth[:20], args.limit)
+        results.append({
+            "tenants": count, "rowsPerTenant": args.rows, "sharedRows": count * args.rows,
+            "sharedLoadSeconds": round(load_seconds, 1),
+            "shared": measure(lambda t: shared, queries, truth, args.limit),
+            "perTenant": measure(lambda t: routed[t], queries, truth, args.limit),
+        })
+        print(json.dumps(results[-1]), file=sys.stderr)
+
+    if not args.keep:
+        with engine.begin() as conn:
+            for name in [SHARED_TABLE] + [TENANT_TABLE.format(t) for t in range(max(counts))]:
+                conn.execute(text(f"DROP TABLE IF EXISTS ai.{name}"))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main_cli()
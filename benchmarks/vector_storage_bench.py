@@ -0,0 +1,180 @@
+"""
+Index size, query latency and recall@k of the compact vector index layouts
+(permission_index.VectorIndex) against the full-precision one, through
+PermissionSearch on a local Postgres with pgvector.
+
+A bench table is filled with clustered synthetic embeddings whose variance
+falls off along the dimensions, like a Matryoshka-trained model's, so that a
+prefix of each vector still ranks (--from-table copies real embeddings
+instead). Permissions come in two groups large enough for partial indexes.
+The table is then converted to each --layouts entry (kind or kind:dimensions)
+with migrate(), and the same queries run unfiltered and per permission.
+
+Per layout: size of all HNSW indexes (what has to stay in memory for fast
+searches) and of the global one, conversion time, p50/p95 latency and
+recall@k with exact rescoring of VECTOR_RESCORE_FACTOR x k candidates, plus
+recall without rescoring (factor 1: the graph's own top k). Recall is
+measured against exact numpy search over the permitted rows. halfvec and
+binary need pgvector >= 0.7 and are skipped on older servers.
+
+Usage:
+    BENCH_DATABASE_URL=postgresql+psycopg://... python benchmarks/vector_storage_bench.py --chunks 20000
+    python benchmarks/vector_storage_bench.py --layouts full,halfvec,binary:768,full:256 --from-table cs_agno_vectordb1
+"""
+import sys
+import json
+import time
+import argparse
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from sqlalchemy import text
+from agno.vectordb.pgvector import PgVector
+
+import permission_index
+from harness import bench_database_url
+from metrics import _percentile
+from permission_index_bench import NoopEmbedder
+
+TABLE = "cs_agno_bench_storage"
+# (share of chunks, metadata)
+GROUPS = [
+    (0.6, {"perm": "1", "superperm": "1", "allperm": 1}),
+    (0.4, {"perm": "2", "superperm": "2", "allperm": 1}),
+]
+FILTERS = [{}, {"perm": "1"}, {"perm": "2"}]
+
+
+def make_data(n, dim, rng):
+    # Leading dimensions carry most of the variance, as in Matryoshka embeddings
+    scale = (1.0 / np.sqrt(1.0 + np.arange(dim) / 32.0)).astype(np.float32)
+    centers = rng.standard_normal((512, dim)).astype(np.float32) * scale
+    vectors = centers[rng.integers(0, len(centers), n)] + 0.4 * rng.standard_normal((n, dim)).astype(np.float32) * scale
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors
+
+
+def read_table(db_url, table, n):
+    vector_db = PgVector(table_name=table, schema="ai", db_url=db_url, embedder=NoopEmbedder(dimensions=1))
+    with vector_db.db_engine.connect() as conn:
+        rows = conn.execute(text(f"SELECT embedding::text FROM ai.{table} LIMIT :n"), {"n": n}).scalars().all()
+    vectors = np.array([json.loads(row) for row in rows], dtype=np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def load(vector_db, vectors, groups):
+    vector_db.drop()
+    vector_db.create()
+    raw = vector_db.db_engine.raw_connection()
+    try:
+        with raw.driver_connection.cursor() as cur:
+            with cur.copy(f"COPY ai.{TABLE} (id, name, meta_data, content, embedding, content_hash, content_id) "
+                          "FROM STDIN") as copy:
+                for i, (vec, g) in enumerate(zip(vectors, groups)):
+                    meta = json.dumps({**GROUPS[g][1], "file_id": f"file-{i // 50}"})
+                    vec_text = "[" + ",".join(f"{x:.6f}" for x in vec) + "]"
+                    copy.write_row((f"chunk-{i}", f"doc-{i // 50}", meta, f"chunk {i}", vec_text, "h", f"file-{i // 50}"))
+        raw.driver_connection.commit()
+    finally:
+        raw.close()
+    with vector_db.db_engine.begin() as conn:
+        conn.execute(text(f"ANALYZE ai.{TABLE}"))
+
+
+def index_sizes(vector_db) -> dict:
+    with vector_db.db_engine.connect() as conn:
+        rows = conn.execute(text(
+            "SELECT indexname, pg_relation_size(format('%I.%I', schemaname, indexname)::regclass) AS bytes "
+            "FROM pg_indexes WHERE schemaname = 'ai' AND tablename = :t AND indexdef LIKE '%USING hnsw%'"
+        ), {"t": TABLE}).all()
+        table_bytes = conn.execute(text(f"SELECT pg_table_size('ai.{TABLE}')")).scalar()
+    return {
+        "hnswBytes": sum(r.bytes for r in rows),
+        "globalIndexBytes": sum(r.bytes for r in rows if r.indexname == f"{TABLE}_hnsw_index"),
+        "hnswIndexes": len(rows),
+        "tableBytes": table_bytes,
+    }
+
+
+def measure(searcher, queries, vectors, groups, limit):
+    latencies, recalls, returned = [], [], []
+    for embedding, meta_filter in queries:
+        start = time.perf_counter()
+        ids = [d.id for d in searcher.search("", embedding.tolist(), meta_filter, limit)]
+        latencies.append(time.perf_counter() - start)
+        allowed = np.ones(len(groups), dtype=bool)
+        for key, value in meta_filter.items():
+            allowed &= np.array([str(GROUPS[g][1][key]) == str(value) for g in range(len(GROUPS))])[groups]
+        candidates = np.flatnonzero(allowed)
+        truth = candidates[np.argsort(-(vectors[candidates] @ embedding))[:limit]]
+        recalls.append(len({f"chunk-{i}" for i in truth} & set(ids)) / limit)
+        returned.append(len(ids))
+    values = sorted(latencies)
+    return {
+        "p50ms": round(_percentile(values, 0.5) * 1000, 2),
+        "p95ms": round(_percentile(values, 0.95) * 1000, 2),
+        "recallAtK": round(float(np.mean(recalls)), 3),
+        "shortResults": int(sum(r < limit for r in returned)),
+    }
+
+
+def run_layout(vector_db, label, n, queries, vectors, groups, args, supported) -> dict:
+    kind, _, dims = label.partition(":")
+    layout = permission_index.VectorIndex(kind, int(dims or 0))
+    if kind != "full" and not supported:
+        return {"layout": label, "skipped": "needs pgvector >= 0.7.0"}
+    t = time.perf_counter()
+    migration = permission_index.migrate(vector_db.db_engine, TABLE, min_partition_rows=n // 10, vector_index=layout)
+    seconds = time.perf_counter() - t
+    result = {"layout": migration["vectorIndex"], "convertSeconds": round(seconds, 1), **index_sizes(vector_db)}
+    searcher = permission_index.PermissionSearch(vector_db)
+    result.update(measure(searcher, queries, vectors, groups, args.limit))
+    if layout.compact(vectors.shape[1]):
+        unscored = measure(permission_index.PermissionSearch(vector_db, rescore_factor=1),
+                           queries, vectors, groups, args.limit)
+        result["recallWithoutRescoring"] = unscored["recallAtK"]
+        result["rescoreFactor"] = searcher.rescore_factor
+    return result
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Benchmark compact vector index layouts")
+    parser.add_argument("--chunks", type=int, default=20000)
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--queries", type=int, default=150)
+    parser.add_argument("--limit", type=int, default=5)
+    parser.add_argument("--layouts", default="full,full:256,halfvec,halfvec:256,binary,binary:384")
+    parser.add_argument("--from-table", help="copy embeddings from this ai.* table instead of generating them")
+    args = parser.parse_args()
+
+    db_url = bench_database_url()
+    rng = np.random.default_rng(17)
+    vectors = read_table(db_url, args.from_table, args.chunks) if args.from_table else make_data(args.chunks, args.dim, rng)
+    n, dim = vectors.shape
+    shares = np.cumsum([g[0] for g in GROUPS])
+    groups = np.searchsorted(shares, rng.random(n), side="right").clip(0, len(GROUPS) - 1)
+    vector_db = PgVector(table_name=TABLE, schema="ai", db_url=db_url, embedder=NoopEmbedder(dimensions=dim))
+    load(vector_db, vectors, groups)
+
+    queries = []
+    for i in range(args.queries):
+        q = vectors[rng.integers(0, n)] + 0.3 * rng.standard_normal(dim).astype(np.float32) / np.sqrt(dim)
+        queries.append((q / np.linalg.norm(q), FILTERS[i % len(FILTERS)]))
+    with vector_db.db_engine.connect() as conn:
+        version = permission_index.pgvector_version(conn)
+
+    report = {"params": vars(args), "chunks": n, "dim": dim, "pgvector": ".".join(map(str, version)), "layouts": []}
+    for label in args.layouts.split(","):
+        result = run_layout(vector_db, label, n, queries, vectors, groups, args,
+                            version >= permission_index.COMPACT_MIN_PGVECTOR)
+        report["layouts"].append(result)
+        print(json.dumps(result), file=sys.stderr)
+    vector_db.drop()
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,361 @@
+import os
+import re
+import json
+import hashlib
+import threading
+from dataclasses import dataclass
+from html.parser import HTMLParser
+from collections import Counter
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+import numpy as np
+
+from embedding_service import estimate_tokens
+
+# --- Structure-aware chunking ---
+# Documents are split into blocks (headings and paragraphs) first: HTML
+# (Google Docs are exported as HTML) and Markdown carry their headings;
+# for PDFs and plain text, numbered ("3.2 Battery care") and all-caps short
+# lines are taken as headings. Chunks follow the sections: a chunk never
+# spans two top-level sections, small sections are packed together, and
+# long ones are split at paragraph then sentence boundaries. Each chunk starts
+# with its heading path, so it still says what it is about on its own.
+#
+# PDF page headers and footers (a line near the top or bottom of a page that
+# repeats on most pages, page numbers ignored) are dropped before chunking.
+#
+#   INGEST_CHUNKING=structure     structure-aware chunks ("pages": the previous
+#                                 per-page chunks, Google Docs exported as PDF)
+#   CHUNK_MAX_TOKENS=400          estimated tokens per chunk, heading path included
+#   CHUNK_MIN_TOKENS=80           smaller sections share a chunk with the next one
+#   BOILERPLATE_PAGE_SHARE=0.5    share of pages a header/footer line must repeat on
+
+CHUNKING = os.getenv("INGEST_CHUNKING", "structure").lower()
+CHUNK_MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", "400"))
+CHUNK_MIN_TOKENS = int(os.getenv("CHUNK_MIN_TOKENS", "80"))
+BOILERPLATE_PAGE_SHARE = float(os.getenv("BOILERPLATE_PAGE_SHARE", "0.5"))
+# Lines this close to a page's top or bottom can be running headers/footers
+EDGE_LINES = 3
+# Headers/footers are learned from this many leading pages of a PDF (the rest is streamed)
+BOILERPLATE_SAMPLE_PAGES = 30
+BOILERPLATE_MIN_PAGES = 3
+
+STRUCTURED_SUFFIXES = {".html", ".htm", ".md", ".markdown", ".txt"}
+
+_NUMBERED_HEADING = re.compile(r"^(\d+(?:\.\d+)*)\.?\s+\S")
+_MARKDOWN_HEADING = re.compile(r"^(#{1,6})\s+(.*?)\s*#*$")
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+_DIGITS = re.compile(r"\d+")
+
+@dataclass
+class Block:
+    text: str
+    level: int = 0  # 1-6 for headings, 0 for body text
+    page: Optional[int] = None
+
+def _heading_level(line: str) -> int:
+    """Heading level of a line of PDF or plain text, 0 if it reads as body text."""
+    words = line.split()
+    if not words or len(words) > 10 or line.endswith((".", ",", ";", ":")):
+        return 0
+    numbered = _NUMBERED_HEADING.match(line)
+    if numbered and len(words) > 1:
+        return min(6, numbered.group(1).count(".") + 1)
+    letters = [c for c in line if c.isalpha()]
+    if len(letters) >= 4 and len(words) <= 8 and all(c.isupper() for c in letters):
+        return 1
+    return 0
+
+def text_blocks(text: str, page: Optional[int] = None) -> List[Block]:
+    """Blocks of PDF page or plain text: heading lines, and paragraphs split at blank lines."""
+    blocks, paragraph = [], []
+
+    def close():
+        if paragraph:
+            blocks.append(Block(" ".join(paragraph), page=page))
+            paragraph.clear()
+
+    for raw in text.splitlines():
+        line = " ".join(raw.split())
+        if not line:
+            close()
+            continue
+        level = _heading_level(line)
+        if level:
+            close()
+            blocks.append(Block(line, level, page))
+        else:
+            paragraph.append(line)
+    close()
+    return blocks
+
+def markdown_blocks(text: str) -> List[Block]:
+    blocks, paragraph = [], []
+    for raw in text.splitlines():
+        line = raw.strip()
+        heading = _MARKDOWN_HEADING.match(line)
+        if heading or not line:
+            if paragraph:
+                blocks.append(Block(" ".join(paragraph)))
+                paragraph = []
+            if heading and heading.group(2):
+                blocks.append(Block(heading.group(2), len(heading.group(1))))
+        else:
+            paragraph.append(line)
+    if paragraph:
+        blocks.append(Block(" ".join(paragraph)))
+    return blocks
+
+class _HTMLBlocks(HTMLParser):
+    HEADINGS = {f"h{n}": n for n in range(1, 7)}
+    # Elements whose end closes a block of text
+    BREAKS = {"p", "div", "li", "tr", "td", "th", "br", "table", "ul", "ol", "blockquote", "pre", "title"}
+    SKIP = {"script", "style", "head"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.blocks: List[Block] = []
+        self._text: List[str] = []
+        self._level = 0
+        self._skip = 0
+
+    def _close(self):
+        text = " ".join("".join(self._text).split())
+        self._text = []
+        if text:
+            self.blocks.append(Block(text, self._level))
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP:
+            self._skip += 1
+        elif tag in self.HEADINGS:
+            self._close()
+            self._level = self.HEADINGS[tag]
+        elif tag in self.BREAKS:
+            self._close()
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP:
+            self._skip = max(0, self._skip - 1)
+        elif tag in self.HEADINGS:
+            self._close()
+            self._level = 0
+        elif tag in self.BREAKS:
+            self._close()
+
+    def handle_data(self, data):
+        if not self._skip:
+            self._text.append(data)
+
+def html_blocks(html: str) -> List[Block]:
+    parser = _HTMLBlocks()
+    parser.feed(html)
+    parser.close()
+    parser._close()
+    return parser.blocks
+
+def _line_key(line: str) -> str:
+    """Header/footer comparison key: page numbers and spacing don't count."""
+    return _DIGITS.sub("#", " ".join(line.split()).lower())
+
+def boilerplate_lines(pages: List[str], share: float = BOILERPLATE_PAGE_SHARE) -> Set[str]:
+    """Keys of lines at the top or bottom of at least `share` of the pages (running headers/footers)."""
+    if len(pages) < BOILERPLATE_MIN_PAGES:
+        return set()
+    seen = Counter()
+    for text in pages:
+        lines = [line for line in text.splitlines() if line.strip()]
+        seen.update({_line_key(line) for line in lines[:EDGE_LINES] + lines[-EDGE_LINES:]})
+    return {key for key, count in seen.items() if count >= max(2, share * len(pages))}
+
+def strip_boilerplate(text: str, boilerplate: Set[str]) -> str:
+    if not boilerplate:
+        return text
+    lines = text.splitlines()
+    content = [i for i, line in enumerate(lines) if line.strip()]
+    edges = set(content[:EDGE_LINES] + content[-EDGE_LINES:])
+    return "\n".join(line for i, line in enumerate(lines) if i not in edges or _line_key(line) not in boilerplate)
+
+def _split_long(text: str, max_tokens: int) -> List[str]:
+    """Splits a paragraph over max_tokens at sentence ends (or words, for run-on text)."""
+    pieces, current = [], ""
+    for sentence in _SENTENCE_END.split(text):
+        while estimate_tokens(sentence) > max_tokens:
+            cut = sentence.rfind(" ", 0, max_tokens * 4)
+            cut = cut if cut > 0 else max_tokens * 4
+            head, sentence = sentence[:cut], sentence[cut:].lstrip()
+            if current:
+                pieces.append(current)
+                current = ""
+            pieces.append(head)
+        candidate = f"{current} {sentence}".strip()
+        if current and estimate_tokens(candidate) > max_tokens:
+            pieces.append(current)
+            current = sentence
+        else:
+            current = candidate
+    if current:
+        pieces.append(current)
+    return pieces
+
+def chunk_blocks(blocks: Iterable[Block], name: str, max_tokens: int = CHUNK_MAX_TOKENS,
+                 min_tokens: int = CHUNK_MIN_TOKENS) -> Iterator[Dict[str, Any]]:
+    """Packs blocks into chunks along their sections; yields {content, meta_data, name}."""
+    path: List[Tuple[int, str]] = []  # open headings, outermost first
+    parts: List[str] = []
+    chunk_path: List[str] = []
+    chunk_page: Optional[int] = None
+    index = 0
+
+    def emit():
+        nonlocal parts, chunk_page, index
+        body = "\n\n".join(parts).strip()
+        parts, page, chunk_page = [], chunk_page, None
+        if not body:
+            return None
+        index += 1
+        section = " > ".join(chunk_path)
+        meta = {"chunk": index, "section": section} if section else {"chunk": index}
+        if page is not None:
+            meta["page"] = page
+        return {"content": f"{section}\n\n{body}" if section else body, "meta_data": meta, "name": name}
+
+    def size() -> int:
+        return estimate_tokens(" > ".join(chunk_path) + "\n\n" + "\n\n".join(parts))
+
+    for block in blocks:
+        if block.level:
+            # A new section starts a new chunk unless the current one is still small and
+            # is text before the first heading or sits in the new heading's top-level section
+            preamble = not chunk_path
+            same_top = path and block.level > 1 and chunk_path[:1] == [path[0][1]]
+            if parts and (size() >= min_tokens or not (preamble or same_top)):
+                chunk = emit()
+                if chunk:
+                    yield chunk
+            path = [(level, text) for level, text in path if level < block.level] + [(block.level, block.text)]
+            if not parts or preamble:
+                chunk_path = [text for _, text in path]
+            else:
+                parts.append(block.text)
+            continue
+        if not parts:
+            chunk_path = [text for _, text in path]
+        heading_tokens = estimate_tokens(" > ".join(chunk_path)) + 1
+        for piece in _split_long(block.text, max(1, max_tokens - heading_tokens)):
+            if parts and estimate_tokens(piece) + size() > max_tokens:
+                chunk = emit()
+                if chunk:
+                    yield chunk
+                chunk_path = [text for _, text in path]
+            if chunk_page is None:
+                chunk_page = block.page
+            parts.append(piece)
+    chunk = emit()
+    if chunk:
+        yield chunk
+
+def structured_blocks(text: str, suffix: str) -> List[Block]:
+    if suffix in (".html", ".htm"):
+        return html_blocks(text)
+    if suffix in (".md", ".markdown"):
+        return markdown_blocks(text)
+    return text_blocks(text)
+
+# --- Near-duplicate chunks ---
+# Each chunk gets a 64-bit SimHash of the lowercased word 3-shingles of its
+# body (the heading path is left out, so section numbering doesn't matter).
+# A chunk within NEAR_DUPLICATE_BITS bits of an earlier chunk with the same
+# permission metadata and the same numbers in the same order is not embedded
+# or stored: two spec paragraphs that differ in one value are both kept. The
+# kept chunk lists the files it stands in for in meta_data.also_in, so they
+# are re-ingested when it goes.
+#
+#   NEAR_DUPLICATE_BITS=3   max differing SimHash bits (0 = identical wording only, -1 = keep all)
+
+NEAR_DUPLICATE_BITS = int(os.getenv("NEAR_DUPLICATE_BITS", "3"))
+SHINGLE_WORDS = 3
+# Permission metadata a chunk may only be deduplicated within
+SCOPE_KEYS = ("tenant_id", "perm", "superperm", "allperm")
+_WORD = re.compile(r"\w+")
+
+def _shingles(text: str) -> List[str]:
+    words = _WORD.findall(text.lower())
+    if len(words) <= SHINGLE_WORDS:
+        return [" ".join(words)]
+    return [" ".join(words[i:i + SHINGLE_WORDS]) for i in range(len(words) - SHINGLE_WORDS + 1)]
+
+def simhash(text: str) -> int:
+    """64-bit SimHash over word shingles, as an unsigned int."""
+    shingles = _shingles(text)
+    hashes = np.frombuffer(b"".join(hashlib.blake2b(s.encode(), digest_size=8).digest() for s in shingles),
+                           dtype=">u8")
+    bits = np.unpackbits(hashes.view(np.uint8).reshape(-1, 8), axis=1)  # most significant bit first
+    votes = bits.sum(axis=0, dtype=np.int64) * 2 - len(shingles)
+    return int.from_bytes(np.packbits(votes > 0).tobytes(), "big")
+
+def fingerprint(content: str, section: str = "") -> str:
+    """"<simhash>-<numbers>" of a chunk's body: 16 hex digits of SimHash, 8 of a hash of its numbers."""
+    if section and content.startswith(section):
+        content = content[len(section):]
+    numbers = hashlib.blake2b(" ".join(_DIGITS.findall(content)).encode(), digest_size=4).hexdigest()
+    return f"{simhash(content):016x}-{numbers}"
+
+def dedupe_key(meta: Dict[str, Any], fingerprint: str) -> Tuple[str, int]:
+    """(scope, SimHash): only chunks of one scope are compared."""
+    value, numbers = fingerprint.split("-")
+    return json.dumps([meta.get(key) for key in SCOPE_KEYS] + [numbers]), int(value, 16)
+
+class NearDuplicateIndex:
+    """
+    SimHash fingerprints by scope, each with a reference to the row holding
+    it. With at most 3 differing bits, two fingerprints agree on at least one
+    of their four 16-bit bands, so only entries sharing a band are compared.
+    """
+
+    BANDS = 4
+
+    def __init__(self, max_distance: int = NEAR_DUPLICATE_BITS):
+        self.max_distance = max_distance
+        self._bands: Dict[Tuple[str, int, int], List[Tuple[int, Any]]] = {}
+        self._by_file: Dict[str, List[Tuple[str, int, Any]]] = {}
+        self._lock = threading.Lock()
+
+    def _keys(self, scope: str, value: int):
+        return [(scope, band, (value >> (16 * band)) & 0xFFFF) for band in range(self.BANDS)]
+
+    def _find(self, scope: str, value: int):
+        if self.max_distance > 3:
+            # Past 3 bits the band lookup could miss a match; compare against the whole scope
+            candidates = (entry for key, entries in self._bands.items() if key[0] == scope and key[1] == 0
+                          for entry in entries)
+        else:
+            candidates = (entry for key in self._keys(scope, value) for entry in self._bands.get(key, ()))
+        for other, ref in candidates:
+            if bin(other ^ value).count("1") <= self.max_distance:
+                return ref
+        return None
+
+    def match_or_add(self, scope: str, value: int, file_id: str, ref: Any) -> Optional[Any]:
+        """The reference of a near duplicate already indexed, else None after indexing this one."""
+        with self._lock:
+            found = self._find(scope, value)
+            if found is not None:
+                return found
+            for key in self._keys(scope, value):
+                self._bands.setdefault(key, []).append((value, ref))
+            self._by_file.setdefault(file_id, []).append((scope, value, ref))
+            return None
+
+    def forget(self, file_id: str):
+        """Drops a file's fingerprints (its chunks are being replaced)."""
+        with self._lock:
+            for scope, value, ref in self._by_file.pop(file_id, ()):
+                for key in self._keys(scope, value):
+                    entries = self._bands.get(key, [])
+                    entries[:] = [e for e in entries if e[1] != ref]
+                    if not entries:
+                        self._bands.pop(key, None)
+
+    def __len__(self):
+        return sum(len(entries) for entries in self._by_file.values())
@@ -0,0 +1,155 @@
+import os
+import time
+import threading
+from typing import Dict, Iterable, Optional, Tuple
+
+from dotenv import load_dotenv
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.engine import Engine
+from agno.db.postgres import PostgresDb
+
+import metrics
+
+load_dotenv()
+
+# --- Shared database engines ---
+# The session store, the vector store and the cache/manifest tables live in
+# the same Postgres. Every module gets its engine from get_engine(), so a
+# process has one pool per database URL instead of one per PgVector/PostgresDb
+# (each with SQLAlchemy's defaults and no pre-ping). The pool is sized for the
+# chat workers plus background jobs, pre-pings connections so ones dropped by
+# the server or a proxy are replaced before a query fails, and recycles them
+# ahead of server-side idle timeouts.
+
+POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "5"))
+POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+# Connections opened at startup; the rest of the pool opens on demand
+WARM_CONNECTIONS = int(os.getenv("DB_WARM_CONNECTIONS", "4"))
+
+CONNECTIONS_OPENED = metrics.counter("db_connections_opened_total", "New database connections by pool")
+CHECKED_OUT = metrics.gauge("db_pool_checked_out", "Connections currently in use by pool")
+
+# (url, pool) -> engine
+_engines: Dict[Tuple[str, str], Engine] = {}
+_lock = threading.Lock()
+
+def database_url() -> Optional[str]:
+    url = os.getenv("DATABASE_URL")
+    return url.strip().strip("'").strip('"') if url else url
+
+def _pool_name(engine: Engine, pool: str = "main") -> str:
+    name = f"{engine.url.host or 'local'}/{engine.url.database}"
+    return name if pool == "main" else f"{name}#{pool}"
+
+def get_engine(url: Optional[str] = None, pool: str = "main", pool_size: int = POOL_SIZE,
+               max_overflow: int = MAX_OVERFLOW) -> Engine:
+    """
+    The process-wide engine for url (DATABASE_URL by default), created on first
+    use. A named pool other than "main" gets its own connections, for callers
+    that hold a connection for a long time (see session_lock.py).
+    """
+    url = url or database_url()
+    engine = _engines.get((url, pool))
+    if engine is not None:
+        return engine
+    with _lock:
+        engine = _engines.get((url, pool))
+        if engine is None:
+            engine = create_engine(
+                url,
+                pool_size=pool_size,
+                max_overflow=max_overflow,
+                pool_timeout=POOL_TIMEOUT,
+                pool_recycle=POOL_RECYCLE,
+                pool_pre_ping=True,
+                # Reuse the most recently returned connection, so idle extras age out via recycle
+                pool_use_lifo=True,
+            )
+            name = _pool_name(engine, pool)
+            event.listen(engine, "connect", lambda *_: CONNECTIONS_OPENED.inc(pool=name))
+            event.listen(engine, "checkout", lambda *_: CHECKED_OUT.set(engine.pool.checkedout(), pool=name))
+            event.listen(engine, "checkin", lambda *_: CHECKED_OUT.set(engine.pool.checkedout(), pool=name))
+            _engines[(url, pool)] = engine
+    return engine
+
+class SessionDb(PostgresDb):
+    """
+    PostgresDb that checks and reflects each of its tables once per process.
+    agno re-checks the table on every session read and write (two catalog
+    queries each, thirteen on the first call), which is a round trip per turn
+    for nothing once the table is known to exist.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._known_tables: Dict[str, object] = {}
+
+    def _get_table(self, table_type: str, create_table_if_not_found: Optional[bool] = False):
+        table = self._known_tables.get(table_type)
+        if table is None:
+            table = super()._get_table(table_type, create_table_if_not_found=create_table_if_not_found)
+            if table is not None:
+                self._known_tables[table_type] = table
+        return table
+
+    def prepare(self) -> bool:
+        """Checks (creating if needed) and reflects the session table. Returns whether it already existed."""
+        existed = self.table_exists(self.session_table_name)
+        self._get_table("sessions", create_table_if_not_found=True)
+        return existed
+
+def warm_up(engine: Engine, tables: Iterable[Tuple[str, str]] = (), connections: int = WARM_CONNECTIONS) -> dict:
+    """
+    Opens `connections` pool connections in parallel (connection setup is
+    mostly network round trips) and reports which of the (schema, table)
+    pairs are missing.
+    """
+    started = time.perf_counter()
+    connections = max(1, min(connections, POOL_SIZE))
+    barrier = threading.Barrier(connections)
+    errors = []
+
+    def open_one():
+        try:
+            with engine.connect() as conn:
+                conn.execute(text("SELECT 1"))
+                # Hold it until the others are open, so each thread opens its own connection
+                barrier.wait(timeout=POOL_TIMEOUT)
+        except Exception as e:
+            errors.append(e)
+            barrier.abort()
+
+    threads = [threading.Thread(target=open_one) for _ in range(connections)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    failures = [e for e in errors if not isinstance(e, threading.BrokenBarrierError)]
+    if failures:
+        raise failures[0]
+
+    inspector = inspect(engine)
+    missing = [f"{schema}.{table}" for schema, table in tables if not inspector.has_table(table, schema=schema)]
+    return {"connections": connections, "missingTables": missing,
+            "seconds": round(time.perf_counter() - started, 3)}
+
+def pool_stats() -> dict:
+    """Per pool: open, in use and idle connections, and how much of pool_size + max_overflow is in use."""
+    out = {}
+    for (_, pool_label), engine in list(_engines.items()):
+        name = _pool_name(engine, pool_label)
+        pool = engine.pool
+        max_overflow = pool._max_overflow
+        capacity = pool.size() + max_overflow
+        out[name] = {
+            "size": pool.size(),
+            "maxOverflow": max_overflow,
+            "checkedOut": pool.checkedout(),
+            "idle": pool.checkedin(),
+            "overflow": max(pool.overflow(), 0),
+            "saturation": round(pool.checkedout() / capacity, 3) if capacity else None,
+            "opened": CONNECTIONS_OPENED.snapshot().get(f"pool={name}", 0),
+        }
+    return out
@@ -0,0 +1,264 @@
+import os
+import logging
+import time
+import queue
+import random
+import asyncio
+import itertools
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from agno.knowledge.embedder.base import Embedder
+from agno.knowledge.embedder.google import GeminiEmbedder
+
+import metrics
+import resilience
+
+log = logging.getLogger(__name__)
+
+# --- Shared embedding service ---
+# Single entry point for query-time and ingestion-time embeddings. Texts from
+# concurrent callers are coalesced into batch requests for a short window, every
+# request draws from requests-per-minute and tokens-per-minute budgets, and
+# rate-limit errors are retried with jittered exponential backoff. Single texts
+# (user queries) are dispatched ahead of bulk ingestion texts.
+
+EMBED_MODEL = "text-embedding-004"
+EMBED_DIMENSIONS = 768
+EMBED_RPM = float(os.getenv("EMBED_RPM", "1500"))
+EMBED_TPM = float(os.getenv("EMBED_TPM", "1000000"))
+EMBED_MAX_BATCH = int(os.getenv("EMBED_MAX_BATCH", "100"))  # Gemini accepts up to 100 texts per request
+EMBED_BATCH_WINDOW = float(os.getenv("EMBED_BATCH_WINDOW_MS", "10")) / 1000
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", "4"))
+EMBED_MAX_RETRIES = int(os.getenv("EMBED_MAX_RETRIES", "6"))
+
+EMBED_REQUESTS = metrics.counter("embedding_requests_total", "Embedding API requests by outcome")
+EMBED_TEXTS = metrics.counter("embedding_texts_total", "Texts embedded through the embedding service")
+EMBED_BATCH_SIZE = metrics.histogram("embedding_batch_size", "Texts per embedding API request")
+QUERY_PRIORITY, BULK_PRIORITY = 0, 1
+
+EMBED_THROTTLE = metrics.counter("embedding_throttle_seconds_total", "Time spent waiting for rate-limit budget")
+
+def estimate_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+def is_rate_limit_error(error: Exception) -> bool:
+    code = getattr(error, "code", None) or getattr(error, "status_code", None)
+    return code == 429 or "429" in str(error) or "RESOURCE_EXHAUSTED" in str(error)
+
+class TokenBucket:
+    """Thread-safe token bucket refilled continuously at rate_per_minute."""
+
+    def __init__(self, rate_per_minute: float, burst_seconds: float = 10.0):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = max(1.0, self.rate * burst_seconds)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, amount: float = 1.0) -> float:
+        """Blocks until amount tokens are available. Returns the time spent waiting."""
+        amount = min(amount, self.capacity)
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return waited
+                wait = (amount - self.tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+def gemini_batch(embedder: GeminiEmbedder) -> Callable[[List[str]], Tuple[List[List[float]], List[Optional[Dict[str, Any]]]]]:
+    """Batch call for GeminiEmbedder (embed_content accepts a list of contents)."""
+
+    def embed(texts: List[str]):
+        model_id = embedder.id.split("/")[-1]
+        config: Dict[str, Any] = {}
+        if embedder.dimensions:
+            config["output_dimensionality"] = embedder.dimensions
+        if embedder.task_type:
+            config["task_type"] = embedder.task_type
+        if embedder.title:
+            config["title"] = embedder.title
+        params: Dict[str, Any] = {"model": model_id, "contents": texts}
+        if config:
+            params["config"] = config
+        if embedder.request_params:
+            params.update(embedder.request_params)
+        response = embedder.client.models.embed_content(**params)
+        usage = None
+        if response.metadata and getattr(response.metadata, "billable_character_count", None) is not None:
+            usage = {"billable_character_count": response.metadata.billable_character_count}
+        embeddings = [e.values or [] for e in (response.embeddings or [])]
+        if len(embeddings) != len(texts):
+            raise RuntimeError(f"Embedding API returned {len(embeddings)} vectors for {len(texts)} texts")
+        return embeddings, [usage] * len(texts)
+
+    return embed
+
+def _single_call_batch(embedder: Embedder):
+    def embed(texts: List[str]):
+        results = [embedder.get_embedding_and_usage(t) for t in texts]
+        return [r[0] for r in results], [r[1] for r in results]
+    return embed
+
+@dataclass
+class BatchingEmbedder(Embedder):
+    """Embedder that coalesces concurrent calls into rate-limited batch requests."""
+
+    inner: Optional[Embedder] = None
+    batch_fn: Optional[Callable[[List[str]], tuple]] = None
+    requests_per_minute: float = EMBED_RPM
+    tokens_per_minute: float = EMBED_TPM
+    max_batch: int = EMBED_MAX_BATCH
+    batch_window: float = EMBED_BATCH_WINDOW
+    concurrency: int = EMBED_CONCURRENCY
+    max_retries: int = EMBED_MAX_RETRIES
+    _queue: Any = field(default=None, init=False, repr=False)
+    _pool: Any = field(default=None, init=False, repr=False)
+    _dispatcher: Any = field(default=None, init=False, repr=False)
+    _start_lock: Any = field(default=None, init=False, repr=False)
+    _slots: Any = field(default=None, init=False, repr=False)
+
+    def __post_init__(self):
+        if self.inner is None:
+            raise ValueError("BatchingEmbedder needs an inner embedder")
+        self.dimensions = self.inner.dimensions
+        if self.batch_fn is None:
+            if isinstance(self.inner, GeminiEmbedder):
+                self.batch_fn = gemini_batch(self.inner)
+            elif hasattr(self.inner, "get_embeddings_batch_and_usage"):
+                self.batch_fn = self.inner.get_embeddings_batch_and_usage
+            else:
+                self.batch_fn = _single_call_batch(self.inner)
+        self.request_bucket = TokenBucket(self.requests_per_minute)
+        self.token_bucket = TokenBucket(self.tokens_per_minute)
+        self._queue = queue.PriorityQueue()
+        self._sequence = itertools.count()
+        self._start_lock = threading.Lock()
+        # Batches are only formed when a worker is free, so queued queries can still jump ahead
+        self._slots = threading.Semaphore(self.concurrency)
+
+    def _ensure_started(self):
+        if self._dispatcher is not None and self._dispatcher.is_alive():
+            return
+        with self._start_lock:
+            if self._dispatcher is None or not self._dispatcher.is_alive():
+                self._pool = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="embed-batch")
+                self._dispatcher = threading.Thread(target=self._dispatch_loop, name="embed-dispatch", daemon=True)
+                self._dispatcher.start()
+
+    # --- batching ---
+
+    def submit(self, text: str, priority: int = QUERY_PRIORITY) -> Future:
+        self._ensure_started()
+        future: Future = Future()
+        self._queue.put((priority, next(self._sequence), text, future))
+        return future
+
+    def _dispatch_loop(self):
+        while True:
+            self._slots.acquire()
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.batch_window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._pool.submit(self._run_batch, [(text, future) for _, _, text, future in batch])
+
+    def _run_batch(self, batch: List[Tuple[str, Future]]):
+        try:
+            # Identical texts (repeated queries, boilerplate chunks) are embedded once
+            unique = list(dict.fromkeys(text for text, _ in batch))
+            try:
+                embeddings, usages = self._call_with_retries(unique)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                return
+            by_text = {text: (emb, usage) for text, emb, usage in zip(unique, embeddings, usages)}
+            for text, future in batch:
+                future.set_result(by_text[text])
+        finally:
+            self._slots.release()
+
+    def _call_with_retries(self, texts: List[str]):
+        tokens = sum(estimate_tokens(t) for t in texts)
+        for attempt in range(self.max_retries + 1):
+            waited = self.request_bucket.acquire(1) + self.token_bucket.acquire(tokens)
+            if waited:
+                EMBED_THROTTLE.inc(waited)
+            try:
+                result = self.batch_fn(texts)
+                EMBED_REQUESTS.inc(outcome="ok")
+                EMBED_BATCH_SIZE.observe(len(texts))
+                EMBED_TEXTS.inc(len(texts))
+                return result
+            except Exception as e:
+                if not is_rate_limit_error(e) or attempt == self.max_retries:
+                    EMBED_REQUESTS.inc(outcome="error")
+                    raise
+                EMBED_REQUESTS.inc(outcome="rate_limited")
+                delay = random.uniform(0, min(30.0, 0.5 * (2 ** attempt)))
+                log.warning("Rate limited, retrying", extra={"texts": len(texts), "delaySeconds": round(delay, 2)})
+                time.sleep(delay)
+
+    # --- Embedder interface ---
+
+    def get_embedding_and_usage(self, text: str):
+        # A query embedding waits no longer than its request's deadline; ingestion has none
+        try:
+            return self.submit(text).result(timeout=resilience.remaining())
+        except TimeoutError:
+            if resilience.expired():
+                raise resilience.exceeded("embedding")
+            raise
+
+    def get_embedding(self, text: str) -> List[float]:
+        return self.get_embedding_and_usage(text)[0]
+
+    def get_embeddings_batch_and_usage(self, texts: List[str]):
+        futures = [self.submit(t, BULK_PRIORITY) for t in texts]
+        results = [f.result() for f in futures]
+        return [r[0] for r in results], [r[1] for r in results]
+
+    async def async_get_embedding_and_usage(self, text: str):
+        return await asyncio.wrap_future(self.submit(text))
+
+    async def async_get_embedding(self, text: str) -> List[float]:
+        return (await self.async_get_embedding_and_usage(text))[0]
+
+    async def async_get_embeddings_batch_and_usage(self, texts: List[str]):
+        results = await asyncio.gather(*(asyncio.wrap_future(self.submit(t, BULK_PRIORITY)) for t in texts))
+        return [r[0] for r in results], [r[1] for r in results]
+
+    def stats(self) -> dict:
+        return {
+            "pending": self._queue.qsize(),
+            "requests": EMBED_REQUESTS.snapshot(),
+            "texts": EMBED_TEXTS.snapshot().get("_", 0),
+            "batchSize": EMBED_BATCH_SIZE.snapshot().get("_"),
+            "throttledSeconds": round(EMBED_THROTTLE.snapshot().get("_", 0), 3),
+        }
+
+_service: Optional[BatchingEmbedder] = None
+_service_lock = threading.Lock()
+
+def get_embedding_service() -> BatchingEmbedder:
+    """Process-wide embedding service shared by the agent and the ingestion pipeline."""
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = BatchingEmbedder(inner=GeminiEmbedder(id=EMBED_MODEL, dimensions=EMBED_DIMENSIONS))
+        return _service
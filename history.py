@@ -0,0 +1,326 @@
+import os
+import logging
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, List, Optional, Tuple
+
+from sqlalchemy import text
+from agno.db.base import SessionType
+from agno.models.message import Message
+from agno.run.base import RunStatus
+
+import metrics
+import resilience
+from embedding_service import estimate_tokens
+
+log = logging.getLogger(__name__)
+
+# --- Token-budgeted conversation history ---
+# Instead of agno's last-10-runs window, each turn gets:
+#   summary   a running summary of every turn already folded out of the window
+#   window    the most recent turns that fit in HISTORY_TOKEN_BUDGET. The
+#             last HISTORY_KEEP_TURNS are always kept; only the last
+#             HISTORY_TOOL_TURNS keep their tool calls and (clipped) results,
+#             older turns keep just the user and assistant text.
+# When the window outgrows the budget, a background job folds the oldest turns
+# into the summary with one model call, shrinking the window to
+# HISTORY_FOLD_RATIO of the budget so the next fold is several turns away.
+# Summaries live next to the session table (<session_table>_summary) rather
+# than in the session row, which agno rewrites whole at the end of every run.
+
+TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "2000"))
+KEEP_TURNS = int(os.getenv("HISTORY_KEEP_TURNS", "2"))
+TOOL_TURNS = int(os.getenv("HISTORY_TOOL_TURNS", "1"))
+TOOL_RESULT_TOKENS = int(os.getenv("HISTORY_TOOL_RESULT_TOKENS", "300"))
+SUMMARY_WORDS = int(os.getenv("HISTORY_SUMMARY_WORDS", "180"))
+FOLD_RATIO = float(os.getenv("HISTORY_FOLD_RATIO", "0.6"))
+# What get_support_team sent before: agno's num_history_runs=10
+BASELINE_RUNS = 10
+SKIP_STATUSES = (RunStatus.paused, RunStatus.cancelled, RunStatus.error)
+
+HISTORY_TOKENS_TOTAL = metrics.counter(
+    "history_tokens_total", "History tokens sent to the model: window (sent) vs baseline (last 10 runs)")
+HISTORY_TOKENS = metrics.histogram("history_prompt_tokens", "History tokens per turn, summary included")
+SUMMARIES = metrics.counter("history_summaries_total", "Summary folds by outcome")
+
+SUMMARY_INSTRUCTIONS = (
+    "You keep the running summary of a customer support conversation so the support agent can "
+    "continue it without the full transcript. Merge the new turns into the existing summary. Keep: "
+    "the user's product, device and setup; the problem and any error messages or codes; steps already "
+    "tried and their results; facts and procedures the agent gave from documentation; tickets created "
+    "(title, status); promises made and open questions. Drop greetings and repetition. "
+    f"Plain text, at most {SUMMARY_WORDS} words."
+)
+
+@dataclass
+class HistoryWindow:
+    messages: List[Message]
+    tokens: int
+    baseline_tokens: int
+    verbatim_turns: int
+    summarized_turns: int
+    session: Optional[object] = None  # the AgentSession the window was built from
+    summary: Optional[dict] = None  # the stored summary it starts with
+    runs: list = field(default_factory=list)  # completed runs not folded into that summary
+
+def message_tokens(message: Message) -> int:
+    tokens = estimate_tokens(message.content) if isinstance(message.content, str) else 0
+    if message.tool_calls:
+        tokens += estimate_tokens(json.dumps(message.tool_calls, default=str))
+    return tokens
+
+def completed_runs(session) -> list:
+    """Top-level runs agno itself would replay as history, oldest first."""
+    return [
+        run for run in (getattr(session, "runs", None) or [])
+        if run.parent_run_id is None and run.status not in SKIP_STATUSES
+    ]
+
+def _clip(content: str, max_tokens: int) -> str:
+    if estimate_tokens(content) <= max_tokens:
+        return content
+    return content[: max_tokens * 4] + " ...[truncated]"
+
+def turn_messages(run, keep_tools: bool, tool_result_tokens: int = TOOL_RESULT_TOKENS) -> List[Message]:
+    """
+    Copies of one run's own messages (not the history it was sent), marked
+    from_history. Without keep_tools, tool calls and their results are dropped
+    together, so the model never sees a call without its response.
+    """
+    messages = []
+    for m in run.messages or []:
+        if m.from_history or m.role == "system":
+            continue
+        if m.role == "tool":
+            if not keep_tools:
+                continue
+            m = m.model_copy(update={"content": _clip(str(m.content or ""), tool_result_tokens)})
+        elif m.tool_calls and not keep_tools:
+            if not m.content:
+                continue
+            m = m.model_copy(update={"tool_calls": None})
+        else:
+            m = m.model_copy()
+        m.from_history = True
+        messages.append(m)
+    return messages
+
+def plan_window(runs: list, budget: int, keep_turns: int = KEEP_TURNS,
+                tool_turns: int = TOOL_TURNS) -> Tuple[List[list], list]:
+    """
+    Splits runs (oldest first) into the window - per-run message lists, oldest
+    first - and the older runs that don't fit the budget.
+    """
+    window, used = [], 0
+    for age, run in enumerate(reversed(runs)):
+        messages = turn_messages(run, keep_tools=age < tool_turns)
+        cost = sum(message_tokens(m) for m in messages)
+        if age >= keep_turns and used + cost > budget:
+            return window[::-1], runs[: len(runs) - age]
+        window.append(messages)
+        used += cost
+    return window[::-1], []
+
+def transcript(runs: list) -> str:
+    """User/agent text of the runs for the summarizer; tool calls appear by name, results are left out."""
+    lines = []
+    for run in runs:
+        for m in run.messages or []:
+            if m.from_history or m.role in ("system", "tool"):
+                continue
+            for call in m.tool_calls or []:
+                function = call.get("function", {})
+                lines.append(f"[Agent called {function.get('name')}({function.get('arguments', '')})]")
+            if m.content:
+                lines.append(f"{'User' if m.role == 'user' else 'Agent'}: {m.content}")
+    return "\n".join(lines)
+
+def model_summarizer(get_model: Callable) -> Callable[[str, str], str]:
+    """summarize(previous_summary, transcript) -> summary, using the shared chat model."""
+    def summarize(previous: str, new_turns: str) -> str:
+        response = get_model().response(messages=[
+            Message(role="system", content=SUMMARY_INSTRUCTIONS),
+            Message(role="user", content=f"Existing summary:\n{previous or '(none)'}\n\nNew turns:\n{new_turns}"),
+        ])
+        return (response.content or "").strip()
+    return summarize
+
+class HistoryManager:
+    def __init__(
+        self,
+        session_db,
+        summarize: Callable[[str, str], str],
+        budget: int = TOKEN_BUDGET,
+        keep_turns: int = KEEP_TURNS,
+        tool_turns: int = TOOL_TURNS,
+        fold_ratio: float = FOLD_RATIO,
+    ):
+        self.session_db = session_db
+        self.summarize = summarize
+        self.budget = budget
+        self.keep_turns = keep_turns
+        self.tool_turns = tool_turns
+        self.fold_ratio = fold_ratio
+        self.summary_table = f"{session_db.db_schema}.{session_db.session_table_name}_summary"
+        self._executor: Optional[ThreadPoolExecutor] = None
+        # session ID -> (window, latest) of the queued fold
+        self._queued: dict = {}
+        self._lock = threading.Lock()
+
+    # --- Summary storage ---
+    def load_summary(self, session_id: str) -> Optional[dict]:
+        try:
+            with self.session_db.db_engine.connect() as conn:
+                row = conn.execute(text(
+                    f"SELECT summary, through_run_id, turns FROM {self.summary_table} WHERE session_id = :id"
+                ), {"id": session_id}).first()
+        except Exception:
+            # Table not created yet (no conversation has been folded)
+            return None
+        return dict(row._mapping) if row else None
+
+    def save_summary(self, session_id: str, summary: str, through_run_id: str, turns: int):
+        with self.session_db.db_engine.begin() as conn:
+            conn.execute(text(
+                f"CREATE TABLE IF NOT EXISTS {self.summary_table} ("
+                "session_id TEXT PRIMARY KEY, summary TEXT NOT NULL, through_run_id TEXT NOT NULL, "
+                "turns INT NOT NULL, updated_at TIMESTAMPTZ NOT NULL DEFAULT now())"
+            ))
+            # A fold from another worker that already covers more turns wins
+            conn.execute(text(
+                f"INSERT INTO {self.summary_table} (session_id, summary, through_run_id, turns) "
+                "VALUES (:id, :summary, :through, :turns) "
+                "ON CONFLICT (session_id) DO UPDATE SET summary = EXCLUDED.summary, "
+                "through_run_id = EXCLUDED.through_run_id, turns = EXCLUDED.turns, updated_at = now() "
+                f"WHERE {self.summary_table}.turns < EXCLUDED.turns"
+            ), {"id": session_id, "summary": summary, "through": through_run_id, "turns": turns})
+
+    def _load(self, session_id: str):
+        session = self.session_db.get_session(session_id=session_id, session_type=SessionType.AGENT)
+        summary = self.load_summary(session_id)
+        runs = completed_runs(session)
+        if summary:
+            ids = [run.run_id for run in runs]
+            if summary["through_run_id"] in ids:
+                runs = runs[ids.index(summary["through_run_id"]) + 1:]
+        return session, summary, runs
+
+    # --- Per turn ---
+    def build(self, session_id: Optional[str]) -> HistoryWindow:
+        """History messages for the next turn of session_id, within the token budget."""
+        if not session_id:
+            return HistoryWindow([], 0, 0, 0, 0)
+        try:
+            # An open breaker skips the read; the turn runs without history rather than waiting on Postgres
+            with resilience.breaker("postgres").guard():
+                session, summary, runs = self._load(session_id)
+        except Exception as e:
+            log.warning("Could not load session", extra={"error": str(e)})
+            return HistoryWindow([], 0, 0, 0, 0)
+
+        messages = []
+        if summary:
+            # A user message: Gemini keeps only one system instruction per request
+            messages.append(Message(role="user", from_history=True, content=(
+                "<summary_of_earlier_conversation>\n" + summary["summary"] + "\n</summary_of_earlier_conversation>"
+            )))
+        budget = self.budget - sum(message_tokens(m) for m in messages)
+        window, unsummarized = plan_window(runs, budget, self.keep_turns, self.tool_turns)
+        # Not folded yet (the background fold is behind or failed): keep their text, never drop turns
+        for run in unsummarized:
+            messages.extend(turn_messages(run, keep_tools=False))
+        for turn in window:
+            messages.extend(turn)
+
+        tokens = sum(message_tokens(m) for m in messages)
+        baseline = 0
+        if session is not None:
+            baseline = sum(message_tokens(m) for m in session.get_messages(last_n_runs=BASELINE_RUNS)
+                           if m.role != "system")
+        HISTORY_TOKENS.observe(tokens)
+        HISTORY_TOKENS_TOTAL.inc(tokens, kind="window")
+        HISTORY_TOKENS_TOTAL.inc(baseline, kind="baseline")
+        if runs or summary:
+            log.info("History window built", extra={
+                "recentTurns": len(window), "summarizedTurns": summary["turns"] if summary else 0,
+                "pendingFold": len(unsummarized), "tokens": tokens, "baselineTokens": baseline,
+            })
+        return HistoryWindow(
+            messages=messages, tokens=tokens, baseline_tokens=baseline, verbatim_turns=len(window),
+            summarized_turns=summary["turns"] if summary else 0, session=session, summary=summary, runs=runs,
+        )
+
+    def fold(self, session_id: str, window: Optional[HistoryWindow] = None, latest=None) -> bool:
+        """
+        Folds the oldest turns into the summary once the window exceeds the
+        budget. Returns True when a new summary was stored. With the window the
+        turn was built from (and latest, the run it produced) nothing is read
+        from the session table; without latest, that run is folded on the
+        session's next turn.
+        """
+        if window is None:
+            _, summary, runs = self._load(session_id)
+        else:
+            summary, runs = window.summary, list(window.runs)
+            if latest is not None and getattr(latest, "status", None) not in SKIP_STATUSES:
+                runs.append(latest)
+        previous = summary["summary"] if summary else ""
+        budget = self.budget - estimate_tokens(previous)
+        if not plan_window(runs, budget, self.keep_turns, self.tool_turns)[1]:
+            return False
+        _, overflow = plan_window(runs, int(budget * self.fold_ratio), self.keep_turns, self.tool_turns)
+        try:
+            new_summary = self.summarize(previous, transcript(overflow))
+        except Exception as e:
+            SUMMARIES.inc(outcome="error")
+            log.warning("Summary failed, turns stay verbatim", extra={"sessionId": session_id, "error": str(e)})
+            return False
+        if not new_summary:
+            SUMMARIES.inc(outcome="empty")
+            return False
+        turns = (summary["turns"] if summary else 0) + len(overflow)
+        self.save_summary(session_id, new_summary, overflow[-1].run_id, turns)
+        SUMMARIES.inc(outcome="ok")
+        log.info("Folded turns into the summary", extra={"sessionId": session_id, "folded": len(overflow), "turns": turns})
+        return True
+
+    def schedule_fold(self, session_id: Optional[str], window: Optional[HistoryWindow] = None, latest=None):
+        """
+        Runs fold() after the reply has been sent; one queued fold per session,
+        with the latest turn's window and run.
+        """
+        if not session_id:
+            return
+        with self._lock:
+            queued = session_id in self._queued
+            self._queued[session_id] = (window, latest)
+            if queued:
+                return
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="history-fold")
+        self._executor.submit(self._run_fold, session_id)
+
+    def _run_fold(self, session_id: str):
+        with self._lock:
+            window, latest = self._queued.pop(session_id, (None, None))
+        try:
+            self.fold(session_id, window, latest)
+        except Exception as e:
+            log.exception("Fold failed", extra={"sessionId": session_id})
+
+def drop_history_window(run_output):
+    """Post-hook: the window is rebuilt from stored runs each turn, so don't store a copy in the run."""
+    run_output.additional_input = None
+
+def stats() -> dict:
+    tokens = HISTORY_TOKENS_TOTAL.snapshot()
+    window, baseline = tokens.get("kind=window", 0), tokens.get("kind=baseline", 0)
+    return {
+        "historyTokens": window,
+        "baselineTokens": baseline,
+        "savedRatio": round(1 - window / baseline, 3) if baseline else None,
+        "perTurn": HISTORY_TOKENS.snapshot(),
+        "summaries": SUMMARIES.snapshot(),
+    }
@@ -0,0 +1,526 @@
+import io
+import os
+import time
+import queue
+import threading
+import itertools
+from hashlib import md5
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import IO, Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
+
+from sqlalchemy import select, text
+from sqlalchemy.dialects import postgresql
+
+import metrics
+from chunking import (BOILERPLATE_SAMPLE_PAGES, CHUNKING, NEAR_DUPLICATE_BITS, STRUCTURED_SUFFIXES, NearDuplicateIndex,
+                      boilerplate_lines, chunk_blocks, dedupe_key, fingerprint, strip_boilerplate, structured_blocks,
+                      text_blocks)
+
+# --- Staged ingestion: download -> parse/chunk -> embed -> bulk write ---
+# Each stage has its own workers and a bounded queue in front of it, so a slow
+# stage applies backpressure instead of letting downloads pile up in memory.
+# Downloads and embedding calls are I/O bound and run on threads; PDF parsing
+# and chunking are CPU bound and run in a process pool.
+#
+# Downloads arrive as in-memory buffers that spill to an anonymous temp file
+# past SPOOL_MAX_MEMORY. Buffers under that size are parsed in the process
+# pool; larger ones are streamed page by page in the parse thread, so memory
+# per file stays bounded whatever the file size.
+#
+# Parsed chunks go through a near-duplicate check (chunking.py) before they
+# are embedded, against the chunks of this run and those already stored, so
+# repeated boilerplate costs neither embedding calls nor index rows.
+
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "4"))
+WRITE_BATCH = int(os.getenv("INGEST_WRITE_BATCH", "500"))
+SPOOL_MAX_MEMORY = int(float(os.getenv("INGEST_SPOOL_MAX_MB", "16")) * 1024 * 1024)
+PDF_CHUNK_SIZE = 5000  # same as Agno's PDFReader default
+
+STAGE_ITEMS = metrics.counter("ingest_stage_items_total", "Files completed per ingestion stage")
+STAGE_ERRORS = metrics.counter("ingest_stage_errors_total", "Files that failed in an ingestion stage")
+STAGE_SECONDS = metrics.counter("ingest_stage_busy_seconds_total", "Worker time spent per ingestion stage")
+CHUNKS = metrics.counter("ingest_chunks_total", "Parsed chunks, kept or dropped as near duplicates")
+
+_DONE = object()
+
+GOOGLE_DOC_MIME = "application/vnd.google-apps.document"
+
+def export_mime(file: dict, chunking: str = CHUNKING) -> Optional[str]:
+    """Export format for a Google Docs/Sheets/Slides file, None for files downloaded as they are."""
+    mime = file.get("mimeType", "")
+    if "google-apps" not in mime:
+        return None
+    # HTML keeps a Doc's headings, which the structure-aware chunker follows
+    return "text/html" if mime == GOOGLE_DOC_MIME and chunking == "structure" else "application/pdf"
+
+def file_suffix(file: dict, chunking: str = CHUNKING) -> str:
+    """Extension used to pick a reader; exported Google files get their export format's."""
+    export = export_mime(file, chunking)
+    if export:
+        return ".html" if export == "text/html" else ".pdf"
+    return Path(file["name"]).suffix.lower() or ".txt"
+
+def iter_pdf_pages(stream: IO[bytes], name: str) -> Iterator[str]:
+    """Page texts; pypdf reads page objects from the stream on demand."""
+    from pypdf import PdfReader
+
+    pdf = PdfReader(stream)
+    if pdf.is_encrypted and not pdf.decrypt(""):
+        raise ValueError(f"{name} is password protected")
+    for page in pdf.pages:
+        yield page.extract_text() or ""
+
+def chunk_pdf_pages(pages: Iterable[str], name: str, chunking: str = CHUNKING) -> Iterator[Dict[str, Any]]:
+    """Chunks PDF page texts: per page (chunking="pages") or along sections, headers and footers removed."""
+    from agno.knowledge.chunking.document import DocumentChunking
+    from agno.knowledge.document.base import Document
+
+    pages = iter(pages)
+    if chunking != "structure":
+        chunker = DocumentChunking(chunk_size=PDF_CHUNK_SIZE)
+        for page_number, text in enumerate(pages, start=1):
+            if not text.strip():
+                continue
+            page_doc = Document(name=name, id=f"{name}_{page_number}", meta_data={"page": page_number}, content=text)
+            for doc in chunker.chunk(page_doc):
+                yield {"content": doc.content, "meta_data": dict(doc.meta_data or {}), "name": doc.name or name}
+        return
+
+    # Headers and footers are learned from the leading pages, so the rest can still be streamed
+    sample = list(itertools.islice(pages, BOILERPLATE_SAMPLE_PAGES))
+    boilerplate = boilerplate_lines(sample)
+    blocks = (block
+              for page_number, text in enumerate(itertools.chain(sample, pages), start=1)
+              for block in text_blocks(strip_boilerplate(text, boilerplate),
+                                                       page=page_number))
+    yield from chunk_blocks(blocks, name)
+
+def iter_pdf_chunks(stream: IO[bytes], name: str, chunking: str = CHUNKING) -> Iterator[Dict[str, Any]]:
+    yield from chunk_pdf_pages(iter_pdf_pages(stream, name), name, chunking)
+
+def iter_chunks(source: Union[str, Path, IO[bytes]], name: str, suffix: str,
+                chunking: str = CHUNKING) -> Iterator[Dict[str, Any]]:
+    """Chunks a local path or a binary stream with the reader for its extension."""
+    if suffix == ".pdf":
+        if isinstance(source, (str, Path)):
+            with open(source, "rb") as fh:
+                yield from iter_pdf_chunks(fh, name, chunking)
+        else:
+            yield from iter_pdf_chunks(source, name, chunking)
+        return
+
+    if chunking == "structure" and suffix in STRUCTURED_SUFFIXES:
+        if isinstance(source, (str, Path)):
+            data = Path(source).read_bytes()
+        else:
+            data = source.read()
+        text = data.decode("utf-8", errors="replace")
+        yield from chunk_blocks(structured_blocks(text, suffix), name)
+        return
+
+    from agno.knowledge.reader.reader_factory import ReaderFactory
+
+    reader = ReaderFactory.get_reader_for_extension(suffix)
+    documents = reader.read(Path(source) if isinstance(source, str) else source, name=name)
+    for doc in documents:
+        yield {"content": doc.content, "meta_data": dict(doc.meta_data or {}), "name": doc.name or name}
+
+def _collect(chunks: Iterator[Dict[str, Any]], name: str) -> List[Dict[str, Any]]:
+    chunks = [c for c in chunks if c["content"] and c["content"].strip()]
+    if not chunks:
+        # Readers log and swallow their own errors; don't record the file as ingested
+        raise ValueError(f"no text extracted from {name}")
+    return chunks
+
+def parse_and_chunk(path: str, name: str, chunking: str = CHUNKING) -> List[Dict[str, Any]]:
+    """Reads and chunks one local file. Runs in a worker process."""
+    return _collect(iter_chunks(path, name, Path(path).suffix.lower() or ".txt", chunking), name)
+
+def parse_bytes(data: bytes, name: str, suffix: str, chunking: str = CHUNKING) -> List[Dict[str, Any]]:
+    """Chunks a downloaded file held in memory. Runs in a worker process."""
+    return _collect(iter_chunks(io.BytesIO(data), name, suffix, chunking), name)
+
+def file_content_hash(file: dict) -> str:
+    return md5(f"{file['id']}:{file.get('md5Checksum') or file.get('modifiedTime') or ''}".encode()).hexdigest()
+
+def delete_file_rows(sess, table, file_id: str) -> Set[str]:
+    """Deletes a file's chunks; returns the other files whose near-duplicate chunks they stood in for."""
+    deleted = sess.execute(table.delete().where(table.c.meta_data.contains({"file_id": file_id}))
+                           .returning(table.c.meta_data["also_in"])).scalars().all()
+    return {other for also_in in deleted for other in (also_in or ())} - {file_id}
+
+def embed_texts(embedder, texts: List[str], pool: ThreadPoolExecutor):
+    """Embeds chunk texts concurrently. Returns (embeddings, usages)."""
+    if hasattr(embedder, "submit"):
+        # Embedding service: the whole file goes in at once and is packed into batch requests
+        return embedder.get_embeddings_batch_and_usage(texts)
+    results = list(pool.map(embedder.get_embedding_and_usage, texts))
+    return [r[0] for r in results], [r[1] for r in results]
+
+class StageStats:
+    def __init__(self, name: str, workers: int):
+        self.name = name
+        self.workers = workers
+        self.items = 0
+        self.chunks = 0
+        self.errors = 0
+        self.busy = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float, chunks: int = 0, error: bool = False):
+        with self._lock:
+            self.busy += seconds
+            if error:
+                self.errors += 1
+            else:
+                self.items += 1
+                self.chunks += chunks
+        STAGE_SECONDS.inc(seconds, stage=self.name)
+        if error:
+            STAGE_ERRORS.inc(stage=self.name)
+        else:
+            STAGE_ITEMS.inc(stage=self.name)
+
+    def summary(self, wall: float) -> dict:
+        return {
+            "workers": self.workers,
+            "files": self.items,
+            "chunks": self.chunks,
+            "errors": self.errors,
+            "busySeconds": round(self.busy, 3),
+            "filesPerSecond": round(self.items / wall, 2) if wall else None,
+            # Share of the stage's worker capacity that was busy; ~1.0 marks the bottleneck
+            "utilization": round(self.busy / (wall * self.workers), 3) if wall else None,
+        }
+
+class IngestionPipeline:
+    """
+    Runs Drive file descriptors through the ingestion stages.
+
+    fetch(file) -> local path or a seekable binary buffer
+                                      (thread-safe; called from download workers)
+    metadata_for(file) -> dict        permission metadata stored with every chunk
+    on_file_done(file)                called after a file's chunks are committed
+    write_rows(files, rows, links)    replaces the files' chunks with rows and adds each
+                                      file in links[row_id] to that stored row's also_in;
+                                      returns (orphaned file IDs, link rows not found)
+
+    Files listed in a deleted chunk's also_in ("orphaned") lost the chunk that
+    stood in for theirs and need to be ingested again; report["orphaned"]
+    lists them. A file whose duplicate chunks point at a row that was not
+    found is written but not passed to on_file_done, so the next sync
+    retries it.
+    """
+
+    def __init__(
+        self,
+        vector_db,
+        embedder,
+        fetch: Callable[[dict], str],
+        metadata_for: Callable[[dict], dict],
+        on_file_done: Optional[Callable[[dict], None]] = None,
+        workers: int = INGEST_WORKERS,
+        parse_workers: Optional[int] = None,
+        write_batch: int = WRITE_BATCH,
+        queue_size: Optional[int] = None,
+        write_rows: Optional[Callable[[List[dict], List[dict], Dict[str, Set[str]]], Any]] = None,
+        chunking: str = CHUNKING,
+        near_duplicate_bits: int = NEAR_DUPLICATE_BITS,
+    ):
+        self.vector_db = vector_db
+        self.embedder = embedder
+        self.fetch = fetch
+        self.metadata_for = metadata_for
+        self.on_file_done = on_file_done or (lambda file: None)
+        self.workers = max(1, workers)
+        self.parse_workers = parse_workers or min(self.workers, os.cpu_count() or 1)
+        self.write_batch = write_batch
+        self.queue_size = queue_size or self.workers * 2
+        self.write_rows = write_rows or self._write_rows
+        self.chunking = chunking
+        self.index = NearDuplicateIndex(near_duplicate_bits) if near_duplicate_bits >= 0 else None
+        self.orphaned: Set[str] = set()
+        self.deferred: Set[str] = set()
+        self.chunk_counts = {"parsed": 0, "nearDuplicates": 0}
+        self._count_lock = threading.Lock()
+        self.stats = {
+            "download": StageStats("download", self.workers),
+            "parse": StageStats("parse", self.parse_workers),
+            "embed": StageStats("embed", self.workers),
+            "write": StageStats("write", 1),
+        }
+
+    # --- stage bodies (one file in, one file out) ---
+
+    def _download(self, unit: dict) -> dict:
+        unit["source"] = self.fetch(unit["file"])
+        return unit
+
+    def _parse(self, unit: dict) -> dict:
+        source, name = unit.pop("source"), unit["file"]["name"]
+        try:
+            if isinstance(source, (str, Path)):
+                unit["chunks"] = self._process_pool.submit(parse_and_chunk, str(source), name, self.chunking).result()
+            elif source.seek(0, io.SEEK_END) <= SPOOL_MAX_MEMORY:
+                source.seek(0)
+                data = source.read()
+                source.close()  # don't hold the buffer and its copy while the worker parses
+                unit["chunks"] = self._process_pool.submit(parse_bytes, data, name, file_suffix(unit["file"], self.chunking),
+                                                           self.chunking).result()
+            else:
+                # Too big to ship to a worker process; stream it from the spill file instead
+                source.seek(0)
+                unit["chunks"] = _collect(iter_chunks(source, name, file_suffix(unit["file"], self.chunking),
+                                                      self.chunking), name)
+        finally:
+            # The download is no longer needed once it has been parsed
+            if isinstance(source, (str, Path)):
+                try:
+                    os.remove(source)
+                except OSError:
+                    pass
+            else:
+                source.close()
+        return self._dedupe(unit)
+
+    def _dedupe(self, unit: dict) -> dict:
+        """Assigns row IDs and drops chunks that nearly duplicate one already indexed with the same permissions."""
+        file, chunks = unit["file"], unit["chunks"]
+        unit["content_hash"] = content_hash = file_content_hash(file)
+        for index, chunk in enumerate(chunks):
+            chunk["id"] = md5(f"{content_hash}:{index}".encode()).hexdigest()
+        unit["links"] = set()
+        if self.index is not None:
+            # The file's stored chunks are about to be replaced; nothing may point at them now
+            self.index.forget(file["id"])
+            metadata = self.metadata_for(file)
+            kept = []
+            for chunk in chunks:
+                chunk["fingerprint"] = fingerprint(chunk["content"], chunk["meta_data"].get("section", ""))
+                scope, value = dedupe_key(metadata, chunk["fingerprint"])
+                match = self.index.match_or_add(scope, value, file["id"], (chunk["id"], file["id"]))
+                if match is None:
+                    kept.append(chunk)
+                elif match[1] != file["id"]:
+                    unit["links"].add(match[0])
+            unit["chunks"] = kept
+        dropped = len(chunks) - len(unit["chunks"])
+        CHUNKS.inc(len(unit["chunks"]), result="kept")
+        if dropped:
+            CHUNKS.inc(dropped, result="near_duplicate")
+        with self._count_lock:
+            self.chunk_counts["parsed"] += len(chunks)
+            self.chunk_counts["nearDuplicates"] += dropped
+        return unit
+
+    def _seed_index(self):
+        """Indexes the fingerprints of the chunks already stored, so new files are checked against them."""
+        table = self.vector_db.table
+        try:
+            with self.vector_db.Session() as sess:
+                rows = sess.execute(select(table.c.id, table.c.meta_data)
+                                    .where(table.c.meta_data.has_key("fingerprint"))).all()
+        except Exception as e:
+            print(f"⚠️ Could not load stored chunk fingerprints; checking this run only: {e}")
+            return
+        for row_id, meta in rows:
+            scope, value = dedupe_key(meta, meta["fingerprint"])
+            self.index.match_or_add(scope, value, meta.get("file_id"), (row_id, meta.get("file_id")))
+
+    def _embed(self, unit: dict) -> dict:
+        texts = [chunk["content"] for chunk in unit["chunks"]]
+        unit["embeddings"], unit["usages"] = embed_texts(self.embedder, texts, self._embed_pool)
+        return unit
+
+    # --- writer ---
+
+    def build_rows(self, unit: dict) -> List[dict]:
+        file = unit["file"]
+        metadata = {**self.metadata_for(file)}
+        content_hash = unit["content_hash"]
+        rows = []
+        for chunk, embedding, usage in zip(unit["chunks"], unit["embeddings"], unit["usages"]):
+            content = chunk["content"].replace("\x00", "\ufffd")
+            meta = {**chunk["meta_data"], **metadata}
+            if "fingerprint" in chunk:
+                meta["fingerprint"] = chunk["fingerprint"]
+            rows.append({
+                "id": chunk["id"],
+                "name": chunk["name"],
+                "meta_data": meta,
+                "filters": None,
+                "content": content,
+                "embedding": embedding,
+                "usage": usage,
+                "content_hash": content_hash,
+                "content_id": file["id"],
+            })
+        return rows
+
+    def _write_rows(self, files: List[dict], rows: List[dict],
+                    links: Dict[str, Set[str]]) -> Tuple[Set[str], Set[str]]:
+        """Replaces the given files' chunks with the new rows and records links, in one transaction."""
+        table = self.vector_db.table
+        orphaned, missing = set(), set()
+        link = text(
+            f'UPDATE "{self.vector_db.schema}"."{self.vector_db.table_name}" SET meta_data = '
+            "jsonb_set(meta_data, '{also_in}', COALESCE(meta_data->'also_in', '[]'::jsonb) || to_jsonb(CAST(:file_id AS text))) "
+            "WHERE id = :id AND NOT COALESCE(meta_data->'also_in', '[]'::jsonb) ? :file_id RETURNING id"
+        )
+        with self.vector_db.Session() as sess, sess.begin():
+            for file in files:
+                orphaned |= delete_file_rows(sess, table, file["id"])
+            for i in range(0, len(rows), self.write_batch):
+                sess.execute(postgresql.insert(table), rows[i:i + self.write_batch])
+            for row_id, file_ids in links.items():
+                for file_id in file_ids:
+                    if sess.execute(link, {"id": row_id, "file_id": file_id}).first() is None and \
+                            not sess.execute(select(table.c.id).where(table.c.id == row_id)).first():
+                        missing.add(row_id)
+        return orphaned, missing
+
+    def _flush(self, units: List[dict]):
+        if not units:
+            return
+        start = time.perf_counter()
+        files = [u["file"] for u in units]
+        rows = [row for u in units for row in self.build_rows(u)]
+        # Duplicates of a row in this batch are recorded on it; others go to the stored row
+        by_id = {row["id"]: row for row in rows}
+        links: Dict[str, Set[str]] = {}
+        for unit in units:
+            for row_id in unit["links"]:
+                if row_id in by_id:
+                    also_in = by_id[row_id]["meta_data"].setdefault("also_in", [])
+                    if unit["file"]["id"] not in also_in:
+                        also_in.append(unit["file"]["id"])
+                else:
+                    links.setdefault(row_id, set()).add(unit["file"]["id"])
+        try:
+            orphaned, missing = self.write_rows(files, rows, links) or (set(), set())
+        except Exception as e:
+            print(f"❌ Bulk write failed for {len(files)} file(s): {e}")
+            for _ in units:
+                self.stats["write"].record(0, error=True)
+            return
+        elapsed = time.perf_counter() - start
+        self.orphaned |= orphaned
+        for unit in units:
+            self.stats["write"].record(elapsed / len(units), chunks=len(unit["chunks"]))
+            if missing & unit["links"]:
+                # A chunk it deferred to is gone; leave the file for the next sync to redo
+                print(f"⏭️ {unit['file']['name']}: a chunk it shares was removed; will be re-ingested")
+                self.deferred.add(unit["file"]["id"])
+                continue
+            self.on_file_done(unit["file"])
+        print(f"💾 Wrote {len(rows)} chunks from {len(files)} file(s) in {elapsed:.2f}s")
+
+    def _writer(self, inbox: queue.Queue):
+        pending, pending_rows = [], 0
+        while True:
+            try:
+                unit = inbox.get(timeout=1.0)
+            except queue.Empty:
+                # Upstream is slow; don't hold finished files back
+                self._flush(pending)
+                pending, pending_rows = [], 0
+                continue
+            if unit is _DONE:
+                self._flush(pending)
+                return
+            pending.append(unit)
+            pending_rows += len(unit["chunks"])
+            if pending_rows >= self.write_batch:
+                self._flush(pending)
+                pending, pending_rows = [], 0
+
+    # --- plumbing ---
+
+    def _stage_worker(self, name: str, fn, inbox: queue.Queue, outbox: queue.Queue, finished: list, lock):
+        stats = self.stats[name]
+        while True:
+            unit = inbox.get()
+            if unit is _DONE:
+                with lock:
+                    finished[0] -= 1
+                    if finished[0] == 0:
+                        outbox.put(_DONE)
+                    else:
+                        # Let the sibling workers see the end of input too
+                        inbox.put(_DONE)
+                return
+            start = time.perf_counter()
+            try:
+                unit = fn(unit)
+            except Exception as e:
+                print(f"❌ {name} failed for {unit['file'].get('name')}: {e}")
+                stats.record(time.perf_counter() - start, error=True)
+                continue
+            stats.record(time.perf_counter() - start, chunks=len(unit.get("chunks", [])))
+            outbox.put(unit)
+
+    def run(self, files: Iterable[dict]) -> dict:
+        started = time.perf_counter()
+        stages = [
+            ("download", self._download, self.workers),
+            ("parse", self._parse, self.parse_workers),
+            ("embed", self._embed, self.workers),
+        ]
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(stages) + 1)]
+        threads = []
+        if self.index is not None and self.write_rows == self._write_rows:
+            self._seed_index()
+
+        with ProcessPoolExecutor(max_workers=self.parse_workers) as process_pool, \
+                ThreadPoolExecutor(max_workers=self.workers * 2, thread_name_prefix="ingest-embed") as embed_pool:
+            self._process_pool = process_pool
+            self._embed_pool = embed_pool
+
+            for i, (name, fn, count) in enumerate(stages):
+                finished, lock = [count], threading.Lock()
+                for n in range(count):
+                    t = threading.Thread(
+                        target=self._stage_worker, name=f"ingest-{name}-{n}",
+                        args=(name, fn, queues[i], queues[i + 1], finished, lock), daemon=True,
+                    )
+                    t.start()
+                    threads.append(t)
+            writer = threading.Thread(target=self._writer, name="ingest-write", args=(queues[-1],), daemon=True)
+            writer.start()
+
+            # files may be a generator (e.g. a Drive crawl still in progress).
+            # Feeding blocks once the download queue is full (backpressure)
+            fed = 0
+            try:
+                for file in files:
+                    queues[0].put({"file": file})
+                    fed += 1
+            finally:
+                # Files already fed are still finished if the source fails part-way
+                queues[0].put(_DONE)
+                writer.join()
+                for t in threads:
+                    t.join()
+
+        wall = time.perf_counter() - started
+        report = {
+            "files": fed,
+            "seconds": round(wall, 3),
+            "filesPerSecond": round(fed / wall, 2) if wall else None,
+            "stages": {name: s.summary(wall) for name, s in self.stats.items()},
+            "chunks": {**self.chunk_counts, "embedded": self.stats["embed"].chunks},
+            "orphaned": sorted(self.orphaned),
+            "deferred": sorted(self.deferred),
+        }
+        self._print_report(report)
+        return report
+
+    def _print_report(self, report: dict):
+        print(f"\n📊 Ingestion: {report['files']} files in {report['seconds']}s ({report['filesPerSecond']} files/s)")
+        for name, s in report["stages"].items():
+            print(f"   {name:<9} workers={s['workers']:<3} files={s['files']:<5} chunks={s['chunks']:<6} "
+                  f"errors={s['errors']:<3} util={s['utilization']}")
+        chunks = report["chunks"]
+        if chunks["nearDuplicates"]:
+            print(f"   {chunks['nearDuplicates']} of {chunks['parsed']} chunks were near duplicates and not embedded")
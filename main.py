@@ -1,11 +1,146 @@
-from fastapi import FastAPI, Request, HTTPException
+from fastapi import FastAPI, Request, Response, HTTPException
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
 from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import contextvars
+import functools
+import json
+import logging
+import math
 import os
+import time
 import uvicorn
-from agents import get_support_team
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+from agno.run.base import RunStatus
+from agents import (FAQ_CACHE, cached_answer, get_store, get_support_team, load_history, loaded_stores,
+                    note_speculation, prefetch_documentation, prefetched_documentation, remember_answer,
+                    speculation_stats, warm_up)
+from backend_sync import outbox
+from session_lock import COALESCED, SessionBusy, in_flight, replay_age, request_key, request_log, session_locks
+from embedding_service import get_embedding_service
+import database
+import metrics
+import retrieval
+import history
+import observability
+import prompt_cache
+import rag_cache
+import resilience
+import session_lock
+import tenancy
+import traffic_capture
 
-app = FastAPI(title="Agno AgentOS - Thanos CS")
+observability.configure_logging()
+observability.init_tracing()
+log = logging.getLogger(__name__)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Opens DB connections and loads table metadata before the first request is accepted
+    try:
+        warm_up()
+        request_log.prepare()
+    except Exception:
+        log.exception("Warm-up failed, first requests will connect on demand")
+    # Replays any spooled ThanosBE callbacks left over from a previous run
+    outbox.start()
+    yield
+    outbox.stop()
+    agent_pool.shutdown(wait=False)
+    traffic_capture.capture.close()
+
+app = FastAPI(title="Agno AgentOS - Thanos CS", lifespan=lifespan)
+
+# --- Concurrency & Admission Control ---
+# team.run() and the backend sync are blocking, so each chat turn runs on a
+# bounded worker pool instead of the event loop. Requests beyond the pool size
+# wait in the executor queue; once CHAT_MAX_QUEUE turns are already waiting we
+# reject immediately instead of letting latency grow without bound.
+CHAT_WORKERS = int(os.getenv("CHAT_WORKERS", "8"))
+CHAT_MAX_QUEUE = int(os.getenv("CHAT_MAX_QUEUE", "32"))
+
+agent_pool = None
+_admitted = 0  # running + queued turns; only touched from the event loop
+
+def init_agent_pool(workers: Optional[int] = None, max_queue: Optional[int] = None):
+    """(Re)creates the agent worker pool. Used at import and by the load test."""
+    global agent_pool, CHAT_WORKERS, CHAT_MAX_QUEUE
+    if workers is not None:
+        CHAT_WORKERS = workers
+    if max_queue is not None:
+        CHAT_MAX_QUEUE = max_queue
+    if agent_pool is not None:
+        agent_pool.shutdown(wait=False)
+    agent_pool = ThreadPoolExecutor(max_workers=CHAT_WORKERS, thread_name_prefix="agent-run")
+    return agent_pool
+
+init_agent_pool()
+
+def get_pool_stats() -> dict:
+    return {
+        "workers": CHAT_WORKERS,
+        "maxQueue": CHAT_MAX_QUEUE,
+        "inFlight": min(_admitted, CHAT_WORKERS),
+        "queued": max(_admitted - CHAT_WORKERS, 0),
+    }
+
+def agent_pool_full() -> bool:
+    return _admitted >= CHAT_WORKERS + CHAT_MAX_QUEUE
+
+def agent_pool_busy() -> HTTPException:
+    return HTTPException(
+        status_code=503,
+        detail="Support agent is busy, please retry shortly",
+        headers={"Retry-After": "1"},
+    )
+
+def reserve_agent_slot():
+    """Admits one turn or raises 503. Returns the callable that releases the slot."""
+    global _admitted
+    if agent_pool_full():
+        raise agent_pool_busy()
+    _admitted += 1
+    released = False
+
+    def release():
+        global _admitted
+        nonlocal released
+        if not released:
+            released = True
+            _admitted -= 1
+
+    return release
+
+async def run_in_agent_pool(func, *args, **kwargs):
+    """Runs a blocking call on the agent pool, rejecting with 503 when saturated."""
+    release = reserve_agent_slot()
+    try:
+        loop = asyncio.get_running_loop()
+        # Carries the request ID and trace into the worker thread
+        ctx = contextvars.copy_context()
+        return await loop.run_in_executor(agent_pool, functools.partial(ctx.run, func, *args, **kwargs))
+    finally:
+        release()
+
+# --- Latency Metrics ---
+CHAT_LATENCY = metrics.histogram("chat_request_duration_seconds", "End-to-end chat turn latency")
+CHAT_TTFT = metrics.histogram("chat_time_to_first_token_seconds", "Time until the first streamed content delta")
+FAQ_HIT_LATENCY = metrics.histogram("faq_cache_hit_seconds", "End-to-end latency of turns answered from the FAQ cache")
+CHAT_TOKENS = metrics.counter("chat_tokens_total", "Model tokens per chat turn by kind, user role and tenant")
+
+def record_tokens(context: dict, run_metrics):
+    if not run_metrics:
+        return
+    labels = {"role": context.get("userRole", "USER"), "tenant": context.get("tenantId", tenancy.DEFAULT_TENANT)}
+    CHAT_TOKENS.inc(run_metrics.input_tokens or 0, kind="input", **labels)
+    CHAT_TOKENS.inc(run_metrics.output_tokens or 0, kind="output", **labels)
+    # Part of the input tokens served from a prompt prefix cache (implicit or explicit)
+    CHAT_TOKENS.inc(run_metrics.cache_read_tokens or 0, kind="cached", **labels)
+    traffic_capture.note(inputTokens=run_metrics.input_tokens, outputTokens=run_metrics.output_tokens,
+                         cachedTokens=run_metrics.cache_read_tokens)
 
 # --- Validation Logic (Phase 2A) ---
 
@@ -25,6 +160,13 @@ def validate_user_context(payload: dict):
     # Normalize role to uppercase
     role = str(payload.get("userRole", "USER")).upper()
     perms = ROLE_MAP.get(role, ROLE_MAP["USER"])
+
+    # Picks the tenant's knowledge and session tables. Tenants this deployment doesn't serve
+    # use the default tenant's, or are refused with TENANT_STRICT=1
+    try:
+        tenant = tenancy.route_tenant(payload.get("tenantId"))
+    except tenancy.UnknownTenant:
+        raise HTTPException(status_code=403, detail="Unknown tenant")
     
     return {
         "message": payload.get("message"),
@@ -34,7 +176,9 @@ def validate_user_context(payload: dict):
         "userName": payload.get("userName", "Unknown"),
         "userEmail": payload.get("userEmail", "Not provided"),
         "userId": payload.get("userId", "unknown"),
-        "tenantId": payload.get("tenantId", "Thanos"),
+        "tenantId": tenant,
+        # What ThanosBE sent, echoed back in its callbacks
+        "callerTenantId": payload.get("tenantId") or tenant,
         "userRole": role,
         **perms
     }
@@ -49,55 +193,358 @@ class ChatPayload(BaseModel):
     userName: Optional[str] = "Unknown"
     userEmail: Optional[str] = "Not provided"
     userId: Optional[str] = "unknown"
-    tenantId: Optional[str] = "Thanos"
+    tenantId: Optional[str] = None  # DEFAULT_TENANT
     accessToken: Optional[str] = None
 
-@app.post("/chat")
-async def handle_chat(payload: ChatPayload):
+def faq_fast_path(context: dict, session_id: str):
+    """(history window, cached run). Both None when FAQ_CACHE is off; the run is None on a miss."""
+    if not FAQ_CACHE:
+        return None, None
+    window = load_history(context)
+    return window, cached_answer(context, window)
+
+def sync_cached_turn(context: dict, session_id: str, cached) -> bool:
+    """Queues a cached answer for /messages like any other turn; the sync only reads these attributes."""
+    view = SimpleNamespace(**context, session_id=session_id, last_user_msg=context["message"])
     try:
-        # 1. Validate & Map Context
-        context = validate_user_context(payload.dict())
-        
-        # 2. Get Agent Team
-        team = get_support_team(context)
-        
-        # 3. Run Agent
-        # Priority: conversationId > sessionId. user request: "take the session id from the user and not anything created"
-        session_id = context.get("conversationId") or context.get("sessionId")
-        if not session_id:
-             raise HTTPException(status_code=400, detail="conversationId or sessionId is required")
-             
-        team.last_user_msg = context["message"] # For sync tool
-        
-        response = team.run(
-            context["message"],
-            session_id=session_id
-        )
-        
-        # 4. Sync turn to backend
-        try:
-            from agents import sync_turn_to_backend
+        from agents import sync_turn_to_backend
+        with observability.span("backend_sync"):
+            return sync_turn_to_backend(view, cached)
+    except Exception:
+        log.exception("Post-run sync failed")
+        return False
+
+def start_turn(context: dict, session_id: str):
+    """
+    (history window, cached FAQ run or None, prefetched documentation or None).
+    The speculative search runs on its own pool while this thread loads the history.
+    """
+    prefetch = prefetch_documentation(context)
+    window, cached = faq_fast_path(context, session_id)
+    if cached is not None:
+        if prefetch is not None:
+            prefetch.cancel()
+        return window, cached, None
+    if window is None:
+        window = load_history(context)
+    return window, None, prefetched_documentation(prefetch)
+
+def raise_run_failure(response):
+    """agno reports a failed run as an error RunOutput; a deadline or open breaker behind it is raised instead."""
+    if getattr(response, "status", None) == RunStatus.error and resilience.failure() is not None:
+        raise resilience.failure()
+
+def run_chat_turn(context: dict, session_id: str):
+    """Blocking part of a chat turn: build the team, run it and sync the turn."""
+    window, cached, documentation = start_turn(context, session_id)
+    if cached is not None:
+        sync_cached_turn(context, session_id, cached)
+        return cached
+    with observability.span("agent_build"):
+        team = get_support_team(context, window, documentation)
+    team.last_user_msg = context["message"] # For sync tool
+
+    resilience.check("model")
+    response = team.run(
+        context["message"],
+        session_id=session_id
+    )
+    raise_run_failure(response)
+    record_tokens(context, response.metrics)
+    note_speculation(team, {t.tool_name for t in (response.tools or [])})
+    remember_answer(context, window, team, response)
+
+    # Sync turn to backend
+    try:
+        from agents import sync_turn_to_backend
+        with observability.span("backend_sync"):
             sync_turn_to_backend(team, response)
-        except Exception as e:
-            print(f"Post-run sync failed: {e}")
+    except Exception:
+        log.exception("Post-run sync failed")
+    get_store(context["tenantId"]).history_manager.schedule_fold(session_id, window, response)
 
-        # 5. Format response
-        output_text = response.content
-        if "TotalToken:" not in output_text and response.metrics:
-            output_text += f"\nTotalToken: {response.metrics.total_tokens}"
-        
-        return {
-            "output": output_text,
-            "sessionId": session_id,
-            "conversationId": context.get("conversationId")
-        }
+    return response
+
+SESSION_BUSY = "Another turn of this conversation is still running"
+DEADLINE_DETAIL = "The support agent did not answer in time, please retry"
+
+def unavailable(e: resilience.CircuitOpen) -> HTTPException:
+    return HTTPException(status_code=503, detail=f"Support agent is degraded ({e.dependency}), please retry shortly",
+                         headers={"Retry-After": str(max(1, math.ceil(e.retry_after)))})
+
+def chat_body(result, context: dict, session_id: str, request_id: str) -> dict:
+    output_text = result.content
+    if "TotalToken:" not in output_text and result.metrics:
+        output_text += f"\nTotalToken: {result.metrics.total_tokens}"
+    return {
+        "output": output_text,
+        "sessionId": session_id,
+        "conversationId": context.get("conversationId"),
+        "requestId": request_id,
+    }
+
+def serve_chat_turn(context: dict, session_id: str, key: str, ttl: Optional[float], request_id: str,
+                    arrived: float):
+    """
+    run_chat_turn under the session lock, its response recorded under the
+    request key. A request whose key was answered within ttl seconds, or
+    without a key since it arrived (a duplicate served by another process),
+    gets the recorded response instead.
+    """
+    with session_locks.hold(context["tenantId"], session_id):
+        stored = request_log.get(key, replay_age(ttl, arrived))
+        if stored is not None:
+            COALESCED.inc(source="stored")
+            return SimpleNamespace(body=stored, replayed=True, faq_hit=False)
+        result = run_chat_turn(context, session_id)
+        body = chat_body(result, context, session_id, request_id)
+        request_log.put(key, session_id, body)
+        return SimpleNamespace(body=body, replayed=False,
+                               faq_hit=bool(result.metadata and "faqCache" in result.metadata))
+
+@app.post("/chat")
+async def handle_chat(payload: ChatPayload, request: Request, response: Response):
+    started = time.perf_counter()
+    request_id = request.headers.get("X-Request-ID") or observability.new_request_id()
+    response.headers["X-Request-ID"] = request_id
+    try:
+        with observability.request_context(request_id, payload.conversationId or payload.sessionId,
+                                           endpoint="chat"), \
+                resilience.deadline(resilience.request_budget(request.headers.get("X-Request-Timeout"))) as deadline, \
+                traffic_capture.capture.request("chat", payload, "Idempotency-Key" in request.headers):
+            # 1. Validate & Map Context
+            with observability.span("validate"):
+                context = validate_user_context(payload.dict())
+            
+            # 2. Resolve Session
+            # Priority: conversationId > sessionId. user request: "take the session id from the user and not anything created"
+            session_id = context.get("conversationId") or context.get("sessionId")
+            if not session_id:
+                 raise HTTPException(status_code=400, detail="conversationId or sessionId is required")
+            
+            # 3. Build, run & sync the agent team on the worker pool, once per request key.
+            # Past the deadline the client gets a 504; the turn finishes (and is recorded) in the background.
+            key, ttl = request_key(context["tenantId"], session_id, context.get("userId"), context["message"],
+                                   request.headers.get("Idempotency-Key"))
+            turn, shared = await resilience.within(deadline, in_flight.run(
+                key, lambda: run_in_agent_pool(serve_chat_turn, context, session_id, key, ttl, request_id, started)))
+
+            # 4. Respond
+            if shared or turn.replayed:
+                response.headers["Idempotent-Replayed"] = "true"
+            traffic_capture.note(responseChars=len(turn.body["output"]), replayed=shared or turn.replayed,
+                                 faqHit=turn.faq_hit)
+            CHAT_LATENCY.observe(time.perf_counter() - started, endpoint="chat")
+            if turn.faq_hit:
+                FAQ_HIT_LATENCY.observe(time.perf_counter() - started, endpoint="chat")
+            return turn.body
         
+    except HTTPException:
+        raise
+    except SessionBusy:
+        raise HTTPException(status_code=409, detail=SESSION_BUSY)
+    except resilience.DeadlineExceeded as e:
+        log.warning("Chat turn ran out of time", extra={"requestId": request_id, "stage": str(e)})
+        raise HTTPException(status_code=504, detail=DEADLINE_DETAIL)
+    except resilience.CircuitOpen as e:
+        log.warning("Chat turn refused by circuit breaker", extra={"requestId": request_id, "dependency": e.dependency})
+        raise unavailable(e)
     except Exception as e:
+        log.exception("Chat turn failed", extra={"requestId": request_id})
         raise HTTPException(status_code=500, detail=str(e))
 
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def stream_chat_turn(context: dict, session_id: str, emit, key: str = None, ttl: Optional[float] = None,
+                     request_id: str = None, arrived: float = None):
+    """
+    Blocking streaming turn, run on the agent pool. Forwards content deltas and
+    tool-call events through emit(event, data) and closes with usage + sync events.
+    Holds the session lock like serve_chat_turn; a request whose key was already
+    answered gets the recorded output as a single delta.
+    """
+    try:
+        with session_locks.hold(context["tenantId"], session_id):
+            stored = request_log.get(key, replay_age(ttl, arrived)) if key else None
+            if stored is not None:
+                COALESCED.inc(source="stored")
+                emit("delta", {"content": stored["output"]})
+                emit("usage", {"totalTokens": None})
+                emit("sync", {"status": "replayed"})
+                return
+            window, cached, documentation = start_turn(context, session_id)
+            if cached is not None:
+                emit("delta", {"content": cached.content})
+                emit("usage", {"totalTokens": 0})
+                emit("sync", {"status": "queued" if sync_cached_turn(context, session_id, cached) else "failed"})
+                return
+            with observability.span("agent_build"):
+                team = get_support_team(context, window, documentation)
+            team.last_user_msg = context["message"] # For sync tool
+
+            resilience.check("model")
+            content_parts = []
+            tools = []
+            run_metrics = None
+            for event in team.run(context["message"], session_id=session_id, stream=True, stream_events=True):
+                kind = getattr(event, "event", "")
+                if kind == "RunContent" and event.content:
+                    content_parts.append(event.content)
+                    emit("delta", {"content": event.content})
+                elif kind in ("ToolCallStarted", "ToolCallCompleted"):
+                    tool = getattr(event, "tool", None)
+                    if kind == "ToolCallCompleted":
+                        tools.append(tool)
+                    emit("tool_call", {
+                        "tool": getattr(tool, "tool_name", None),
+                        "status": "started" if kind == "ToolCallStarted" else "completed",
+                    })
+                elif kind == "RunCompleted":
+                    run_metrics = getattr(event, "metrics", None)
+                elif kind == "RunError":
+                    raise resilience.failure() or RuntimeError(getattr(event, "content", None) or "Agent run failed")
+
+            total_tokens = run_metrics.total_tokens if run_metrics else None
+            record_tokens(context, run_metrics)
+            emit("usage", {"totalTokens": total_tokens})
+
+            response = SimpleNamespace(content="".join(content_parts), metrics=run_metrics,
+                                       status=RunStatus.completed, tools=tools)
+            if key:
+                request_log.put(key, session_id, chat_body(response, context, session_id, request_id))
+            note_speculation(team, {getattr(t, "tool_name", None) for t in tools})
+            traffic_capture.note(responseChars=len(response.content))
+            remember_answer(context, window, team, response)
+            try:
+                from agents import sync_turn_to_backend
+                with observability.span("backend_sync"):
+                    synced = sync_turn_to_backend(team, response)
+                emit("sync", {"status": "queued" if synced else "failed"})
+            except Exception:
+                log.exception("Post-run sync failed")
+                emit("sync", {"status": "failed"})
+            # The streamed run isn't a RunOutput; it is folded with the next turn
+            get_store(context["tenantId"]).history_manager.schedule_fold(session_id, window)
+    except SessionBusy:
+        traffic_capture.note(error="SessionBusy")
+        emit("error", {"detail": SESSION_BUSY})
+    except resilience.DeadlineExceeded as e:
+        log.warning("Streaming chat turn ran out of time", extra={"stage": str(e)})
+        traffic_capture.note(error="DeadlineExceeded")
+        emit("error", {"detail": DEADLINE_DETAIL})
+    except resilience.CircuitOpen as e:
+        traffic_capture.note(error="CircuitOpen")
+        emit("error", {"detail": unavailable(e).detail})
+    except Exception as e:
+        log.exception("Streaming chat turn failed")
+        traffic_capture.note(error=type(e).__name__)
+        emit("error", {"detail": str(e)})
+    finally:
+        emit(None, None)
+
+@app.post("/chat/stream")
+async def handle_chat_stream(payload: ChatPayload, request: Request):
+    """Server-Sent Events variant of /chat: delta, tool_call, usage, sync, done."""
+    started = time.perf_counter()
+    request_id = request.headers.get("X-Request-ID") or observability.new_request_id()
+    context = validate_user_context(payload.dict())
+    session_id = context.get("conversationId") or context.get("sessionId")
+    if not session_id:
+        raise HTTPException(status_code=400, detail="conversationId or sessionId is required")
+
+    key, ttl = request_key(context["tenantId"], session_id, context.get("userId"), context["message"],
+                           request.headers.get("Idempotency-Key"))
+    budget = resilience.request_budget(request.headers.get("X-Request-Timeout"))
+    if agent_pool_full():
+        raise agent_pool_busy()
+    loop = asyncio.get_running_loop()
+    events: asyncio.Queue = asyncio.Queue()
+
+    def emit(event, data):
+        loop.call_soon_threadsafe(events.put_nowait, (event, data))
+
+    async def event_stream():
+        # The slot is taken here, not in the handler: a client that disconnects
+        # before the body starts never runs this generator, and would leak it
+        first_token_at = None
+        future = None
+        release = None
+        try:
+            with observability.request_context(request_id, session_id, endpoint="chat_stream"), \
+                    resilience.deadline(budget) as deadline, \
+                    traffic_capture.capture.request("chat_stream", payload, "Idempotency-Key" in request.headers):
+                try:
+                    release = reserve_agent_slot()
+                except HTTPException as e:
+                    # Filled up since the handler checked; too late for a 503 status
+                    traffic_capture.note(error="AgentPoolBusy")
+                    yield sse_event("error", {"detail": e.detail})
+                    return
+                ctx = contextvars.copy_context()
+                future = loop.run_in_executor(agent_pool, ctx.run, stream_chat_turn, context, session_id, emit,
+                                              key, ttl, request_id, started)
+                # The worker keeps its slot until it finishes, even if the client disconnects
+                future.add_done_callback(lambda _: release())
+                yield sse_event("session", {"sessionId": session_id, "conversationId": context.get("conversationId"),
+                                            "requestId": request_id})
+                while True:
+                    try:
+                        event, data = await asyncio.wait_for(events.get(), deadline.remaining() + resilience.DEADLINE_GRACE)
+                    except asyncio.TimeoutError:
+                        # The worker still ends on its own; its later events have no reader
+                        resilience.exceeded("response")
+                        traffic_capture.note(error="DeadlineExceeded")
+                        yield sse_event("error", {"detail": DEADLINE_DETAIL})
+                        break
+                    if event is None:
+                        break
+                    if event == "delta" and first_token_at is None:
+                        first_token_at = time.perf_counter()
+                        CHAT_TTFT.observe(first_token_at - started, endpoint="chat_stream")
+                        traffic_capture.note(ttftMs=round((first_token_at - started) * 1000, 1))
+                    yield sse_event(event, data)
+
+                total = time.perf_counter() - started
+                CHAT_LATENCY.observe(total, endpoint="chat_stream")
+                yield sse_event("done", {
+                    "timeToFirstToken": round(first_token_at - started, 3) if first_token_at else None,
+                    "totalLatency": round(total, 3),
+                })
+        except BaseException:
+            if future is None and release is not None:
+                release()
+            raise
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "X-Request-ID": request_id},
+    )
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Every registered counter, gauge and histogram in the Prometheus text format."""
+    return PlainTextResponse(metrics.render_prometheus(), media_type="text/plain; version=0.0.4")
+
 @app.get("/health")
 async def health_check():
-    return {"status": "healthy", "service": "agno-agent-thanos"}
+    return {"status": "healthy", "service": "agno-agent-thanos", "agentPool": get_pool_stats(),
+            "latency": {"total": CHAT_LATENCY.snapshot(), "timeToFirstToken": CHAT_TTFT.snapshot()},
+            "backendSync": outbox.stats(),
+            "dbPool": database.pool_stats(),
+            "ragCache": {"embedding": rag_cache.embedding_stats(),
+                         **{store.tenant: store.search_cache.stats() for store in loaded_stores()}},
+            "faqCache": {"enabled": FAQ_CACHE, "hitLatency": FAQ_HIT_LATENCY.snapshot(),
+                         **{store.tenant: store.answer_cache.stats() for store in loaded_stores()}},
+            "prompt": {"blockTokens": prompt_cache.block_tokens(), "contextCache": prompt_cache.context_cache.stats()},
+            "ragContext": retrieval.stats(),
+            "speculativeRetrieval": speculation_stats(),
+            "singleFlight": session_lock.stats(),
+            "resilience": resilience.stats(),
+            "trafficCapture": traffic_capture.capture.stats(),
+            "history": history.stats(),
+            "embeddings": get_embedding_service().stats()}
 
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,145 @@
+import time
+import threading
+from collections import deque
+from typing import Dict, Tuple
+
+# --- In-process metrics for the chat service ---
+# Lightweight counters and latency histograms shared by main.py and agents.py.
+# Histograms keep a bounded window of recent samples so percentiles reflect
+# current behaviour rather than the whole process lifetime.
+
+LatencyKey = Tuple[Tuple[str, str], ...]
+
+def _label_key(labels: dict) -> LatencyKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def _percentile(sorted_values, q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    idx = min(int(round(q * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[idx]
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._values: Dict[LatencyKey, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {",".join(f"{k}={v}" for k, v in key) or "_": value for key, value in self._values.items()}
+
+    def total(self, **labels) -> float:
+        """Sum over every label set that includes `labels`."""
+        wanted = set(_label_key(labels))
+        with self._lock:
+            return sum(value for key, value in self._values.items() if wanted <= set(key))
+
+class Gauge(Counter):
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[_label_key(labels)] = value
+
+class Histogram:
+    def __init__(self, name: str, help: str, window: int = 1024):
+        self.name = name
+        self.help = help
+        self.window = window
+        self._samples: Dict[LatencyKey, deque] = {}
+        self._totals: Dict[LatencyKey, list] = {}  # [count, sum] over process lifetime
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._samples.setdefault(key, deque(maxlen=self.window)).append(value)
+            totals = self._totals.setdefault(key, [0, 0.0])
+            totals[0] += 1
+            totals[1] += value
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def snapshot(self) -> dict:
+        out = {}
+        with self._lock:
+            for key, samples in self._samples.items():
+                values = sorted(samples)
+                count, total = self._totals[key]
+                out[",".join(f"{k}={v}" for k, v in key) or "_"] = {
+                    "count": count,
+                    "sum": round(total, 4),
+                    "p50": round(_percentile(values, 0.50), 4),
+                    "p95": round(_percentile(values, 0.95), 4),
+                    "p99": round(_percentile(values, 0.99), 4),
+                }
+        return out
+
+class _Timer:
+    def __init__(self, histogram: Histogram, labels: dict):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+        return False
+
+REGISTRY: Dict[str, object] = {}
+
+def counter(name: str, help: str) -> Counter:
+    return REGISTRY.setdefault(name, Counter(name, help))
+
+def gauge(name: str, help: str) -> Gauge:
+    return REGISTRY.setdefault(name, Gauge(name, help))
+
+def histogram(name: str, help: str) -> Histogram:
+    return REGISTRY.setdefault(name, Histogram(name, help))
+
+def snapshot() -> dict:
+    return {name: metric.snapshot() for name, metric in REGISTRY.items()}
+
+# --- Prometheus text exposition (served by /metrics) ---
+# Histograms are exported as summaries: quantiles over the recent-sample
+# window, _sum and _count over the process lifetime.
+
+SUMMARY_QUANTILES = (0.5, 0.95, 0.99)
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(key: LatencyKey, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+    pairs = key + extra
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+def render_prometheus() -> str:
+    lines = []
+    for name, metric in list(REGISTRY.items()):
+        lines.append(f"# HELP {name} {metric.help}")
+        if isinstance(metric, Histogram):
+            lines.append(f"# TYPE {name} summary")
+            with metric._lock:
+                series = [(key, sorted(samples), metric._totals[key]) for key, samples in metric._samples.items()]
+            for key, values, (count, total) in series:
+                for q in SUMMARY_QUANTILES:
+                    lines.append(f"{name}{_labels(key, (('quantile', str(q)),))} {_percentile(values, q)}")
+                lines.append(f"{name}_sum{_labels(key)} {total}")
+                lines.append(f"{name}_count{_labels(key)} {count}")
+        else:
+            lines.append(f"# TYPE {name} {'gauge' if isinstance(metric, Gauge) else 'counter'}")
+            with metric._lock:
+                values = list(metric._values.items())
+            for key, value in values:
+                lines.append(f"{name}{_labels(key)} {value}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,158 @@
+import os
+import json
+import time
+import uuid
+import logging
+import contextvars
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timezone
+from typing import Optional
+
+import metrics
+
+# --- Request tracing and structured logs ---
+# Each chat request gets a request ID (the caller's X-Request-ID or a new one)
+# held in a contextvar. Log lines from any module and every span are tied to it;
+# the agent worker pool runs turns inside a copy of the request's context.
+# span() times one pipeline stage into chat_stage_seconds{stage}, adds it to
+# the request's trace (logged as a single "request finished" line with the
+# per-stage breakdown) and, when OTEL_EXPORTER_OTLP_ENDPOINT is set and the
+# OpenTelemetry SDK is installed, exports it as an OTel span too.
+
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")  # json | text
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+OTEL_ENDPOINT = os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT")
+SERVICE_NAME = os.getenv("OTEL_SERVICE_NAME", "agno-agent-thanos")
+
+STAGE_SECONDS = metrics.histogram("chat_stage_seconds", "Time spent per chat pipeline stage")
+STAGE_ERRORS = metrics.counter("chat_stage_errors_total", "Pipeline stages that raised, by stage")
+
+_request_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("request_id", default=None)
+_session_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("session_id", default=None)
+# (stage, seconds) spans of the current request; shared by reference with worker threads
+_trace: contextvars.ContextVar[Optional[list]] = contextvars.ContextVar("trace", default=None)
+_tracer = None
+_logging_configured = False
+
+log = logging.getLogger(__name__)
+
+# Attributes every LogRecord has; anything else came from extra={...}
+_RECORD_FIELDS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+def new_request_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+def _fields(record: logging.LogRecord) -> dict:
+    fields = {"requestId": _request_id.get(), "sessionId": _session_id.get()}
+    fields.update({k: v for k, v in vars(record).items() if k not in _RECORD_FIELDS})
+    return {k: v for k, v in fields.items() if v is not None}
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            **_fields(record),
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class TextFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        fields = " ".join(f"{k}={v}" for k, v in _fields(record).items())
+        line = f"{self.formatTime(record)} {record.levelname:<7} [{record.name}] {record.getMessage()} {fields}"
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line.rstrip()
+
+def configure_logging(fmt: str = LOG_FORMAT, level: str = LOG_LEVEL):
+    """Installs the JSON (or text) handler on the root logger once."""
+    global _logging_configured
+    if _logging_configured:
+        return
+    handler = logging.StreamHandler()
+    handler.setFormatter(TextFormatter() if fmt == "text" else JsonFormatter())
+    root = logging.getLogger()
+    root.addHandler(handler)
+    root.setLevel(level.upper())
+    _logging_configured = True
+
+def init_tracing():
+    """Exports spans over OTLP when OTEL_EXPORTER_OTLP_ENDPOINT is set and the SDK is installed."""
+    global _tracer
+    if not OTEL_ENDPOINT or _tracer is not None:
+        return
+    try:
+        from opentelemetry import trace
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+    except ImportError:
+        log.warning("OTEL_EXPORTER_OTLP_ENDPOINT is set but opentelemetry-sdk and "
+                    "opentelemetry-exporter-otlp-proto-http are not installed; spans stay local")
+        return
+    provider = TracerProvider(resource=Resource.create({"service.name": SERVICE_NAME}))
+    provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+    trace.set_tracer_provider(provider)
+    _tracer = trace.get_tracer(SERVICE_NAME)
+    log.info("Exporting traces", extra={"endpoint": OTEL_ENDPOINT})
+
+@contextmanager
+def span(stage: str, **attributes):
+    """Times one pipeline stage; nested spans are timed separately (and nest in OTel)."""
+    started = time.perf_counter()
+    otel_span = nullcontext()
+    if _tracer is not None:
+        otel_span = _tracer.start_as_current_span(stage, attributes={
+            k: v for k, v in attributes.items() if isinstance(v, (str, bool, int, float))
+        })
+    with otel_span:
+        try:
+            yield
+        except BaseException:
+            STAGE_ERRORS.inc(stage=stage)
+            raise
+        finally:
+            seconds = time.perf_counter() - started
+            STAGE_SECONDS.observe(seconds, stage=stage)
+            trace = _trace.get()
+            if trace is not None:
+                trace.append((stage, seconds))
+
+def trace_stages() -> list:
+    """(stage, seconds) of the current request's finished spans, in the order they ended."""
+    trace = _trace.get()
+    return list(trace) if trace is not None else []
+
+@contextmanager
+def request_context(request_id: Optional[str] = None, session_id: Optional[str] = None, **attributes):
+    """
+    Scope of one chat request: sets the request/session IDs for logs and spans,
+    wraps the work in a "request" span and logs the stage breakdown at the end.
+    """
+    request_id = request_id or new_request_id()
+    tokens = [(_request_id, _request_id.set(request_id)), (_session_id, _session_id.set(session_id)),
+              (_trace, _trace.set([]))]
+    trace = _trace.get()
+    started = time.perf_counter()
+    try:
+        with span("request", request_id=request_id, **attributes):
+            yield request_id
+    finally:
+        stages = {}
+        for stage, seconds in trace:
+            if stage != "request":
+                stages[stage] = round(stages.get(stage, 0.0) + seconds * 1000, 1)
+        log.info("request finished", extra={
+            "durationMs": round((time.perf_counter() - started) * 1000, 1), "stagesMs": stages, **attributes,
+        })
+        for var, token in reversed(tokens):
+            try:
+                var.reset(token)
+            except ValueError:
+                # A streaming response can finish in a different context than it started in
+                pass
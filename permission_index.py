@@ -0,0 +1,467 @@
+import os
+import re
+import logging
+import time
+from dataclasses import dataclass, replace
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from sqlalchemy import Text, cast, func, inspect, literal_column, select, text
+from agno.knowledge.document.base import Document
+from agno.vectordb.distance import Distance
+
+import resilience
+
+log = logging.getLogger(__name__)
+
+# --- Permission-aware indexing for the knowledge table ---
+# meta_data stores perm/superperm/allperm with mixed types ("3", 0, 1). JSONB
+# containment compares them strictly, and the planner cannot estimate them, so
+# a filtered search either scans every row or (with a global HNSW index) walks
+# the ANN graph first and drops rows that fail the filter, returning < limit.
+#
+# The migration adds typed generated columns (acl_perm, acl_superperm,
+# acl_allperm), a btree on each and one partial HNSW index per permission
+# value. A permission-scoped search then walks only that permission's graph;
+# permissions too small for their own index are ranked exactly via the btree.
+# A stored content tsvector (content_tsv) with a GIN index serves keyword
+# candidates for hybrid search without re-parsing every chunk per query.
+#
+# tenant_id in a filter is checked with JSONB containment next to the typed
+# conditions: each tenant has its own table, so it is a guard that passes for
+# every row rather than a selective predicate the planner has to estimate.
+
+PERMISSION_KEYS = ("perm", "superperm", "allperm")
+TENANT_KEY = "tenant_id"
+TSV_COLUMN = "content_tsv"
+EF_SEARCH = int(os.getenv("RAG_HNSW_EF_SEARCH", "100"))
+PARTIAL_INDEX_MIN_ROWS = int(os.getenv("RAG_PARTIAL_INDEX_MIN_ROWS", "5000"))
+HNSW_M = 16
+HNSW_EF_CONSTRUCTION = 64
+# A permission covering this share of the table is served by the global index
+GLOBAL_INDEX_SHARE = 0.9
+
+# --- Compact vector indexes ---
+# Each HNSW graph keeps its own copy of every embedding, and a search is only
+# fast while the graphs fit in memory. VECTOR_INDEX picks what the graphs store:
+#
+#   full      vector, 4 bytes per dimension (the original layout)
+#   halfvec   16-bit floats, half the size                          (pgvector >= 0.7)
+#   binary    one bit per dimension (binary_quantize), Hamming      (pgvector >= 0.7)
+#
+# VECTOR_INDEX_DIMENSIONS indexes only the leading dimensions (Matryoshka
+# truncation: Gemini embeddings are trained so that a prefix still ranks
+# well). Unless the graphs hold the full vectors, a search takes
+# VECTOR_RESCORE_FACTOR x limit candidates from the graph and re-ranks them by
+# exact cosine distance on the embedding column, which stays in the table.
+#
+# The settings apply to tables indexed for the first time; re-running the
+# migration (every sync does) keeps a table's layout. Convert an existing
+# table with `python permission_index.py --vector-index halfvec`.
+#
+#   VECTOR_INDEX=full
+#   VECTOR_INDEX_DIMENSIONS=0          0 = all dimensions
+#   VECTOR_RESCORE_FACTOR=4
+
+VECTOR_INDEX = os.getenv("VECTOR_INDEX", "full")
+VECTOR_INDEX_DIMENSIONS = int(os.getenv("VECTOR_INDEX_DIMENSIONS", "0"))
+RESCORE_FACTOR = int(os.getenv("VECTOR_RESCORE_FACTOR", "4"))
+VECTOR_INDEX_KINDS = ("full", "halfvec", "binary")
+# halfvec, bit_hamming_ops and binary_quantize arrived in pgvector 0.7.0
+COMPACT_MIN_PGVECTOR = (0, 7, 0)
+
+@dataclass(frozen=True)
+class VectorIndex:
+    """What the HNSW graphs store: kind and indexed dimensions (0 = all)."""
+    kind: str = "full"
+    dimensions: int = 0
+
+    def __post_init__(self):
+        if self.kind not in VECTOR_INDEX_KINDS:
+            raise ValueError(f"vector index must be one of {', '.join(VECTOR_INDEX_KINDS)}, not {self.kind!r}")
+
+    @classmethod
+    def from_env(cls) -> "VectorIndex":
+        return cls(VECTOR_INDEX, VECTOR_INDEX_DIMENSIONS)
+
+    @classmethod
+    def parse(cls, indexdef: str) -> "VectorIndex":
+        """The layout of an HNSW index from its pg_indexes definition."""
+        kind = "binary" if "bit_hamming_ops" in indexdef else "halfvec" if "halfvec_cosine_ops" in indexdef else "full"
+        prefix = re.search(r"\[1:(\d+)\]", indexdef)
+        return cls(kind, int(prefix.group(1)) if prefix else 0)
+
+    def resolve(self, table_dimensions: int) -> "VectorIndex":
+        """Dimensions made explicit: 0 and anything past the column's size mean all of them."""
+        if not 0 < self.dimensions < table_dimensions:
+            return replace(self, dimensions=table_dimensions)
+        return self
+
+    @property
+    def label(self) -> str:
+        return f"{self.kind}:{self.dimensions}" if self.dimensions else self.kind
+
+    def compact(self, table_dimensions: int) -> bool:
+        """Whether graph distances are approximate and candidates need rescoring."""
+        return self.kind != "full" or self.resolve(table_dimensions).dimensions < table_dimensions
+
+    def _source(self, table_dimensions: int) -> str:
+        d = self.resolve(table_dimensions).dimensions
+        # Array slicing instead of subvector() so truncated full-precision indexes work on pgvector < 0.7
+        return "embedding" if d == table_dimensions else f"((embedding::real[])[1:{d}])::vector({d})"
+
+    def expression(self, table_dimensions: int) -> str:
+        d = self.resolve(table_dimensions).dimensions
+        source = self._source(table_dimensions)
+        if self.kind == "halfvec":
+            return f"({source})::halfvec({d})"
+        if self.kind == "binary":
+            return f"(binary_quantize({source}))::bit({d})"
+        return source
+
+    def hnsw(self, table_dimensions: int) -> str:
+        """USING clause of the HNSW indexes; the original full layout keeps its original text."""
+        opclass = {"full": "vector_cosine_ops", "halfvec": "halfvec_cosine_ops", "binary": "bit_hamming_ops"}[self.kind]
+        expression = self.expression(table_dimensions)
+        column = expression if expression == "embedding" else f"({expression})"
+        return f"USING hnsw ({column} {opclass}) WITH (m = {HNSW_M}, ef_construction = {HNSW_EF_CONSTRUCTION})"
+
+    def distance(self, embedding: Sequence[float], table_dimensions: int):
+        """ORDER BY clause that walks these graphs for a query embedding."""
+        d = self.resolve(table_dimensions).dimensions
+        prefix = list(embedding)[:d]
+        if self.kind == "binary":
+            # Same bits binary_quantize() sets: one for every positive component
+            return text(f"{self.expression(table_dimensions)} <~> CAST(:query AS bit({d}))").bindparams(
+                query="".join("1" if x > 0 else "0" for x in prefix))
+        vector_type = f"halfvec({d})" if self.kind == "halfvec" else f"vector({d})"
+        return text(f"{self.expression(table_dimensions)} <=> CAST(:query AS {vector_type})").bindparams(
+            query="[" + ",".join(repr(float(x)) for x in prefix) + "]")
+
+def pgvector_version(conn) -> Tuple[int, ...]:
+    version = conn.execute(text("SELECT extversion FROM pg_extension WHERE extname = 'vector'")).scalar() or "0"
+    return tuple(int(part) for part in re.findall(r"\d+", version))
+
+def embedding_dimensions(conn, full: str) -> int:
+    """Declared size of the embedding column (its type modifier)."""
+    return conn.execute(text(
+        "SELECT atttypmod FROM pg_attribute WHERE attrelid = CAST(:t AS regclass) AND attname = 'embedding'"
+    ), {"t": full}).scalar()
+
+def acl_column(key: str) -> str:
+    return f"acl_{key}"
+
+def _generated_expression(key: str) -> str:
+    # Generated columns keep every writer (pipeline, knowledge.insert) in sync without code changes
+    return (f"CASE WHEN meta_data->>'{key}' ~ '^[0-9]+$' "
+            f"THEN (meta_data->>'{key}')::smallint ELSE 0 END")
+
+def typed_filter(meta_filter: Optional[Dict[str, Any]]) -> Optional[List[Tuple[str, int]]]:
+    """
+    {"perm": "3"} -> [("acl_perm", 3)]. Returns None when the filter uses keys
+    or values the typed columns can't express, so callers fall back to JSONB.
+    tenant_id is left to tenant_condition().
+    """
+    conditions = []
+    for key, value in (meta_filter or {}).items():
+        if key == TENANT_KEY:
+            continue
+        if key not in PERMISSION_KEYS or not str(value).isdigit():
+            return None
+        conditions.append((acl_column(key), int(value)))
+    return conditions
+
+def tenant_condition(table, meta_filter: Optional[Dict[str, Any]]):
+    tenant = (meta_filter or {}).get(TENANT_KEY)
+    return None if tenant is None else table.c.meta_data.contains({TENANT_KEY: tenant})
+
+def _index_name(table: str, key: str, value: int) -> str:
+    return f"idx_{table}_hnsw_{key}_{value}"
+
+def bound_statement(sess):
+    """Caps the transaction's statements at the request's remaining time, if it has a deadline."""
+    left = resilience.remaining()
+    if left is not None:
+        sess.execute(text(f"SET LOCAL statement_timeout = {max(1, int(left * 1000))}"))
+
+def _tsvector_sql(language: str) -> str:
+    return f"to_tsvector('{language}'::regconfig, content)"
+
+def migrate(engine, table: str, schema: str = "ai", min_partition_rows: int = PARTIAL_INDEX_MIN_ROWS,
+            language: str = "english", vector_index: Optional[VectorIndex] = None) -> dict:
+    """
+    Idempotent. Adds the typed permission columns and content_tsv (rewriting
+    existing rows once), their btree and GIN indexes, a global HNSW index for
+    unfiltered searches and a partial HNSW index for every permission value
+    with at least min_partition_rows chunks. Smaller partitions are ranked
+    exactly. Re-run after ingestion so new permission values get their own index.
+
+    vector_index converts the HNSW indexes to another layout. Without it the
+    table keeps the layout of its global index, and a table without one gets
+    VECTOR_INDEX. A converted index is built next to the old one and swapped
+    in, so searches keep working meanwhile.
+    """
+    full = f"{schema}.{table}"
+    created = []
+    started = time.perf_counter()
+    existing = {c["name"] for c in inspect(engine).get_columns(table, schema=schema)}
+    columns = {acl_column(key): f"smallint GENERATED ALWAYS AS ({_generated_expression(key)}) STORED"
+               for key in PERMISSION_KEYS}
+    columns[TSV_COLUMN] = f"tsvector GENERATED ALWAYS AS ({_tsvector_sql(language)}) STORED"
+    missing = [name for name in columns if name not in existing]
+
+    with engine.begin() as conn:
+        if missing:
+            log.info("Adding generated columns", extra={"table": full, "columns": missing})
+            conn.execute(text(f"ALTER TABLE {full} " + ", ".join(
+                f"ADD COLUMN {name} {columns[name]}" for name in missing
+            )))
+        for key in PERMISSION_KEYS:
+            conn.execute(text(f"CREATE INDEX IF NOT EXISTS idx_{table}_{acl_column(key)} ON {full} ({acl_column(key)})"))
+
+    global_index = f"{table}_hnsw_index"
+    with engine.connect() as conn:
+        indexes = dict(conn.execute(text(
+            "SELECT indexname, indexdef FROM pg_indexes WHERE schemaname = :s AND tablename = :t"
+        ), {"s": schema, "t": table}).all())
+        dimensions = embedding_dimensions(conn, full)
+        layout = _target_layout(conn, indexes.get(global_index), vector_index, dimensions)
+    hnsw = layout.hnsw(dimensions)
+    # Same names agno's PgVector.optimize() uses
+    wanted = [
+        (f"{table}_content_gin_index", f"USING gin ({TSV_COLUMN})"),
+        (global_index, hnsw),
+    ]
+    with engine.connect() as conn:
+        total = conn.execute(text(f"SELECT count(*) FROM {full}")).scalar()
+        for key in PERMISSION_KEYS:
+            rows = conn.execute(text(
+                f"SELECT {acl_column(key)} AS value, count(*) AS n FROM {full} "
+                f"WHERE {acl_column(key)} <> 0 GROUP BY 1"
+            ))
+            for row in rows:
+                # A partition covering most of the table is served well enough by the global index
+                if min_partition_rows <= row.n < GLOBAL_INDEX_SHARE * total:
+                    wanted.append((_index_name(table, key, row.value),
+                                   f"{hnsw} WHERE {acl_column(key)} = {int(row.value)}"))
+
+    converted, dropped = [], []
+    for name, definition in wanted:
+        if name in indexes:
+            if "USING hnsw" not in indexes[name] or VectorIndex.parse(indexes[name]).resolve(dimensions) == layout:
+                continue
+            log.info("Converting index", extra={"index": name, "layout": layout.label})
+            _swap_index(engine, schema, full, name, definition)
+            converted.append(name)
+            continue
+        log.info("Building index", extra={"index": name})
+        with engine.begin() as conn:
+            conn.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON {full} {definition}"))
+        created.append(name)
+
+    # Partial graphs of the old layout that are no longer wanted would never be used again
+    wanted_names = {name for name, _ in wanted}
+    for name, definition in indexes.items():
+        if (name.startswith(f"idx_{table}_hnsw_") and name not in wanted_names
+                and VectorIndex.parse(definition).resolve(dimensions) != layout):
+            with engine.begin() as conn:
+                conn.execute(text(f"DROP INDEX IF EXISTS {schema}.{name}"))
+            dropped.append(name)
+
+    with engine.begin() as conn:
+        conn.execute(text(f"ANALYZE {full}"))
+    log.info("Permission indexes ready", extra={
+        "table": full, "built": len(created), "converted": len(converted), "vectorIndex": layout.label,
+        "seconds": round(time.perf_counter() - started, 1),
+    })
+    return {"addedColumns": missing, "createdIndexes": created, "convertedIndexes": converted,
+            "droppedIndexes": dropped, "vectorIndex": layout.label}
+
+def _target_layout(conn, global_indexdef: Optional[str], requested: Optional[VectorIndex], dimensions: int) -> VectorIndex:
+    """The layout migrate() builds: the requested one, else the table's current one, else VECTOR_INDEX."""
+    if requested is None and global_indexdef is not None:
+        return VectorIndex.parse(global_indexdef).resolve(dimensions)
+    layout = (requested or VectorIndex.from_env()).resolve(dimensions)
+    if layout.kind != "full" and pgvector_version(conn) < COMPACT_MIN_PGVECTOR:
+        message = f"VECTOR_INDEX={layout.kind} needs pgvector >= 0.7.0"
+        if requested is not None:
+            raise ValueError(message)
+        # A sync shouldn't fail after ingesting because of an index setting
+        log.warning(f"{message}; building full-precision indexes", extra={"dimensions": layout.dimensions})
+        layout = replace(layout, kind="full")
+    return layout
+
+def _swap_index(engine, schema: str, full: str, name: str, definition: str):
+    # CREATE INDEX blocks writes to the table but not reads; the swap itself is one short transaction
+    building = f"{name[:59]}_new"
+    with engine.begin() as conn:
+        conn.execute(text(f"DROP INDEX IF EXISTS {schema}.{building}"))
+        conn.execute(text(f"CREATE INDEX {building} ON {full} {definition}"))
+    with engine.begin() as conn:
+        conn.execute(text(f"DROP INDEX {schema}.{name}"))
+        conn.execute(text(f"ALTER INDEX {schema}.{building} RENAME TO {name}"))
+
+class PermissionSearch:
+    """Filter-first vector search over the typed permission columns."""
+
+    def __init__(self, vector_db, ef_search: int = EF_SEARCH, rescore_factor: int = RESCORE_FACTOR):
+        self.vector_db = vector_db
+        self.ef_search = ef_search
+        self.rescore_factor = rescore_factor
+        self._layout: Optional[dict] = None
+        self._checked_at = 0.0
+        self._warned = False
+
+    def layout(self) -> Optional[dict]:
+        """
+        Partial indexes, permission shares (from pg_stats), the layout of the
+        HNSW graphs and whether content_tsv exists, refreshed once a minute so
+        servers pick up a migration or new indexes without a restart. None
+        until the typed columns exist.
+        """
+        if self._checked_at and time.monotonic() - self._checked_at < 60:
+            return self._layout
+        self._checked_at = time.monotonic()
+        db = self.vector_db
+        try:
+            with db.db_engine.connect() as conn:
+                columns = {c["name"] for c in inspect(conn).get_columns(db.table_name, schema=db.schema)}
+                if not all(acl_column(k) in columns for k in PERMISSION_KEYS):
+                    if not self._warned:
+                        log.warning("Typed permission columns missing; run `python permission_index.py` to migrate")
+                        self._warned = True
+                    self._layout = None
+                    return None
+                indexes = dict(conn.execute(text(
+                    "SELECT indexname, indexdef FROM pg_indexes WHERE schemaname = :s AND tablename = :t"
+                ), {"s": db.schema, "t": db.table_name}).all())
+                shares = {}
+                for row in conn.execute(text(
+                    "SELECT attname, most_common_vals::text::int[] AS vals, most_common_freqs AS freqs "
+                    "FROM pg_stats WHERE schemaname = :s AND tablename = :t AND attname LIKE 'acl\\_%'"
+                ), {"s": db.schema, "t": db.table_name}):
+                    for value, freq in zip(row.vals or [], row.freqs or []):
+                        shares[(row.attname, value)] = freq
+        except Exception as e:
+            log.warning("Could not read permission index layout", extra={"error": str(e)})
+            return self._layout
+        global_index = indexes.get(f"{db.table_name}_hnsw_index")
+        vector_index = VectorIndex.parse(global_index) if global_index else VectorIndex()
+        self._layout = {"indexes": set(indexes), "shares": shares, "tsv": TSV_COLUMN in columns,
+                        "vectorIndex": vector_index.resolve(db.dimensions)}
+        return self._layout
+
+    def _use_ann(self, layout: dict, conditions: List[Tuple[str, int]]) -> bool:
+        table = self.vector_db.table_name
+        for column, value in conditions:
+            if _index_name(table, column[len("acl_"):], value) in layout["indexes"]:
+                return True
+        # No partial index: the global graph only works when nearly every row passes the filter
+        return min(layout["shares"].get(c, 0.0) for c in conditions) >= GLOBAL_INDEX_SHARE
+
+    def search(self, query: str, embedding: List[float], meta_filter: Optional[dict], limit: int = 5) -> List[Document]:
+        conditions = typed_filter(meta_filter)
+        layout = self.layout() if conditions is not None and self.vector_db.distance == Distance.cosine else None
+        if layout is None:
+            return self.vector_db.search(query=query, limit=limit, filters=meta_filter)
+
+        table = self.vector_db.table
+        dimensions = self.vector_db.dimensions
+        distance = table.c.embedding.cosine_distance(embedding)
+        ann = not conditions or self._use_ann(layout, conditions)
+        if not ann:
+            # "+ 0" stops the planner from walking the global HNSW graph and dropping
+            # filtered rows; the permission's rows are read via the btree and sorted exactly
+            distance = distance + 0
+        columns = (table.c.id, table.c.name, table.c.meta_data, table.c.content, table.c.embedding, table.c.usage)
+        vector_index = layout["vectorIndex"]
+        rescore = ann and vector_index.compact(dimensions)
+        candidates = max(limit * self.rescore_factor, limit) if rescore else limit
+        stmt = select(table.c.id) if rescore else select(*columns)
+        for column, value in conditions:
+            # Inlined (validated ints) so the planner can match the partial index predicate
+            stmt = stmt.where(text(f"{column} = {int(value)}"))
+        tenant = tenant_condition(table, meta_filter)
+        if tenant is not None:
+            stmt = stmt.where(tenant)
+        if rescore:
+            # The compact graph picks candidates; exact distances on the stored embeddings order them
+            shortlist = stmt.order_by(vector_index.distance(embedding, dimensions)).limit(candidates).subquery()
+            stmt = select(*columns).join(shortlist, shortlist.c.id == table.c.id)
+        stmt = stmt.order_by(distance).limit(limit)
+
+        try:
+            with resilience.breaker("postgres").guard(), self.vector_db.Session() as sess, sess.begin():
+                bound_statement(sess)
+                sess.execute(text(f"SET LOCAL hnsw.ef_search = {int(max(self.ef_search, candidates))}"))
+                rows = sess.execute(stmt).fetchall()
+        except resilience.CircuitOpen:
+            raise
+        except Exception as e:
+            if resilience.expired():
+                raise resilience.exceeded("retrieval") from e
+            log.warning("Typed permission search failed, using JSONB filter", extra={"error": str(e)})
+            self._checked_at = 0.0
+            return self.vector_db.search(query=query, limit=limit, filters=meta_filter)
+        return self._documents(rows)
+
+    def keyword_search(self, query: str, meta_filter: Optional[dict], limit: int = 20) -> List[Document]:
+        """
+        Full-text candidates within the permission filter, ranked by ts_rank_cd.
+        A chunk matches if it contains any of the query's terms.
+        """
+        table = self.vector_db.table
+        language = self.vector_db.content_language
+        layout = self.layout()
+        # Tables migrated before content_tsv existed parse every candidate chunk per query
+        ts_vector = literal_column(TSV_COLUMN if layout and layout["tsv"] else _tsvector_sql(language))
+        # websearch_to_tsquery ANDs every term, which a chat question rarely satisfies
+        ts_query = func.to_tsquery(literal_column(f"'{language}'::regconfig"), func.replace(
+            cast(func.websearch_to_tsquery(literal_column(f"'{language}'::regconfig"), query), Text), " & ", " | "))
+        stmt = select(table.c.id, table.c.name, table.c.meta_data, table.c.content, table.c.embedding, table.c.usage)
+        stmt = stmt.where(ts_vector.op("@@")(ts_query))
+
+        conditions = typed_filter(meta_filter)
+        if conditions is not None and layout is not None:
+            for column, value in conditions:
+                stmt = stmt.where(text(f"{column} = {int(value)}"))
+            tenant = tenant_condition(table, meta_filter)
+            if tenant is not None:
+                stmt = stmt.where(tenant)
+        elif meta_filter:
+            stmt = stmt.where(table.c.meta_data.contains(meta_filter))
+        stmt = stmt.order_by(func.ts_rank_cd(ts_vector, ts_query).desc()).limit(limit)
+
+        try:
+            with resilience.breaker("postgres").guard(), self.vector_db.Session() as sess, sess.begin():
+                bound_statement(sess)
+                rows = sess.execute(stmt).fetchall()
+        except Exception as e:
+            log.warning("Keyword search failed", extra={"error": str(e)})
+            return []
+        return self._documents(rows)
+
+    def _documents(self, rows) -> List[Document]:
+        return [
+            Document(id=r.id, name=r.name, meta_data=r.meta_data, content=r.content,
+                     embedder=self.vector_db.embedder, embedding=r.embedding, usage=r.usage)
+            for r in rows
+        ]
+
+if __name__ == "__main__":
+    import argparse
+    from database import database_url, get_engine
+    from observability import configure_logging
+
+    parser = argparse.ArgumentParser(description="Add typed permission columns and search indexes")
+    parser.add_argument("--table", default="cs_agno_vectordb1")
+    parser.add_argument("--schema", default="ai")
+    parser.add_argument("--min-partition-rows", type=int, default=PARTIAL_INDEX_MIN_ROWS)
+    parser.add_argument("--vector-index", choices=VECTOR_INDEX_KINDS,
+                        help="convert the HNSW indexes to this layout (default: keep the table's)")
+    parser.add_argument("--index-dimensions", type=int, default=VECTOR_INDEX_DIMENSIONS,
+                        help="leading dimensions to index with --vector-index (0 = all)")
+    args = parser.parse_args()
+    configure_logging(fmt="text")
+    vector_index = VectorIndex(args.vector_index, args.index_dimensions) if args.vector_index else None
+    print(migrate(get_engine(database_url()), args.table, args.schema, args.min_partition_rows,
+                  vector_index=vector_index))
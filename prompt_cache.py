@@ -0,0 +1,152 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+from dotenv import load_dotenv
+
+import metrics
+from embedding_service import estimate_tokens
+
+load_dotenv()
+log = logging.getLogger(__name__)
+
+# --- Prompt prefix caching ---
+# The system instruction is laid out as an invariant prefix (core behavior
+# and the static part of prompt.md) followed by a short per-user suffix
+# (name, email, permission flags). The prefix is byte-identical on every
+# request, which is what Gemini's implicit caching keys on. With
+# GEMINI_CONTEXT_CACHE=1 the prefix and the tool declarations are also
+# stored once as an explicit context cache; requests then reference it by
+# name and carry the user suffix as their first content instead.
+#
+#   GEMINI_CONTEXT_CACHE=1                explicit context cache for the prefix
+#   GEMINI_CONTEXT_CACHE_TTL=3600         lifetime of a cache entry (seconds)
+#   GEMINI_CONTEXT_CACHE_MIN_TOKENS=1024  smaller prefixes are sent inline
+#                                         (the API rejects caches below its minimum)
+
+CONTEXT_CACHE = os.getenv("GEMINI_CONTEXT_CACHE", "0").lower() in ("1", "true", "yes")
+CONTEXT_CACHE_TTL = int(os.getenv("GEMINI_CONTEXT_CACHE_TTL", "3600"))
+CONTEXT_CACHE_MIN_TOKENS = int(os.getenv("GEMINI_CONTEXT_CACHE_MIN_TOKENS", "1024"))
+# An entry is replaced this long before it expires, so no request references an expired cache
+REFRESH_MARGIN = 60
+# After a failed create, requests go inline for this long before trying again
+RETRY_AFTER = 300
+
+PROMPT_BLOCK_TOKENS = metrics.gauge("prompt_block_tokens", "Estimated tokens of each static prompt block and tool schema")
+CONTEXT_CACHE_LOOKUPS = metrics.counter("gemini_context_cache_total", "Explicit context cache lookups by result")
+
+def instruction_text(instructions: List[str]) -> str:
+    """The system message text agno renders for a list of instructions (no instruction tags)."""
+    return "".join(f"- {line}\n" for line in instructions)
+
+def tool_schema(function) -> Dict[str, Any]:
+    """JSON schema the model receives for an agno @tool function."""
+    function = function.model_copy(deep=True)
+    function.process_entrypoint()
+    return function.to_dict()
+
+_block_tokens: Dict[str, int] = {}
+
+def account(blocks: Dict[str, str], tools: list) -> Dict[str, int]:
+    """
+    Estimates the tokens of each prompt block and tool schema once and
+    publishes them as prompt_block_tokens{block=...}.
+    """
+    sizes = {name: estimate_tokens(text) for name, text in blocks.items()}
+    for function in tools:
+        schema = tool_schema(function)
+        sizes[f"tool.{schema['name']}"] = estimate_tokens(json.dumps(schema))
+    for name, tokens in sizes.items():
+        PROMPT_BLOCK_TOKENS.set(tokens, block=name)
+    _block_tokens.clear()
+    _block_tokens.update(sizes)
+    return sizes
+
+def block_tokens() -> Dict[str, int]:
+    return dict(_block_tokens)
+
+@dataclass
+class _Entry:
+    key: str
+    name: str
+    expires_at: float
+    tokens: int
+
+class ContextCache:
+    """
+    One explicit Gemini context cache holding the system prefix and tool
+    declarations. The prefix is the same for every user, role and tenant, so
+    a single entry serves all requests; a changed prompt.md or tool list gets
+    a new key and replaces it.
+    """
+
+    def __init__(self, ttl: int = CONTEXT_CACHE_TTL, min_tokens: int = CONTEXT_CACHE_MIN_TOKENS):
+        self.ttl = ttl
+        self.min_tokens = min_tokens
+        self._entry: Optional[_Entry] = None
+        self._retry_at = 0.0
+        self._lock = threading.Lock()
+
+    def lookup(self, client, model_id: str, system_prefix: str, tools: List[Dict[str, Any]]) -> Optional[str]:
+        """Name of the cache for this prefix and these tools, created on first use; None to send them inline."""
+        tools_json = json.dumps(tools, sort_keys=True, default=str)
+        if estimate_tokens(system_prefix) + estimate_tokens(tools_json) < self.min_tokens:
+            CONTEXT_CACHE_LOOKUPS.inc(result="too_small")
+            return None
+        key = hashlib.sha256(f"{model_id}\0{system_prefix}\0{tools_json}".encode()).hexdigest()
+        entry = self._entry
+        if entry is not None and entry.key == key and entry.expires_at - REFRESH_MARGIN > time.time():
+            CONTEXT_CACHE_LOOKUPS.inc(result="hit")
+            return entry.name
+        with self._lock:
+            entry = self._entry
+            now = time.time()
+            if entry is not None and entry.key == key and entry.expires_at - REFRESH_MARGIN > now:
+                CONTEXT_CACHE_LOOKUPS.inc(result="hit")
+                return entry.name
+            if now < self._retry_at:
+                CONTEXT_CACHE_LOOKUPS.inc(result="unavailable")
+                return None
+            try:
+                self._entry = self._create(client, model_id, system_prefix, tools, key)
+            except Exception as e:
+                self._retry_at = now + RETRY_AFTER
+                CONTEXT_CACHE_LOOKUPS.inc(result="error")
+                log.warning("Context cache create failed; sending the prefix inline",
+                            extra={"error": str(e), "retryInSeconds": RETRY_AFTER})
+                return None
+            CONTEXT_CACHE_LOOKUPS.inc(result="created")
+            log.info("Created context cache", extra={"cache": self._entry.name, "tokens": self._entry.tokens})
+            return self._entry.name
+
+    def _create(self, client, model_id: str, system_prefix: str, tools: List[Dict[str, Any]], key: str) -> _Entry:
+        from google.genai.types import CreateCachedContentConfig
+        from agno.utils.gemini import format_function_definitions
+
+        declarations = format_function_definitions(tools)
+        cached = client.caches.create(model=model_id, config=CreateCachedContentConfig(
+            display_name=f"prompt-prefix-{key[:12]}",
+            system_instruction=system_prefix,
+            tools=[declarations] if declarations else None,
+            ttl=f"{self.ttl}s",
+        ))
+        usage = getattr(cached, "usage_metadata", None)
+        return _Entry(key=key, name=cached.name, expires_at=time.time() + self.ttl,
+                      tokens=getattr(usage, "total_token_count", None) or 0)
+
+    def stats(self) -> dict:
+        entry = self._entry
+        return {
+            "enabled": CONTEXT_CACHE,
+            "cache": entry.name if entry else None,
+            "tokens": entry.tokens if entry else None,
+            "expiresInSeconds": max(0, round(entry.expires_at - time.time())) if entry else None,
+            "lookups": CONTEXT_CACHE_LOOKUPS.snapshot(),
+        }
+
+context_cache = ContextCache()
@@ -8,6 +8,8 @@ from agno.knowledge.knowledge import Knowledge
 from agno.vectordb.pgvector import PgVector, SearchType
 from agno.knowledge.embedder.google import GeminiEmbedder
 
+from database import get_engine
+
 # Load environment variables
 load_dotenv()
 
@@ -25,7 +27,7 @@ TABLE_NAME = "cs_agno_vectordb1"
 vector_db = PgVector(
     table_name=TABLE_NAME,
     schema="ai",
-    db_url=DB_URL,
+    db_engine=get_engine(DB_URL),
     search_type=SearchType.hybrid,
     embedder=GeminiEmbedder(id="text-embedding-004", dimensions=768)
 )
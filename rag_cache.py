@@ -0,0 +1,406 @@
+import os
+import logging
+import re
+import json
+import time
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Optional, List, Dict, Any, Iterable, Set, Tuple
+
+import numpy as np
+from sqlalchemy import text
+from agno.knowledge.embedder.base import Embedder
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+# --- Retrieval caches for search_documentation ---
+# Tier 1: query embeddings, keyed by normalized query text.
+# Tier 2: search results, partitioned by the permission filter and matched by
+#         exact text or by embedding similarity within that partition only.
+# Results are dropped whenever upsert_drive_docs bumps the knowledge version.
+# Tier 3 (opt-in, FAQ_CACHE=1): final answers to stateless first turns, with
+#         the files they were answered from. A knowledge version bump drops only
+#         the answers citing a file that was re-ingested or removed.
+
+EMBED_CACHE_SIZE = int(os.getenv("RAG_EMBED_CACHE_SIZE", "4096"))
+EMBED_CACHE_TTL = float(os.getenv("RAG_EMBED_CACHE_TTL", "86400"))
+RESULT_CACHE_SIZE = int(os.getenv("RAG_RESULT_CACHE_SIZE", "256"))  # per permission filter
+RESULT_CACHE_TTL = float(os.getenv("RAG_RESULT_CACHE_TTL", "900"))
+RESULT_SIMILARITY = float(os.getenv("RAG_RESULT_SIMILARITY", "0.97"))
+VERSION_CHECK_INTERVAL = float(os.getenv("RAG_CACHE_VERSION_CHECK", "30"))
+FAQ_CACHE = os.getenv("FAQ_CACHE", "0") == "1"
+FAQ_CACHE_SIZE = int(os.getenv("FAQ_CACHE_SIZE", "512"))  # per permission filter
+FAQ_CACHE_TTL = float(os.getenv("FAQ_CACHE_TTL", "86400"))
+FAQ_SIMILARITY = float(os.getenv("FAQ_SIMILARITY", "0.97"))
+
+KB_VERSION_TABLE = "ai.cs_agno_kb_version"
+# file_id -> knowledge version at which the file was last re-ingested or removed
+KB_CHANGES_TABLE = "ai.cs_agno_kb_changes"
+# Recorded when a bump doesn't say which files changed: every cached answer is suspect
+ALL_FILES = "*"
+
+# The embedding tier is shared by every tenant; results and answers lookups are labelled by tenant
+CACHE_LOOKUPS = metrics.counter("rag_cache_lookups_total", "Retrieval cache lookups by tier, outcome and tenant")
+EMBED_CALLS = metrics.counter("rag_embedding_calls_total", "Query embeddings sent to the embedding API")
+FAQ_TOKENS_SAVED = metrics.counter("faq_cache_tokens_saved_total", "Model tokens not spent thanks to cached answers")
+FAQ_INVALIDATED = metrics.counter("faq_cache_invalidated_total", "Cached answers dropped because a source file changed")
+
+_WHITESPACE = re.compile(r"\s+")
+
+def normalize_query(query: str) -> str:
+    return _WHITESPACE.sub(" ", query.strip().lower())
+
+def filter_key(meta_filter: Optional[Dict[str, Any]]) -> str:
+    """Canonical, type-preserving key for a permission filter ({"perm": "1"} != {"perm": 1})."""
+    return json.dumps(meta_filter or {}, sort_keys=True)
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries also expire after ttl seconds."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Any, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+@dataclass
+class CachingEmbedder(Embedder):
+    """Embedder wrapper that memoizes query embeddings by normalized text."""
+
+    inner: Optional[Embedder] = None
+    cache_size: int = EMBED_CACHE_SIZE
+    cache_ttl: float = EMBED_CACHE_TTL
+    _cache: Optional[TTLCache] = field(default=None, init=False, repr=False)
+
+    def __post_init__(self):
+        if self.inner is None:
+            raise ValueError("CachingEmbedder needs an inner embedder")
+        self.dimensions = self.inner.dimensions
+        self.enable_batch = self.inner.enable_batch
+        self.batch_size = self.inner.batch_size
+        self._cache = TTLCache(self.cache_size, self.cache_ttl)
+
+    def _cached(self, text: str):
+        embedding = self._cache.get(normalize_query(text))
+        CACHE_LOOKUPS.inc(tier="embedding", outcome="hit" if embedding is not None else "miss")
+        return embedding
+
+    def get_embedding(self, text: str) -> List[float]:
+        embedding = self._cached(text)
+        if embedding is None:
+            EMBED_CALLS.inc()
+            embedding = self.inner.get_embedding(text)
+            if embedding:
+                self._cache.put(normalize_query(text), embedding)
+        return embedding
+
+    def get_embedding_and_usage(self, text: str):
+        embedding = self._cached(text)
+        if embedding is not None:
+            return embedding, None
+        EMBED_CALLS.inc()
+        embedding, usage = self.inner.get_embedding_and_usage(text)
+        if embedding:
+            self._cache.put(normalize_query(text), embedding)
+        return embedding, usage
+
+    async def async_get_embedding(self, text: str) -> List[float]:
+        embedding = self._cached(text)
+        if embedding is None:
+            EMBED_CALLS.inc()
+            embedding = await self.inner.async_get_embedding(text)
+            if embedding:
+                self._cache.put(normalize_query(text), embedding)
+        return embedding
+
+    async def async_get_embedding_and_usage(self, text: str):
+        embedding = self._cached(text)
+        if embedding is not None:
+            return embedding, None
+        EMBED_CALLS.inc()
+        embedding, usage = await self.inner.async_get_embedding_and_usage(text)
+        if embedding:
+            self._cache.put(normalize_query(text), embedding)
+        return embedding, usage
+
+# --- Knowledge version (cross-process invalidation) ---
+
+def get_kb_version(engine, table_name: str) -> int:
+    try:
+        with engine.connect() as conn:
+            version = conn.execute(
+                text(f"SELECT version FROM {KB_VERSION_TABLE} WHERE name = :name"), {"name": table_name}
+            ).scalar()
+        return int(version or 0)
+    except Exception:
+        # Table not created yet (no ingestion has run since caching was added)
+        return 0
+
+def bump_kb_version(engine, table_name: str, file_ids: Optional[Iterable[str]] = None) -> int:
+    """
+    Called after ingestion so every server process drops its cached results.
+    file_ids are the files whose existing chunks were replaced or deleted;
+    None means unknown, which drops every cached answer too.
+    """
+    file_ids = [ALL_FILES] if file_ids is None else list(file_ids)
+    with engine.begin() as conn:
+        conn.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {KB_VERSION_TABLE} ("
+            "name TEXT PRIMARY KEY, version BIGINT NOT NULL, updated_at TIMESTAMPTZ NOT NULL DEFAULT now())"
+        ))
+        conn.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {KB_CHANGES_TABLE} ("
+            "name TEXT NOT NULL, file_id TEXT NOT NULL, version BIGINT NOT NULL, "
+            "changed_at TIMESTAMPTZ NOT NULL DEFAULT now(), PRIMARY KEY (name, file_id))"
+        ))
+        version = conn.execute(text(
+            f"INSERT INTO {KB_VERSION_TABLE} (name, version) VALUES (:name, 1) "
+            f"ON CONFLICT (name) DO UPDATE SET version = {KB_VERSION_TABLE}.version + 1, updated_at = now() "
+            "RETURNING version"
+        ), {"name": table_name}).scalar()
+        if file_ids:
+            conn.execute(text(
+                f"INSERT INTO {KB_CHANGES_TABLE} (name, file_id, version) VALUES (:name, :file_id, :version) "
+                "ON CONFLICT (name, file_id) DO UPDATE SET version = EXCLUDED.version, changed_at = now()"
+            ), [{"name": table_name, "file_id": f, "version": version} for f in file_ids])
+    log.info("Knowledge version bumped", extra={"table": table_name, "version": version, "files": len(file_ids)})
+    return int(version)
+
+def changed_files(engine, table_name: str, since: int) -> Set[str]:
+    """Files re-ingested or removed after knowledge version `since` (ALL_FILES if unknown)."""
+    try:
+        with engine.connect() as conn:
+            return set(conn.execute(text(
+                f"SELECT file_id FROM {KB_CHANGES_TABLE} WHERE name = :name AND version > :since"
+            ), {"name": table_name, "since": since}).scalars())
+    except Exception as e:
+        log.warning("Could not read knowledge changes", extra={"error": str(e)})
+        return {ALL_FILES}
+
+# --- Result cache ---
+
+class _FilterPartition:
+    """Cached searches for one permission filter. Never consulted for any other filter."""
+
+    def __init__(self):
+        self.entries: "OrderedDict[str, dict]" = OrderedDict()  # normalized query -> entry
+        self.matrix: Optional[np.ndarray] = None  # unit-norm embeddings, rebuilt lazily
+        self.keys: List[str] = []
+
+    def rebuild(self):
+        self.keys = list(self.entries.keys())
+        if self.keys:
+            self.matrix = np.vstack([self.entries[k]["unit"] for k in self.keys])
+        else:
+            self.matrix = None
+
+class SearchResultCache:
+    tier = "results"
+
+    def __init__(
+        self,
+        maxsize: int = RESULT_CACHE_SIZE,
+        ttl: float = RESULT_CACHE_TTL,
+        similarity: float = RESULT_SIMILARITY,
+        version_source=None,
+        version_check_interval: float = VERSION_CHECK_INTERVAL,
+        tenant: Optional[str] = None,
+    ):
+        self.maxsize = maxsize
+        # Labels of this cache's counters
+        self.labels = {"tenant": tenant} if tenant else {}
+        self.ttl = ttl
+        self.similarity = similarity
+        self.version_source = version_source  # callable returning the current knowledge version
+        self.version_check_interval = version_check_interval
+        self._partitions: Dict[str, _FilterPartition] = {}
+        self._lock = threading.Lock()
+        self._version: Optional[int] = None
+        self._version_checked_at = 0.0
+
+    def check_version(self):
+        if self.version_source is None:
+            return
+        now = time.monotonic()
+        if now - self._version_checked_at < self.version_check_interval:
+            return
+        self._version_checked_at = now
+        version = self.version_source()
+        if self._version is not None and version != self._version:
+            self.knowledge_changed(self._version, version)
+        self._version = version
+
+    def knowledge_changed(self, previous: int, version: int):
+        log.info("Knowledge version changed, clearing result cache",
+                 extra={"previous": previous, "version": version})
+        self.invalidate()
+
+    def invalidate(self):
+        with self._lock:
+            self._partitions.clear()
+
+    def get(self, query: str, embedding: Optional[List[float]], meta_filter: Optional[dict]):
+        self.check_version()
+        key = normalize_query(query)
+        now = time.monotonic()
+        with self._lock:
+            partition = self._partitions.get(filter_key(meta_filter))
+            entry = partition.entries.get(key) if partition else None
+            outcome = "exact"
+            if entry is None and partition and embedding is not None and partition.entries:
+                if partition.matrix is None:
+                    partition.rebuild()
+                unit = _unit(embedding)
+                scores = partition.matrix @ unit
+                best = int(np.argmax(scores))
+                if scores[best] >= self.similarity:
+                    key = partition.keys[best]
+                    entry = partition.entries[key]
+                    outcome = "similar"
+            if entry is not None and entry["expires_at"] < now:
+                del partition.entries[key]
+                partition.matrix = None
+                entry = None
+            if entry is None:
+                CACHE_LOOKUPS.inc(tier=self.tier, outcome="miss", **self.labels)
+                return None
+            partition.entries.move_to_end(key)
+        CACHE_LOOKUPS.inc(tier=self.tier, outcome=outcome, **self.labels)
+        return entry["results"]
+
+    def put(self, query: str, embedding: Optional[List[float]], meta_filter: Optional[dict], results):
+        """results is stored as given (a document list or packed context) and must not be mutated."""
+        if embedding is None:
+            return
+        key = normalize_query(query)
+        with self._lock:
+            partition = self._partitions.setdefault(filter_key(meta_filter), _FilterPartition())
+            partition.entries[key] = {
+                "unit": _unit(embedding),
+                "results": results,
+                "expires_at": time.monotonic() + self.ttl,
+            }
+            partition.entries.move_to_end(key)
+            while len(partition.entries) > self.maxsize:
+                partition.entries.popitem(last=False)
+            partition.matrix = None
+
+    def _lookups(self) -> tuple:
+        """(hits, lookups) of this cache."""
+        total = CACHE_LOOKUPS.total(tier=self.tier, **self.labels)
+        return total - CACHE_LOOKUPS.total(tier=self.tier, outcome="miss", **self.labels), total
+
+    def stats(self) -> dict:
+        """This cache's own lookups; the shared embedding cache is in embedding_stats()."""
+        hits, total = self._lookups()
+        with self._lock:
+            entries = sum(len(p.entries) for p in self._partitions.values())
+        return {
+            "resultHitRate": round(hits / total, 3) if total else None,
+            "resultEntries": entries,
+            "knowledgeVersion": self._version,
+        }
+
+# --- Answer cache ---
+
+@dataclass
+class CachedAnswer:
+    content: str
+    chunk_ids: List[str]
+    file_ids: Set[str]
+    tokens: int  # input + output tokens of the run that produced the answer
+
+class AnswerCache(SearchResultCache):
+    """
+    Final answers, partitioned by permission filter like search results. On a
+    knowledge version change only answers citing a changed file are dropped;
+    changes_source(since_version) returns those file IDs.
+    """
+    tier = "answers"
+
+    def __init__(self, changes_source=None, maxsize: int = FAQ_CACHE_SIZE, ttl: float = FAQ_CACHE_TTL,
+                 similarity: float = FAQ_SIMILARITY, **kwargs):
+        super().__init__(maxsize=maxsize, ttl=ttl, similarity=similarity, **kwargs)
+        self.changes_source = changes_source
+
+    def knowledge_changed(self, previous: int, version: int):
+        files = self.changes_source(previous) if self.changes_source else {ALL_FILES}
+        if ALL_FILES in files:
+            log.info("Knowledge changed without a file list, clearing answer cache", extra={"version": version})
+            self.invalidate()
+            return
+        dropped = 0
+        with self._lock:
+            for partition in self._partitions.values():
+                stale = [k for k, e in partition.entries.items() if e["results"].file_ids & files]
+                for key in stale:
+                    del partition.entries[key]
+                if stale:
+                    partition.matrix = None
+                    dropped += len(stale)
+        FAQ_INVALIDATED.inc(dropped, **self.labels)
+        log.info("Dropped cached answers citing changed files",
+                 extra={"version": version, "files": len(files), "answers": dropped})
+
+    def get(self, query: str, embedding: Optional[List[float]], meta_filter: Optional[dict]) -> Optional[CachedAnswer]:
+        answer = super().get(query, embedding, meta_filter)
+        if answer is not None:
+            FAQ_TOKENS_SAVED.inc(answer.tokens, **self.labels)
+        return answer
+
+    def stats(self) -> dict:
+        hits, total = self._lookups()
+        with self._lock:
+            entries = sum(len(p.entries) for p in self._partitions.values())
+        return {
+            "hitRate": round(hits / total, 3) if total else None,
+            "hits": hits,
+            "tokensSaved": FAQ_TOKENS_SAVED.total(**self.labels),
+            "invalidated": FAQ_INVALIDATED.total(**self.labels),
+            "entries": entries,
+            "knowledgeVersion": self._version,
+        }
+
+def embedding_stats() -> dict:
+    """The query embedding cache, shared by every tenant."""
+    total = CACHE_LOOKUPS.total(tier="embedding")
+    hits = CACHE_LOOKUPS.total(tier="embedding", outcome="hit")
+    return {
+        "embeddingHitRate": round(hits / total, 3) if total else None,
+        "embeddingCallsMade": EMBED_CALLS.total(),
+        "embeddingCallsSaved": hits,
+    }
+
+def _unit(embedding) -> np.ndarray:
+    vec = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vec)
+    return vec / norm if norm else vec
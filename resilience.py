@@ -0,0 +1,378 @@
+import os
+import time
+import queue
+import random
+import asyncio
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Iterator, Optional
+
+from dotenv import load_dotenv
+
+import metrics
+
+load_dotenv()
+log = logging.getLogger(__name__)
+
+# --- Request deadlines ---
+# A chat request gets CHAT_DEADLINE seconds in total, or less when the client
+# sends X-Request-Timeout. The deadline travels with the request's context
+# into the agent, tool and prefetch threads. Every blocking call on the way
+# waits at most the time that is left: the session lock, the query embedding,
+# the vector search (as statement_timeout), model calls and ThanosBE calls.
+# Stages check it before they start, so a late turn ends with a 504 instead of
+# holding a worker.
+#
+# --- Circuit breakers ---
+# One per dependency: gemini, postgres, thanosbe. After BREAKER_FAILURES
+# failures in a row (errors or timeouts), calls fail at once for BREAKER_RESET
+# seconds. Then one probe call is let through; it closes the breaker or opens
+# it again.
+#
+# --- Model calls ---
+# A model call may take MODEL_TIMEOUT seconds, or less if the deadline comes
+# first. With MODEL_HEDGE_AFTER set, a call still running after that many
+# seconds is sent again and the first answer wins. Failed calls (429, 5xx,
+# timeouts) are retried up to MODEL_RETRIES times while the deadline leaves
+# room for it.
+#
+#   CHAT_DEADLINE=45           seconds per /chat or /chat/stream request
+#   MODEL_TIMEOUT=30
+#   MODEL_HEDGE_AFTER=0        0 = no hedging
+#   MODEL_RETRIES=1
+#   MODEL_CALL_WORKERS=32      threads running model calls (hedges included)
+#   BREAKER_FAILURES=5
+#   BREAKER_RESET=30
+
+CHAT_DEADLINE = float(os.getenv("CHAT_DEADLINE", "45"))
+MODEL_TIMEOUT = float(os.getenv("MODEL_TIMEOUT", "30"))
+MODEL_HEDGE_AFTER = float(os.getenv("MODEL_HEDGE_AFTER", "0"))
+MODEL_RETRIES = int(os.getenv("MODEL_RETRIES", "1"))
+MODEL_CALL_WORKERS = int(os.getenv("MODEL_CALL_WORKERS", "32"))
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "5"))
+BREAKER_RESET = float(os.getenv("BREAKER_RESET", "30"))
+# How long past the deadline the handler waits for a turn that ignores it (a DB call without timeout)
+DEADLINE_GRACE = 0.5
+# A retry is only worth starting with at least this much time left
+MIN_RETRY_SECONDS = 1.0
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+DEADLINE_EXCEEDED = metrics.counter("deadline_exceeded_total", "Requests that ran out of time, by stage")
+MODEL_CALLS = metrics.counter("model_calls_total", "Model calls by outcome (ok, hedge_won, retried, failed, timeout)")
+HEDGES = metrics.counter("model_hedges_total", "Second model requests sent for slow calls")
+BREAKER_OPEN = metrics.gauge("circuit_breaker_open", "1 while a dependency's circuit breaker is open")
+BREAKER_REJECTED = metrics.counter("circuit_breaker_rejected_total", "Calls refused by an open circuit breaker")
+
+class DeadlineExceeded(TimeoutError):
+    """The request's time budget ran out; args[0] names the stage."""
+
+class CircuitOpen(Exception):
+    """A dependency's breaker is open; retry_after is the time until it lets a probe through."""
+
+    def __init__(self, dependency: str, retry_after: float):
+        super().__init__(f"{dependency} is unavailable (circuit open)")
+        self.dependency = dependency
+        self.retry_after = retry_after
+
+class Deadline:
+    """Absolute time budget of one request, shared by every thread working on it."""
+
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+        # The first DeadlineExceeded or CircuitOpen raised under this deadline.
+        # agno turns exceptions in a run into an error RunOutput; this keeps the cause.
+        self.failure: Optional[Exception] = None
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return time.monotonic() >= self.expires_at
+
+_deadline: contextvars.ContextVar[Optional[Deadline]] = contextvars.ContextVar("deadline", default=None)
+
+def request_budget(header: Optional[str]) -> float:
+    """CHAT_DEADLINE, lowered (never raised) by a positive X-Request-Timeout in seconds."""
+    try:
+        asked = float(header) if header else 0.0
+    except ValueError:
+        asked = 0.0
+    return min(asked, CHAT_DEADLINE) if asked > 0 else CHAT_DEADLINE
+
+@contextmanager
+def deadline(seconds: float) -> Iterator[Deadline]:
+    current = Deadline(seconds)
+    token = _deadline.set(current)
+    try:
+        yield current
+    finally:
+        _deadline.reset(token)
+
+def current() -> Optional[Deadline]:
+    return _deadline.get()
+
+def remaining(default: Optional[float] = None) -> Optional[float]:
+    """What a blocking call may wait: min(default, time left); default when there is no deadline."""
+    current = _deadline.get()
+    if current is None:
+        return default
+    left = current.remaining()
+    return left if default is None else min(default, left)
+
+def expired() -> bool:
+    current = _deadline.get()
+    return current is not None and current.expired()
+
+def record(error: Exception) -> Exception:
+    current = _deadline.get()
+    if current is not None and current.failure is None:
+        current.failure = error
+    return error
+
+def failure() -> Optional[Exception]:
+    current = _deadline.get()
+    return current.failure if current is not None else None
+
+def exceeded(stage: str) -> DeadlineExceeded:
+    """A DeadlineExceeded for stage, counted and recorded on the request's deadline."""
+    DEADLINE_EXCEEDED.inc(stage=stage)
+    return record(DeadlineExceeded(stage))
+
+def check(stage: str):
+    """Raises DeadlineExceeded if the deadline passed before stage could start."""
+    if expired():
+        raise exceeded(stage)
+
+async def within(deadline: Deadline, awaitable):
+    """
+    Awaits until the deadline (plus DEADLINE_GRACE). The work itself is
+    shielded: on timeout it keeps running to completion in the background, so
+    its worker slot and recorded response stay consistent.
+    """
+    task = asyncio.ensure_future(awaitable)
+    try:
+        return await asyncio.wait_for(asyncio.shield(task), deadline.remaining() + DEADLINE_GRACE)
+    except asyncio.TimeoutError:
+        # Marks a late failure retrieved; the caller has answered already
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        raise exceeded("response")
+
+# --- Circuit breakers ---
+
+class CircuitBreaker:
+    """Consecutive-failure breaker: closed -> open -> one probe (half-open) -> closed or open."""
+
+    def __init__(self, name: str, failures: int = BREAKER_FAILURES, reset: float = BREAKER_RESET):
+        self.name = name
+        self.failures = failures
+        self.reset = reset
+        self.state = "closed"
+        self._consecutive = 0
+        self._opened_at = 0.0
+        self._probe_started = 0.0
+        self._lock = threading.Lock()
+
+    def retry_after(self) -> float:
+        return max(0.0, self._opened_at + self.reset - time.monotonic())
+
+    def allow(self):
+        """Raises CircuitOpen unless a call may go through now. Report its outcome with success()/failure()."""
+        with self._lock:
+            if self.state == "closed":
+                return
+            now = time.monotonic()
+            if self.state == "open" and now >= self._opened_at + self.reset:
+                self.state = "half_open"
+                self._probe_started = now
+                return
+            # A probe that never reported back (its caller died) doesn't block the dependency forever
+            if self.state == "half_open" and now >= self._probe_started + self.reset:
+                self._probe_started = now
+                return
+        BREAKER_REJECTED.inc(dependency=self.name)
+        raise record(CircuitOpen(self.name, self.retry_after() or self.reset))
+
+    def success(self):
+        with self._lock:
+            self._consecutive = 0
+            if self.state != "closed":
+                log.info("Circuit closed", extra={"dependency": self.name})
+                self.state = "closed"
+                BREAKER_OPEN.set(0, dependency=self.name)
+
+    def failure(self):
+        with self._lock:
+            self._consecutive += 1
+            if self.state == "half_open" or (self.state == "closed" and self._consecutive >= self.failures):
+                log.warning("Circuit opened", extra={"dependency": self.name, "failures": self._consecutive})
+                self.state = "open"
+                self._opened_at = time.monotonic()
+                BREAKER_OPEN.set(1, dependency=self.name)
+
+    @contextmanager
+    def guard(self):
+        """allow(), then any exception from the block counts as a failure."""
+        self.allow()
+        try:
+            yield
+        except Exception:
+            self.failure()
+            raise
+        self.success()
+
+    def stats(self) -> dict:
+        return {"state": self.state, "consecutiveFailures": self._consecutive,
+                "retryAfter": round(self.retry_after(), 1) if self.state != "closed" else None}
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+def breaker(dependency: str) -> CircuitBreaker:
+    gate = _breakers.get(dependency)
+    if gate is None:
+        with _breakers_lock:
+            gate = _breakers.setdefault(dependency, CircuitBreaker(dependency))
+    return gate
+
+# --- Model calls ---
+
+_call_pool: Optional[ThreadPoolExecutor] = None
+
+class CallTimeout(TimeoutError):
+    """A model call ran past its own timeout while the request still had time."""
+
+def is_retryable(error: BaseException) -> bool:
+    code = getattr(error, "code", None) or getattr(error, "status_code", None)
+    return (isinstance(error, (TimeoutError, ConnectionError)) or code in RETRYABLE_STATUS
+            or "Timeout" in type(error).__name__ or "Connect" in type(error).__name__)
+
+def _submit(call: Callable[[float], Any], timeout: float):
+    global _call_pool
+    if _call_pool is None:
+        with _breakers_lock:
+            if _call_pool is None:
+                _call_pool = ThreadPoolExecutor(max_workers=MODEL_CALL_WORKERS, thread_name_prefix="model-call")
+    # Keeps the request's deadline and trace context in the call thread
+    return _call_pool.submit(contextvars.copy_context().run, call, timeout)
+
+def _race(call: Callable[[float], Any], limit: float, hedge_after: float):
+    """call(timeout) once, and once more after hedge_after seconds; the first success wins."""
+    started = time.monotonic()
+    primary = _submit(call, limit)
+    pending, error = {primary}, None
+    hedged = hedge_after <= 0 or hedge_after >= limit
+    while pending:
+        elapsed = time.monotonic() - started
+        left = limit - elapsed
+        if left <= 0:
+            break
+        done, pending = wait(pending, timeout=left if hedged else max(0.0, min(left, hedge_after - elapsed)),
+                             return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                MODEL_CALLS.inc(result="ok" if future is primary else "hedge_won")
+                return future.result()
+            error = future.exception()
+        if not hedged and time.monotonic() - started >= hedge_after and (pending or error is None):
+            hedged = True
+            HEDGES.inc()
+            pending.add(_submit(call, limit - (time.monotonic() - started)))
+        elif not pending and error is not None:
+            raise error
+    raise CallTimeout(f"model call took longer than {limit:.1f}s")
+
+def call_model(call: Callable[[float], Any], dependency: str = "gemini", timeout: Optional[float] = None,
+               hedge_after: Optional[float] = None, retries: Optional[int] = None):
+    """
+    Runs call(timeout_seconds) under the dependency's breaker, within
+    min(timeout, time left), hedged and retried as configured. call must pass
+    the timeout on to its HTTP request so an abandoned attempt ends too.
+    """
+    timeout = MODEL_TIMEOUT if timeout is None else timeout
+    hedge_after = MODEL_HEDGE_AFTER if hedge_after is None else hedge_after
+    retries = MODEL_RETRIES if retries is None else retries
+    gate = breaker(dependency)
+    attempt = 0
+    while True:
+        limit = remaining(timeout)
+        if limit <= 0:
+            raise exceeded("model")
+        gate.allow()
+        try:
+            result = _race(call, limit, hedge_after)
+        except Exception as e:
+            if not is_retryable(e):
+                # The dependency answered; the request itself was wrong
+                gate.success()
+                MODEL_CALLS.inc(result="failed")
+                raise
+            gate.failure()
+            if attempt < retries and remaining(timeout) > MIN_RETRY_SECONDS:
+                attempt += 1
+                MODEL_CALLS.inc(result="retried")
+                log.warning("Model call failed, retrying", extra={"attempt": attempt, "error": str(e)})
+                time.sleep(min(random.uniform(0.1, 0.5), remaining(timeout)))
+                continue
+            MODEL_CALLS.inc(result="timeout" if isinstance(e, TimeoutError) else "failed")
+            if isinstance(e, TimeoutError) and expired():
+                raise exceeded("model") from e
+            raise
+        gate.success()
+        return result
+
+def stream_model(open_stream: Callable[[float], Iterator], dependency: str = "gemini",
+                 timeout: Optional[float] = None) -> Iterator:
+    """
+    Chunks of open_stream(timeout_seconds), produced on a call thread so the
+    wait for each chunk is bounded by min(timeout, time left). Not hedged:
+    a second stream would repeat content already sent to the client.
+    """
+    limit = remaining(MODEL_TIMEOUT if timeout is None else timeout)
+    if limit <= 0:
+        raise exceeded("model")
+    gate = breaker(dependency)
+    gate.allow()
+    chunks: "queue.Queue" = queue.Queue()
+    done = object()
+
+    def produce(call_timeout: float):
+        try:
+            for chunk in open_stream(call_timeout):
+                chunks.put((chunk, None))
+        except Exception as e:
+            chunks.put((None, e))
+        chunks.put((done, None))
+
+    _submit(produce, limit)
+    ends_at = time.monotonic() + limit
+    while True:
+        try:
+            chunk, error = chunks.get(timeout=max(0.0, ends_at - time.monotonic()))
+        except queue.Empty:
+            gate.failure()
+            MODEL_CALLS.inc(result="timeout")
+            if expired():
+                raise exceeded("model")
+            raise CallTimeout(f"model stream took longer than {limit:.1f}s")
+        if error is not None:
+            (gate.failure if is_retryable(error) else gate.success)()
+            MODEL_CALLS.inc(result="failed")
+            raise error
+        if chunk is done:
+            gate.success()
+            MODEL_CALLS.inc(result="ok")
+            return
+        yield chunk
+
+def stats() -> dict:
+    return {
+        "chatDeadline": CHAT_DEADLINE,
+        "deadlineExceeded": DEADLINE_EXCEEDED.snapshot(),
+        "modelCalls": MODEL_CALLS.snapshot(),
+        "hedges": HEDGES.snapshot().get("_", 0),
+        "breakers": {name: gate.stats() for name, gate in sorted(_breakers.items())},
+    }
@@ -0,0 +1,229 @@
+import os
+import logging
+import re
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+from agno.knowledge.document.base import Document
+
+import metrics
+from embedding_service import estimate_tokens
+
+log = logging.getLogger(__name__)
+
+# --- Retrieval pipeline for search_documentation ---
+# 1. Candidates: vector and full-text lists from PermissionSearch, fused with
+#    reciprocal rank fusion (RRF), so exact terms (error codes, part numbers)
+#    surface even when their embeddings are not the nearest.
+# 2. Rerank: maximal marginal relevance (MMR) over the candidates' stored
+#    embeddings. No model call; near-identical chunks stop crowding the top.
+# 3. Dedupe: a chunk whose word shingles mostly appear in an already chosen
+#    chunk (page overlap, boilerplate repeated across manuals) is dropped.
+# 4. Pack: chosen chunks fill RAG_CONTEXT_TOKENS. A chunk over its share is cut
+#    down to the run of sentences that mentions the query terms most.
+
+CANDIDATES = int(os.getenv("RAG_CANDIDATES", "20"))
+CONTEXT_TOKENS = int(os.getenv("RAG_CONTEXT_TOKENS", "1200"))
+CHUNK_TOKENS = int(os.getenv("RAG_CHUNK_TOKENS", "500"))
+MAX_CHUNKS = int(os.getenv("RAG_MAX_CHUNKS", "5"))
+MMR_LAMBDA = float(os.getenv("RAG_MMR_LAMBDA", "0.7"))
+DEDUPE_OVERLAP = float(os.getenv("RAG_DEDUPE_OVERLAP", "0.8"))
+RRF_K = 60
+SHINGLE_WORDS = 5
+# What search_documentation sent before packing: the top 5 vector hits, verbatim
+BASELINE_CHUNKS = 5
+# Smaller leftovers of the budget aren't worth a fragment
+MIN_FRAGMENT_TOKENS = 60
+
+CONTEXT_TOKENS_TOTAL = metrics.counter(
+    "rag_context_tokens_total", "Retrieved context tokens: packed (sent) vs baseline (top-5 raw chunks)")
+RETRIEVAL_SECONDS = metrics.histogram("rag_retrieval_seconds", "Retrieval latency by stage")
+DROPPED_CHUNKS = metrics.counter("rag_dropped_chunks_total", "Candidates dropped as near-duplicates")
+
+_WORD = re.compile(r"[a-z0-9][a-z0-9\-_.]*[a-z0-9]|[a-z0-9]")
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+|\n{2,}")
+_STOPWORDS = frozenset(
+    "a an and are as at be by can do does for from how i if in is it my of on or the this to what when "
+    "where which who why with you your me we our not no".split()
+)
+
+@dataclass
+class PackedContext:
+    documents: List[Document]
+    tokens: int
+    baseline_tokens: int
+    candidates: int
+
+    @property
+    def tokens_saved(self) -> int:
+        return max(self.baseline_tokens - self.tokens, 0)
+
+    def render(self) -> str:
+        return "\n\n".join(d.content for d in self.documents)
+
+def query_terms(query: str) -> Set[str]:
+    # 5-character prefixes: a crude stem so "calibrating" matches "calibration"
+    return {w[:5] for w in _WORD.findall(query.lower()) if w not in _STOPWORDS}
+
+def _doc_key(doc: Document) -> str:
+    return doc.id or str(hash(doc.content))
+
+def _shingles(text: str) -> Set[int]:
+    words = _WORD.findall(text.lower())
+    if len(words) < SHINGLE_WORDS:
+        return {hash(tuple(words))} if words else set()
+    return {hash(tuple(words[i:i + SHINGLE_WORDS])) for i in range(len(words) - SHINGLE_WORDS + 1)}
+
+def _unit_rows(embeddings: Sequence) -> np.ndarray:
+    matrix = np.asarray([np.asarray(e, dtype=np.float32) for e in embeddings])
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+def reciprocal_rank_fusion(*ranked: List[Document], k: int = RRF_K) -> List[Tuple[Document, float]]:
+    """Merges ranked lists by sum(1 / (k + rank)); a chunk in both lists ranks above one in either."""
+    scores: Dict[str, float] = {}
+    docs: Dict[str, Document] = {}
+    for results in ranked:
+        for rank, doc in enumerate(results):
+            key = _doc_key(doc)
+            docs.setdefault(key, doc)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank + 1)
+    order = sorted(scores, key=scores.get, reverse=True)
+    return [(docs[key], scores[key]) for key in order]
+
+def mmr_select(candidates: List[Tuple[Document, float]], max_chunks: int, mmr_lambda: float = MMR_LAMBDA,
+               dedupe_overlap: float = DEDUPE_OVERLAP) -> List[Document]:
+    """
+    Greedy MMR: each pick maximizes lambda * relevance - (1 - lambda) * max
+    similarity to the picks so far. Relevance is the fused score scaled to
+    [0, 1]; similarity is cosine over the stored chunk embeddings.
+    """
+    if not candidates:
+        return []
+    docs = [doc for doc, _ in candidates]
+    relevance = np.asarray([score for _, score in candidates], dtype=np.float32)
+    relevance /= relevance.max()
+    has_embeddings = all(d.embedding is not None and len(d.embedding) for d in docs)
+    unit = _unit_rows([d.embedding for d in docs]) if has_embeddings else None
+
+    chosen: List[int] = []
+    chosen_shingles: List[Set[int]] = []
+    max_sim = np.zeros(len(docs), dtype=np.float32)
+    remaining = set(range(len(docs)))
+    while remaining and len(chosen) < max_chunks:
+        scores = {i: mmr_lambda * relevance[i] - (1 - mmr_lambda) * max_sim[i] for i in remaining}
+        best = max(scores, key=scores.get)
+        remaining.discard(best)
+        shingles = _shingles(docs[best].content)
+        if shingles and any(len(shingles & seen) / len(shingles) >= dedupe_overlap for seen in chosen_shingles):
+            DROPPED_CHUNKS.inc()
+            continue
+        chosen.append(best)
+        chosen_shingles.append(shingles)
+        if unit is not None:
+            max_sim = np.maximum(max_sim, unit @ unit[best])
+    return [docs[i] for i in chosen]
+
+def best_window(text: str, terms: Set[str], max_tokens: int) -> str:
+    """The contiguous run of sentences within max_tokens that mentions the most query terms."""
+    sentences = [s for s in _SENTENCE_END.split(text) if s.strip()]
+    if not sentences:
+        return ""
+    costs = [estimate_tokens(s) + 1 for s in sentences]
+    hits = [sum(1 for w in _WORD.findall(s.lower()) if w[:5] in terms) for s in sentences]
+
+    best_score, best_range = -1, (0, 0)
+    end, used, score = 0, 0, 0
+    for start in range(len(sentences)):
+        while end < len(sentences) and used + costs[end] <= max_tokens:
+            used += costs[end]
+            score += hits[end]
+            end += 1
+        if end > start and score > best_score:
+            best_score, best_range = score, (start, end)
+        if end > start:
+            used -= costs[start]
+            score -= hits[start]
+        else:
+            end = start + 1
+    start, end = best_range
+    if end == start:
+        # A single sentence longer than the budget: keep its beginning
+        return sentences[0][: max_tokens * 4]
+    return " ".join(s.strip() for s in sentences[start:end])
+
+def pack(documents: List[Document], terms: Set[str], budget: int = CONTEXT_TOKENS,
+         chunk_tokens: int = CHUNK_TOKENS) -> Tuple[List[Document], int]:
+    """Fits the chosen chunks into the token budget, in rank order. Returns (documents, tokens)."""
+    packed, used = [], 0
+    for doc in documents:
+        remaining = budget - used
+        if remaining < MIN_FRAGMENT_TOKENS:
+            break
+        allowance = min(remaining, chunk_tokens)
+        content = doc.content
+        if estimate_tokens(content) > allowance:
+            content = best_window(content, terms, allowance)
+            if not content:
+                continue
+        tokens = estimate_tokens(content)
+        packed.append(doc if content is doc.content else Document(
+            id=doc.id, name=doc.name, meta_data=doc.meta_data, content=content, embedding=doc.embedding))
+        used += tokens
+    return packed, used
+
+class HybridRetriever:
+    def __init__(
+        self,
+        searcher,
+        candidates: int = CANDIDATES,
+        context_tokens: int = CONTEXT_TOKENS,
+        chunk_tokens: int = CHUNK_TOKENS,
+        max_chunks: int = MAX_CHUNKS,
+        mmr_lambda: float = MMR_LAMBDA,
+        hybrid: bool = True,
+    ):
+        self.searcher = searcher  # PermissionSearch: search() and keyword_search()
+        self.candidates = candidates
+        self.context_tokens = context_tokens
+        self.chunk_tokens = chunk_tokens
+        self.max_chunks = max_chunks
+        self.mmr_lambda = mmr_lambda
+        self.hybrid = hybrid
+
+    def retrieve(self, query: str, embedding: List[float], meta_filter: Optional[dict]) -> PackedContext:
+        with RETRIEVAL_SECONDS.time(stage="vector"):
+            vector_hits = self.searcher.search(query, embedding, meta_filter, limit=self.candidates)
+        keyword_hits = []
+        if self.hybrid:
+            with RETRIEVAL_SECONDS.time(stage="keyword"):
+                keyword_hits = self.searcher.keyword_search(query, meta_filter, limit=self.candidates)
+        baseline = sum(estimate_tokens(d.content) for d in vector_hits[:BASELINE_CHUNKS])
+
+        with RETRIEVAL_SECONDS.time(stage="rerank"):
+            fused = reciprocal_rank_fusion(vector_hits, keyword_hits)
+            chosen = mmr_select(fused, self.max_chunks, self.mmr_lambda)
+            documents, tokens = pack(chosen, query_terms(query), self.context_tokens, self.chunk_tokens)
+        return PackedContext(documents=documents, tokens=tokens, baseline_tokens=baseline, candidates=len(fused))
+
+def report(context: PackedContext):
+    """Logs and counts the context sent for one search_documentation call."""
+    CONTEXT_TOKENS_TOTAL.inc(context.tokens, kind="packed")
+    CONTEXT_TOKENS_TOTAL.inc(context.baseline_tokens, kind="baseline")
+    log.info("Packed search context", extra={
+        "chunks": len(context.documents), "candidates": context.candidates, "tokens": context.tokens,
+        "baselineTokens": context.baseline_tokens, "tokensSaved": context.tokens_saved,
+    })
+
+def stats() -> dict:
+    tokens = CONTEXT_TOKENS_TOTAL.snapshot()
+    packed, baseline = tokens.get("kind=packed", 0), tokens.get("kind=baseline", 0)
+    return {
+        "contextTokens": packed,
+        "baselineTokens": baseline,
+        "tokensSaved": max(baseline - packed, 0),
+        "savedRatio": round(1 - packed / baseline, 3) if baseline else None,
+        "duplicatesDropped": DROPPED_CHUNKS.snapshot().get("_", 0),
+    }
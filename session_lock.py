@@ -0,0 +1,262 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from dotenv import load_dotenv
+from sqlalchemy import text
+
+import metrics
+import resilience
+from database import get_engine
+
+load_dotenv()
+log = logging.getLogger(__name__)
+
+# --- Per-session single flight ---
+# Two turns of one conversation must not run at once: both would load the
+# same history, pay for a model run and write the session back, the later
+# write dropping the earlier turn. A turn holds a Postgres advisory lock keyed
+# by tenant and session ID, so turns are serialized across every worker
+# process; a crashed process drops its connection and with it the lock.
+#
+# Retries and double submits are coalesced by request key: the client's
+# Idempotency-Key header, or else a hash of the session, user and message.
+# A duplicate arriving while the first request runs in the same process
+# awaits its result; one arriving in another process waits for the session
+# lock and then finds the recorded response. Responses to Idempotency-Key
+# requests are replayed for IDEMPOTENCY_TTL seconds. Without a key, only a
+# request that was still running when the duplicate arrived is coalesced, so
+# a user who repeats a message ("yes", "yes") gets a new turn.
+#
+#   SESSION_LOCK_TIMEOUT=60        seconds a turn waits for its session (then 409)
+#   SESSION_LOCK_POOL_SIZE=8       connections held by running turns (own pool)
+#   IDEMPOTENCY_TTL=600            how long responses to Idempotency-Key requests are replayed
+
+SESSION_LOCK_TIMEOUT = float(os.getenv("SESSION_LOCK_TIMEOUT", "60"))
+SESSION_LOCK_POOL_SIZE = int(os.getenv("SESSION_LOCK_POOL_SIZE", "8"))
+IDEMPOTENCY_TTL = float(os.getenv("IDEMPOTENCY_TTL", "600"))
+REQUESTS_TABLE = "ai.cs_agno_chat_requests"
+# Recorded responses older than IDEMPOTENCY_TTL are deleted every this many records
+PRUNE_EVERY = 200
+LOCK_POLL_SECONDS = 0.05
+
+LOCK_WAIT = metrics.histogram("session_lock_wait_seconds", "Time a chat turn waited for its session lock")
+LOCK_TIMEOUTS = metrics.counter("session_lock_timeouts_total", "Chat turns that gave up waiting for their session")
+COALESCED = metrics.counter("chat_coalesced_total", "Duplicate chat requests answered with another request's result")
+
+class SessionBusy(Exception):
+    """Another turn of the session held the lock for longer than SESSION_LOCK_TIMEOUT."""
+
+def lock_id(tenant: str, session_id: str) -> int:
+    """Signed 64-bit advisory lock ID for a session."""
+    digest = hashlib.sha256(f"session\0{tenant}\0{session_id}".encode()).digest()
+    return int.from_bytes(digest[:8], "big", signed=True)
+
+def request_key(tenant: str, session_id: str, user_id: str, message: str,
+                idempotency_key: Optional[str] = None) -> Tuple[str, Optional[float]]:
+    """(key, seconds its recorded response is replayed; None without an Idempotency-Key)."""
+    if idempotency_key:
+        raw, ttl = f"key\0{tenant}\0{session_id}\0{idempotency_key}", IDEMPOTENCY_TTL
+    else:
+        raw, ttl = f"message\0{tenant}\0{session_id}\0{user_id}\0{' '.join(message.split())}", None
+    return hashlib.sha256(raw.encode()).hexdigest(), ttl
+
+def replay_age(ttl: Optional[float], arrived: float) -> float:
+    """
+    Max age of a recorded response a request may get: ttl, or without a key
+    only responses recorded since the request arrived (time.perf_counter()),
+    i.e. by a duplicate that was still running.
+    """
+    return ttl if ttl is not None else time.perf_counter() - arrived
+
+class SessionLocks:
+    """
+    Advisory locks on a pool of their own, since a lock's connection is held
+    for the whole turn. Threads of one process queue on an in-process lock
+    first, so a session never holds more than one connection per process.
+    """
+
+    def __init__(self, engine=None, timeout: float = SESSION_LOCK_TIMEOUT):
+        self._engine = engine
+        self.timeout = timeout
+        self._local: Dict[int, list] = {}  # lock ID -> [threading.Lock, users]
+        self._guard = threading.Lock()
+
+    @property
+    def engine(self):
+        if self._engine is None:
+            self._engine = get_engine(pool="session-locks", pool_size=SESSION_LOCK_POOL_SIZE,
+                                      max_overflow=SESSION_LOCK_POOL_SIZE)
+        return self._engine
+
+    def _local_lock(self, key: int) -> threading.Lock:
+        with self._guard:
+            entry = self._local.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+            return entry[0]
+
+    def _release_local(self, key: int):
+        with self._guard:
+            entry = self._local[key]
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._local[key]
+
+    @contextmanager
+    def hold(self, tenant: str, session_id: str):
+        key = lock_id(tenant, session_id)
+        started = time.perf_counter()
+        # The request's deadline may leave less than SESSION_LOCK_TIMEOUT
+        timeout = resilience.remaining(self.timeout)
+        deadline = time.monotonic() + timeout
+        local = self._local_lock(key)
+        try:
+            if not local.acquire(timeout=timeout):
+                raise self._gave_up(session_id)
+            try:
+                conn = self.engine.connect()
+                try:
+                    while not conn.execute(text("SELECT pg_try_advisory_lock(:id)"), {"id": key}).scalar():
+                        conn.rollback()
+                        if time.monotonic() > deadline:
+                            raise self._gave_up(session_id)
+                        time.sleep(LOCK_POLL_SECONDS)
+                    # The lock belongs to the connection, not the transaction; don't sit idle in one
+                    conn.commit()
+                    LOCK_WAIT.observe(time.perf_counter() - started)
+                    try:
+                        yield
+                    finally:
+                        self._unlock(conn, key)
+                finally:
+                    conn.close()
+            finally:
+                local.release()
+        finally:
+            self._release_local(key)
+
+    @staticmethod
+    def _gave_up(session_id: str) -> Exception:
+        if resilience.expired():
+            return resilience.exceeded("session_lock")
+        LOCK_TIMEOUTS.inc()
+        return SessionBusy(session_id)
+
+    def _unlock(self, conn, key: int):
+        try:
+            conn.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": key})
+            conn.commit()
+        except Exception as e:
+            # Closing the connection for good releases the lock server-side
+            log.warning("Session unlock failed; dropping the connection", extra={"error": str(e)})
+            conn.invalidate()
+
+class RequestLog:
+    """Responses of completed chat requests by request key, shared by all processes."""
+
+    def __init__(self, engine=None):
+        self._engine = engine
+        self._ready = False
+        self._records = 0
+        self._lock = threading.Lock()
+
+    @property
+    def engine(self):
+        if self._engine is None:
+            self._engine = get_engine()
+        return self._engine
+
+    def prepare(self):
+        if self._ready:
+            return
+        with self.engine.begin() as conn:
+            conn.execute(text(
+                f"CREATE TABLE IF NOT EXISTS {REQUESTS_TABLE} ("
+                "key TEXT PRIMARY KEY, session_id TEXT NOT NULL, response JSONB NOT NULL, "
+                "completed_at TIMESTAMPTZ NOT NULL DEFAULT now())"
+            ))
+        self._ready = True
+
+    def get(self, key: str, max_age: float) -> Optional[dict]:
+        """The recorded response if it completed within max_age seconds. Errors read as a miss."""
+        try:
+            self.prepare()
+            with self.engine.connect() as conn:
+                return conn.execute(text(
+                    f"SELECT response FROM {REQUESTS_TABLE} "
+                    "WHERE key = :key AND completed_at > now() - make_interval(secs => :age)"
+                ), {"key": key, "age": max_age}).scalar()
+        except Exception as e:
+            log.warning("Could not read request log", extra={"error": str(e)})
+            return None
+
+    def put(self, key: str, session_id: str, response: dict):
+        try:
+            self.prepare()
+            with self.engine.begin() as conn:
+                conn.execute(text(
+                    f"INSERT INTO {REQUESTS_TABLE} (key, session_id, response) VALUES (:key, :session_id, :response) "
+                    "ON CONFLICT (key) DO UPDATE SET response = EXCLUDED.response, completed_at = now()"
+                ), {"key": key, "session_id": session_id, "response": json.dumps(response)})
+        except Exception as e:
+            # The turn itself succeeded; only a later duplicate would run again
+            log.warning("Could not record response", extra={"error": str(e)})
+            return
+        with self._lock:
+            self._records += 1
+            prune = self._records % PRUNE_EVERY == 0
+        if prune:
+            with self.engine.begin() as conn:
+                conn.execute(text(
+                    f"DELETE FROM {REQUESTS_TABLE} WHERE completed_at < now() - make_interval(secs => :age)"
+                ), {"age": IDEMPOTENCY_TTL})
+
+class InFlight:
+    """Requests running in this process by key; a duplicate awaits the running one. Event-loop only."""
+
+    def __init__(self):
+        self._running: Dict[str, asyncio.Future] = {}
+
+    async def run(self, key: str, call: Callable[[], Awaitable]) -> Tuple[object, bool]:
+        """(result, whether it came from another request)."""
+        running = self._running.get(key)
+        if running is not None:
+            COALESCED.inc(source="inflight")
+            return await asyncio.shield(running), True
+        future = asyncio.get_running_loop().create_future()
+        self._running[key] = future
+        try:
+            result = await call()
+            future.set_result(result)
+            return result, False
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # Marks it retrieved when no duplicate was waiting
+            future.exception()
+            raise
+        finally:
+            del self._running[key]
+
+    def __len__(self):
+        return len(self._running)
+
+session_locks = SessionLocks()
+request_log = RequestLog()
+in_flight = InFlight()
+
+def stats() -> dict:
+    return {
+        "inFlight": len(in_flight),
+        "coalesced": COALESCED.snapshot(),
+        "lockWait": LOCK_WAIT.snapshot().get("_"),
+        "lockTimeouts": LOCK_TIMEOUTS.snapshot().get("_", 0),
+    }
@@ -0,0 +1,98 @@
+import os
+import re
+from typing import Dict, List, Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# --- Tenants ---
+# Every tenant gets its own knowledge table, session table and Drive manifest,
+# so one tenant's searches never scan (or rank against) another tenant's
+# chunks and each table keeps its own permission indexes. The default tenant
+# keeps the original table names, so a single-tenant deployment is unchanged.
+#
+#   TENANTS=Thanos,Acme                       tenants this deployment serves
+#   TENANT_STRICT=0                           1 = /chat refuses other tenantIds (403);
+#                                             by default they use the default
+#                                             tenant's tables, as before tenants
+#   TENANT_DRIVE_FOLDERS=Acme=1AbC...,...     Drive folder synced for each tenant
+#                                             (the default tenant falls back to
+#                                             GOOGLE_DRIVE_FOLDER_ID)
+
+DEFAULT_TENANT = os.getenv("DEFAULT_TENANT", "Thanos").strip()
+TENANT_STRICT = os.getenv("TENANT_STRICT", "0") == "1"
+# Keeps "<table>_t_<slug>" plus the index-name suffixes under Postgres' 63-character limit
+SLUG_MAX_LENGTH = 16
+
+class UnknownTenant(ValueError):
+    pass
+
+def tenant_slug(tenant: str) -> str:
+    slug = re.sub(r"[^a-z0-9]+", "_", tenant.lower()).strip("_")[:SLUG_MAX_LENGTH]
+    if not slug:
+        raise UnknownTenant(f"Tenant {tenant!r} has no usable characters for a table name")
+    return slug
+
+def _parse_tenants(value: str) -> Dict[str, str]:
+    """Lowercased name -> configured name, rejecting tenants whose table names would collide."""
+    tenants: Dict[str, str] = {}
+    slugs: Dict[str, str] = {}
+    for name in [DEFAULT_TENANT] + [t.strip() for t in value.split(",")]:
+        if not name or name.lower() in tenants:
+            continue
+        slug = tenant_slug(name)
+        if slug in slugs:
+            raise ValueError(f"Tenants {slugs[slug]!r} and {name!r} map to the same tables ({slug})")
+        tenants[name.lower()] = name
+        slugs[slug] = name
+    return tenants
+
+def _parse_folders(value: str) -> Dict[str, str]:
+    folders = {}
+    for pair in value.split(","):
+        if "=" in pair:
+            tenant, folder_id = pair.split("=", 1)
+            folders[tenant.strip().lower()] = folder_id.strip()
+    return folders
+
+_TENANTS = _parse_tenants(os.getenv("TENANTS", ""))
+_FOLDERS = _parse_folders(os.getenv("TENANT_DRIVE_FOLDERS", ""))
+
+def tenants() -> List[str]:
+    """Configured tenants, the default first."""
+    return list(_TENANTS.values())
+
+def resolve_tenant(tenant_id: Optional[str]) -> str:
+    """Canonical name of a configured tenant (case-insensitive); None means the default tenant."""
+    if tenant_id is None or not str(tenant_id).strip():
+        return DEFAULT_TENANT
+    tenant = _TENANTS.get(str(tenant_id).strip().lower())
+    if tenant is None:
+        raise UnknownTenant(f"Unknown tenant {tenant_id!r}")
+    return tenant
+
+def route_tenant(tenant_id: Optional[str]) -> str:
+    """
+    Tenant whose tables serve a chat request: the configured tenant, else the
+    default tenant. With TENANT_STRICT=1 an unconfigured tenant raises UnknownTenant.
+    """
+    try:
+        return resolve_tenant(tenant_id)
+    except UnknownTenant:
+        if TENANT_STRICT:
+            raise
+        return DEFAULT_TENANT
+
+def is_default(tenant: str) -> bool:
+    return tenant.lower() == DEFAULT_TENANT.lower()
+
+def tenant_table(base: str, tenant: str) -> str:
+    """Name of a per-tenant table: the base name for the default tenant, "<base>_t_<slug>" otherwise."""
+    return base if is_default(tenant) else f"{base}_t_{tenant_slug(tenant)}"
+
+def drive_folder(tenant: str) -> Optional[str]:
+    folder_id = _FOLDERS.get(tenant.lower())
+    if folder_id is None and is_default(tenant):
+        folder_id = os.getenv("GOOGLE_DRIVE_FOLDER_ID")
+    return folder_id.strip() if folder_id else None
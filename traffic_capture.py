@@ -0,0 +1,214 @@
+import os
+import hmac
+import json
+import time
+import queue
+import atexit
+import hashlib
+import logging
+import secrets
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Optional
+
+from dotenv import load_dotenv
+
+import metrics
+import observability
+
+load_dotenv()
+log = logging.getLogger(__name__)
+
+# --- Traffic capture ---
+# With TRAFFIC_CAPTURE set to a file path, each chat request (of a
+# TRAFFIC_CAPTURE_SAMPLE share of sessions) appends one JSON line describing
+# its shape, never its content: arrival time, endpoint, hashed session, user
+# and tenant IDs, role, message size, status, latency, stage times, the
+# latency of each model call, the tool calls in order and token counts.
+# benchmarks/replay_traffic.py replays a capture against a server.
+#
+# IDs are keyed hashes. Give every worker the same TRAFFIC_CAPTURE_SALT so
+# the turns of a session keep one ID across processes; "{pid}" in the path
+# gives each process a file of its own. Lines are written by a background
+# thread; records it can't keep up with are dropped and counted.
+#
+#   TRAFFIC_CAPTURE=             e.g. /var/log/agno/traffic-{pid}.jsonl; empty = off
+#   TRAFFIC_CAPTURE_SAMPLE=1.0   share of sessions captured
+#   TRAFFIC_CAPTURE_SALT=        key of the ID hashes; random per process when empty
+#   TRAFFIC_CAPTURE_MAX_MB=512   capturing stops once the file reaches this size
+
+TRAFFIC_CAPTURE = os.getenv("TRAFFIC_CAPTURE", "")
+TRAFFIC_CAPTURE_SAMPLE = float(os.getenv("TRAFFIC_CAPTURE_SAMPLE", "1.0"))
+TRAFFIC_CAPTURE_SALT = os.getenv("TRAFFIC_CAPTURE_SALT", "")
+TRAFFIC_CAPTURE_MAX_MB = float(os.getenv("TRAFFIC_CAPTURE_MAX_MB", "512"))
+# Records waiting for the writer thread; more are dropped
+QUEUE_SIZE = 10000
+
+RECORDS = metrics.counter("traffic_capture_records_total", "Captured chat requests (written, dropped, full)")
+
+# The record of the current request, shared by reference with its worker threads
+_record: contextvars.ContextVar[Optional[dict]] = contextvars.ContextVar("traffic_record", default=None)
+
+class TrafficCapture:
+    """Appends one anonymized JSON line per sampled chat request to `path`."""
+
+    def __init__(self, path: str, sample: float = 1.0, salt: str = "", max_mb: float = 512):
+        self.path = path.replace("{pid}", str(os.getpid())) if path else ""
+        self.sample = sample
+        self._key = (salt or secrets.token_hex(16)).encode()
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.active = 0
+        self.full = False
+        self._queue: "queue.Queue[Optional[dict]]" = queue.Queue(maxsize=QUEUE_SIZE)
+        self._writer: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        if self.path and not salt:
+            log.warning("TRAFFIC_CAPTURE_SALT is not set; session IDs won't match across worker processes")
+
+    @classmethod
+    def from_env(cls) -> "TrafficCapture":
+        return cls(TRAFFIC_CAPTURE, TRAFFIC_CAPTURE_SAMPLE, TRAFFIC_CAPTURE_SALT, TRAFFIC_CAPTURE_MAX_MB)
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path) and not self.full
+
+    def anonymize(self, value) -> Optional[str]:
+        if value is None:
+            return None
+        return hmac.new(self._key, str(value).encode(), hashlib.sha256).hexdigest()[:16]
+
+    def sampled(self, session: Optional[str]) -> bool:
+        """Whole sessions are in or out, so replayed sessions keep all their turns."""
+        if self.sample >= 1.0:
+            return True
+        return session is not None and int(session[:8], 16) / 0xFFFFFFFF < self.sample
+
+    @contextmanager
+    def request(self, endpoint: str, payload, idempotent: bool = False):
+        """
+        Scope of one chat request; run it inside observability.request_context
+        so the record gets the request's spans. Yields the record, or None when
+        the request isn't captured. An exception leaving the block is recorded
+        by its status_code (HTTPException) or type.
+        """
+        with self._lock:
+            self.active += 1
+            concurrent = self.active
+        session = self.anonymize(payload.conversationId or payload.sessionId)
+        record = None
+        if self.enabled and self.sampled(session):
+            message = payload.message or ""
+            record = {
+                "t": round(time.time(), 3),
+                "endpoint": endpoint,
+                "session": session,
+                "user": self.anonymize(payload.userId),
+                "tenant": self.anonymize(payload.tenantId),
+                "role": str(payload.userRole or "USER").upper(),
+                "messageChars": len(message),
+                "messageWords": len(message.split()),
+                "idempotencyKey": idempotent,
+                "concurrent": concurrent,
+            }
+        token = _record.set(record)
+        started = time.perf_counter()
+        try:
+            yield record
+            if record is not None:
+                record.setdefault("status", 200)
+        except BaseException as e:
+            if record is not None:
+                record["status"] = getattr(e, "status_code", None)
+                record["error"] = type(e).__name__
+            raise
+        finally:
+            try:
+                _record.reset(token)
+            except ValueError:
+                # A streaming response can finish in a different context than it started in
+                pass
+            with self._lock:
+                self.active -= 1
+            if record is not None:
+                record["durationMs"] = round((time.perf_counter() - started) * 1000, 1)
+                self._add_spans(record)
+                self._enqueue(record)
+
+    @staticmethod
+    def _add_spans(record: dict):
+        stages, model_ms, tools = {}, [], []
+        for stage, seconds in observability.trace_stages():
+            ms = round(seconds * 1000, 1)
+            if stage == "request":
+                continue
+            stages[stage] = round(stages.get(stage, 0.0) + ms, 1)
+            if stage == "model":
+                model_ms.append(ms)
+            elif stage.startswith("tool."):
+                tools.append([stage[len("tool."):], ms])
+        record.update(stagesMs=stages, modelMs=model_ms, tools=tools)
+
+    def _enqueue(self, record: dict):
+        if self._writer is None:
+            with self._lock:
+                if self._writer is None:
+                    self._writer = threading.Thread(target=self._write_loop, name="traffic-capture", daemon=True)
+                    self._writer.start()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            RECORDS.inc(result="dropped")
+
+    def _write_loop(self):
+        with open(self.path, "a", encoding="utf-8") as out:
+            size = out.tell()
+            while True:
+                record = self._queue.get()
+                if record is None:
+                    return
+                batch = [record]
+                while not self._queue.empty() and len(batch) < 1000:
+                    record = self._queue.get_nowait()
+                    if record is None:
+                        break
+                    batch.append(record)
+                if self.full:
+                    RECORDS.inc(len(batch), result="full")
+                else:
+                    lines = "".join(json.dumps(r, separators=(",", ":")) + "\n" for r in batch)
+                    out.write(lines)
+                    out.flush()
+                    size += len(lines.encode())
+                    RECORDS.inc(len(batch), result="written")
+                    if size >= self.max_bytes:
+                        self.full = True
+                        log.warning("Traffic capture stopped at TRAFFIC_CAPTURE_MAX_MB", extra={"path": self.path})
+                if record is None:
+                    return
+
+    def close(self, timeout: float = 5.0):
+        """Writes the records still queued."""
+        if self._writer is not None:
+            self._queue.put(None)
+            self._writer.join(timeout)
+            self._writer = None
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "path": self.path or None,
+            "sample": self.sample,
+            "queued": self._queue.qsize(),
+            "records": RECORDS.snapshot(),
+        }
+
+capture = TrafficCapture.from_env()
+atexit.register(capture.close)
+
+def note(**fields):
+    """Adds fields to the current request's record, if it is captured."""
+    record = _record.get()
+    if record is not None:
+        record.update(fields)
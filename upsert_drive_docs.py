@@ -2,7 +2,10 @@ import os
 import time
 import io
 import json
-import shutil
+import queue
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from dotenv import load_dotenv
 
@@ -12,13 +15,19 @@ from googleapiclient.http import MediaIoBaseDownload
 
 from agno.knowledge.knowledge import Knowledge
 from agno.vectordb.pgvector import PgVector, SearchType
-from agno.knowledge.embedder.google import GeminiEmbedder
+
+from database import database_url, get_engine
+from embedding_service import get_embedding_service
+from rag_cache import bump_kb_version
+import permission_index
+import tenancy
+from ingest_pipeline import IngestionPipeline, INGEST_WORKERS, SPOOL_MAX_MEMORY, delete_file_rows, export_mime
 
 # Load environment variables
 load_dotenv()
 
 # Configuration
-DB_URL = os.getenv("DATABASE_URL")
+DB_URL = database_url()
 # if DB_URL:
 #     DB_URL = DB_URL.strip().strip("'").strip('"')
 # else:
@@ -26,18 +35,16 @@ DB_URL = os.getenv("DATABASE_URL")
 
 TABLE_NAME = "cs_agno_vectordb1"
 SERVICE_ACCOUNT_FILE = os.getenv("GOOGLE_APPLICATION_CREDENTIALS", "credentials.json").strip()
-FOLDER_ID = os.getenv("GOOGLE_DRIVE_FOLDER_ID")
-if FOLDER_ID:
-    FOLDER_ID = FOLDER_ID.strip()
+DOWNLOAD_CHUNK_SIZE = 8 * 1024 * 1024
 
 # 1. Setup Vector DB & Knowledge Base
-# Using Gemini Embedder for consistency with the Gemini agent team
+# Same Gemini embedding service as the agent team: batched and kept under the API rate limits
 vector_db = PgVector(
     table_name=TABLE_NAME,
     schema="ai",
-    db_url=DB_URL,
+    db_engine=get_engine(DB_URL),
     search_type=SearchType.hybrid,
-    embedder=GeminiEmbedder(id="text-embedding-004", dimensions=768)
+    embedder=get_embedding_service()
 )
 
 knowledge = Knowledge(
@@ -46,6 +53,21 @@ knowledge = Knowledge(
 # Ensure table exists
 # vector_db.create() # Usually handled by Agno when inserting if configured
 
+# Other tenants' knowledge tables, same engine and embedding service
+_vector_dbs = {TABLE_NAME: vector_db}
+
+def get_vector_db(tenant=tenancy.DEFAULT_TENANT):
+    table = tenancy.tenant_table(TABLE_NAME, tenant)
+    if table not in _vector_dbs:
+        _vector_dbs[table] = PgVector(
+            table_name=table,
+            schema="ai",
+            db_engine=vector_db.db_engine,
+            search_type=SearchType.hybrid,
+            embedder=vector_db.embedder
+        )
+    return _vector_dbs[table]
+
 # 2. Replicate n8n Permission Mapping from production_rag_plan.md
 DOCUMENT_ROLE_MAPPING = {
     "1k6uBRowoVMw62PKPdvA2mB7hfnwJniyd": {"roles": ["CUSTOMER_ADMIN", "ADMIN"], "perm": 0, "superperm": "1"},
@@ -73,78 +95,385 @@ def download_file(service, file_id, file_name, local_dir):
     # Ensure directory exists
     local_path.parent.mkdir(parents=True, exist_ok=True)
     
-    fh = io.FileIO(local_path, 'wb')
-    downloader = MediaIoBaseDownload(fh, request)
-    done = False
-    while done is False:
-        status, done = downloader.next_chunk()
-        print(f"   Downloading {file_name}: {int(status.progress() * 100)}%")
+    with io.FileIO(local_path, 'wb') as fh:
+        downloader = MediaIoBaseDownload(fh, request, chunksize=DOWNLOAD_CHUNK_SIZE)
+        done = False
+        while done is False:
+            _, done = downloader.next_chunk()
     
     return str(local_path)
 
-def upsert_document(file_path, file_id, file_name):
-    """
-    Inserts a document into PgVector with specific role-based metadata.
-    Using Agno 2.x knowledge.insert() for built-in reading and chunking.
-    """
+def download_to_buffer(request, max_memory=SPOOL_MAX_MEMORY):
+    """Downloads into memory, spilling to an anonymous temp file past max_memory bytes."""
+    buffer = tempfile.SpooledTemporaryFile(max_size=max_memory)
+    try:
+        downloader = MediaIoBaseDownload(buffer, request, chunksize=DOWNLOAD_CHUNK_SIZE)
+        done = False
+        while done is False:
+            _, done = downloader.next_chunk()
+    except BaseException:
+        buffer.close()
+        raise
+    buffer.seek(0)
+    return buffer
+
+def document_metadata(file_id, file_name, tenant=tenancy.DEFAULT_TENANT):
+    """Role-based metadata stored with every chunk of a Drive file."""
     mapping = DOCUMENT_ROLE_MAPPING.get(file_id, {"roles": ["ADMIN"], "perm": 0, "superperm": 0})
-    
-    metadata = {
+    return {
         "file_id": file_id,
         "file_name": file_name,
         "perm": mapping["perm"],
         "superperm": mapping["superperm"],
         "allperm": 1 if "ADMIN" in mapping["roles"] else 0,
-        "tenant_id": "Thanos",
+        "tenant_id": tenant,
         "source": "google_drive",
         "upserted_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
     }
-    
+
+def upsert_document(file_path, file_id, file_name):
+    """
+    Inserts one local file into PgVector with its role-based metadata,
+    chunked, deduplicated and embedded the same way as a Drive sync.
+    """
     print(f"🚀 Processing: {file_name} for Knowledge Base...")
-    
-    # In Agno 2.x, knowledge.insert() handles:
-    # 1. Reading the file (PDF, Text, etc.)
-    # 2. Chunking the content
-    # 3. Generating embeddings
-    # 4. Upserting into the vector database
-    knowledge.insert(path=file_path, metadata=metadata)
-    
-    print(f"✅ Successfully processed {file_name}")
+    # The reader is picked by extension; the local path's stands in when the name has none
+    name = file_name if Path(file_name).suffix else file_name + Path(file_path).suffix
+    vector_db.create()
+    pipeline = IngestionPipeline(
+        vector_db=vector_db,
+        embedder=vector_db.embedder,
+        # A buffer rather than the path, which the pipeline would delete after parsing
+        fetch=lambda file: open(file_path, "rb"),
+        metadata_for=lambda file: document_metadata(file_id, file_name),
+        workers=1,
+    )
+    report = pipeline.run([{"id": file_id, "name": name, "mimeType": ""}])
+    if report["stages"]["write"]["files"]:
+        print(f"✅ Successfully processed {file_name}")
 
-def verify_db_persistence():
+def verify_db_persistence(tenant=tenancy.DEFAULT_TENANT):
     """Manual SQL check to confirm data is in the database."""
-    from sqlalchemy import create_engine, text
-    engine = create_engine(DB_URL.replace("postgresql+psycopg", "postgresql"))
-    with engine.connect() as conn:
-        count = conn.execute(text(f"SELECT COUNT(*) FROM ai.{TABLE_NAME}")).scalar()
-        print(f"\n� Final DB Check: Total rows in {TABLE_NAME} = {count}")
+    from sqlalchemy import text
+    table = tenancy.tenant_table(TABLE_NAME, tenant)
+    with get_engine(DB_URL).connect() as conn:
+        count = conn.execute(text(f"SELECT COUNT(*) FROM ai.{table}")).scalar()
+        print(f"\n� Final DB Check: Total rows in {table} = {count}")
         if count > 0:
-            sample = conn.execute(text(f"SELECT name, meta_data FROM ai.{TABLE_NAME} LIMIT 1")).fetchone()
+            sample = conn.execute(text(f"SELECT name, meta_data FROM ai.{table} LIMIT 1")).fetchone()
             print(f"   Sample Document: {sample[0]}")
 
-def sync_google_drive():
+# 3. Incremental Sync Manifest
+# Remembers what was last ingested for each Drive file so a sync only
+# downloads and re-embeds files whose content fingerprint changed. Changes are
+# written every DRIVE_MANIFEST_FLUSH_EVERY files and when the sync ends; files
+# ingested since the last write are re-ingested if the process dies.
+MANIFEST_TABLE = "cs_agno_drive_manifest"
+MANIFEST_FLUSH_EVERY = int(os.getenv("DRIVE_MANIFEST_FLUSH_EVERY", "200"))
+LIST_FIELDS = "nextPageToken, files(id, name, mimeType, modifiedTime, md5Checksum)"
+FOLDER_MIME = "application/vnd.google-apps.folder"
+SHORTCUT_MIME = "application/vnd.google-apps.shortcut"
+CRAWL_WORKERS = int(os.getenv("DRIVE_CRAWL_WORKERS", "8"))
+
+def file_fingerprint(file):
+    """md5Checksum for binary files; Google Docs have none, so fall back to modifiedTime."""
+    return file.get("md5Checksum") or file.get("modifiedTime") or ""
+
+class DriveManifest:
     """
-    Syncs Google Drive folder to PgVector.
+    file_id -> {name, mimeType, fingerprint, syncedAt}, persisted as a JSON file.
+    Changes are saved every flush_every record()/forget() calls and by flush().
     """
-    if not FOLDER_ID:
-        print("❌ Error: GOOGLE_DRIVE_FOLDER_ID not set in .env")
-        return
 
-    # Load service account info for debugging
-    with open(SERVICE_ACCOUNT_FILE, 'r') as f:
-        sa_info = json.load(f)
-        sa_email = sa_info.get("client_email")
-        print(f"🔑 Using Service Account: {sa_email}")
-        print(f"👉 Ensure this email has 'Viewer' access to the folder!")
+    def __init__(self, path, flush_every=MANIFEST_FLUSH_EVERY):
+        self.path = Path(path)
+        self.entries = {}
+        self.flush_every = max(1, flush_every)
+        self._unsaved = 0
+        # record() runs on the pipeline's writer thread
+        self._lock = threading.RLock()
+
+    def load(self):
+        if self.path.exists():
+            self.entries = json.loads(self.path.read_text())
+        return self
+
+    def save(self):
+        tmp = self.path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(self.entries, indent=2))
+        os.replace(tmp, self.path)
+
+    def flush(self):
+        with self._lock:
+            if self._unsaved:
+                self.save()
+                self._unsaved = 0
+
+    def _changed(self):
+        self._unsaved += 1
+        if self._unsaved >= self.flush_every:
+            self.save()
+            self._unsaved = 0
+
+    def record(self, file):
+        with self._lock:
+            self.entries[file["id"]] = {
+                "name": file["name"],
+                "mimeType": file["mimeType"],
+                "fingerprint": file_fingerprint(file),
+                "syncedAt": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            }
+            self._changed()
+
+    def forget(self, file_id):
+        with self._lock:
+            self.entries.pop(file_id, None)
+            self._changed()
+
+class PgDriveManifest(DriveManifest):
+    """Same manifest kept in Postgres next to the vectors it describes."""
+
+    def __init__(self, engine, table=f"ai.{MANIFEST_TABLE}", flush_every=MANIFEST_FLUSH_EVERY):
+        super().__init__(path=table, flush_every=flush_every)
+        self.engine = engine
+        self.table = table
+        # Rows changed since the last save
+        self._upserts = {}
+        self._deletes = set()
+
+    def load(self):
+        from sqlalchemy import text
+        with self.engine.begin() as conn:
+            conn.execute(text(
+                f"CREATE TABLE IF NOT EXISTS {self.table} ("
+                "file_id TEXT PRIMARY KEY, name TEXT, mime_type TEXT, fingerprint TEXT, "
+                "synced_at TIMESTAMPTZ NOT NULL DEFAULT now())"
+            ))
+            rows = conn.execute(text(f"SELECT file_id, name, mime_type, fingerprint, synced_at FROM {self.table}"))
+            self.entries = {
+                r.file_id: {"name": r.name, "mimeType": r.mime_type, "fingerprint": r.fingerprint,
+                            "syncedAt": r.synced_at.isoformat()}
+                for r in rows
+            }
+        return self
+
+    def save(self):
+        """Writes the changed rows in one transaction."""
+        from sqlalchemy import text
+        with self.engine.begin() as conn:
+            if self._deletes:
+                conn.execute(text(f"DELETE FROM {self.table} WHERE file_id = ANY(:ids)"),
+                             {"ids": list(self._deletes)})
+            if self._upserts:
+                conn.execute(text(
+                    f"INSERT INTO {self.table} (file_id, name, mime_type, fingerprint, synced_at) "
+                    "VALUES (:id, :name, :mime, :fp, now()) "
+                    "ON CONFLICT (file_id) DO UPDATE SET name = EXCLUDED.name, mime_type = EXCLUDED.mime_type, "
+                    "fingerprint = EXCLUDED.fingerprint, synced_at = now()"
+                ), list(self._upserts.values()))
+        self._upserts.clear()
+        self._deletes.clear()
+
+    def record(self, file):
+        with self._lock:
+            self._deletes.discard(file["id"])
+            self._upserts[file["id"]] = {"id": file["id"], "name": file["name"], "mime": file["mimeType"],
+                                         "fp": file_fingerprint(file)}
+            super().record(file)
+
+    def forget(self, file_id):
+        with self._lock:
+            self._upserts.pop(file_id, None)
+            self._deletes.add(file_id)
+            super().forget(file_id)
+
+def get_manifest(tenant=tenancy.DEFAULT_TENANT):
+    """DRIVE_MANIFEST=postgres (default) or a path to a local JSON file; one manifest per tenant."""
+    target = os.getenv("DRIVE_MANIFEST", "postgres")
+    if target == "postgres":
+        return PgDriveManifest(vector_db.db_engine, table=f"ai.{tenancy.tenant_table(MANIFEST_TABLE, tenant)}").load()
+    path = Path(target)
+    return DriveManifest(path.with_name(tenancy.tenant_table(path.stem, tenant) + path.suffix)).load()
+
+def iter_folder_pages(service, folder_id):
+    """Yields each page of non-trashed children of one folder (files and subfolders)."""
+    query = f"'{folder_id}' in parents and trashed = false"
+    page_token = None
+    while True:
+        results = service.files().list(
+            q=query,
+            fields=LIST_FIELDS,
+            supportsAllDrives=True,
+            includeItemsFromAllDrives=True,
+            spaces='drive',
+            pageSize=1000,
+            pageToken=page_token,
+        ).execute()
+        yield results.get('files', [])
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            return
+
+def list_folder_files(service, folder_id):
+    """All non-trashed files directly in the folder, following every result page."""
+    print(f"🔍 Running Query: '{folder_id}' in parents and trashed = false")
+    return [f for page in iter_folder_pages(service, folder_id) for f in page]
 
-    service = get_google_drive_service()
+def crawl_folder_tree(service_factory, root_id, workers=CRAWL_WORKERS):
+    """
+    Yields every file under root_id, subfolders included, as listing pages arrive.
+
+    Folders are listed concurrently, each worker thread with its own Drive
+    service. A file reachable through several folders is yielded once. Any
+    listing error is raised to the caller, so a partial crawl is never
+    mistaken for a complete one.
+    """
+    local = threading.local()
+    out = queue.Queue()
+    lock = threading.Lock()
+    seen_folders = {root_id}
+    pending = [1]
+
+    def list_folder(folder_id):
+        try:
+            if not hasattr(local, "service"):
+                local.service = service_factory()
+            for page in iter_folder_pages(local.service, folder_id):
+                files = []
+                for item in page:
+                    if item["mimeType"] == FOLDER_MIME:
+                        with lock:
+                            if item["id"] in seen_folders:
+                                continue
+                            seen_folders.add(item["id"])
+                            pending[0] += 1
+                        pool.submit(list_folder, item["id"])
+                    elif item["mimeType"] != SHORTCUT_MIME:
+                        files.append(item)
+                if files:
+                    out.put(("files", files))
+        except Exception as e:
+            out.put(("error", e))
+        finally:
+            with lock:
+                pending[0] -= 1
+                if pending[0] == 0:
+                    out.put(("done", None))
+
+    pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="drive-crawl")
+    pool.submit(list_folder, root_id)
+    seen_files = set()
+    try:
+        while True:
+            kind, payload = out.get()
+            if kind == "error":
+                raise payload
+            if kind == "done":
+                print(f"🔍 Crawled {len(seen_folders)} folder(s), {len(seen_files)} file(s)")
+                return
+            for file in payload:
+                if file["id"] not in seen_files:
+                    seen_files.add(file["id"])
+                    yield file
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+def classify_file(file, manifest, full=False):
+    """'new', 'changed' or 'unchanged' relative to the manifest."""
+    entry = manifest.entries.get(file["id"])
+    if entry is None:
+        return "new"
+    if full or entry["fingerprint"] != file_fingerprint(file):
+        return "changed"
+    return "unchanged"
+
+def plan_sync(files, manifest, full=False):
+    """Splits the listing into (new, changed, unchanged) files and removed file IDs."""
+    groups = {"new": [], "changed": [], "unchanged": []}
+    for file in files:
+        groups[classify_file(file, manifest, full)].append(file)
+    new, changed, unchanged = groups["new"], groups["changed"], groups["unchanged"]
+    listed = {f["id"] for f in files}
+    removed = [file_id for file_id in manifest.entries if file_id not in listed]
+    return new, changed, unchanged, removed
+
+def fetch_file(service, file):
+    """
+    Downloads a Drive file into a spooled buffer. Google Docs are exported as
+    HTML (as PDF with INGEST_CHUNKING=pages), Sheets and Slides as PDF.
+    """
+    export = export_mime(file)
+    if export:
+        print(f"   Exporting Google file '{file['name']}' as {export}...")
+        request = service.files().export_media(fileId=file['id'], mimeType=export)
+    else:
+        request = service.files().get_media(fileId=file['id'])
+    return download_to_buffer(request)
+
+def remove_document(file_id, tenant=tenancy.DEFAULT_TENANT):
+    """
+    Deletes every chunk that was ingested from the given Drive file. Returns
+    the IDs of files whose near-duplicate chunks were only stored as these.
+    """
+    target = get_vector_db(tenant)
+    with target.Session() as sess, sess.begin():
+        return delete_file_rows(sess, target.table, file_id)
+
+def ingest_files(files, service_factory, manifest, workers=INGEST_WORKERS, tenant=tenancy.DEFAULT_TENANT):
+    """Downloads, chunks, embeds and writes the given files through the staged pipeline."""
+    # googleapiclient services are not thread-safe, so each download worker builds its own
+    local = threading.local()
+
+    def fetch(file):
+        if not hasattr(local, "service"):
+            local.service = service_factory()
+        print(f"📄 Downloading: {file['name']} ({file['id']})")
+        return fetch_file(local.service, file)
+
+    target = get_vector_db(tenant)
+    target.create()
+    pipeline = IngestionPipeline(
+        vector_db=target,
+        embedder=target.embedder,
+        fetch=fetch,
+        metadata_for=lambda file: document_metadata(file["id"], file["name"], tenant),
+        on_file_done=manifest.record,
+        workers=workers,
+    )
+    return pipeline.run(files)
+
+def sync_google_drive(full=False, service=None, manifest=None, folder_id=None, workers=INGEST_WORKERS,
+                      crawl_workers=CRAWL_WORKERS, tenant=None):
+    """
+    Syncs a tenant's Google Drive folder tree (subfolders included) to its
+    knowledge table. Only new or modified files are downloaded and embedded;
+    chunks of files that were removed or trashed are deleted. full=True
+    re-ingests every file. tenant=None syncs the default tenant.
+    """
+    tenant = tenancy.resolve_tenant(tenant)
+    table = tenancy.tenant_table(TABLE_NAME, tenant)
+    folder_id = folder_id or tenancy.drive_folder(tenant)
+    if not folder_id:
+        print(f"❌ Error: no Drive folder for tenant {tenant} "
+              "(GOOGLE_DRIVE_FOLDER_ID / TENANT_DRIVE_FOLDERS in .env)")
+        return
+
+    service_factory = (lambda: service) if service is not None else get_google_drive_service
+    if service is None:
+        # Load service account info for debugging
+        with open(SERVICE_ACCOUNT_FILE, 'r') as f:
+            sa_info = json.load(f)
+            sa_email = sa_info.get("client_email")
+            print(f"🔑 Using Service Account: {sa_email}")
+            print(f"👉 Ensure this email has 'Viewer' access to the folder!")
+        service = get_google_drive_service()
     
-    print(f"🔄 Syncing Google Drive Folder ID: {FOLDER_ID}")
+    print(f"🔄 Syncing Google Drive Folder ID: {folder_id} (tenant {tenant} -> ai.{table})")
     
     try:
         # Verify Folder Access
         folder_meta = service.files().get(
-            fileId=FOLDER_ID, 
+            fileId=folder_id, 
             fields="name, driveId", 
             supportsAllDrives=True
         ).execute()
@@ -155,61 +484,89 @@ def sync_google_drive():
         print(f"⚠️ Warning: Could not verify folder metadata. Error: {e}")
         print("Continuing anyway...")
 
-    # Query for all files in folder
-    # Added supportsAllDrives and includeItemsFromAllDrives for Shared Drive support
-    query = f"'{FOLDER_ID}' in parents and trashed = false"
-    print(f"🔍 Running Query: {query}")
-    
-    results = service.files().list(
-        q=query, 
-        fields="files(id, name, mimeType)",
-        supportsAllDrives=True,
-        includeItemsFromAllDrives=True,
-        spaces='drive'
-    ).execute()
-    
-    files = results.get('files', [])
+    manifest = manifest or get_manifest(tenant)
+    try:
+        known = set(manifest.entries)
+        counts = {"new": 0, "changed": 0, "unchanged": 0}
+        seen = {}
+        # Files whose previous chunks get replaced; cached answers citing them are dropped
+        replaced = []
 
-    if not files:
-        print("ℹ️ No files found in the specified folder.")
-        return
+        def files_to_ingest():
+            # Files start downloading while the rest of the tree is still being listed
+            for file in crawl_folder_tree(service_factory, folder_id, workers=crawl_workers):
+                seen[file["id"]] = file
+                status = classify_file(file, manifest, full=full)
+                counts[status] += 1
+                if status == "changed":
+                    replaced.append(file["id"])
+                if status != "unchanged":
+                    yield file
 
-    # Temporary directory for downloads
-    temp_dir = "temp_drive_files"
-    if os.path.exists(temp_dir):
-        shutil.rmtree(temp_dir)
-    os.makedirs(temp_dir)
+        try:
+            # Each file's previous chunks are replaced in the same transaction as its new ones
+            report = ingest_files(files_to_ingest(), service_factory, manifest, workers=workers, tenant=tenant)
+        except Exception:
+            print("❌ Sync interrupted before the folder tree was fully listed; skipping deletions")
+            if counts["new"] or counts["changed"]:
+                bump_kb_version(vector_db.db_engine, table, file_ids=replaced)
+            raise
 
-    try:
-        for file in files:
-            print(f"📄 Processing: {file['name']} ({file['id']})")
-            
-            # Handle Google Docs/Sheets/Slides by exporting them as PDFs
-            if "google-apps" in file['mimeType']:
-                print(f"   Exporting Google Doc '{file['name']}' as PDF...")
-                request = service.files().export_media(fileId=file['id'], mimeType='application/pdf')
-                local_path = os.path.join(temp_dir, f"{file['name']}.pdf")
-                with io.FileIO(local_path, 'wb') as fh:
-                    downloader = MediaIoBaseDownload(fh, request)
-                    done = False
-                    while done is False:
-                        _, done = downloader.next_chunk()
-            else:
-                local_path = download_file(service, file['id'], file['name'], temp_dir)
-            
-            # Upsert into Agno Knowledge Base
-            upsert_document(local_path, file['id'], file['name'])
+        removed = [file_id for file_id in known if file_id not in seen]
+        print(f"📋 Sync: {counts['new']} new, {counts['changed']} changed, "
+              f"{counts['unchanged']} unchanged, {len(removed)} removed")
+        orphaned = set(report.get("orphaned", ()))
+        for file_id in removed:
+            print(f"🗑️ Removing chunks for deleted file: {manifest.entries[file_id]['name']} ({file_id})")
+            orphaned |= remove_document(file_id, tenant=tenant) or set()
+            manifest.forget(file_id)
+
+        # Files whose duplicate chunks were only stored as chunks that are now gone
+        orphaned = [seen[file_id] for file_id in sorted(orphaned) if file_id in seen and file_id not in removed]
+        if orphaned:
+            print(f"♻️ Re-ingesting {len(orphaned)} file(s) that shared chunks with replaced or removed files")
+            for file in orphaned:
+                manifest.forget(file["id"])
+            again = ingest_files(orphaned, service_factory, manifest, workers=workers, tenant=tenant)
+            replaced.extend(file["id"] for file in orphaned)
+            # A further round of orphans is left for the next sync
+            for file_id in again.get("orphaned", ()):
+                manifest.forget(file_id)
+
+        summary = {"added": counts["new"], "updated": counts["changed"], "unchanged": counts["unchanged"],
+                   "deleted": len(removed)}
+        if not counts["new"] and not counts["changed"] and not removed and not orphaned:
+            print("✅ Knowledge base already up to date.")
+            return summary
+        summary["failed"] = counts["new"] + counts["changed"] - report["stages"]["write"]["files"]
+
+        # Typed permission columns and per-permission HNSW indexes (no-op once they exist)
+        permission_index.migrate(vector_db.db_engine, table)
 
+        # Tell running agent servers to drop this tenant's cached search results
+        bump_kb_version(vector_db.db_engine, table, file_ids=replaced + removed)
+
+        return summary
     finally:
-        # Clean up temporary files
-        if os.path.exists(temp_dir):
-            shutil.rmtree(temp_dir)
-            print(f"🧹 Cleaned up temporary directory: {temp_dir}")
+        # Changes recorded since the last batch
+        manifest.flush()
+
 
 if __name__ == "__main__":
-    try:
-        sync_google_drive()
-        verify_db_persistence()
-        print("\n✨ Phase 1 Sync Complete!")
-    except Exception as e:
-        print(f"\n❌ Sync failed: {str(e)}")
+    import argparse
+    parser = argparse.ArgumentParser(description="Sync Google Drive documents into PgVector")
+    parser.add_argument("--full", action="store_true", help="re-ingest every file, ignoring the manifest")
+    parser.add_argument("--workers", type=int, default=INGEST_WORKERS, help="parallel downloads/embedding calls")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--tenant", help=f"tenant to sync (default: {tenancy.DEFAULT_TENANT})")
+    group.add_argument("--all-tenants", action="store_true", help="sync every tenant in TENANTS, one after another")
+    args = parser.parse_args()
+    from observability import configure_logging
+    configure_logging(fmt="text")
+    for tenant in (tenancy.tenants() if args.all_tenants else [tenancy.resolve_tenant(args.tenant)]):
+        try:
+            sync_google_drive(full=args.full, workers=args.workers, tenant=tenant)
+            verify_db_persistence(tenant)
+            print(f"\n✨ Phase 1 Sync Complete for {tenant}!")
+        except Exception as e:
+            print(f"\n❌ Sync failed for {tenant}: {str(e)}")